@@ -0,0 +1,292 @@
+import sys
+from pathlib import Path
+import itertools
+
+sys.path.append(str(Path(__file__).parent / ".." / ".." / ".." / "silicon"))
+sys.path.append(str(Path(__file__).parent / ".." / ".." / ".." / "silicon" / "unit_tests"))
+
+try:
+    from .brew_types import *
+    from .scan import *
+    from .synth import *
+except ImportError:
+    from brew_types import *
+    from scan import *
+    from synth import *
+
+from silicon import *
+from copy import copy
+
+class ApbIntCtrl(GenericModule):
+    """
+    Interrupt controller
+
+    Collects the (active high, level sensitive) interrupt requests of the peripherals and feeds
+    the single interrupt input of the pipeline. Requests are not latched: they need to be cleared
+    at the source, as before.
+
+    Register map:
+        0:          int_enable:  bit N enables source N. Resets to 'enable_reset_value', or all 1-s
+                                 (all sources enabled) if that's not set.
+        1:          int_pending: bit N is set if source N requests an interrupt (read-only, not masked)
+        2:          int_vector:  number of the highest priority, enabled and pending source in bits [4:0].
+                                 Bit 31 is set if there's no such source (read-only)
+        4+N:        int_prio_N:  priority of source N (3 bits, higher value is higher priority).
+                                 Between sources of the same priority, the lower number wins.
+    """
+
+    clk = ClkPort()
+    rst = RstPort()
+
+    bus_if = Input(CsrIf)
+
+    int_req = Input()
+    interrupt = Output(logic)
+
+    def construct(self, enable_reset_value: Optional[int] = None):
+        self.enable_reset_value = enable_reset_value
+
+    def body(self):
+        self.src_cnt = self.int_req.get_num_bits()
+        assert self.src_cnt <= 32
+
+        ### Register offsets
+        ################################
+        enable_ofs = 0
+        #pending_ofs = 1 Read-only, so offset constant is not directly used
+        #vector_ofs = 2 Read-only, so offset constant is not directly used
+        prio_ofs = 4
+
+        prio_bits = 3
+
+        reg_write_strobe = self.bus_if.psel & self.bus_if.pwrite & self.bus_if.penable
+        self.bus_if.pready <<= 1
+
+        reg_addr = self.bus_if.paddr
+
+        int_enable = Wire(Unsigned(self.src_cnt))
+        int_enable <<= Reg(
+            self.bus_if.pwdata[self.src_cnt-1:0],
+            clock_en = (reg_addr == enable_ofs) & reg_write_strobe,
+            reset_value_port = (1 << self.src_cnt) - 1 if self.enable_reset_value is None else self.enable_reset_value
+        )
+        int_prios = tuple(
+            Reg(self.bus_if.pwdata[prio_bits-1:0], clock_en = (reg_addr == prio_ofs + idx) & reg_write_strobe)
+            for idx in range(self.src_cnt)
+        )
+
+        int_active = Wire(Unsigned(self.src_cnt))
+        int_active <<= self.int_req & int_enable
+
+        # A source wins if no other active source has a higher priority, or the same priority and a lower number
+        def beats(winner, loser):
+            if winner < loser:
+                return int_prios[winner] >= int_prios[loser]
+            return int_prios[winner] > int_prios[loser]
+
+        int_wins = []
+        for idx in range(self.src_cnt):
+            wins = int_active[idx]
+            for other in range(self.src_cnt):
+                if other != idx:
+                    wins = wins & ~(int_active[other] & beats(other, idx))
+            int_wins.append(wins)
+
+        int_any = or_gate(*(int_active[idx] for idx in range(self.src_cnt)))
+        int_vector = concat(
+            ~int_any,
+            "26'b0",
+            Unsigned(5)(SelectOne(*itertools.chain.from_iterable((int_wins[idx], idx) for idx in range(self.src_cnt)), default_port = 0))
+        )
+
+        self.bus_if.prdata <<= Reg(Select(
+            reg_addr,
+            int_enable,
+            self.int_req,
+            int_vector,
+            0,
+            *int_prios,
+            default_port = 0
+        ))
+
+        self.interrupt <<= int_any
+
+
+def sim(cycles: int = 300) -> int:
+    class Driver(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        reg_if = Output(CsrIf)
+        int_req = Output(Unsigned(3))
+        interrupt = Input(logic)
+
+        def construct(self):
+            self.reg_if.paddr.set_net_type(Unsigned(4))
+            self.done = False
+
+        def simulate(self, simulator: Simulator):
+            def wait_clk():
+                yield (self.clk, )
+                while self.clk.get_sim_edge() != EdgeType.Positive:
+                    yield (self.clk, )
+
+            def wait_rst():
+                yield from wait_clk()
+                while self.rst == 1:
+                    yield from wait_clk()
+
+            def write_reg(addr, value):
+                self.reg_if.psel <<= 1
+                self.reg_if.penable <<= 0
+                self.reg_if.pwrite <<= 1
+                self.reg_if.paddr <<= addr
+                self.reg_if.pwdata <<= value
+                yield from wait_clk()
+                self.reg_if.penable <<= 1
+                yield from wait_clk()
+                while not self.reg_if.pready:
+                    yield from wait_clk()
+                simulator.log(f"REG {addr:02x} written with value {value:08x}")
+                self.reg_if.psel <<= 0
+                self.reg_if.penable <<= None
+                self.reg_if.pwrite <<= None
+                self.reg_if.paddr <<= None
+                self.reg_if.pwdata <<= None
+
+            def read_reg(addr):
+                self.reg_if.psel <<= 1
+                self.reg_if.penable <<= 0
+                self.reg_if.pwrite <<= 0
+                self.reg_if.paddr <<= addr
+                self.reg_if.pwdata <<= None
+                yield from wait_clk()
+                self.reg_if.penable <<= 1
+                yield from wait_clk()
+                while not self.reg_if.pready:
+                    yield from wait_clk()
+                ret_val = copy(self.reg_if.prdata)
+                simulator.log(f"REG {addr:02x} read returned value {ret_val:08x}")
+                self.reg_if.psel <<= 0
+                self.reg_if.penable <<= None
+                self.reg_if.pwrite <<= None
+                self.reg_if.paddr <<= None
+                self.reg_if.pwdata <<= None
+                return ret_val
+
+            def check_reg(addr, expected):
+                value = yield from read_reg(addr)
+                simulator.sim_assert(value == expected, f"REG {addr:02x} returned {value:08x}, expected {expected:08x}")
+
+            def check_int(expected):
+                simulator.sim_assert(self.interrupt == expected, f"interrupt is {self.interrupt}, expected {expected}")
+
+            enable_ofs = 0
+            pending_ofs = 1
+            vector_ofs = 2
+            prio_ofs = 4
+            none_pending = 1 << 31
+
+            self.reg_if.psel <<= 0
+            self.int_req <<= 0
+            yield from wait_rst()
+
+            # Reset state: sources 0 and 1 enabled, nothing pending
+            yield from check_reg(enable_ofs, 0b011)
+            yield from check_reg(pending_ofs, 0)
+            yield from check_reg(vector_ofs, none_pending)
+            check_int(0)
+
+            # Source 2 is disabled out of reset
+            self.int_req <<= 0b100
+            yield from wait_clk()
+            check_int(0)
+            yield from check_reg(pending_ofs, 0b100)
+            yield from check_reg(vector_ofs, none_pending)
+            yield from write_reg(enable_ofs, 0b111)
+            yield from check_reg(vector_ofs, 2)
+            check_int(1)
+
+            # Same priority: the lower number wins
+            self.int_req <<= 0b101
+            yield from wait_clk()
+            check_int(1)
+            yield from check_reg(pending_ofs, 0b101)
+            yield from check_reg(vector_ofs, 0)
+
+            # Higher priority wins, regardless of the number
+            yield from write_reg(prio_ofs + 2, 3)
+            yield from check_reg(prio_ofs + 2, 3)
+            yield from check_reg(vector_ofs, 2)
+
+            # Tie again, at a non-zero priority
+            yield from write_reg(prio_ofs + 0, 3)
+            yield from check_reg(vector_ofs, 0)
+
+            # Masking: pending still shows the raw requests, the vector only the enabled ones
+            yield from write_reg(enable_ofs, 0b110)
+            yield from check_reg(pending_ofs, 0b101)
+            yield from check_reg(vector_ofs, 2)
+            check_int(1)
+            yield from write_reg(enable_ofs, 0b010)
+            yield from check_reg(vector_ofs, none_pending)
+            check_int(0)
+            self.int_req <<= 0b010
+            yield from wait_clk()
+            check_int(1)
+            yield from check_reg(vector_ofs, 1)
+
+            # Requests are not latched: removing it at the source clears the interrupt
+            self.int_req <<= 0
+            yield from wait_clk()
+            check_int(0)
+            yield from check_reg(vector_ofs, none_pending)
+
+            # Unused offsets read as 0
+            yield from check_reg(3, 0)
+            yield from check_reg(prio_ofs + 3, 0)
+            yield from check_reg(15, 0)
+
+            simulator.log("All checks passed")
+            self.done = True
+
+    class top(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        def body(self):
+            dut = ApbIntCtrl(enable_reset_value=0b011)
+            self.driver = driver = Driver()
+
+            dut.bus_if <<= driver.reg_if
+            dut.int_req <<= driver.int_req
+            driver.interrupt <<= dut.interrupt
+
+        def simulate(self, simulator: Simulator):
+            def clk() -> int:
+                yield 5
+                self.clk <<= ~self.clk & self.clk
+                yield 5
+                self.clk <<= ~self.clk
+                yield 0
+
+            print("Simulation started")
+
+            self.rst <<= 1
+            self.clk <<= 1
+            yield 10
+            for i in range(5):
+                yield from clk()
+            self.rst <<= 0
+
+            for i in range(cycles):
+                yield from clk()
+            assert self.driver.done, "Test sequence didn't complete"
+            now = yield 10
+            print(f"Done at {now}")
+
+    Build.simulation(top, "apb_int_ctrl.vcd", add_unnamed_scopes=True)
+    return cycles
+
+if __name__ == "__main__":
+    sim()
@@ -14,11 +14,19 @@ except ImportError:
     from synth import *
 
 from silicon import *
+from copy import copy
+from random import *
 
 
-class ApbSimpleTimer(Module):
+class ApbSimpleTimer(GenericModule):
     """
     A very simple timer to generate periodic pulses (a.k.a. interrupts)
+
+    In addition to the periodic timer, there's a free-running 64-bit counter. Reading its low word latches the high word,
+    so that a read of the low word, followed by a read of the high word returns a consistent value.
+
+    Capture channels record the low word of the 64-bit counter on a rising edge of their 'capture' input.
+    Compare channels raise an interrupt when the low word of the 64-bit counter matches their compare value.
     """
 
     clk = ClkPort()
@@ -29,6 +37,16 @@ class ApbSimpleTimer(Module):
     tick = Output(logic)
     n_int = Output(logic)
 
+    def construct(self, capture_cnt: int = 2, compare_cnt: int = 2, cycle_cnt_reset_value: int = 0):
+        assert capture_cnt <= 4
+        assert compare_cnt <= 4
+        self.capture_cnt = capture_cnt
+        self.compare_cnt = compare_cnt
+        # Only useful for simulation: lets a test-bench get to a carry between the two words in reasonable time
+        self.cycle_cnt_reset_value = cycle_cnt_reset_value
+        if capture_cnt > 0:
+            self.capture = Input(Unsigned(capture_cnt))
+
     def body(self):
         timer_val = Wire(Unsigned(32))
         timer_limit = Wire(Unsigned(32))
@@ -36,10 +54,16 @@ class ApbSimpleTimer(Module):
         int_pending = Wire(logic)
         enabled = Wire(logic)
 
+        cycle_cnt = Wire(Unsigned(64))
+        cycle_cnt_low_read = Wire(logic)
+        cycle_cnt_high = Wire(Unsigned(32))
+
         self.reg_map = {
             0:     RegMapEntry("timer_cnt_limit",     (RegField(read_wire = timer_val, write_wire = timer_limit,access="RW"),), "Timer count and limit register", write_pulse=timer_limit_write),
             1:     RegMapEntry("timer_int_stat",      (RegField(wire = int_pending, set_wire = self.tick, access="RW1C"),), "Timer interrupt status register"),
-            2:     RegMapEntry("timer_ctrl",          (RegField(wire = enabled, access="RW"),), "Timer control register")
+            2:     RegMapEntry("timer_ctrl",          (RegField(wire = enabled, access="RW"),), "Timer control register"),
+            3:     RegMapEntry("timer_cycle_low",     (RegField(cycle_cnt[31:0], access="R"),), "Cycle counter low word (latches high word)", read_pulse=cycle_cnt_low_read),
+            4:     RegMapEntry("timer_cycle_high",    (RegField(cycle_cnt_high, access="R"),), "Cycle counter high word, as of the last read of the low word"),
         }
 
         limit_reached = timer_val == timer_limit
@@ -50,8 +74,232 @@ class ApbSimpleTimer(Module):
             0,
         ))
 
+        cycle_cnt <<= Reg(increment(cycle_cnt), reset_value_port=self.cycle_cnt_reset_value)
+        cycle_cnt_high <<= Reg(cycle_cnt[63:32], clock_en=cycle_cnt_low_read)
+
+        # Capture/compare status and control registers. Bits [3:0] belong to the capture channels, bits [19:16] to the compare channels.
+        cc_stat_fields = []
+        cc_ctrl_fields = []
+
+        # Capture channels: capture values start at register 8
+        if self.capture_cnt > 0:
+            capture_edge = Wire(Unsigned(self.capture_cnt))
+            capture_edge <<= self.capture & ~Reg(self.capture)
+        for idx in range(self.capture_cnt):
+            capture_en = Wire(logic)
+            capture_pending = Wire(logic)
+            capture_event = Wire(logic)
+            capture_event <<= capture_edge[idx] & capture_en
+            capture_val = Reg(cycle_cnt[31:0], clock_en=capture_event)
+            self.reg_map[8+idx] = RegMapEntry(f"timer_capture_{idx}", (RegField(capture_val, access="R"),), f"Capture channel {idx} value register")
+            cc_stat_fields.append(RegField(wire = capture_pending, set_wire = capture_event, start_bit = idx, access="RW1C"))
+            cc_ctrl_fields.append(RegField(wire = capture_en, start_bit = idx, access="RW"))
+
+        # Compare channels: compare values start at register 12. The comparison is registered, so the event fires one cycle after the match.
+        compare_ints = []
+        for idx in range(self.compare_cnt):
+            compare_val = Wire(Unsigned(32))
+            compare_en = Wire(logic)
+            compare_pending = Wire(logic)
+            compare_event = Wire(logic)
+            compare_event <<= Reg(cycle_cnt[31:0] == compare_val) & compare_en
+            self.reg_map[12+idx] = RegMapEntry(f"timer_compare_{idx}", (RegField(wire = compare_val, access="RW"),), f"Compare channel {idx} value register")
+            cc_stat_fields.append(RegField(wire = compare_pending, set_wire = compare_event, start_bit = 16+idx, access="RW1C"))
+            cc_ctrl_fields.append(RegField(wire = compare_en, start_bit = 16+idx, access="RW"))
+            compare_ints.append(compare_pending)
+
+        if len(cc_stat_fields) > 0:
+            self.reg_map[5] = RegMapEntry("timer_cc_stat", tuple(cc_stat_fields), "Capture/compare status register")
+            self.reg_map[6] = RegMapEntry("timer_cc_ctrl", tuple(cc_ctrl_fields), "Capture/compare control register")
+
         self.tick <<= limit_reached & enabled
-        self.n_int <<= ~int_pending
+        self.n_int <<= ~or_gate(int_pending, *compare_ints) if len(compare_ints) > 0 else ~int_pending
 
         create_apb_reg_map(self.reg_map, self.bus_if)
 
+
+def sim(rng_seed: int = 0, cycles: int = 1000) -> int:
+    # Start the cycle counter close enough to the carry into the high word that the bench gets there
+    cycle_cnt_reset_value = (1 << 32) - 100
+
+    class Driver(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        reg_if = Output(CsrIf)
+        capture = Output(Unsigned(2))
+        n_int = Input(logic)
+
+        def construct(self):
+            self.reg_if.paddr.set_net_type(Unsigned(4))
+            self.done = False
+
+        def simulate(self, simulator: Simulator):
+            def wait_clk():
+                yield (self.clk, )
+                while self.clk.get_sim_edge() != EdgeType.Positive:
+                    yield (self.clk, )
+
+            def wait_rst():
+                yield from wait_clk()
+                while self.rst == 1:
+                    yield from wait_clk()
+
+            def write_reg(addr, value):
+                self.reg_if.psel <<= 1
+                self.reg_if.penable <<= 0
+                self.reg_if.pwrite <<= 1
+                self.reg_if.paddr <<= addr
+                self.reg_if.pwdata <<= value
+                yield from wait_clk()
+                self.reg_if.penable <<= 1
+                yield from wait_clk()
+                while not self.reg_if.pready:
+                    yield from wait_clk()
+                simulator.log(f"REG {addr:02x} written with value {value:08x}")
+                self.reg_if.psel <<= 0
+                self.reg_if.penable <<= None
+                self.reg_if.pwrite <<= None
+                self.reg_if.paddr <<= None
+                self.reg_if.pwdata <<= None
+
+            def read_reg(addr):
+                self.reg_if.psel <<= 1
+                self.reg_if.penable <<= 0
+                self.reg_if.pwrite <<= 0
+                self.reg_if.paddr <<= addr
+                self.reg_if.pwdata <<= None
+                yield from wait_clk()
+                self.reg_if.penable <<= 1
+                yield from wait_clk()
+                while not self.reg_if.pready:
+                    yield from wait_clk()
+                ret_val = copy(self.reg_if.prdata)
+                simulator.log(f"REG {addr:02x} read returned value {ret_val:08x}")
+                self.reg_if.psel <<= 0
+                self.reg_if.penable <<= None
+                self.reg_if.pwrite <<= None
+                self.reg_if.paddr <<= None
+                self.reg_if.pwdata <<= None
+                return ret_val
+
+            def read_cycles():
+                low = yield from read_reg(cycle_low_ofs)
+                for _ in range(randint(0,3)):
+                    yield from wait_clk()
+                high = yield from read_reg(cycle_high_ofs)
+                return (high << 32) | low
+
+            def check_reg(addr, expected):
+                value = yield from read_reg(addr)
+                simulator.sim_assert(value == expected, f"REG {addr:02x} returned {value:08x}, expected {expected:08x}")
+
+            cycle_low_ofs = 3
+            cycle_high_ofs = 4
+            cc_stat_ofs = 5
+            cc_ctrl_ofs = 6
+            capture_ofs = 8
+            compare_ofs = 12
+
+            self.reg_if.psel <<= 0
+            self.capture <<= 0
+            yield from wait_rst()
+
+            # Read the 64-bit counter until it wraps its low word. The high word is latched when the low word is read,
+            # so the combined value must never be off by a carry (it's monotonic and stays within a few cycles of the previous read).
+            prev_cnt = None
+            saw_carry = False
+            while not saw_carry:
+                for _ in range(randint(0,3)):
+                    yield from wait_clk()
+                cnt = yield from read_cycles()
+                if prev_cnt is not None:
+                    simulator.sim_assert(prev_cnt < cnt < prev_cnt + 30, f"Inconsistent cycle counter read: {cnt:016x} after {prev_cnt:016x}")
+                saw_carry = (cnt >> 32) != (cycle_cnt_reset_value >> 32)
+                prev_cnt = cnt
+
+            # Capture: only enabled channels, only on rising edges
+            yield from write_reg(cc_ctrl_ofs, 0b01)
+            yield from write_reg(cc_stat_ofs, 0xffffffff)
+            yield from check_reg(cc_stat_ofs, 0)
+            before = yield from read_reg(cycle_low_ofs)
+            self.capture <<= 0b11
+            yield from wait_clk()
+            after = yield from read_reg(cycle_low_ofs)
+            captured = yield from read_reg(capture_ofs + 0)
+            simulator.sim_assert(before < captured < after, f"Capture value {captured:08x} is not between {before:08x} and {after:08x}")
+            yield from check_reg(cc_stat_ofs, 0b01)
+            # Holding the input high is not a new edge
+            for _ in range(5):
+                yield from wait_clk()
+            yield from check_reg(capture_ofs + 0, captured)
+            # A falling edge doesn't capture either
+            self.capture <<= 0b00
+            for _ in range(5):
+                yield from wait_clk()
+            yield from check_reg(capture_ofs + 0, captured)
+            yield from write_reg(cc_stat_ofs, 0b01)
+            yield from check_reg(cc_stat_ofs, 0)
+            simulator.sim_assert(self.n_int == 1, "Capture events shouldn't interrupt")
+
+            # Compare: fires once the low word matches, the status bit is W1C and drives n_int
+            now = yield from read_reg(cycle_low_ofs)
+            match = (now + 40) & 0xffffffff
+            yield from write_reg(compare_ofs + 0, match)
+            yield from write_reg(compare_ofs + 1, match)
+            yield from write_reg(cc_ctrl_ofs, 1 << 16)
+            while True:
+                now = yield from read_reg(cycle_low_ofs)
+                if now > match + 2:
+                    break
+                simulator.sim_assert(self.n_int == 1, f"Compare interrupt fired early at {now:08x}")
+            simulator.sim_assert(self.n_int == 0, "Compare interrupt didn't fire")
+            yield from check_reg(cc_stat_ofs, 1 << 16) # Channel 1 is not enabled
+            yield from write_reg(cc_stat_ofs, 1 << 16)
+            yield from check_reg(cc_stat_ofs, 0)
+            simulator.sim_assert(self.n_int == 1, "Compare interrupt didn't clear")
+
+            simulator.log("All checks passed")
+            self.done = True
+
+    class top(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        def body(self):
+            seed(rng_seed)
+            dut = ApbSimpleTimer(cycle_cnt_reset_value=cycle_cnt_reset_value)
+            self.driver = driver = Driver()
+
+            dut.bus_if <<= driver.reg_if
+            dut.capture <<= driver.capture
+            driver.n_int <<= dut.n_int
+
+        def simulate(self, simulator: Simulator):
+            def clk() -> int:
+                yield 5
+                self.clk <<= ~self.clk & self.clk
+                yield 5
+                self.clk <<= ~self.clk
+                yield 0
+
+            print("Simulation started")
+
+            self.rst <<= 1
+            self.clk <<= 1
+            yield 10
+            for i in range(5):
+                yield from clk()
+            self.rst <<= 0
+
+            for i in range(cycles):
+                yield from clk()
+            assert self.driver.done, "Test sequence didn't complete"
+            now = yield 10
+            print(f"Done at {now}")
+
+    Build.simulation(top, "apb_timer.vcd", add_unnamed_scopes=True)
+    return cycles
+
+if __name__ == "__main__":
+    sim()
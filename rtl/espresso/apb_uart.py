@@ -35,19 +35,30 @@ class UartWordSize(Enum):
 class PhyDataIf(ReadyValid):
     data = Unsigned(8)
 
-class ApbUart(Module):
+class ApbUart(GenericModule):
     clk = ClkPort()
     rst = RstPort()
 
     bus_if = Input(Apb8If)
     interrupt = Output(logic)
 
+    # DMA requests (active high), compatible with CpuDma.drq
+    rx_drq = Output(logic)
+    tx_drq = Output(logic)
+
     rxd = Input(logic)
     txd = Output(logic)
     cts = Input(logic)
     rts = Output(logic)
     n_tx_en = Output(logic)
 
+    def construct(self, rx_fifo_depth: int = 16, tx_fifo_depth: int = 16):
+        """
+        FIFO depths of 0 mean no FIFO: a single character is buffered in each direction.
+        """
+        self.rx_fifo_depth = rx_fifo_depth
+        self.tx_fifo_depth = tx_fifo_depth
+
     class UartTxPhy(Module):
         clk = ClkPort()
         rst = RstPort()
@@ -373,6 +384,11 @@ class ApbUart(Module):
     config1_reg_ofs = 2
     config2_reg_ofs = 3
     divider_reg_ofs = 4
+    rx_threshold_reg_ofs = 5
+    tx_threshold_reg_ofs = 6
+    fifo_ctrl_reg_ofs = 7
+    rx_cnt_reg_ofs = 8
+    tx_cnt_reg_ofs = 9
     """
     Reg 0:
         read  - received data (block if not ready)
@@ -398,16 +414,89 @@ class ApbUart(Module):
         bit 7   - tx_en (1 to enable TX)
     Reg 4: divider
         divider
+    Reg 5: RX threshold
+        RX request is raised when at least this many characters are in the RX FIFO
+    Reg 6: TX threshold
+        TX request is raised when at least this many entries are free in the TX FIFO
+    Reg 7: FIFO control
+        bit 0   - RX DMA request enable
+        bit 1   - TX DMA request enable
+        bit 2   - RX and TX interrupts are based on thresholds (instead of a single character)
+        bit 3   - RX FIFO flush (write-only, self-clearing)
+        bit 4   - TX FIFO flush (write-only, self-clearing)
+    Reg 8: RX count (read-only)
+        number of characters in the RX FIFO
+    Reg 9: TX count (read-only)
+        number of characters in the TX FIFO
+
+    DMA requests are raised when the FIFO reaches its threshold and stay active until the RX FIFO
+    empties or the TX FIFO fills up. This allows the DMA controller (in burst mode) to move a
+    whole block without the FIFO running dry in the middle. Thresholds of 0 are treated as 1.
+    The DMA acknowledge cycle needs to be turned into a data register access by the bus glue.
     """
     def body(self):
         tx_phy = ApbUart.UartTxPhy()
         rx_phy = ApbUart.UartRxPhy()
 
+        fifo_ctrl_reg_wr = (self.bus_if.psel & self.bus_if.penable &  self.bus_if.pwrite & (self.bus_if.paddr == ApbUart.fifo_ctrl_reg_ofs))
+        rx_flush = fifo_ctrl_reg_wr & self.bus_if.pwdata[3]
+        tx_flush = fifo_ctrl_reg_wr & self.bus_if.pwdata[4]
+
         config_reg = Wire(Unsigned(8))
         rx_data = Wire(PhyDataIf)
-        rx_data <<= ForwardBuf(rx_phy.data_out)
         tx_data = Wire(PhyDataIf)
-        tx_phy.data_in <<= ForwardBuf(tx_data)
+        if self.rx_fifo_depth > 0:
+            rx_data <<= Fifo(depth=self.rx_fifo_depth)(rx_phy.data_out, clear=rx_flush)
+        else:
+            rx_data <<= ForwardBuf(rx_phy.data_out)
+        if self.tx_fifo_depth > 0:
+            tx_phy.data_in <<= Fifo(depth=self.tx_fifo_depth)(tx_data, clear=tx_flush)
+        else:
+            tx_phy.data_in <<= ForwardBuf(tx_data)
+
+        # Fill levels. These count handshakes on the two sides of the buffers, so they include the skid-buffers
+        # of the FIFOs as well.
+        rx_cnt_type = Unsigned(max(self.rx_fifo_depth, 1).bit_length())
+        tx_cnt_type = Unsigned(max(self.tx_fifo_depth, 1).bit_length())
+        rx_cnt = Wire(rx_cnt_type)
+        tx_cnt = Wire(tx_cnt_type)
+        rx_push = rx_phy.data_out.valid & rx_phy.data_out.ready
+        rx_pop = rx_data.valid & rx_data.ready
+        tx_push = tx_data.valid & tx_data.ready
+        tx_pop = tx_phy.data_in.valid & tx_phy.data_in.ready
+        rx_cnt <<= Reg(Select(rx_flush, (rx_cnt + rx_push - rx_pop)[rx_cnt_type.length-1:0], 0))
+        tx_cnt <<= Reg(Select(tx_flush, (tx_cnt + tx_push - tx_pop)[tx_cnt_type.length-1:0], 0))
+
+        rx_threshold = Wire(Unsigned(8))
+        tx_threshold = Wire(Unsigned(8))
+        rx_dma_en = Wire(logic)
+        tx_dma_en = Wire(logic)
+        threshold_int = Wire(logic)
+        rx_threshold <<= Reg(self.bus_if.pwdata, clock_en=(self.bus_if.psel & self.bus_if.penable & self.bus_if.pwrite & (self.bus_if.paddr == ApbUart.rx_threshold_reg_ofs)), reset_value_port=1)
+        tx_threshold <<= Reg(self.bus_if.pwdata, clock_en=(self.bus_if.psel & self.bus_if.penable & self.bus_if.pwrite & (self.bus_if.paddr == ApbUart.tx_threshold_reg_ofs)), reset_value_port=1)
+        rx_dma_en <<= Reg(self.bus_if.pwdata[0], clock_en=fifo_ctrl_reg_wr)
+        tx_dma_en <<= Reg(self.bus_if.pwdata[1], clock_en=fifo_ctrl_reg_wr)
+        threshold_int <<= Reg(self.bus_if.pwdata[2], clock_en=fifo_ctrl_reg_wr)
+
+        tx_free = (max(self.tx_fifo_depth, 1) - tx_cnt)
+        rx_level_reached = (rx_cnt >= rx_threshold) & rx_data.valid
+        tx_level_reached = (tx_free >= tx_threshold) & tx_data.ready
+
+        rx_drq = Wire(logic)
+        tx_drq = Wire(logic)
+        rx_drq <<= Reg(SelectFirst(
+            ~rx_dma_en | ~rx_data.valid, 0,
+            rx_level_reached, 1,
+            default_port = rx_drq
+        ))
+        tx_drq <<= Reg(SelectFirst(
+            ~tx_dma_en | ~tx_data.ready, 0,
+            tx_level_reached, 1,
+            default_port = tx_drq
+        ))
+        self.rx_drq <<= rx_drq & rx_data.valid
+        self.tx_drq <<= tx_drq & tx_data.ready
+
         prescaler_select = Wire(Unsigned(3))
         soft_rts = Wire(logic)
         divider_limit = Wire(Unsigned(8))
@@ -459,6 +548,17 @@ class ApbUart(Module):
                 ),
                 # Reg 4: divider 2
                 divider_limit,
+                # Reg 5: RX threshold
+                rx_threshold,
+                # Reg 6: TX threshold
+                tx_threshold,
+                # Reg 7: FIFO control
+                concat(threshold_int, tx_dma_en, rx_dma_en),
+                # Reg 8: RX count
+                rx_cnt,
+                # Reg 9: TX count
+                tx_cnt,
+                default_port = 0
             )
         )
         data_reg_wr =    (self.bus_if.psel & self.bus_if.penable &  self.bus_if.pwrite & (self.bus_if.paddr == ApbUart.data_buf_reg_ofs))
@@ -480,7 +580,9 @@ class ApbUart(Module):
         rx_data.ready <<= data_reg_rd
         rx_phy.clear <<= status_reg_wr
 
-        self.interrupt <<= (rx_phy.overrun_error | rx_phy.framing_error | rx_phy.parity_error | tx_data.ready | rx_data.valid) & interrupt_en
+        rx_int = Select(threshold_int, rx_data.valid, rx_level_reached)
+        tx_int = Select(threshold_int, tx_data.ready, tx_level_reached)
+        self.interrupt <<= (rx_phy.overrun_error | rx_phy.framing_error | rx_phy.parity_error | tx_int | rx_int) & interrupt_en
 
         rx_phy.prescaler_select <<= prescaler_select
         rx_phy.divider_limit <<= divider_limit
@@ -518,7 +620,7 @@ class ApbUart(Module):
         )
 
 
-def sim():
+def sim(cycles: int = 5000) -> int:
 
     class test_top(Module):
         clk               = ClkPort()
@@ -532,11 +634,11 @@ def sim():
             self.uart2 = ApbUart()
 
             self.reg_if1 = Wire(Apb8If)
-            self.reg_if1.paddr.set_net_type(Unsigned(3))
+            self.reg_if1.paddr.set_net_type(Unsigned(4))
             self.uart1.bus_if <<= self.reg_if1
 
             self.reg_if2 = Wire(Apb8If)
-            self.reg_if2.paddr.set_net_type(Unsigned(3))
+            self.reg_if2.paddr.set_net_type(Unsigned(4))
             self.uart2.bus_if <<= self.reg_if2
 
             self.uart1.rxd <<= self.uart2.txd
@@ -547,9 +649,16 @@ def sim():
             self.interrupt1 <<= self.uart1.interrupt
             self.interrupt2 <<= self.uart2.interrupt
 
+            # UART1 transmits and UART2 receives in the DMA request tests
+            self.tx_drq1 = Wire(logic)
+            self.tx_drq1 <<= self.uart1.tx_drq
+            self.rx_drq2 = Wire(logic)
+            self.rx_drq2 <<= self.uart2.rx_drq
+
         def simulate(self, simulator: Simulator):
             from copy import copy
             reg_ifs = (self.reg_if1, self.reg_if2)
+            self.done = False
 
             def wait_clk():
                 yield (self.clk, )
@@ -622,8 +731,87 @@ def sim():
             for _ in range(5):
                 yield from write_reg(0, ApbUart.data_buf_reg_ofs, 0x55)
                 yield from read_reg(1,  ApbUart.data_buf_reg_ofs)
+
+            # A character takes about 130 cycles with this setup
+            char_cycles = 130
+
+            # RX threshold and DMA request
+            rx_threshold = 4
+            yield from write_reg(1, ApbUart.rx_threshold_reg_ofs, rx_threshold)
+            yield from write_reg(1, ApbUart.fifo_ctrl_reg_ofs, 1 << 0) # RX DMA request enable
+            simulator.sim_assert(self.rx_drq2 == 0, "RX DMA request active with empty FIFO")
+            rx_chars = tuple(0x10 + i for i in range(6))
+            for char in rx_chars:
+                yield from write_reg(0, ApbUart.data_buf_reg_ofs, char)
+            timeout = 0
+            while self.rx_drq2 != 1:
+                # Characters arrive slowly, so the count can't jump over the threshold between the read and the check
+                rx_cnt = yield from read_reg(1, ApbUart.rx_cnt_reg_ofs)
+                if rx_cnt < rx_threshold-1:
+                    simulator.sim_assert(self.rx_drq2 == 0, f"RX DMA request active with only {rx_cnt} characters in the FIFO")
+                timeout += 1
+                simulator.sim_assert(timeout < len(rx_chars)*char_cycles, "RX DMA request never got asserted")
+            rx_cnt = yield from read_reg(1, ApbUart.rx_cnt_reg_ofs)
+            simulator.sim_assert(rx_cnt >= rx_threshold, f"RX DMA request active with only {rx_cnt} characters in the FIFO")
+            # The request is held until the FIFO empties, even below the threshold
+            for char in rx_chars:
+                rx_cnt = yield from read_reg(1, ApbUart.rx_cnt_reg_ofs)
+                simulator.sim_assert(rx_cnt == 0 or self.rx_drq2 == 1, "RX DMA request dropped before the FIFO emptied")
+                data = yield from read_reg(1, ApbUart.data_buf_reg_ofs)
+                simulator.sim_assert(data == char, f"RX data mismatch: {data:02x}, expected {char:02x}")
+            rx_cnt = yield from read_reg(1, ApbUart.rx_cnt_reg_ofs)
+            simulator.sim_assert(rx_cnt == 0, f"RX FIFO not empty after reading all characters ({rx_cnt})")
+            simulator.sim_assert(self.rx_drq2 == 0, "RX DMA request active with empty FIFO")
+
+            # TX threshold and DMA request
+            tx_threshold = 4
+            yield from write_reg(0, ApbUart.tx_threshold_reg_ofs, tx_threshold)
+            yield from write_reg(0, ApbUart.fifo_ctrl_reg_ofs, 1 << 1) # TX DMA request enable
+            yield from wait_clk()
+            simulator.sim_assert(self.tx_drq1 == 1, "TX DMA request not active with empty FIFO")
+            # The request is held until the FIFO fills up
+            tx_cnt = 0
+            while True:
+                status = yield from read_reg(0, ApbUart.status_reg_ofs)
+                if status & (1 << 1) == 0:
+                    break
+                simulator.sim_assert(self.tx_drq1 == 1, f"TX DMA request dropped before the FIFO filled up")
+                yield from write_reg(0, ApbUart.data_buf_reg_ofs, 0x20 + tx_cnt)
+                tx_cnt += 1
+                simulator.sim_assert(tx_cnt <= 20, "TX FIFO never filled up")
+            tx_cnt = yield from read_reg(0, ApbUart.tx_cnt_reg_ofs)
+            simulator.sim_assert(tx_cnt >= 16, f"TX FIFO reported full with only {tx_cnt} entries")
+            simulator.sim_assert(self.tx_drq1 == 0, "TX DMA request active with full FIFO")
+            # ... and re-asserted once enough space frees up
+            timeout = 0
+            while self.tx_drq1 != 1:
+                yield from wait_clk()
+                timeout += 1
+                simulator.sim_assert(timeout < (tx_threshold+2)*char_cycles, "TX DMA request never got re-asserted")
+            tx_cnt = yield from read_reg(0, ApbUart.tx_cnt_reg_ofs)
+            simulator.sim_assert(16 - tx_cnt >= tx_threshold, f"TX DMA request active with {tx_cnt} entries in the FIFO")
+
+            # Flushes: drop the rest of the TX stream, wait for the character in flight, then flush what UART2 received
+            yield from write_reg(0, ApbUart.fifo_ctrl_reg_ofs, (1 << 1) | (1 << 4))
+            tx_cnt = yield from read_reg(0, ApbUart.tx_cnt_reg_ofs)
+            simulator.sim_assert(tx_cnt == 0, f"TX FIFO not empty after flush ({tx_cnt})")
+            simulator.sim_assert(self.tx_drq1 == 1, "TX DMA request not active after flush")
+            for _ in range(2*char_cycles):
+                yield from wait_clk()
+            rx_cnt = yield from read_reg(1, ApbUart.rx_cnt_reg_ofs)
+            simulator.sim_assert(rx_cnt > 0, "UART2 didn't receive anything")
+            simulator.sim_assert(self.rx_drq2 == (1 if rx_cnt >= rx_threshold else 0), f"RX DMA request doesn't match the fill level of {rx_cnt}")
+            yield from write_reg(1, ApbUart.fifo_ctrl_reg_ofs, (1 << 0) | (1 << 3))
+            rx_cnt = yield from read_reg(1, ApbUart.rx_cnt_reg_ofs)
+            simulator.sim_assert(rx_cnt == 0, f"RX FIFO not empty after flush ({rx_cnt})")
+            simulator.sim_assert(self.rx_drq2 == 0, "RX DMA request active after flush")
+            status = yield from read_reg(1, ApbUart.status_reg_ofs)
+            simulator.sim_assert(status & (1 << 0) == 0, "RX data available after flush")
+            yield from write_reg(1, ApbUart.status_reg_ofs, 0) # clear overrun, if any
+
             for i in range(5):
                 yield from write_reg(0, ApbUart.data_buf_reg_ofs, i)
+            self.done = True
 
     class top(Module):
         clk               = ClkPort()
@@ -634,6 +822,7 @@ def sim():
 
         def body(self):
             local_top = test_top()
+            self.local_top = local_top
 
             self.interrupt1 <<= local_top.interrupt1
             self.interrupt2 <<= local_top.interrupt2
@@ -656,9 +845,10 @@ def sim():
                 yield from clk()
             self.rst <<= 0
 
-            for i in range(1500):
+            for i in range(cycles):
                 yield from clk()
             yield 10
+            simulator.sim_assert(self.local_top.done, "Test didn't finish in time")
             simulator.log("Done")
 
     top_class = top
@@ -668,11 +858,13 @@ def sim():
     with Netlist().elaborate() as netlist:
         top_inst = top_class()
     netlist.simulate(vcd_filename, add_unnamed_scopes=False)
+    return cycles
 
 def gen():
     class ApbUart(globals()["ApbUart"]):
-        def construct(self):
-            self.bus_if.paddr.set_net_type(Unsigned(3))
+        def construct(self, rx_fifo_depth: int = 16, tx_fifo_depth: int = 16):
+            super().construct(rx_fifo_depth, tx_fifo_depth)
+            self.bus_if.paddr.set_net_type(Unsigned(4))
 
     #def top():
     #    return ScanWrapper(UartWrapper, {"clk", "rst"})
@@ -117,6 +117,10 @@ def create_symbol(name: str, value = None):
 def set_symbol(name: str, value):
     _sym_table[name] = value
 
+def get_symbol_addr(name: str) -> int:
+    value = _sym_table[name]
+    return value if isinstance(value, int) else value.abs_addr()
+
 def place_symbol(name):
     if name not in _sym_table: create_symbol(name)
     set_symbol(name, get_dot())
@@ -259,6 +263,7 @@ def r_eq_wse_r( rD, rA): _prog(_asm.r_eq_wse_r(_r(rD), _r(rA)))
 def r_eq_I( rD, imm): _prog(_asm.r_eq_I(_r(rD), _I(imm)))
 def pc_eq_I( imm): _prog(_asm.pc_eq_I(_I(imm)))
 def tpc_eq_I( imm): _prog(_asm.tpc_eq_I(_I(imm)))
+def call_I( imm): _prog(_asm.call_I(_I(imm)))
 def r_eq_i( rD, imm): _prog(_asm.r_eq_i(_r(rD), _i(imm)))
 def pc_eq_i( imm): _prog(_asm.pc_eq_i(_i(imm)))
 def tpc_eq_i( imm): _prog(_asm.tpc_eq_i(_i(imm)))
@@ -148,6 +148,7 @@ class DecodeExpectations(object):
     def r_eq_I(self, rD = None, imm = None): return ExecExp(fn_name(), exec_unit=op_class.alu)
     def pc_eq_I(self, imm = None): return ExecExp(fn_name(), exec_unit=op_class.branch)
     def tpc_eq_I(self, imm = None): return ExecExp(fn_name(), exec_unit=op_class.branch)
+    def call_I(self, imm = None): return ExecExp(fn_name(), exec_unit=op_class.branch)
     def r_eq_i(self, rD = None, imm = None): return ExecExp(fn_name(), exec_unit=op_class.alu)
     def pc_eq_i(self, imm = None): return ExecExp(fn_name(), exec_unit=op_class.branch)
     def tpc_eq_i(self, imm = None): return ExecExp(fn_name(), exec_unit=op_class.branch)
@@ -252,6 +253,7 @@ class BrewAssembler(object):
     def r_eq_I(self, rD = None, imm = None): return (_inst(_r(rD), 0x0, 0x0, 0xf), *_I(imm))
     def pc_eq_I(self, imm = None): return (_inst(0x2, 0x0, 0xe, 0xf), *_I(imm))
     def tpc_eq_I(self, imm = None): return (_inst(0x3, 0x0, 0xe, 0xf), *_I(imm))
+    def call_I(self, imm = None): return (_inst(0x4, 0x0, 0xe, 0xf), *_I(imm))
     def r_eq_i(self, rD = None, imm = None): return (_inst(_r(rD), 0x0, 0xf, 0x0), *_i(imm))
     def pc_eq_i(self, imm = None): return (_inst(0x2, 0x0, 0xf, 0xe), *_i(imm))
     def tpc_eq_i(self, imm = None): return (_inst(0x3, 0x0, 0xf, 0xe), *_i(imm))
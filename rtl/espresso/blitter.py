@@ -0,0 +1,538 @@
+#!/usr/bin/python3
+from random import *
+from typing import *
+from silicon import *
+try:
+    from .brew_types import *
+    from .brew_utils import *
+except ImportError:
+    from brew_types import *
+    from brew_utils import *
+
+"""
+    2D blitter
+
+    Copies (or fills) a rectangle of 16-bit words, combining the source with the destination
+    through a raster operation. Source and destination can have independent strides, so
+    sub-rectangles of frame buffers (or sprites packed in memory) can be handled.
+
+    Since the blitter needs to see the data it moves, it can't use the fly-by DMA port of BusIf.
+    It is a bus master with the same interface as the fetch and memory units. Each row is
+    processed in chunks: a chunk of source words is read into a small buffer in a single burst,
+    then (if the raster op needs it) a chunk of destination words is read into a second buffer,
+    finally the result is written back in a single burst. Chunks never cross DRAM page boundaries
+    (on either the source or the destination side), so all bursts are valid page-mode bursts.
+
+    Raster operation:
+        The 4-bit 'rop' field is a truth table: result bit = rop[{src_bit, dst_bit}], that is:
+            0b0000 - clear          0b1100 - copy (src)      0b0011 - ~src
+            0b1010 - dst (nop)      0b0101 - ~dst            0b1111 - set
+            0b1000 - src & dst      0b1110 - src | dst       0b0110 - src ^ dst
+        The destination is only read if the rop depends on it; the source is only read if the rop
+        depends on it and 'fill' is not set.
+
+    Transparency:
+        If enabled, source bytes that equal the 8-bit color key are not written (through byte-enables).
+        Words where both bytes are transparent are skipped entirely, no bus cycle is generated for them.
+
+    Overlapping blits:
+        Rows are processed in the order given by the strides; within a row, chunks are processed
+        left-to-right, or right-to-left if 'reverse' is set. A chunk is completely read before it is
+        written, but the blitter doesn't check for overlap between the source and the destination:
+        if they overlap, software must pick the direction (just like with memmove):
+        - if the destination is below the source, use positive strides and clear 'reverse'
+        - if the destination is above the source, point the addresses to the last row, use negative
+          strides and set 'reverse'
+        Any other combination might read source words that were already overwritten.
+
+    Registers:
+        0: source address (byte address, bit 0 is ignored)
+        1: destination address (byte address, bit 0 is ignored)
+        2: source stride (in bytes, two's complement)
+        3: destination stride (in bytes, two's complement)
+        4: size: [15:0] width in words, [31:16] height in rows
+        5: fill/key: [15:0] fill value (used as the source if 'fill' is set), [23:16] transparent color key
+        6: config: [3:0] rop, [4] fill, [5] transparency enable, [6] interrupt enable, [7] reverse
+        7: control/status:
+            write: [0] start (ignored while busy), [1] clear pending interrupt (if 1)
+            read:  [0] busy, [1] interrupt pending
+"""
+
+class Blitter(GenericModule):
+    clk = ClkPort()
+    rst = RstPort()
+
+    bus_request = Output(BusIfRequestIf)
+    bus_response = Input(BusIfResponseIf)
+    reg_if = Input(CsrIf)
+
+    interrupt = Output(logic)
+
+    src_addr_ofs = 0
+    dst_addr_ofs = 1
+    src_stride_ofs = 2
+    dst_stride_ofs = 3
+    size_ofs = 4
+    fill_ofs = 5
+    config_ofs = 6
+    ctrl_ofs = 7
+
+    def construct(self, buf_bits: int = 4, page_bits: int = 8):
+        """
+        buf_bits:  size of the chunk buffers (in 16-bit words); this is also the longest burst the blitter generates
+        page_bits: number of word-address bits that can change within a DRAM burst
+        """
+        self.buf_bits = buf_bits
+        self.page_bits = page_bits
+
+    def body(self):
+        class BlitterStates(Enum):
+            idle = 0
+            setup = 1
+            src_req = 2
+            src_rsp = 3
+            dst_req = 4
+            dst_rsp = 5
+            write_req = 6
+            next = 7
+
+        buf_size = 1 << self.buf_bits
+        page_size = 1 << self.page_bits
+        chunk_bits = self.buf_bits + 1
+        addr_len = BrewBusAddr.length
+
+        # Register interface
+        ####################
+        reg_write_strobe = self.reg_if.psel & self.reg_if.pwrite & self.reg_if.penable
+        self.reg_if.pready <<= 1
+
+        reg_addr = self.reg_if.paddr
+
+        def reg_wr(ofs):
+            return (reg_addr == ofs) & reg_write_strobe
+
+        src_base = Reg(self.reg_if.pwdata, clock_en=reg_wr(self.src_addr_ofs))
+        dst_base = Reg(self.reg_if.pwdata, clock_en=reg_wr(self.dst_addr_ofs))
+        src_stride = Reg(self.reg_if.pwdata, clock_en=reg_wr(self.src_stride_ofs))
+        dst_stride = Reg(self.reg_if.pwdata, clock_en=reg_wr(self.dst_stride_ofs))
+        size = Reg(self.reg_if.pwdata, clock_en=reg_wr(self.size_ofs))
+        fill_key = Reg(self.reg_if.pwdata[23:0], clock_en=reg_wr(self.fill_ofs))
+        config = Reg(self.reg_if.pwdata[7:0], clock_en=reg_wr(self.config_ofs))
+
+        width = size[15:0]
+        height = size[31:16]
+        fill_value = fill_key[15:0]
+        color_key = fill_key[23:16]
+        rop = config[3:0]
+        fill = config[4]
+        transparent = config[5]
+        int_enable = config[6]
+        reverse = config[7]
+
+        # The rop depends on the source if flipping the source bit changes the result; same for the destination
+        needs_dst = (rop[0] ^ rop[1]) | (rop[2] ^ rop[3])
+        needs_src = ((rop[0] ^ rop[2]) | (rop[1] ^ rop[3])) & ~fill
+
+        self.fsm = FSM()
+
+        self.fsm.reset_value   <<= BlitterStates.idle
+        self.fsm.default_state <<= BlitterStates.idle
+
+        state = Wire()
+        state <<= self.fsm.state
+
+        busy = state != BlitterStates.idle
+        start = reg_wr(self.ctrl_ofs) & self.reg_if.pwdata[0] & ~busy
+        empty = (width == 0) | (height == 0)
+
+        # Rectangle walking
+        ###################
+        src_row = Wire(BrewBusAddr)
+        dst_row = Wire(BrewBusAddr)
+        src_pos = Wire(BrewBusAddr)
+        dst_pos = Wire(BrewBusAddr)
+        row_left = Wire(Unsigned(16))
+        rows_left = Wire(Unsigned(16))
+        chunk_len = Wire(Unsigned(chunk_bits))
+
+        chunk_end = state == BlitterStates.next
+        row_done = chunk_end & (row_left == chunk_len)
+        blit_done = row_done & (rows_left == 1)
+
+        next_src_row = (src_row + src_stride[31:1])[addr_len-1:0]
+        next_dst_row = (dst_row + dst_stride[31:1])[addr_len-1:0]
+
+        # src_pos/dst_pos track the unprocessed part of the row: they point to its first word going
+        # forward and one past its last word in reverse
+        row_start_ofs = Select(reverse, 0, width)
+        def next_pos(pos):
+            return Select(reverse, (pos + chunk_len)[addr_len-1:0], (pos - chunk_len)[addr_len-1:0])
+        src_row <<= Reg(SelectFirst(
+            start,    src_base[31:1],
+            row_done, next_src_row,
+            default_port = src_row
+        ))
+        dst_row <<= Reg(SelectFirst(
+            start,    dst_base[31:1],
+            row_done, next_dst_row,
+            default_port = dst_row
+        ))
+        src_pos <<= Reg(SelectFirst(
+            start,     (src_base[31:1] + row_start_ofs)[addr_len-1:0],
+            row_done,  (next_src_row + row_start_ofs)[addr_len-1:0],
+            chunk_end, next_pos(src_pos),
+            default_port = src_pos
+        ))
+        dst_pos <<= Reg(SelectFirst(
+            start,     (dst_base[31:1] + row_start_ofs)[addr_len-1:0],
+            row_done,  (next_dst_row + row_start_ofs)[addr_len-1:0],
+            chunk_end, next_pos(dst_pos),
+            default_port = dst_pos
+        ))
+        src_addr = Select(reverse, src_pos, (src_pos - chunk_len)[addr_len-1:0])
+        dst_addr = Select(reverse, dst_pos, (dst_pos - chunk_len)[addr_len-1:0])
+        row_left <<= Reg(SelectFirst(
+            start | row_done, width,
+            chunk_end,        (row_left - chunk_len)[15:0],
+            default_port = row_left
+        ))
+        rows_left <<= Reg(SelectFirst(
+            start,    height,
+            row_done, (rows_left - 1)[15:0],
+            default_port = rows_left
+        ))
+
+        # Chunk length is the smallest of: the rest of the row, the buffer size and the rest of the source and destination pages
+        def min_of(a, b):
+            return Select(a < b, b, a)
+        # In reverse, the chunk ends at the current position, so the room is what's below it in the page
+        def page_room(pos):
+            page_ofs = pos[self.page_bits-1:0]
+            return Select(reverse, page_size - page_ofs, Select(page_ofs == 0, page_ofs, page_size))
+        src_room = page_room(src_pos)
+        dst_room = page_room(dst_pos)
+        chunk_limit = min_of(Select(needs_src, dst_room, min_of(src_room, dst_room)), buf_size)
+        chunk_len <<= Reg(min_of(row_left, chunk_limit)[chunk_bits-1:0], clock_en=state == BlitterStates.setup)
+
+        # Bus requests and responses
+        ############################
+        req_state = (state == BlitterStates.src_req) | (state == BlitterStates.dst_req) | (state == BlitterStates.write_req)
+        write_skip = Wire(logic)
+        advance_request = self.bus_request.valid & self.bus_request.ready
+        advance_response = self.bus_response.valid
+        # Fully transparent words don't generate a bus cycle, but still step through the chunk
+        step_request = advance_request | write_skip
+
+        req_idx = Wire(Unsigned(chunk_bits))
+        req_idx <<= Reg(Select(req_state, 0, (req_idx + step_request)[chunk_bits-1:0]))
+        last_request = step_request & (req_idx == chunk_len - 1)
+
+        rsp_idx = Wire(Unsigned(chunk_bits))
+        src_done = (state == BlitterStates.src_rsp) & (rsp_idx == chunk_len)
+        dst_done = (state == BlitterStates.dst_rsp) & (rsp_idx == chunk_len)
+        rsp_idx <<= Reg(SelectFirst(
+            (state == BlitterStates.setup) | src_done, 0,
+            default_port = (rsp_idx + advance_response)[chunk_bits-1:0]
+        ))
+
+        src_phase = (state == BlitterStates.src_req) | (state == BlitterStates.src_rsp)
+        dst_phase = (state == BlitterStates.dst_req) | (state == BlitterStates.dst_rsp)
+
+        self.fsm.add_transition(BlitterStates.idle,      start & ~empty,                   BlitterStates.setup)
+        self.fsm.add_transition(BlitterStates.setup,     needs_src,                        BlitterStates.src_req)
+        self.fsm.add_transition(BlitterStates.setup,     ~needs_src &  needs_dst,          BlitterStates.dst_req)
+        self.fsm.add_transition(BlitterStates.setup,     ~needs_src & ~needs_dst,          BlitterStates.write_req)
+        self.fsm.add_transition(BlitterStates.src_req,   ~last_request,                    BlitterStates.src_req)
+        self.fsm.add_transition(BlitterStates.src_req,    last_request,                    BlitterStates.src_rsp)
+        self.fsm.add_transition(BlitterStates.src_rsp,   ~src_done,                        BlitterStates.src_rsp)
+        self.fsm.add_transition(BlitterStates.src_rsp,    src_done &  needs_dst,           BlitterStates.dst_req)
+        self.fsm.add_transition(BlitterStates.src_rsp,    src_done & ~needs_dst,           BlitterStates.write_req)
+        self.fsm.add_transition(BlitterStates.dst_req,   ~last_request,                    BlitterStates.dst_req)
+        self.fsm.add_transition(BlitterStates.dst_req,    last_request,                    BlitterStates.dst_rsp)
+        self.fsm.add_transition(BlitterStates.dst_rsp,   ~dst_done,                        BlitterStates.dst_rsp)
+        self.fsm.add_transition(BlitterStates.dst_rsp,    dst_done,                        BlitterStates.write_req)
+        self.fsm.add_transition(BlitterStates.write_req, ~last_request,                    BlitterStates.write_req)
+        self.fsm.add_transition(BlitterStates.write_req,  last_request,                    BlitterStates.next)
+        self.fsm.add_transition(BlitterStates.next,      ~blit_done,                       BlitterStates.setup)
+
+        # Chunk buffers
+        ###############
+        src_buf = SimpleDualPortMemory(
+            registered_input_a=False, registered_output_a=True, registered_input_b=False, registered_output_b=False,
+            addr_type=Unsigned(self.buf_bits), data_type=BrewBusData
+        )
+        dst_buf = SimpleDualPortMemory(
+            registered_input_a=False, registered_output_a=True, registered_input_b=False, registered_output_b=False,
+            addr_type=Unsigned(self.buf_bits), data_type=BrewBusData
+        )
+        src_buf.port1_write_en <<= advance_response & src_phase
+        src_buf.port1_data_in <<= self.bus_response.data
+        src_buf.port1_addr <<= rsp_idx[self.buf_bits-1:0]
+        src_buf.port2_addr <<= req_idx[self.buf_bits-1:0]
+        dst_buf.port1_write_en <<= advance_response & dst_phase
+        dst_buf.port1_data_in <<= self.bus_response.data
+        dst_buf.port1_addr <<= rsp_idx[self.buf_bits-1:0]
+        dst_buf.port2_addr <<= req_idx[self.buf_bits-1:0]
+
+        # Raster op
+        ###########
+        def replicate(bit):
+            return Select(bit, 0, 0xffff)
+        src_data = Select(fill, src_buf.port2_data_out, fill_value)
+        dst_data = dst_buf.port2_data_out
+        rop_result = (
+            (~src_data & ~dst_data & replicate(rop[0])) |
+            (~src_data &  dst_data & replicate(rop[1])) |
+            ( src_data & ~dst_data & replicate(rop[2])) |
+            ( src_data &  dst_data & replicate(rop[3]))
+        )[15:0]
+        write_byte_en = concat(
+            ~(transparent & (src_data[15:8] == color_key)),
+            ~(transparent & (src_data[7:0] == color_key))
+        )
+        write_skip <<= (state == BlitterStates.write_req) & (write_byte_en == 0)
+
+        self.bus_request.valid          <<= req_state & ~write_skip
+        self.bus_request.read_not_write <<= state != BlitterStates.write_req
+        self.bus_request.byte_en        <<= Select(state == BlitterStates.write_req, 3, write_byte_en)
+        self.bus_request.addr           <<= (Select(state == BlitterStates.src_req, dst_addr, src_addr) + req_idx)[addr_len-1:0]
+        self.bus_request.data           <<= rop_result
+
+        # Status and interrupt
+        ######################
+        int_pending = Wire(logic)
+        int_pending <<= Reg(SelectFirst(
+            (blit_done | (start & empty)) & int_enable, 1,
+            reg_wr(self.ctrl_ofs) & self.reg_if.pwdata[1], 0,
+            default_port = int_pending
+        ))
+        self.interrupt <<= int_pending
+
+        self.reg_if.prdata <<= Reg(Select(
+            reg_addr,
+            src_base,                   # src_addr_ofs
+            dst_base,                   # dst_addr_ofs
+            src_stride,                 # src_stride_ofs
+            dst_stride,                 # dst_stride_ofs
+            size,                       # size_ofs
+            fill_key,                   # fill_ofs
+            config,                     # config_ofs
+            concat(int_pending, busy),  # ctrl_ofs
+        ))
+
+
+def blit_reference(mem: Dict[int, int], src: int, dst: int, src_stride: int, dst_stride: int, width: int, height: int, fill_value: int, color_key: int, rop: int, fill: bool, transparent: bool):
+    """
+    Python model of the blitter. 'mem' is indexed by word address; addresses and strides are in bytes.
+
+    The whole source is read before anything is written, which is what the blitter does for
+    overlapping blits too, as long as the direction is set up properly.
+    """
+    src_words = dict(
+        ((row, col), fill_value if fill else mem.get((src + row*src_stride) // 2 + col, 0))
+        for row in range(height) for col in range(width)
+    )
+    for row in range(height):
+        for col in range(width):
+            dst_word = (dst + row*dst_stride) // 2 + col
+            s = src_words[(row, col)]
+            d = mem.get(dst_word, 0)
+            result = 0
+            for bit in range(16):
+                sel = (((s >> bit) & 1) << 1) | ((d >> bit) & 1)
+                result |= ((rop >> sel) & 1) << bit
+            for byte in range(2):
+                if transparent and ((s >> (byte*8)) & 0xff) == color_key:
+                    continue
+                mask = 0xff << (byte*8)
+                d = (d & ~mask) | (result & mask)
+            mem[dst_word] = d
+
+def sim(rng_seed: int = 0, cycles: int = 12000) -> int:
+    seed(rng_seed)
+
+    page_bits = 4
+    mem_size = 1024 # in words
+    init_mem = dict((addr, randint(0, 0xffff)) for addr in range(mem_size))
+    # Make some bytes transparent
+    for addr in range(0, mem_size, 3):
+        init_mem[addr] = (init_mem[addr] & 0xff00) | 0x5a
+    # ... and some words fully transparent
+    for addr in range(0, mem_size, 7):
+        init_mem[addr] = 0x5a5a
+
+    # Addresses are for the first row, they are moved to the last row for negative strides
+    blits = (
+        # src,  dst,   src_stride, dst_stride, width, height, fill_value, color_key, rop,    fill,  transparent, reverse
+        (0x000, 0x400, 64,         80,         20,    5,      0,          0x00,      0b1100, False, False,       False),
+        (0x010, 0x500, 40,         -40,        7,     4,      0,          0x5a,      0b1100, False, True,        False),
+        (0x100, 0x600, 32,         32,         9,     3,      0,          0x00,      0b0110, False, False,       False),
+        (0x000, 0x700, 0,          18,         9,     6,      0x1234,     0x00,      0b1100, True,  False,       False),
+        (0x010, 0x780, 32,         34,         23,    3,      0,          0x5a,      0b1100, False, True,        True),
+        # Overlapping blits: move a rectangle right and down, then back left and up
+        (0x200, 0x246, -64,        -64,        20,    4,      0,          0x00,      0b1100, False, False,       True),
+        (0x246, 0x200, 64,         64,         20,    4,      0,          0x00,      0b1100, False, False,       False),
+        # Overlap within rows only, moving right by less than a chunk
+        (0x300, 0x304, -64,        -64,        25,    3,      0,          0x5a,      0b1100, False, True,        True),
+    )
+
+    class BusEmulator(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        bus_request = Input(BusIfRequestIf)
+        bus_response = Output(BusIfResponseIf)
+
+        mem = dict(init_mem)
+
+        def simulate(self, simulator: 'Simulator') -> TSimEvent:
+            delay_queue = [None, None]
+            burst_page = None
+            burst_read = None
+
+            def wait_clk():
+                yield (self.clk, )
+                while self.clk.get_sim_edge() != EdgeType.Positive:
+                    yield (self.clk, )
+
+            self.bus_request.ready <<= 0
+            self.bus_response.valid <<= 0
+            self.bus_response.data <<= None
+
+            while True:
+                yield from wait_clk()
+
+                if self.rst == 1:
+                    self.bus_request.ready <<= 0
+                    self.bus_response.valid <<= 0
+                    self.bus_response.data <<= None
+                    continue
+
+                if self.bus_request.valid == 1 and self.bus_request.ready == 1:
+                    addr = int(self.bus_request.addr)
+                    read_not_write = int(self.bus_request.read_not_write)
+                    page = addr >> page_bits
+                    assert burst_page is None or burst_page == page, f"Burst crossed page boundary at address {addr:x}"
+                    assert burst_read is None or burst_read == read_not_write, f"Reads and writes mixed in burst at address {addr:x}"
+                    burst_page = page
+                    burst_read = read_not_write
+                    if read_not_write == 1:
+                        delay_queue[-1] = self.mem.get(addr, 0)
+                    else:
+                        byte_en = int(self.bus_request.byte_en)
+                        assert byte_en != 0, f"Write without byte-enables at address {addr:x}"
+                        data = int(self.bus_request.data)
+                        old = self.mem.get(addr, 0)
+                        if byte_en & 1:
+                            old = (old & 0xff00) | (data & 0x00ff)
+                        if byte_en & 2:
+                            old = (old & 0x00ff) | (data & 0xff00)
+                        self.mem[addr] = old
+                elif self.bus_request.valid != 1:
+                    burst_page = None
+                    burst_read = None
+                if burst_page is None:
+                    self.bus_request.ready <<= randint(0, 3) != 0
+                if delay_queue[0] is not None:
+                    self.bus_response.data <<= delay_queue[0]
+                    self.bus_response.valid <<= 1
+                else:
+                    self.bus_response.data <<= None
+                    self.bus_response.valid <<= 0
+                delay_queue = delay_queue[1:] + [None, ]
+
+    class top(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        interrupt = Output(logic)
+
+        def body(self):
+            self.blitter = Blitter(page_bits=page_bits)
+            self.bus = BusEmulator()
+            self.reg_if = Wire(CsrIf)
+            self.reg_if.paddr.set_net_type(Unsigned(3))
+            self.blitter.reg_if <<= self.reg_if
+            self.bus.bus_request <<= self.blitter.bus_request
+            self.blitter.bus_response <<= self.bus.bus_response
+            self.interrupt <<= self.blitter.interrupt
+
+        def simulate(self, simulator: Simulator) -> TSimEvent:
+            sim_cycles = 0
+
+            def clk() -> int:
+                nonlocal sim_cycles
+                yield 50
+                self.clk <<= ~self.clk & self.clk
+                yield 50
+                self.clk <<= ~self.clk
+                yield 0
+                sim_cycles += 1
+
+            def write_reg(addr, value):
+                self.reg_if.psel <<= 1
+                self.reg_if.penable <<= 0
+                self.reg_if.pwrite <<= 1
+                self.reg_if.paddr <<= addr
+                self.reg_if.pwdata <<= value & 0xffffffff
+                yield from clk()
+                self.reg_if.penable <<= 1
+                yield from clk()
+                self.reg_if.psel <<= 0
+                self.reg_if.penable <<= None
+                self.reg_if.pwrite <<= None
+                self.reg_if.paddr <<= None
+                self.reg_if.pwdata <<= None
+
+            simulator.log("Simulation started")
+
+            self.rst <<= 1
+            self.clk <<= 1
+            self.reg_if.psel <<= 0
+            yield 10
+            for i in range(5):
+                yield from clk()
+            self.rst <<= 0
+
+            expected_mem = dict(init_mem)
+            for src, dst, src_stride, dst_stride, width, height, fill_value, color_key, rop, fill, transparent, reverse in blits:
+                if src_stride < 0:
+                    src += (height-1) * -src_stride
+                if dst_stride < 0:
+                    dst += (height-1) * -dst_stride
+                blit_reference(expected_mem, src, dst, src_stride, dst_stride, width, height, fill_value, color_key, rop, fill, transparent)
+                yield from write_reg(Blitter.src_addr_ofs, src)
+                yield from write_reg(Blitter.dst_addr_ofs, dst)
+                yield from write_reg(Blitter.src_stride_ofs, src_stride)
+                yield from write_reg(Blitter.dst_stride_ofs, dst_stride)
+                yield from write_reg(Blitter.size_ofs, (height << 16) | width)
+                yield from write_reg(Blitter.fill_ofs, (color_key << 16) | fill_value)
+                yield from write_reg(Blitter.config_ofs, rop | (fill << 4) | (transparent << 5) | (1 << 6) | (reverse << 7))
+                yield from write_reg(Blitter.ctrl_ofs, 1)
+                start_cycle = sim_cycles
+                while self.interrupt != 1:
+                    yield from clk()
+                    assert sim_cycles < cycles, "Blit timed out"
+                simulator.log(f"Blit of {width}x{height} words done in {sim_cycles - start_cycle} cycles")
+                yield from write_reg(Blitter.ctrl_ofs, 2)
+
+            for addr in range(mem_size):
+                actual = top_inst.bus.mem.get(addr, 0)
+                assert actual == expected_mem.get(addr, 0), f"Memory mismatch at word {addr:x}: {actual:04x}, expected {expected_mem.get(addr, 0):04x}"
+            simulator.log("Done")
+
+    vcd_filename = "blitter.vcd"
+    with Netlist().elaborate() as netlist:
+        top_inst = top()
+    netlist.simulate(vcd_filename, add_unnamed_scopes=False)
+    return cycles
+
+def gen():
+    def top():
+        return Blitter()
+
+    netlist = Build.generate_rtl(top, "blitter.sv")
+
+
+if __name__ == "__main__":
+    gen()
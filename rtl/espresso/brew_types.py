@@ -124,12 +124,31 @@ class ExternalBusIf(Interface):
     tc            = logic
     bus_en        = logic
 
+# Same as ExternalBusIf, but with a 16-bit data bus: both byte-lanes are transferred on the same CAS cycle
+class ExternalWideBusIf(Interface):
+    n_ras_a       = logic
+    n_ras_b       = logic
+    n_cas_0       = logic
+    n_cas_1       = logic
+    addr          = Unsigned(11)
+    n_we          = logic
+    data_in       = Reverse(BrewBusData)
+    data_out      = BrewBusData
+    data_out_en   = logic
+    n_nren        = logic
+    n_wait        = Reverse(logic)
+    n_dack        = Unsigned(4)
+    tc            = logic
+    bus_en        = logic
+
 class FetchDecodeIf(ReadyValid):
     inst_0 = Unsigned(16)
     inst_1 = Unsigned(16)
     inst_2 = Unsigned(16)
     inst_len = Unsigned(2) # Len 3 is reserved
     av = logic
+    pred_taken = logic # Set for predicted-taken branches (returns, loop branches), for which fetch continued from pred_target
+    pred_target = BrewInstAddr
 
 class DecodeExecIf(ReadyValid):
     exec_unit = EnumNet(op_class)
@@ -150,6 +169,8 @@ class DecodeExecIf(ReadyValid):
     result_reg_addr = BrewRegAddr
     result_reg_addr_valid = logic
     fetch_av = logic
+    pred_taken = logic
+    pred_target = BrewInstAddr
 
 class MemInputIf(ReadyValid):
     read_not_write = logic
@@ -19,6 +19,7 @@ try:
     from .synth import *
     from .assembler import *
     from .apb_timer import ApbSimpleTimer
+    from .apb_int_ctrl import ApbIntCtrl
 
 except ImportError:
     from brew_types import *
@@ -30,21 +31,30 @@ except ImportError:
     from synth import *
     from assembler import *
     from apb_timer import ApbSimpleTimer
+    from apb_int_ctrl import ApbIntCtrl
 
 class BrewV1Top(GenericModule):
     clk               = ClkPort()
     rst               = RstPort()
 
-    # DRAM interface
-    dram              = Output(ExternalBusIf)
+    # DRAM interface (ExternalBusIf or ExternalWideBusIf, depending on 'wide_bus')
+    dram              = Output()
 
     # External dma-request
     drq               = Input(Unsigned(4))
 
     n_int             = Input(logic)
 
-    def construct(self, nram_base: int = 0x0, has_multiply: bool = True, has_shift: bool = True, page_bits: int = 7):
+    def construct(self, nram_base: int = 0x0, has_multiply: bool = True, has_shift: bool = True, page_bits: int = 7, wide_bus: bool = False, wide_fetch: bool = False, ras_depth: int = 0, loop_buffer_depth: int = 0, store_buffer_depth: int = 0, shadow_bank: bool = False, has_int_ctrl: bool = False):
         self.nram_base = nram_base
+        self.wide_bus = wide_bus
+        self.wide_fetch = wide_fetch
+        self.ras_depth = ras_depth
+        self.loop_buffer_depth = loop_buffer_depth
+        self.store_buffer_depth = store_buffer_depth
+        self.shadow_bank = shadow_bank
+        self.has_int_ctrl = has_int_ctrl
+        self.dram.set_net_type(ExternalWideBusIf if wide_bus else ExternalBusIf)
         self.has_multiply = has_multiply
         self.has_shift = has_shift
         self.page_bits = page_bits
@@ -71,8 +81,8 @@ class BrewV1Top(GenericModule):
         self.csr_eaddr_reg      = self.csr_cpu_scheduler_mode_page + self.csr_eaddr_ofs
 
     def body(self):
-        bus_if = BusIf(nram_base=self.nram_base)
-        pipeline = Pipeline(has_multiply=self.has_multiply, has_shift=self.has_shift, page_bits=self.page_bits)
+        bus_if = BusIf(nram_base=self.nram_base, wide_bus=self.wide_bus)
+        pipeline = Pipeline(has_multiply=self.has_multiply, has_shift=self.has_shift, page_bits=self.page_bits, wide_fetch=self.wide_fetch, ras_depth=self.ras_depth, loop_buffer_depth=self.loop_buffer_depth, store_buffer_depth=self.store_buffer_depth, nram_base=self.nram_base, shadow_bank=self.shadow_bank)
         dma = CpuDma()
         timer = ApbSimpleTimer()
 
@@ -113,6 +123,8 @@ class BrewV1Top(GenericModule):
         bus_if_reg_if = Wire(CsrIf)
         dma_reg_if = Wire(CsrIf)
         timer_reg_if = Wire(CsrIf)
+        if self.has_int_ctrl:
+            int_ctrl_reg_if = Wire(CsrIf)
 
         # BUS INTERFACE
         ###########################
@@ -139,6 +151,8 @@ class BrewV1Top(GenericModule):
         # Timer
         ############################
         timer.bus_if <<= timer_reg_if
+        # Capture channel 0: DMA interrupt; capture channel 1: external interrupt (synchronized)
+        timer.capture <<= concat(Reg(Reg(~self.n_int)), dma.interrupt)
 
         # PIPELINE
         ############################
@@ -156,7 +170,15 @@ class BrewV1Top(GenericModule):
         pipeline.dmem_base  <<= dmem_base
         pipeline.dmem_limit <<= dmem_limit
 
-        pipeline.interrupt <<= ~self.n_int | ~timer.n_int
+        if self.has_int_ctrl:
+            # Sources: 0 - external interrupt; 1 - timer; 2 - DMA
+            # Only the external and timer interrupts are enabled out of reset, same as without an interrupt controller
+            int_ctrl = ApbIntCtrl(enable_reset_value=0b011)
+            int_ctrl.bus_if <<= int_ctrl_reg_if
+            int_ctrl.int_req <<= concat(dma.interrupt, ~timer.n_int, ~self.n_int)
+            pipeline.interrupt <<= int_ctrl.interrupt
+        else:
+            pipeline.interrupt <<= ~self.n_int | ~timer.n_int
 
         event_fetch_wait_on_bus = pipeline.event_fetch_wait_on_bus
         event_decode_wait_on_rf = pipeline.event_decode_wait_on_rf
@@ -200,7 +222,7 @@ class BrewV1Top(GenericModule):
         timer_reg_if.pwrite  <<= csr_if.pwrite
         timer_reg_if.psel    <<= csr_timer_psel
         timer_reg_if.penable <<= csr_if.penable
-        timer_reg_if.paddr   <<= csr_if.paddr[1:0]
+        timer_reg_if.paddr   <<= csr_if.paddr[3:0]
         timer_reg_if.pwdata  <<= csr_if.pwdata
 
         self.cpu_task_mode_csr_if.pwrite  <<= csr_if.pwrite
@@ -217,22 +239,54 @@ class BrewV1Top(GenericModule):
 
         event_prdata = Wire(BrewData)
 
-        csr_if.prdata <<= SelectOne(
+        prdata_selectors = [
             csr_dma_psel,                dma_reg_if.prdata,
             csr_timer_psel,              timer_reg_if.prdata,
             csr_bus_if_psel,             bus_if_reg_if.prdata,
             csr_event_psel,              event_prdata,
             csr_cpu_task_mode_psel,      self.cpu_task_mode_csr_if.prdata,
             csr_cpu_scheduler_mode_psel, self.cpu_scheduler_mode_csr_if.prdata
-        )
-        csr_if.pready <<= SelectOne(
+        ]
+        pready_selectors = [
             csr_dma_psel,                dma_reg_if.pready,
             csr_timer_psel,              timer_reg_if.pready,
             csr_bus_if_psel,             bus_if_reg_if.pready,
             csr_event_psel,              1,
             csr_cpu_task_mode_psel,      self.cpu_task_mode_csr_if.pready,
             csr_cpu_scheduler_mode_psel, self.cpu_scheduler_mode_csr_if.pready
-        )
+        ]
+
+        # TASK mode register bank (only with a shadow register bank)
+        if self.shadow_bank:
+            reg_bank_if = Wire(CsrIf)
+            csr_reg_bank_psel = csr_if.psel & (csr_if.paddr[15:8] == 0x05)
+
+            reg_bank_if.pwrite  <<= csr_if.pwrite
+            reg_bank_if.psel    <<= csr_reg_bank_psel
+            reg_bank_if.penable <<= csr_if.penable
+            reg_bank_if.paddr   <<= csr_if.paddr[3:0]
+            reg_bank_if.pwdata  <<= csr_if.pwdata
+
+            pipeline.reg_bank_if <<= reg_bank_if
+
+            prdata_selectors += [csr_reg_bank_psel, reg_bank_if.prdata]
+            pready_selectors += [csr_reg_bank_psel, reg_bank_if.pready]
+
+        # Interrupt controller (optional)
+        if self.has_int_ctrl:
+            csr_int_ctrl_psel = csr_if.psel & (csr_if.paddr[15:8] == 0x06)
+
+            int_ctrl_reg_if.pwrite  <<= csr_if.pwrite
+            int_ctrl_reg_if.psel    <<= csr_int_ctrl_psel
+            int_ctrl_reg_if.penable <<= csr_if.penable
+            int_ctrl_reg_if.paddr   <<= csr_if.paddr[3:0]
+            int_ctrl_reg_if.pwdata  <<= csr_if.pwdata
+
+            prdata_selectors += [csr_int_ctrl_psel, int_ctrl_reg_if.prdata]
+            pready_selectors += [csr_int_ctrl_psel, int_ctrl_reg_if.pready]
+
+        csr_if.prdata <<= SelectOne(*prdata_selectors)
+        csr_if.pready <<= SelectOne(*pready_selectors)
 
         # EVENT COUNTERS
         #############################
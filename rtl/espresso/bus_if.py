@@ -116,6 +116,9 @@ Non-DRAM accesses:
 4. n_wait is sampled on the rising edge of every cycle, after internal wait-states are accounted for
 5. There is at least one internal wait-state
 6. For writes, the relevant byte of 'req_data' should be valid.
+7. With the 'wide_bus' generic set, the external data bus is 16 bits wide (ExternalWideBusIf). Both
+   byte-lanes are strobed with the timing of DRAM_nCAS_A and non-DRAM 16-bit transfers are done in a
+   single access. DRAM_nCAS_A and DRAM_nCAS_B then act as byte-lane enables.
 
 TODO: These timings don't really support external devices with non-0 data hold-time requirements. Maybe we can delay turning off data-bus drivers by half a cycle?
 
@@ -150,14 +153,16 @@ class BusIf(GenericModule):
     # CRS interface for config registers
     reg_if = Input(CsrIf)
 
-    # DRAM interface
-    dram = Output(ExternalBusIf)
+    # DRAM interface (ExternalBusIf or ExternalWideBusIf, depending on 'wide_bus')
+    dram = Output()
 
     # Events
     event_bus_idle = Output(logic)
 
-    def construct(self, nram_base: int = 0):
+    def construct(self, nram_base: int = 0, wide_bus: bool = False):
         self.nram_base = nram_base
+        self.wide_bus = wide_bus
+        self.dram.set_net_type(ExternalWideBusIf if wide_bus else ExternalBusIf)
 
     """
     Address map:
@@ -197,6 +202,10 @@ class BusIf(GenericModule):
     # bit 11: DRAM bank swap: 0 - no swap, 1 - swap
     # bit 12: Single-bank DRAM: 0 - decode both banks, 1 - bank 0 and 1 are the same
     refresh_counter_size = 8
+    # Number of refresh cycles that can be executed ahead of schedule in idle cycles
+    refresh_credit_limit = 4
+    # Number of refresh cycles that can be postponed before they are forced onto the bus
+    refresh_debt_limit = 8
 
     #### TODO:
     #### - Wait-state selection should probably change. Have only three bits and decode as follows:
@@ -233,25 +242,33 @@ class BusIf(GenericModule):
         # Refresh logic
         # We seem to need to generate 256 refresh cycles in 4ms. That would mean a refresh cycle
         # every 200 or so cycles at least. So, an 8-bit counter should suffice
+        #
+        # Refresh cycles are not issued when the counter expires. Instead, we keep a balance of
+        # refreshes: every expiry of the counter adds one, every executed refresh cycle removes one.
+        # The balance starts at 'refresh_credit_limit', meaning that up to that many refreshes can
+        # be executed ahead of schedule (when the bus is idle anyways) and up to 'refresh_debt_limit'
+        # refreshes can be postponed. Only when the debt limit is reached do we force a refresh
+        # ahead of all other requestors. Since DRAMs tolerate refresh cycles being moved around
+        # as long as the average rate is maintained, this hides almost all refreshes in idle cycles.
         refresh_tc = refresh_counter == 0
         refresh_rsp = Wire(logic)
-        refresh_req = Wire(logic)
-        refresh_req <<= Reg(Select(
-            refresh_tc & ~refresh_disable,
-            Select(
-                refresh_rsp,
-                refresh_req,
-                0
+        refresh_tick = refresh_tc & ~refresh_disable
+        refresh_balance_max = self.refresh_credit_limit + self.refresh_debt_limit
+        refresh_balance_bits = refresh_balance_max.bit_length()
+        refresh_balance = Wire(Unsigned(refresh_balance_bits))
+        refresh_balance <<= Reg(
+            SelectFirst(
+                refresh_tick & ~refresh_rsp & (refresh_balance != refresh_balance_max), (refresh_balance + 1)[refresh_balance_bits-1:0],
+                ~refresh_tick & refresh_rsp,                                            (refresh_balance - 1)[refresh_balance_bits-1:0],
+                default_port = refresh_balance
             ),
-            1
-        ))
+            reset_value_port = self.refresh_credit_limit
+        )
+        refresh_forced = refresh_balance >= refresh_balance_max
+        refresh_early = (refresh_balance != 0) & ~refresh_disable
         refresh_counter <<= Reg(Select(
                 refresh_tc,
-                Select(
-                    refresh_req,
-                    (refresh_counter-1)[self.refresh_counter_size-1:0],
-                    refresh_counter
-                ),
+                (refresh_counter-1)[self.refresh_counter_size-1:0],
                 refresh_divider
         ))
         refresh_addr = Wire(self.dram.addr.get_net_type())
@@ -290,10 +307,15 @@ class BusIf(GenericModule):
             refresh_port = 3
 
         arb_port_select = Wire()
+        # NOTE: we can't use event_bus_idle for the early refresh condition: that depends on the
+        #       arbitration result through next_state. Refresh is simply the lowest priority
+        #       requestor though, so it only wins if there's nothing else to do.
         arb_port_comb = SelectFirst(
-            refresh_req, Ports.refresh_port,
+            refresh_forced, Ports.refresh_port,
             self.dma_request.valid, Ports.dma_port,
             self.mem_request.valid, Ports.mem_port,
+            self.fetch_request.valid, Ports.fetch_port,
+            refresh_early, Ports.refresh_port,
             default_port = Ports.fetch_port
         )
         arb_port_select <<= hold(arb_port_comb, enable=state == BusIfStates.idle)
@@ -351,7 +373,10 @@ class BusIf(GenericModule):
         waiting = ~self.dram.n_wait | (wait_states != 0)
 
         two_cycle_nram_access = Wire(logic)
-        two_cycle_nram_access <<= Reg((req_byte_en == 3) & req_nram, clock_en=start)
+        if self.wide_bus:
+            two_cycle_nram_access <<= 0
+        else:
+            two_cycle_nram_access <<= Reg((req_byte_en == 3) & req_nram, clock_en=start)
         nram_access = Wire(logic)
         nram_access <<= Reg(req_nram, clock_en=start)
 
@@ -543,7 +568,11 @@ class BusIf(GenericModule):
         cas_n_window_b_1 <<= NegReg(cas_n_window_a_1, reset_value_port = 1)
 
         dram_n_cas_0 = cas_n_window_a_0 | cas_n_window_b_0 |  self.clk
-        dram_n_cas_1 = cas_n_window_b_1 | cas_n_window_c_1 | ~self.clk
+        if self.wide_bus:
+            # Both byte-lanes have their own data pins, so they share the timing of n_cas_0
+            dram_n_cas_1 = cas_n_window_a_1 | cas_n_window_b_1 |  self.clk
+        else:
+            dram_n_cas_1 = cas_n_window_b_1 | cas_n_window_c_1 | ~self.clk
 
         self.dram.n_ras_a     <<= dram_n_ras_a
         self.dram.n_ras_b     <<= dram_n_ras_b
@@ -564,41 +593,45 @@ class BusIf(GenericModule):
         self.dram.addr        <<= dram_addr
         self.dram.n_we        <<= read_not_write
         self.dram.data_out_en <<= data_out_en
-        data_out_low = Wire()
-        nr_cas_logic_1_reg = Wire(logic)
-        nr_cas_logic_1_reg <<= Reg(Select(
-            n_nren,
-            nr_cas_logic_1_reg | nr_cas_logic_1,
-            0
-        ))
-        data_out_low <<= NegReg(
-            Select(
-                nram_access,
-                data_out[7:0],
+        if self.wide_bus:
+            # Drive the full word with the timing of the low byte-lane
+            self.dram.data_out <<= NegReg(data_out)
+        else:
+            data_out_low = Wire()
+            nr_cas_logic_1_reg = Wire(logic)
+            nr_cas_logic_1_reg <<= Reg(Select(
+                n_nren,
+                nr_cas_logic_1_reg | nr_cas_logic_1,
+                0
+            ))
+            data_out_low <<= NegReg(
                 Select(
-                    two_cycle_nram_access & (nr_cas_logic_1_reg | nr_cas_logic_1 | ~nr_n_cas_1),
+                    nram_access,
                     data_out[7:0],
-                    data_out[15:8]
+                    Select(
+                        two_cycle_nram_access & (nr_cas_logic_1_reg | nr_cas_logic_1 | ~nr_n_cas_1),
+                        data_out[7:0],
+                        data_out[15:8]
+                    )
                 )
             )
-        )
-        data_out_high = Wire()
-        data_out_high <<= Reg(
-            Select(
-                nram_access,
-                data_out[15:8],
+            data_out_high = Wire()
+            data_out_high <<= Reg(
                 Select(
-                    two_cycle_nram_access & (nr_cas_logic_1_reg | nr_cas_logic_1),
-                    data_out[7:0],
-                    data_out[15:8]
+                    nram_access,
+                    data_out[15:8],
+                    Select(
+                        two_cycle_nram_access & (nr_cas_logic_1_reg | nr_cas_logic_1),
+                        data_out[7:0],
+                        data_out[15:8]
+                    )
                 )
             )
-        )
-        self.dram.data_out   <<= Select(
-            self.clk,
-            data_out_low,
-            data_out_high
-        )
+            self.dram.data_out   <<= Select(
+                self.clk,
+                data_out_low,
+                data_out_high
+            )
 
         self.dram.n_nren      <<= n_nren
         self.dram.n_dack      <<= n_dack
@@ -613,19 +646,25 @@ class BusIf(GenericModule):
             ((state == BusIfStates.non_dram_wait) & ~waiting & ~two_cycle_nram_access) |
             ((state == BusIfStates.non_dram_dual_wait) & ~waiting)
         ) & read_not_write
-        data_in_low = Wire()
-        data_in_low <<= Reg(self.dram.data_in, clock_en=(
+        data_in_sample = (
             (state == BusIfStates.non_dram_wait) |
             (state == BusIfStates.first) |
             (state == BusIfStates.middle)
-        ))
-
-        ndram_data_in_high = Reg(self.dram.data_in, clock_en=(state == BusIfStates.non_dram_dual_wait))
-        data_in_high = Select(
-            nram_access,
-            NegReg(self.dram.data_in),
-            Select(two_cycle_nram_access, data_in_low, ndram_data_in_high)
         )
+        data_in_low = Wire()
+        if self.wide_bus:
+            # Both byte-lanes arrive together, for DRAM and non-DRAM accesses alike
+            data_in_low <<= Reg(self.dram.data_in[7:0], clock_en=data_in_sample)
+            data_in_high = Reg(self.dram.data_in[15:8], clock_en=data_in_sample)
+        else:
+            data_in_low <<= Reg(self.dram.data_in, clock_en=data_in_sample)
+
+            ndram_data_in_high = Reg(self.dram.data_in, clock_en=(state == BusIfStates.non_dram_dual_wait))
+            data_in_high = Select(
+                nram_access,
+                NegReg(self.dram.data_in),
+                Select(two_cycle_nram_access, data_in_low, ndram_data_in_high)
+            )
 
         resp_data = Wire()
         resp_data <<= Reg(Select(
@@ -642,69 +681,142 @@ class BusIf(GenericModule):
         self.mem_response.data <<= resp_data
         self.fetch_response.data <<= resp_data
 
-def sim():
+def sim(rng_seed: int = 0, cycles: int = 3000, wide_bus: bool = False) -> int:
+    from copy import copy
     inst_stream = []
 
+    # The generators keep the bus busy until this many cycles before the end; the rest is left idle
+    idle_tail = 300
+    traffic_end = max(cycles - idle_tail, 0)
+    # Refresh divider used by the test: one refresh is due every 'refresh_divider+1' cycles
+    refresh_divider = 40
 
-    class DRAM_sim(Module):
+
+    class DRAM_sim(GenericModule):
+        """
+        Memory model for the external bus. Contents are indexed by (RAS line, row, column, byte-lane).
+        Locations that were never written return bytes of their address.
+
+        With 'wide_bus' set, the data bus is 16 bits wide and both byte-lanes are transferred on the
+        same CAS cycle. Otherwise the byte-lanes are strobed one after the other on an 8-bit data bus.
+        """
         addr_bus_len = 12
         addr_bus_mask = (1 << addr_bus_len) - 1
 
-        bus_if = Input(ExternalBusIf)
+        bus_if = Input()
+
+        def construct(self, wide_bus: bool = False):
+            self.wide_bus = wide_bus
+            self.bus_if.set_net_type(ExternalWideBusIf if wide_bus else ExternalBusIf)
 
         def simulate(self, simulator) -> TSimEvent:
             full_addr = 0
+            ras_line = None
+            mem = {}
             self.bus_if.data_in <<= None
             self.bus_if.n_wait <<= 1
             while True:
-                yield (self.bus_if.n_ras_a, self.bus_if.n_nren, self.bus_if.n_cas_0, self.bus_if.n_cas_1)
+                yield (self.bus_if.n_ras_a, self.bus_if.n_ras_b, self.bus_if.n_nren, self.bus_if.n_cas_0, self.bus_if.n_cas_1)
+                ras_edges = (
+                    ("a", self.bus_if.n_ras_a),
+                    ("b", self.bus_if.n_ras_b),
+                    ("n", self.bus_if.n_nren),
+                )
+                row_strobes = tuple(name for name, strobe in ras_edges if strobe.get_sim_edge() == EdgeType.Negative)
+                if len(row_strobes) > 0:
+                    # Falling edge or nRAS (or nNREN): capture row address
+                    ras_line = row_strobes[0] if len(row_strobes) == 1 else "refresh"
+                    full_addr = full_addr & self.addr_bus_mask | (self.bus_if.addr << self.addr_bus_len)
+                    simulator.log(f"Capturing raw address {self.bus_if.addr:03x} into full address {full_addr:08x}")
+                    self.bus_if.data_in <<= None
+                    continue
                 data_assigned = False
-                for (byte, cas) in (("low", self.bus_if.n_cas_0), ("high", self.bus_if.n_cas_1)):
-                    if (self.bus_if.n_ras_a.get_sim_edge() == EdgeType.Negative) or (self.bus_if.n_nren.get_sim_edge() == EdgeType.Negative):
-                        #assert self.dram_n_cas_0.get_sim_edge() == EdgeType.NoEdge
-                        #assert self.dram_n_cas_1.get_sim_edge() == EdgeType.NoEdge
-                        #assert self.dram_n_cas_0 == 1
-                        #assert self.dram_n_cas_1 == 1
-                        # Falling edge or nRAS: capture row address
-                        if full_addr is None:
-                            full_addr = 0
-                        full_addr = full_addr & self.addr_bus_mask | (self.bus_if.addr << self.addr_bus_len)
-                        simulator.log("Capturing raw address {self.bus_if.addr:03x} into full address {full_addr:08x}")
+                read_data = 0
+                for (lane, cas) in ((0, self.bus_if.n_cas_0), (1, self.bus_if.n_cas_1)):
+                    if cas.get_sim_edge() != EdgeType.Negative:
+                        continue
+                    # Falling edge of nCAS
+                    full_addr = full_addr & (self.addr_bus_mask << self.addr_bus_len) | self.bus_if.addr
+                    key = (ras_line, full_addr, lane)
+                    # On the narrow bus, both lanes use the same data pins
+                    shift = 8 if self.wide_bus and lane == 1 else 0
+                    if self.bus_if.n_we == 0:
+                        # Write to the address
+                        data = self.bus_if.data_out
+                        data = None if data is None else (int(data) >> shift) & 0xff
+                        mem[key] = data
+                        simulator.log(f"Writing byte {lane} to address {ras_line}:{full_addr:08x} {data}")
                     else:
-                        if cas.get_sim_edge() == EdgeType.Negative:
-                            #assert self.DRAM_nRAS.get_sim_edge() == EdgeType.NoEdge
-                            #assert self.DRAM_nRAS == 0
-                            # Falling edge of nCAS
-                            full_addr = full_addr & (self.addr_bus_mask << self.addr_bus_len) | self.bus_if.addr
-                            if self.bus_if.n_we == 0:
-                                # Write to the address
-                                data = f"{self.bus_if.data_out:04x}"
-                                simulator.log(f"Writing byte {byte} to address {full_addr:08x} {data}")
-                            else:
-                                shift = 8 if byte == "high" else 0
-                                data = (full_addr >> shift) & 0xff
-                                if data_assigned:
-                                    simulator.log(f"Driving both bytes at the same time")
-                                simulator.log(f"Reading byte {byte} from address {full_addr:08x} {data:04x}")
-                                self.bus_if.data_in <<= data
-                                data_assigned = True
-                if not data_assigned:
+                        data = mem.get(key, (full_addr >> (8*lane)) & 0xff)
+                        if data is None:
+                            data = 0
+                        if data_assigned and not self.wide_bus:
+                            simulator.log(f"Driving both bytes at the same time")
+                        simulator.log(f"Reading byte {lane} from address {ras_line}:{full_addr:08x} {data:02x}")
+                        read_data |= data << shift
+                        data_assigned = True
+                if data_assigned:
+                    self.bus_if.data_in <<= read_data
+                else:
                     self.bus_if.data_in <<= None
 
     class CsrDriver(Module):
+        """
+        Sets up the bus interface and checks the refresh schedule.
+
+        Refresh cycles are counted on the DRAM interface and compared against the number of refreshes
+        that are due. The phase of the refresh timer is recovered by reading it back through the CSR.
+        The difference must stay within the credit and debt limits of BusIf at all times and once the
+        bus goes idle, all the credit should get used up by early refreshes.
+        """
         clk = ClkPort()
         rst = RstPort()
 
         reg_if = Output(CsrIf)
 
+        n_ras_a = Input(logic)
+        n_ras_b = Input(logic)
+        n_cas_0 = Input(logic)
+        n_cas_1 = Input(logic)
+
         def construct(self):
             self.reg_if.paddr.set_net_type(Unsigned(1))
 
         def simulate(self, simulator: Simulator):
+            cycle = 0
+            first_tick = None
+            refreshes = 0
+            in_refresh = False
+            max_balance = None
+
+            def refresh_balance():
+                # What the refresh balance of BusIf should be, assuming no ticks got lost
+                ticks = 0 if first_tick is None or cycle < first_tick else (cycle - first_tick) // (refresh_divider + 1) + 1
+                return BusIf.refresh_credit_limit + ticks - refreshes
+
+            def check_refresh():
+                nonlocal cycle, refreshes, in_refresh, max_balance
+                cycle += 1
+                both_ras = (self.n_ras_a == 0) and (self.n_ras_b == 0)
+                if both_ras and not in_refresh:
+                    simulator.sim_assert(self.n_cas_0 == 1 and self.n_cas_1 == 1, "CAS asserted during refresh")
+                    refreshes += 1
+                in_refresh = both_ras
+                if first_tick is None:
+                    return
+                balance = refresh_balance()
+                max_balance = balance if max_balance is None else max(max_balance, balance)
+                # One refresh worth of slack in both directions for the timer phase recovery
+                simulator.sim_assert(balance <= BusIf.refresh_credit_limit + BusIf.refresh_debt_limit + 1, f"Refresh debt exceeds the limit at cycle {cycle}")
+                # ... and one more below, in case the timer expired before its phase was recovered
+                simulator.sim_assert(balance >= -2, f"More refreshes than the credit allows at cycle {cycle}")
+
             def wait_clk():
                 yield (self.clk, )
                 while self.clk.get_sim_edge() != EdgeType.Positive:
                     yield (self.clk, )
+                if self.rst == 0:
+                    check_refresh()
 
             def wait_rst():
                 yield from wait_clk()
@@ -753,17 +865,27 @@ def sim():
             yield from wait_rst()
             for _ in range(3):
                 yield from wait_clk()
-            yield from write_reg(0, (1 << 8) | (10))
+            yield from write_reg(0, refresh_divider)
+            # The counter keeps counting from where it was; it hits 0 (and a refresh is due) that many cycles later
+            refresh_counter = yield from read_reg(0)
+            first_tick = cycle + (refresh_counter & ((1 << BusIf.refresh_counter_size) - 1))
 
+            while cycle < cycles - 2:
+                yield from wait_clk()
+            simulator.log(f"{refreshes} refreshes in {cycle} cycles, maximum refresh balance: {max_balance}")
+            # The bus has been idle for a while: early refreshes should have used up all the credit
+            balance = refresh_balance()
+            simulator.sim_assert(-2 <= balance <= 1, f"Idle cycles were not used for early refresh (refresh balance: {balance})")
 
-    # These two queues will contain the expected read-back values
-    read_data_l = []
-    read_data_h = []
+
+    # Bytes written by the generators, indexed by (is_dram, address, byte). Reads of these locations are checked.
+    written = {}
     class Generator(GenericModule):
         clk = ClkPort()
         rst = RstPort()
 
         request_port = Output(BusIfRequestIf)
+        response_port = Input(BusIfResponseIf)
 
         def construct(self, nram_base: int = 0) -> None:
             self.mode = None
@@ -779,10 +901,13 @@ def sim():
         #data            = BrewBusData
         #last            = logic
 
-        def simulate(self) -> TSimEvent:
+        def simulate(self, simulator: Simulator) -> TSimEvent:
             self.burst_cnt = None
             self.burst_addr = None
             self.is_dram = None
+            self.cycle = 0
+            # (byte_en, low byte, high byte) for each read in flight; unknown bytes are None
+            self.expected = []
 
             def reset():
                 self.request_port.valid <<= 0
@@ -826,38 +951,99 @@ def sim():
                 read_or_write(addr, is_dram, burst_len, byte_en, data, wait_states, do_write=True)
 
             def cont_write(data):
-                read_or_write(None, None, None, 3, data, None, False)
+                read_or_write(None, None, None, 3, data, None, True)
+
+            def check_response():
+                if self.response_port.valid != 1:
+                    return
+                simulator.sim_assert(len(self.expected) > 0, f"Unexpected {self.mode} response")
+                byte_en, low, high = self.expected.pop(0)
+                data = int(self.response_port.data)
+                if byte_en == 1:
+                    high = None
+                elif byte_en == 2:
+                    low, high = high, None # High byte reads are returned in the low byte
+                for byte, expected_byte in enumerate((low, high)):
+                    actual_byte = (data >> (8*byte)) & 0xff
+                    simulator.sim_assert(expected_byte is None or actual_byte == expected_byte, f"{self.mode} read data mismatch: {data:04x} (byte-enables: {byte_en}, expected low: {low}, high: {high})")
 
             def wait_clk():
                 yield (self.clk, )
                 while self.clk.get_sim_edge() != EdgeType.Positive:
                     yield (self.clk, )
+                if self.rst == 0:
+                    self.cycle += 1
+                    check_response()
 
             def wait_for_advance():
                 yield from wait_clk()
                 while not (self.request_port.ready & self.request_port.valid):
                     yield from wait_clk()
 
+            # Bookkeeping of accepted requests; the bus executes them in the order they were accepted
+            def record_write():
+                byte_en = int(self.request_port.byte_en)
+                data = int(self.request_port.data)
+                if byte_en == 2:
+                    data <<= 8 # 8-bit writes to the high byte take their data from the low byte
+                for byte in range(2):
+                    if (byte_en >> byte) & 1:
+                        written[(self.is_dram, self.burst_addr, byte)] = (data >> (8*byte)) & 0xff
+
+            def record_read():
+                byte_en = int(self.request_port.byte_en)
+                self.expected.append((byte_en, written.get((self.is_dram, self.burst_addr, 0), None), written.get((self.is_dram, self.burst_addr, 1), None)))
+
             def write(addr, is_dram, burst_len, byte_en, data, wait_states=0):
                 idx = 0
                 start_write(addr, is_dram, burst_len, byte_en, data[idx], wait_states)
                 yield from wait_for_advance()
+                record_write()
                 while idx < burst_len:
                     idx += 1
                     cont_write(data[idx])
                     yield from wait_for_advance()
+                    record_write()
                 reset()
 
-            def read(addr, is_dram, burst_len, byte_en, wait_states=0):
+            def read(addr, is_dram, burst_len, byte_en, wait_states=0, gap=True):
                 idx = 0
                 start_read(addr, is_dram, burst_len, byte_en, wait_states)
                 yield from wait_for_advance()
+                record_read()
                 while idx < burst_len:
                     idx += 1
                     cont_read()
                     yield from wait_for_advance()
+                    record_read()
                 reset()
-                yield from wait_clk()
+                if gap:
+                    yield from wait_clk()
+
+            def random_addr():
+                # Both DRAM banks, but away from the directed and DMA accesses (DMA writes don't come with data)
+                return (randint(0x100, 0xffff) | (randint(0, 1) << 16)) & ~3
+
+            def random_traffic():
+                # Back-to-back requests until the end of the traffic phase
+                while self.cycle < traffic_end:
+                    if self.mode == "fetch":
+                        yield from read(random_addr(), True, randint(0, 3), 3, gap=False)
+                    else:
+                        is_dram = randint(0, 3) != 0
+                        burst_len = randint(0, 3) if is_dram else 0
+                        wait_states = 0 if is_dram else randint(0, 2)
+                        byte_en = randint(1, 3)
+                        addr = random_addr()
+                        if randint(0, 1) == 0:
+                            yield from read(addr, is_dram, burst_len, byte_en, wait_states, gap=False)
+                        else:
+                            data = tuple(randint(0, 0xffff) for _ in range(burst_len+1))
+                            yield from write(addr, is_dram, burst_len, byte_en, data, wait_states)
+                # Wait for the last responses to arrive
+                for _ in range(50):
+                    yield from wait_clk()
+                simulator.sim_assert(len(self.expected) == 0, f"{len(self.expected)} {self.mode} responses never arrived")
 
             reset()
             if self.mode == "fetch":
@@ -875,11 +1061,13 @@ def sim():
                 yield from wait_clk()
                 yield from read(0x34,True,0,2)
                 yield from read(0x4,False,0,3)
+                yield from random_traffic()
             elif self.mode == "mem":
                 yield from wait_clk()
                 while self.rst == 1:
                     yield from wait_clk()
                 yield from read(0x5678,False,0,3, wait_states=2)
+                yield from random_traffic()
 
     class DmaGenerator(GenericModule):
         clk = ClkPort()
@@ -1039,18 +1227,20 @@ def sim():
         rst = RstPort()
 
         def body(self):
-            seed(0)
+            seed(rng_seed)
             fetch_req = Wire(BusIfRequestIf)
             fetch_rsp = Wire(BusIfResponseIf)
             fetch_generator = Generator()
             fetch_generator.set_mode("fetch")
             fetch_req <<= fetch_generator.request_port
+            fetch_generator.response_port <<= fetch_rsp
 
             mem_req = Wire(BusIfRequestIf)
             mem_rsp = Wire(BusIfResponseIf)
             mem_generator = Generator()
             mem_generator.set_mode("mem")
             mem_req <<= mem_generator.request_port
+            mem_generator.response_port <<= mem_rsp
 
             dma_req = Wire(BusIfDmaRequestIf)
             dma_generator = DmaGenerator()
@@ -1058,10 +1248,10 @@ def sim():
 
             csr_driver = CsrDriver()
 
-            dram_if = Wire(ExternalBusIf)
-            dram_sim = DRAM_sim()
+            dram_if = Wire(ExternalWideBusIf if wide_bus else ExternalBusIf)
+            dram_sim = DRAM_sim(wide_bus=wide_bus)
 
-            dut = BusIf()
+            dut = BusIf(wide_bus=wide_bus)
 
             dut.fetch_request <<= fetch_req
             fetch_rsp <<= dut.fetch_response
@@ -1071,6 +1261,10 @@ def sim():
             dram_if <<= dut.dram
             dram_sim.bus_if <<= dram_if
             dut.reg_if <<= csr_driver.reg_if
+            csr_driver.n_ras_a <<= dram_if.n_ras_a
+            csr_driver.n_ras_b <<= dram_if.n_ras_b
+            csr_driver.n_cas_0 <<= dram_if.n_cas_0
+            csr_driver.n_cas_1 <<= dram_if.n_cas_1
 
 
         def simulate(self) -> TSimEvent:
@@ -1090,12 +1284,19 @@ def sim():
                 yield from clk()
             self.rst <<= 0
 
-            for i in range(150):
+            for i in range(cycles):
                 yield from clk()
             now = yield 10
             print(f"Done at {now}")
 
-    Build.simulation(top, "bus_if.vcd", add_unnamed_scopes=True)
+    Build.simulation(top, "bus_if_wide.vcd" if wide_bus else "bus_if.vcd", add_unnamed_scopes=True)
+    return cycles
+
+def sim2(rng_seed: int = 0, cycles: int = 3000) -> int:
+    """
+    Same as sim(), but with a 16-bit external data bus
+    """
+    return sim(rng_seed, cycles, wide_bus=True)
 
 
 def gen():
@@ -299,7 +299,7 @@ class CpuDma(Module):
         self.bus_req_if.terminal_count  <<= tc
 
 
-def sim():
+def sim(rng_seed: int = 0, cycles: int = 300) -> int:
     class BusIfSim(Module):
         clk = ClkPort()
         rst = RstPort()
@@ -463,6 +463,7 @@ def sim():
         rst = RstPort()
 
         def body(self):
+            seed(rng_seed)
             dut = CpuDma()
             bus_if_sim = BusIfSim()
             driver = Driver()
@@ -491,12 +492,13 @@ def sim():
                 yield from clk()
             self.rst <<= 0
 
-            for i in range(300):
+            for i in range(cycles):
                 yield from clk()
             now = yield 10
             print(f"Done at {now}")
 
     Build.simulation(top, "cpu_dma.vcd", add_unnamed_scopes=True)
+    return cycles
 
 
 def gen():
@@ -593,13 +593,15 @@ class DecodeStage(GenericModule):
         self.output_port.result_reg_addr       <<= Reg(BrewRegAddr(res_addr), clock_en=register_outputs)
         self.output_port.result_reg_addr_valid <<= Reg(rsv_needed, clock_en=register_outputs)
         self.output_port.fetch_av              <<= Reg(self.fetch.av, clock_en=register_outputs)
+        self.output_port.pred_taken            <<= Reg(self.fetch.pred_taken, clock_en=register_outputs)
+        self.output_port.pred_target           <<= Reg(self.fetch.pred_target, clock_en=register_outputs)
 
         #self.break_fetch_burst <<= register_outputs & ((exec_unit == op_class.ld_st) | (exec_unit == op_class.branch))
         #self.break_fetch_burst <<= register_outputs & ((exec_unit == op_class.branch))
         self.break_fetch_burst <<= register_outputs & (exec_unit == op_class.ld_st)
 
 
-def sim():
+def sim(rng_seed: int = 0, cycles: int = 1000) -> int:
     class RegFileEmulator(Module):
         clk = ClkPort()
         rst = RstPort()
@@ -723,6 +725,8 @@ def sim():
                 self.exp_queue.append(exp)
                 self.fetch.inst_len <<= len(inst) - 1
                 self.fetch.av <<= av
+                self.fetch.pred_taken <<= 0
+                self.fetch.pred_target <<= None
                 yield from wait_transfer()
 
             self.fetch.valid <<= 0
@@ -869,7 +873,7 @@ def sim():
 
 
         def simulate(self) -> TSimEvent:
-            seed(0)
+            seed(rng_seed)
 
             def clk() -> int:
                 yield 10
@@ -887,12 +891,13 @@ def sim():
                 yield from clk()
             self.rst <<= 0
 
-            for i in range(1000):
+            for i in range(cycles):
                 yield from clk()
             now = yield 10
             print(f"Done at {now}")
 
     Build.simulation(top, "decode.vcd", add_unnamed_scopes=True)
+    return cycles
 
 def gen():
     def top():
@@ -33,7 +33,7 @@ class SDRamIf(Interface):
     data_out      = Unsigned(32)
     data_out_en   = logic
 
-class DramEmu(Module):
+class DramEmu(GenericModule):
     clk = ClkPort()
     rst = RstPort()
 
@@ -43,917 +43,556 @@ class DramEmu(Module):
     # SDRAM interface
     sdram = Output(SDRamIf)
 
-    def body(self):
-        def cmd_bank_activate(bank, row):
-            self.sdram.cke = 1
-            #self.sdram.dqm = None
-            self.sdram.ba = bank
-            self.sdram.addr = row
-            self.sdram.n_cs = 0
-            self.sdram.n_ras = 0
-            self.sdram.n_cas = 1
-            self.sdram.n_we = 1
-            #self.sdram.data_out = None
-            self.sdram.data_out_en = 0
-        def cmd_bank_precharge(bank):
-            self.sdram.cke = 1
-            #self.sdram.dqm = None
-            self.sdram.ba = bank
-            self.sdram.addr = 0b1_00000_00000
-            self.sdram.n_cs = 0
-            self.sdram.n_ras = 0
-            self.sdram.n_cas = 1
-            self.sdram.n_we = 0
-            #self.sdram.data_out = None
-            self.sdram.data_out_en = 0
-        def cmd_precharge_all():
-            self.sdram.cke = 1
-            #self.sdram.dqm = None
-            #self.sdram.ba = None
-            self.sdram.addr = 0b0_00000_00000
-            self.sdram.n_cs = 0
-            self.sdram.n_ras = 0
-            self.sdram.n_cas = 1
-            self.sdram.n_we = 0
-            #self.sdram.data_out = None
-            self.sdram.data_out_en = 0
-        def cmd_write(bank, col, data, dqm):
-            self.sdram.cke = 1
-            self.sdram.dqm = dqm
-            self.sdram.ba = bank
-            self.sdram.addr = col # MAKE SURE col DOESN'T SET A10!!
-            self.sdram.n_cs = 0
-            self.sdram.n_ras = 1
-            self.sdram.n_cas = 0
-            self.sdram.n_we = 0
-            self.sdram.data_out = data
-            self.sdram.data_out_en = 1
-
-
-        refresh_counter = Wire(Unsigned(self.refresh_counter_size))
-        # CSR interface
-        reg_write_strobe = self.reg_if.psel & self.reg_if.pwrite & self.reg_if.penable
-        self.reg_if.pready <<= 1
-
-        reg_addr = self.reg_if.paddr
-
-        refresh_divider = Reg(self.reg_if.pwdata[self.refresh_counter_size-1:0], clock_en=(reg_addr == self.reg_dram_config_ofs) & reg_write_strobe, reset_value_port=128)
-        refresh_disable = Reg(self.reg_if.pwdata[self.refresh_counter_size], clock_en=(reg_addr == self.reg_dram_config_ofs) & reg_write_strobe)
-        dram_bank_size = Reg(self.reg_if.pwdata[self.refresh_counter_size+2:self.refresh_counter_size+1], clock_en=(reg_addr == self.reg_dram_config_ofs) & reg_write_strobe)
-        dram_bank_swap = Reg(self.reg_if.pwdata[self.refresh_counter_size+3], clock_en=(reg_addr == self.reg_dram_config_ofs) & reg_write_strobe)
-        dram_single_bank = Reg(self.reg_if.pwdata[self.refresh_counter_size+4], clock_en=(reg_addr == self.reg_dram_config_ofs) & reg_write_strobe)
-        self.reg_if.prdata <<= concat(
-            dram_single_bank,
-            dram_bank_swap,
-            dram_bank_size,
-            refresh_disable,
-            refresh_counter
-        )
+    def construct(self, cas_latency: int = 2, t_rcd: int = 2, t_rp: int = 2, t_rfc: int = 7, refresh_interval: int = 700, refresh_debt_limit: int = 8):
+        """
+        All timing parameters are in 'clk' cycles.
 
-        # Refresh logic
-        # We seem to need to generate 256 refresh cycles in 4ms. That would mean a refresh cycle
-        # every 200 or so cycles at least. So, an 8-bit counter should suffice
-        refresh_tc = refresh_counter == 0
-        refresh_rsp = Wire(logic)
-        refresh_req = Wire(logic)
-        refresh_req <<= Reg(Select(
-            refresh_tc & ~refresh_disable,
-            Select(
-                refresh_rsp,
-                refresh_req,
-                0
-            ),
-            1
-        ))
-        refresh_counter <<= Reg(Select(
-                refresh_tc,
-                Select(
-                    refresh_req,
-                    (refresh_counter-1)[self.refresh_counter_size-1:0],
-                    refresh_counter
-                ),
-                refresh_divider
-        ))
-        refresh_addr = Wire(self.dram.addr.get_net_type())
-        refresh_addr <<= Reg(Select(refresh_rsp, refresh_addr, self.dram.addr.get_net_type()(refresh_addr+1)))
-
-        class BusIfStates(Enum):
-            idle                 = 0
-            first                = 1
-            middle               = 2
-            external             = 3
-            precharge            = 4
-            non_dram_first       = 5
-            non_dram_wait        = 6
-            non_dram_dual        = 7
-            non_dram_dual_first  = 8
-            non_dram_dual_wait   = 9
-            non_dram_last        = 10
-            dma_first            = 11
-            dma_wait             = 12
-            refresh              = 13
+        'refresh_interval' is the number of cycles between SDRAM auto-refresh commands. For 4096 rows
+        in 64ms that's 15.6us or less.
+
+        'refresh_debt_limit' is the number of auto-refresh commands that can be postponed. SDRAMs
+        allow up to 8 refreshes to be pulled in or postponed, as long as the average rate is kept.
+        """
+        self.cas_latency = cas_latency
+        self.t_rcd = t_rcd
+        self.t_rp = t_rp
+        self.t_rfc = t_rfc
+        self.refresh_interval = refresh_interval
+        self.refresh_debt_limit = refresh_debt_limit
+
+    """
+    The emulator runs from a clock that's several times faster than the bus clock of the processor.
+    The emulated DRAM signals are synchronized and their edges trigger SDRAM commands.
+
+    Address mapping:
+        emulated n_ras_a/n_ras_b    -> SDRAM bank 0/1
+        emulated row address        -> SDRAM row address
+        emulated column [8:1]       -> SDRAM column address
+        emulated column [0], n_cas  -> SDRAM byte-lane (n_cas_0: low, n_cas_1: high byte of each 16-bit half)
+
+    SDRAM rows are left open after the emulated RAS cycle ends (open-row policy): each SDRAM bank
+    tracks its active row, and only gets pre-charged if a different row is needed. Consecutive
+    RAS cycles to the same row thus don't pay for tRP and tRCD.
+
+    Reads fill a 32-bit word buffer (which covers two emulated columns). After each read, the next
+    word is pre-fetched into a second buffer, so sequential page-mode bursts are served from the
+    buffers, hiding the CAS latency of the SDRAM.
+
+    RAS-only cycles on both emulated banks (refresh cycles of the processor) are ignored. The SDRAM
+    is refreshed based on an internal timer instead, which closes all open rows. Expired refresh
+    intervals accumulate as a debt, which gets paid back whenever the emulated bus is idle (no RAS
+    cycle in progress) and there's nothing else to do. Only once the debt reaches 'refresh_debt_limit'
+    is a refresh forced in front of row changes and pre-fetches. Refreshes are not issued ahead of
+    schedule: since they close all rows, that would throw away open-row hits for no benefit.
+    """
+    def body(self):
+        class SdramCmds(Enum):
+            nop           = 0
+            activate      = 1
+            read          = 2
+            write         = 3
+            precharge     = 4
+            precharge_all = 5
+            refresh       = 6
+
+        class EmuStates(Enum):
+            idle             = 0
+            precharge_wait   = 1
+            activate_wait    = 2
+            read_wait        = 3
+            refresh_prechg   = 4
+            refresh_wait     = 5
+
+        # Synchronize the emulated DRAM interface into our clock domain
+        def sync_strobe(signal):
+            return Reg(Reg(signal, reset_value_port=1), reset_value_port=1)
+        def sync(signal):
+            return Reg(Reg(signal))
+        def fall(signal):
+            return Reg(signal, reset_value_port=1) & ~signal
+
+        n_ras_a = sync_strobe(self.dram.n_ras_a)
+        n_ras_b = sync_strobe(self.dram.n_ras_b)
+        n_cas_0 = sync_strobe(self.dram.n_cas_0)
+        n_cas_1 = sync_strobe(self.dram.n_cas_1)
+        n_we = sync_strobe(self.dram.n_we)
+        addr = sync(self.dram.addr)
+        data_out = sync(self.dram.data_out)
+
+        ras_active = n_ras_a ^ n_ras_b # Exactly one bank is selected; both is a refresh cycle
+        ras_fall = (fall(n_ras_a) | fall(n_ras_b)) & ras_active
+        cas_fall_0 = fall(n_cas_0) & ras_active
+        cas_fall_1 = fall(n_cas_1) & ras_active
+        cas_fall = cas_fall_0 | cas_fall_1
+
+        emu_row_a = Wire(self.dram.addr.get_net_type())
+        emu_row_b = Wire(self.dram.addr.get_net_type())
+        emu_row_a <<= Reg(addr, clock_en=fall(n_ras_a) & n_ras_b)
+        emu_row_b <<= Reg(addr, clock_en=fall(n_ras_b) & n_ras_a)
 
         self.fsm = FSM()
 
-        self.fsm.reset_value   <<= BusIfStates.idle
-        self.fsm.default_state <<= BusIfStates.idle
+        self.fsm.reset_value   <<= EmuStates.idle
+        self.fsm.default_state <<= EmuStates.idle
 
         state = Wire()
-        next_state = Wire()
         state <<= self.fsm.state
-        next_state <<= self.fsm.next_state
-
-        class Ports(Enum):
-            fetch_port = 0
-            mem_port = 1
-            dma_port = 2
-            refresh_port = 3
-
-        arb_port_select = Wire()
-        arb_port_comb = SelectFirst(
-            refresh_req, Ports.refresh_port,
-            self.dma_request.valid, Ports.dma_port,
-            self.mem_request.valid, Ports.mem_port,
-            default_port = Ports.fetch_port
-        )
-        arb_port_select <<= hold(arb_port_comb, enable=state == BusIfStates.idle)
-
-        req_ready = Wire()
-        req_ready <<= (state == BusIfStates.idle) | (state == BusIfStates.first) | (state == BusIfStates.middle)
-        refresh_rsp <<= (state == BusIfStates.refresh)
-        self.mem_request.ready <<= req_ready & (arb_port_select == Ports.mem_port)
-        self.fetch_request.ready <<= req_ready & (arb_port_select == Ports.fetch_port)
-        self.dma_request.ready <<= (req_ready & (arb_port_select == Ports.dma_port)) | (state == BusIfStates.external)
-
-        req_valid = Wire()
-        start = Wire()
-        req_addr = Wire()
-        req_data = Wire()
-        req_read_not_write = Wire()
-        req_byte_en = Wire()
-
-        req_valid <<= Select(arb_port_select, self.fetch_request.valid, self.mem_request.valid, self.dma_request.valid, 1)
-        start <<= (state == BusIfStates.idle) & req_valid
-        req_addr <<= Select(arb_port_select, self.fetch_request.addr, self.mem_request.addr, self.dma_request.addr)
-        req_data <<= Select(arb_port_select, self.fetch_request.data, self.mem_request.data, None)
-        req_read_not_write <<= Select(arb_port_select, self.fetch_request.read_not_write, self.mem_request.read_not_write, self.dma_request.read_not_write, 1)
-        req_byte_en <<= Select(arb_port_select, self.fetch_request.byte_en, self.mem_request.byte_en, self.dma_request.byte_en)
-        req_advance = req_valid & req_ready
-
-        req_dram = (req_addr[26:25] != self.nram_base) & ((arb_port_select == Ports.mem_port) | (arb_port_select == Ports.fetch_port))
-        req_nram = (req_addr[26:25] == self.nram_base) & ((arb_port_select == Ports.mem_port) | (arb_port_select == Ports.fetch_port))
-        req_dma  = (arb_port_select == Ports.dma_port) & ~self.dma_request.is_master
-        req_ext  = (arb_port_select == Ports.dma_port) &  self.dma_request.is_master
-        req_rfsh = (arb_port_select == Ports.refresh_port)
-
-        dram_addr_muxing = Select(start, Reg(req_dram | req_dma, clock_en=start), req_dram | req_dma)
-        dma_ch = Reg(self.dma_request.one_hot_channel, clock_en=start)
-        tc = Reg(self.dma_request.terminal_count, clock_en=start)
-
-        req_wait_states = (req_addr[30:27]-1)[3:0]
-        wait_states_store = Reg(req_wait_states, clock_en=start)
-        wait_states = Wire(Unsigned(4))
-        wait_states <<= Reg(
-            Select(
-                start,
-                Select(
-                    wait_states == 0,
-                    (wait_states - ((state == BusIfStates.dma_wait) | (state == BusIfStates.non_dram_dual_wait) | (state == BusIfStates.non_dram_wait)))[3:0],
-                    Select(
-                        state == BusIfStates.non_dram_dual,
-                        0,
-                        wait_states_store
-                    )
-                ),
-                req_wait_states
-            )
-        )
-        waiting = ~self.dram.n_wait | (wait_states != 0)
-
-        two_cycle_nram_access = Wire(logic)
-        two_cycle_nram_access <<= Reg((req_byte_en == 3) & req_nram, clock_en=start)
-        nram_access = Wire(logic)
-        nram_access <<= Reg(req_nram, clock_en=start)
-
-        self.event_bus_idle <<= (state == BusIfStates.idle) & (next_state == BusIfStates.idle)
-
-        self.fsm.add_transition(BusIfStates.idle,                         req_valid & req_ext,                                  BusIfStates.external)
-        self.fsm.add_transition(BusIfStates.idle,                         req_valid & req_nram,                                 BusIfStates.non_dram_first)
-        self.fsm.add_transition(BusIfStates.idle,                         req_valid & req_dma,                                  BusIfStates.dma_first)
-        self.fsm.add_transition(BusIfStates.idle,                         req_valid & req_dram,                                 BusIfStates.first)
-        self.fsm.add_transition(BusIfStates.idle,                         req_valid & req_rfsh,                                 BusIfStates.refresh)
-        self.fsm.add_transition(BusIfStates.external,                     req_valid & ~req_ext,                                 BusIfStates.idle)
-        self.fsm.add_transition(BusIfStates.external,                    ~req_valid,                                            BusIfStates.idle)
-        self.fsm.add_transition(BusIfStates.first,                       ~req_valid,                                            BusIfStates.precharge)
-        self.fsm.add_transition(BusIfStates.first,                        req_valid,                                            BusIfStates.middle)
-        self.fsm.add_transition(BusIfStates.middle,                      ~req_valid,                                            BusIfStates.precharge)
-        self.fsm.add_transition(BusIfStates.precharge, 1,                                                                       BusIfStates.idle)
-        self.fsm.add_transition(BusIfStates.non_dram_first, 1,                                                                  BusIfStates.non_dram_wait)
-        self.fsm.add_transition(BusIfStates.non_dram_wait,  waiting,                                                            BusIfStates.non_dram_wait)
-        self.fsm.add_transition(BusIfStates.non_dram_wait, ~waiting &  two_cycle_nram_access,                                   BusIfStates.non_dram_dual)
-        self.fsm.add_transition(BusIfStates.non_dram_wait, ~waiting & ~two_cycle_nram_access,                                   BusIfStates.non_dram_last)
-        self.fsm.add_transition(BusIfStates.non_dram_dual, 1,                                                                   BusIfStates.non_dram_dual_first)
-        self.fsm.add_transition(BusIfStates.non_dram_dual_first, 1,                                                             BusIfStates.non_dram_dual_wait)
-        self.fsm.add_transition(BusIfStates.non_dram_dual_wait,  waiting,                                                       BusIfStates.non_dram_dual_wait)
-        self.fsm.add_transition(BusIfStates.non_dram_dual_wait, ~waiting,                                                       BusIfStates.non_dram_last)
-        self.fsm.add_transition(BusIfStates.non_dram_last, 1,                                                                   BusIfStates.idle)
-        self.fsm.add_transition(BusIfStates.dma_first, 1,                                                                       BusIfStates.dma_wait)
-        self.fsm.add_transition(BusIfStates.dma_wait,  waiting,                                                                 BusIfStates.dma_wait)
-        self.fsm.add_transition(BusIfStates.dma_wait, ~waiting,                                                                 BusIfStates.idle)
-        self.fsm.add_transition(BusIfStates.refresh, 1,                                                                         BusIfStates.idle)
-
-        dram_bank = Wire()
-        dram_bank_next = Select(
-            dram_bank_size,
-            req_addr[16],
-            req_addr[18],
-            req_addr[20],
-            req_addr[22],
-        )
-        dram_bank <<= Select(start, Reg(dram_bank_next, clock_en=start), dram_bank_next)
-
-        input_row_addr = Wire()
-        input_row_addr <<= Select(
-            dram_addr_muxing,
-            req_addr[21:11],
-            concat(req_addr[21], req_addr[19], req_addr[17], req_addr[15:8])
-        )
-        row_addr = Wire()
-        row_addr <<= Reg(Select(req_rfsh, input_row_addr, refresh_addr), clock_en=start)
-        col_addr = Wire()
-        col_addr <<= Reg(Select(
-            dram_addr_muxing,
-            req_addr[10:0],
-            concat(req_addr[20], req_addr[18], req_addr[16], req_addr[7:0])
-        ), clock_en=req_advance)
-        read_not_write = Wire()
-        read_not_write <<= Reg(req_read_not_write, clock_en=start, reset_value_port=1) # reads and writes can't mix within a burst
-        data_out_en = Wire()
-        data_out_en <<= Reg(~req_read_not_write & (arb_port_select != Ports.dma_port), clock_en=start) # reads and writes can't mix within a burst
-        byte_en = Wire()
-        byte_en <<= hold(req_byte_en, enable=req_advance)
-        data_out = Wire()
-        data_out <<= Reg(
-            Select(
-                req_byte_en[0],
-                concat(req_data[7:0], req_data[7:0]), # low-byte-en is 0 --> 8-bit access to the high-byte
-                req_data, # low-byte-en is 1 --> either 16-bit access or 8-bit access from the low-byte
-            ),
-            clock_en=req_advance
-        )
-
-        #AssertOnClk((input_row_addr == row_addr) | (state == BusIfStates.idle))
-
-        '''
-        CAS generation:
-
-            CLK             \__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/
-            CAS_nWINDOW_A   ^^^^^^^^^\_______________________/^^^^^\_____/^^^^^\_____/^^^^^\_______________________/^^^^^^^^^^^^^^^^^^^^^^^^
-            CAS_nWINDOW_B   ^^^^^^^^^^^^\_______________________/^^^^^\_____/^^^^^\_____/^^^^^\_______________________/^^^^^^^^^^^^^^^^^^^^^
-            CAS_nWINDOW_C   ^^^^^^^^^^^^^^^\_______________________/^^^^^\_____/^^^^^\_____/^^^^^\_______________________/^^^^^^^^^^^^^^^^^^
-            CAS_nEN_A       ^^^^^^^^^^^^\____________________/^^^^^^^^\__/^^^^^^^^\__/^^^^^^^^\____________________/^^^^^^^^^^^^^^^^^^^^^^^^
-            DRAM_nCAS_A     ^^^^^^^^^^^^\__/^^\__/^^\__/^^\__/^^^^^^^^\__/^^^^^^^^\__/^^^^^^^^\__/^^\__/^^\__/^^\__/^^^^^^^^^^^^^^^^^^^^^^^^
-            CAS_nEN_A       ^^^^^^^^^^^^^^^\____________________/^^^^^^^^\__/^^^^^^^^\__/^^^^^^^^\____________________/^^^^^^^^^^^^^^^^^^^^^
-            DRAM_nCAS_B     ^^^^^^^^^^^^^^^\__/^^\__/^^\__/^^\__/^^^^^^^^\__/^^^^^^^^\__/^^^^^^^^\__/^^\__/^^\__/^^\__/^^^^^^^^^^^^^^^^^^^^^
-
-        We need to avoid changing the enable signal on opposite edges of the clock.
-        That is, CAS_nEN falls with ~CLK falling and rises with ~CLK rising.
-
-        This way timing is not that critical, provided the LUT is just as glitch-free
-        as logic gates would be. That's actually up to debate. Apparently Xilinx only
-        guarantees glitch-free output for single input toggling, but in practice it
-        appears to be true that the output doesn't glitch if normal logic wouldn't.
-
-        From what I've gathered, the glitch-free nature of the output comes from
-        depending on the output capacitance of the read-wire and careful timing of
-        the switching of the pass-gates that make up the LUT read mux. So, fingers
-        crossed, this is a safe circuit...
-        '''
-
-        dram_ras_active = (
-            (next_state == BusIfStates.first) |
-            (next_state == BusIfStates.middle) |
-            (next_state == BusIfStates.precharge) |
-            (next_state == BusIfStates.dma_first) |
-            (next_state == BusIfStates.dma_wait)
-        )
-        # Decode DRAM banks as follows:
-        #
-        # dram_bank    bank_swap    single_bank   ras_a     ras_b
-        #     0            0              0         1         0
-        #     1            0              0         0         1
-        #     0            1              0         0         1
-        #     1            1              0         1         0
-        #     0            0              1         1         0
-        #     1            0              1         1         0
-        #     0            1              1         0         1
-        #     1            1              1         0         1
-        dram_ras_a = Reg((dram_ras_active & ((dram_bank == dram_bank_swap) | (~dram_bank_swap & dram_single_bank))) | (next_state == BusIfStates.refresh)) # We re-register the state to remove all glitches
-        dram_ras_b = Reg((dram_ras_active & ((dram_bank != dram_bank_swap) | ( dram_bank_swap & dram_single_bank))) | (next_state == BusIfStates.refresh)) # We re-register the state to remove all glitches
-        dram_n_ras_a = ~dram_ras_a
-        dram_n_ras_b = ~dram_ras_b
-        n_nren = Wire()
-        n_nren <<= Reg(
-            (next_state != BusIfStates.non_dram_first) & (next_state != BusIfStates.non_dram_wait) & (next_state != BusIfStates.non_dram_dual_first) & (next_state != BusIfStates.non_dram_dual_wait),
-            reset_value_port = 1
-        ) # We re-register the state to remove all glitches
-        n_dack = Wire(self.dma_request.one_hot_channel.get_net_type())
-        n_dack <<= ~Reg(
-            Select(
-                (state == BusIfStates.dma_first) | ((state == BusIfStates.dma_wait) & waiting) | ((state == BusIfStates.external) & req_valid & req_ext),
-                0,
-                dma_ch
-            )
-        )
-        nr_cas_logic = (
-            (state == BusIfStates.non_dram_dual_first) | (state == BusIfStates.non_dram_first) | (state == BusIfStates.dma_first) |
-            (waiting & ((state == BusIfStates.non_dram_dual_wait) | (state == BusIfStates.non_dram_wait) | (state == BusIfStates.dma_wait)))
-        )
-        """
-        BUG BUG BUG
-        for DMA accesses, n_cas needs to be delayed until data is ready on the data-bus, as it gets latched in the falling edge.
-        This probably means that n_cas will have to go down for the last half-cycle of the DMA, after n_wait is sampled high.
-        BUG BUG BUG
-        """
-        nr_cas_logic_0 = nr_cas_logic & (~two_cycle_nram_access | (state == BusIfStates.non_dram_first) | (state == BusIfStates.non_dram_wait) | (state == BusIfStates.dma_first) | (state == BusIfStates.dma_wait))
-        nr_cas_logic_1 = nr_cas_logic & (~two_cycle_nram_access | (state == BusIfStates.non_dram_dual_first) | (state == BusIfStates.non_dram_dual_wait) | (state == BusIfStates.dma_first) | (state == BusIfStates.dma_wait))
-        nr_n_cas_0 = Wire()
-        nr_n_cas_0 <<= Reg(~nr_cas_logic_0 | ~byte_en[0], reset_value_port = 1) # We re-register the state to remove all glitches
-        nr_n_cas_1 = Wire()
-        nr_n_cas_1 <<= Reg(~nr_cas_logic_1 | ~byte_en[1], reset_value_port = 1) # We re-register the state to remove all glitches
-        cas_n_window_a_0 = Wire()
-        cas_n_window_a_0 <<= Reg(
-            ~byte_en[0] |
-            (next_state == BusIfStates.idle) |
-            (next_state == BusIfStates.precharge) |
-            (next_state == BusIfStates.non_dram_first) |
-            (next_state == BusIfStates.non_dram_wait) |
-            (next_state == BusIfStates.non_dram_dual) |
-            (next_state == BusIfStates.non_dram_dual_first) |
-            (next_state == BusIfStates.non_dram_dual_wait) |
-            (next_state == BusIfStates.non_dram_last) |
-            (next_state == BusIfStates.dma_first) |
-            (next_state == BusIfStates.dma_wait) |
-            (next_state == BusIfStates.refresh),
-            reset_value_port = 1
-        ) # We re-register the state to remove all glitches
-        cas_n_window_a_1 = Wire()
-        cas_n_window_a_1 <<= Reg(
-            ~byte_en[1] |
-            (next_state == BusIfStates.idle) |
-            (next_state == BusIfStates.precharge) |
-            (next_state == BusIfStates.non_dram_first) |
-            (next_state == BusIfStates.non_dram_wait) |
-            (next_state == BusIfStates.non_dram_dual) |
-            (next_state == BusIfStates.non_dram_dual_first) |
-            (next_state == BusIfStates.non_dram_dual_wait) |
-            (next_state == BusIfStates.non_dram_last) |
-            (next_state == BusIfStates.dma_first) |
-            (next_state == BusIfStates.dma_wait) |
-            (next_state == BusIfStates.refresh),
-            reset_value_port = 1
-        ) # We re-register the state to remove all glitches
-        #cas_n_window_c_0 = Wire()
-        #cas_n_window_c_0 <<= Reg(cas_n_window_a_0, reset_value_port = 1)
-        cas_n_window_b_0 = Wire()
-        cas_n_window_b_0 <<= NegReg(cas_n_window_a_0, reset_value_port = 1)
-        cas_n_window_c_1 = Wire()
-        cas_n_window_c_1 <<= Reg(cas_n_window_a_1, reset_value_port = 1)
-        cas_n_window_b_1 = Wire()
-        cas_n_window_b_1 <<= NegReg(cas_n_window_a_1, reset_value_port = 1)
-
-        dram_n_cas_0 = cas_n_window_a_0 | cas_n_window_b_0 |  self.clk
-        dram_n_cas_1 = cas_n_window_b_1 | cas_n_window_c_1 | ~self.clk
-
-        self.dram.n_ras_a     <<= dram_n_ras_a
-        self.dram.n_ras_b     <<= dram_n_ras_b
-        self.dram.n_cas_0     <<= dram_n_cas_0 & nr_n_cas_0
-        self.dram.n_cas_1     <<= dram_n_cas_1 & nr_n_cas_1
-        col_addr_nr = NegReg(col_addr)
-        dram_addr = Select(
-            (
-                (state == BusIfStates.first) |
-                (state == BusIfStates.non_dram_first) |
-                (state == BusIfStates.non_dram_dual_first) |
-                (state == BusIfStates.dma_first) |
-                (state == BusIfStates.refresh)
-            ) & self.clk,
-            col_addr_nr,
-            row_addr
-        )
-        self.dram.addr        <<= dram_addr
-        self.dram.n_we        <<= read_not_write
-        self.dram.data_out_en <<= data_out_en
-        data_out_low = Wire()
-        nr_cas_logic_1_reg = Wire(logic)
-        nr_cas_logic_1_reg <<= Reg(Select(
-            n_nren,
-            nr_cas_logic_1_reg | nr_cas_logic_1,
-            0
+        idle = state == EmuStates.idle
+        wait_cnt = Wire(Unsigned(4))
+        wait_done = wait_cnt == 0
+
+        # Open-row tracker
+        open_a = Wire(logic)
+        open_b = Wire(logic)
+        open_row_a = Wire(self.dram.addr.get_net_type())
+        open_row_b = Wire(self.dram.addr.get_net_type())
+        row_ready_a = open_a & (open_row_a == emu_row_a)
+        row_ready_b = open_b & (open_row_b == emu_row_b)
+
+        # Pending activation (from the emulated RAS edge)
+        act_pend = Wire(logic)
+        act_bank = Wire(logic)
+        act_bank <<= Reg(~n_ras_b, clock_en=ras_fall)
+        act_row_ready = Select(act_bank, row_ready_a, row_ready_b)
+        act_pend <<= Reg(Select(ras_fall, act_pend & ~act_row_ready, 1))
+
+        # Pending access (from the emulated CAS edge)
+        cas_pend = Wire(logic)
+        cas_bank = Wire(logic)
+        cas_col = Wire(self.dram.addr.get_net_type())
+        cas_write = Wire(logic)
+        cas_lane = Wire(logic)
+        cas_data = Wire(BrewByte)
+        cas_bank <<= Reg(~n_ras_b, clock_en=cas_fall)
+        cas_col <<= Reg(addr, clock_en=cas_fall)
+        cas_write <<= Reg(~n_we, clock_en=cas_fall)
+        cas_lane <<= Reg(~cas_fall_0, clock_en=cas_fall)
+        cas_data <<= Reg(data_out, clock_en=cas_fall)
+        cas_row_ready = Select(cas_bank, row_ready_a, row_ready_b)
+        cas_tag = concat(cas_bank, Select(cas_bank, emu_row_a, emu_row_b), cas_col[8:1])
+
+        # Read buffers: the current word and the pre-fetched next one
+        cur_valid = Wire(logic)
+        cur_tag = Wire(Unsigned(20))
+        cur_data = Wire(Unsigned(32))
+        next_valid = Wire(logic)
+        next_tag = Wire(Unsigned(20))
+        next_data = Wire(Unsigned(32))
+        prefetch_pend = Wire(logic)
+        prefetch_tag = concat(cur_tag[19:8], (cur_tag[7:0] + 1)[7:0])
+        prefetch_row_ready = Select(cur_tag[19], open_a & (open_row_a == cur_tag[18:8]), open_b & (open_row_b == cur_tag[18:8]))
+        hit_cur = cur_valid & (cur_tag == cas_tag)
+        hit_next = next_valid & (next_tag == cas_tag)
+
+        # Refresh timer and postponement debt
+        refresh_cnt = Wire(Unsigned(self.refresh_interval.bit_length()))
+        refresh_debt = Wire(Unsigned(self.refresh_debt_limit.bit_length()))
+        refresh_tc = refresh_cnt == 0
+        refresh_cnt <<= Reg(Select(refresh_tc, (refresh_cnt - 1)[refresh_cnt.get_num_bits()-1:0], self.refresh_interval - 1))
+        refresh_forced = refresh_debt == self.refresh_debt_limit
+
+        # Scheduling, in priority order: accesses to open rows, forced refresh, row changes, pre-fetches and refresh
+        do_write = idle & cas_pend & cas_write & cas_row_ready
+        do_hit = idle & cas_pend & ~cas_write & cas_row_ready & (hit_cur | hit_next)
+        do_read = idle & cas_pend & ~cas_write & cas_row_ready & ~hit_cur & ~hit_next
+        row_needed = Select(cas_pend, act_pend & ~act_row_ready & ~refresh_forced, ~cas_row_ready)
+        row_bank = Wire(logic)
+        row_bank <<= Select(cas_pend, act_bank, cas_bank)
+        row_bank_l = Wire(logic)
+        row_bank_l <<= Reg(row_bank, clock_en=idle & row_needed)
+        do_precharge = idle & row_needed & Select(row_bank, open_a, open_b)
+        do_activate = (idle & row_needed & ~Select(row_bank, open_a, open_b)) | ((state == EmuStates.precharge_wait) & wait_done)
+        activate_bank = Select(idle, row_bank_l, row_bank)
+        do_prefetch = idle & ~cas_pend & ~row_needed & prefetch_pend & prefetch_row_ready & ~refresh_forced
+        drop_prefetch = idle & ~cas_pend & ~row_needed & prefetch_pend & ~prefetch_row_ready
+        do_refresh = idle & ~cas_pend & ~row_needed & (refresh_forced | (~prefetch_pend & ~ras_active & (refresh_debt != 0)))
+        do_refresh_cmd = (state == EmuStates.refresh_prechg) & wait_done
+
+        refresh_debt <<= Reg(SelectFirst(
+            refresh_tc & ~do_refresh_cmd & ~refresh_forced, (refresh_debt + 1)[refresh_debt.get_num_bits()-1:0],
+            ~refresh_tc & do_refresh_cmd,                   (refresh_debt - 1)[refresh_debt.get_num_bits()-1:0],
+            default_port = refresh_debt
         ))
-        data_out_low <<= NegReg(
-            Select(
-                nram_access,
-                data_out[7:0],
-                Select(
-                    two_cycle_nram_access & (nr_cas_logic_1_reg | nr_cas_logic_1 | ~nr_n_cas_1),
-                    data_out[7:0],
-                    data_out[15:8]
-                )
-            )
-        )
-        data_out_high = Wire()
-        data_out_high <<= Reg(
-            Select(
-                nram_access,
-                data_out[15:8],
-                Select(
-                    two_cycle_nram_access & (nr_cas_logic_1_reg | nr_cas_logic_1),
-                    data_out[7:0],
-                    data_out[15:8]
-                )
-            )
-        )
-        self.dram.data_out   <<= Select(
-            self.clk,
-            data_out_low,
-            data_out_high
-        )
 
-        self.dram.n_nren      <<= n_nren
-        self.dram.n_dack      <<= n_dack
-        self.dram.tc         <<= tc
-        self.dram.bus_en     <<= state != BusIfStates.external
-
-        read_active = Wire()
-        read_active <<= (
-            (state == BusIfStates.first) |
-            (state == BusIfStates.middle) |
-            ((state == BusIfStates.dma_wait) & ~waiting) |
-            ((state == BusIfStates.non_dram_wait) & ~waiting & ~two_cycle_nram_access) |
-            ((state == BusIfStates.non_dram_dual_wait) & ~waiting)
-        ) & read_not_write
-        data_in_low = Wire()
-        data_in_low <<= Reg(self.dram.data_in, clock_en=(
-            (state == BusIfStates.non_dram_wait) |
-            (state == BusIfStates.first) |
-            (state == BusIfStates.middle)
+        rd_to_next = Wire(logic)
+        rd_to_next <<= Reg(do_prefetch, clock_en=do_read | do_prefetch)
+        rd_tag = Wire(Unsigned(20))
+        rd_tag <<= Reg(Select(do_prefetch, cas_tag, prefetch_tag), clock_en=do_read | do_prefetch)
+        rd_done = (state == EmuStates.read_wait) & wait_done
+        rd_done_cur = rd_done & ~rd_to_next
+        rd_done_next = rd_done & rd_to_next
+
+        cas_pend <<= Reg(Select(cas_fall, cas_pend & ~(do_write | do_hit | (rd_done_cur & (rd_tag == cas_tag))), 1))
+
+        cur_valid <<= Reg(Select(do_write, Select(rd_done_cur | (do_hit & ~hit_cur), cur_valid, 1), 0))
+        cur_tag <<= Reg(Select(rd_done_cur, next_tag, rd_tag), clock_en=rd_done_cur | (do_hit & ~hit_cur))
+        cur_data <<= Reg(Select(rd_done_cur, next_data, self.sdram.data_in), clock_en=rd_done_cur | (do_hit & ~hit_cur))
+        next_valid <<= Reg(Select(do_write | rd_done_cur | (do_hit & ~hit_cur), Select(rd_done_next, next_valid, 1), 0))
+        next_tag <<= Reg(rd_tag, clock_en=rd_done_next)
+        next_data <<= Reg(self.sdram.data_in, clock_en=rd_done_next)
+        prefetch_pend <<= Reg(Select(rd_done_cur | (do_hit & ~hit_cur), prefetch_pend & ~do_prefetch & ~drop_prefetch, 1))
+
+        open_a <<= Reg(Select(do_refresh, Select(do_activate & ~activate_bank, open_a & ~(do_precharge & ~row_bank), 1), 0))
+        open_b <<= Reg(Select(do_refresh, Select(do_activate &  activate_bank, open_b & ~(do_precharge &  row_bank), 1), 0))
+        activate_row = Select(activate_bank, emu_row_a, emu_row_b)
+        open_row_a <<= Reg(activate_row, clock_en=do_activate & ~activate_bank)
+        open_row_b <<= Reg(activate_row, clock_en=do_activate &  activate_bank)
+
+        self.fsm.add_transition(EmuStates.idle,            do_precharge,             EmuStates.precharge_wait)
+        self.fsm.add_transition(EmuStates.idle,            do_activate,              EmuStates.activate_wait)
+        self.fsm.add_transition(EmuStates.idle,            do_read | do_prefetch,    EmuStates.read_wait)
+        self.fsm.add_transition(EmuStates.idle,            do_refresh,               EmuStates.refresh_prechg)
+        self.fsm.add_transition(EmuStates.precharge_wait, ~wait_done,                EmuStates.precharge_wait)
+        self.fsm.add_transition(EmuStates.precharge_wait,  wait_done,                EmuStates.activate_wait)
+        self.fsm.add_transition(EmuStates.activate_wait,  ~wait_done,                EmuStates.activate_wait)
+        self.fsm.add_transition(EmuStates.activate_wait,   wait_done,                EmuStates.idle)
+        self.fsm.add_transition(EmuStates.read_wait,      ~wait_done,                EmuStates.read_wait)
+        self.fsm.add_transition(EmuStates.read_wait,       wait_done,                EmuStates.idle)
+        self.fsm.add_transition(EmuStates.refresh_prechg, ~wait_done,                EmuStates.refresh_prechg)
+        self.fsm.add_transition(EmuStates.refresh_prechg,  wait_done,                EmuStates.refresh_wait)
+        self.fsm.add_transition(EmuStates.refresh_wait,   ~wait_done,                EmuStates.refresh_wait)
+        self.fsm.add_transition(EmuStates.refresh_wait,    wait_done,                EmuStates.idle)
+
+        # The read data is captured 'cas_latency' cycles after the (registered) command is issued
+        wait_cnt <<= Reg(SelectFirst(
+            do_precharge,           self.t_rp - 1,
+            do_activate,            self.t_rcd - 1,
+            do_read | do_prefetch,  self.cas_latency,
+            do_refresh,             self.t_rp - 1,
+            do_refresh_cmd,         self.t_rfc - 1,
+            wait_done,              0,
+            default_port = (wait_cnt - 1)[3:0]
         ))
 
-        ndram_data_in_high = Reg(self.dram.data_in, clock_en=(state == BusIfStates.non_dram_dual_wait))
-        data_in_high = Select(
-            nram_access,
-            NegReg(self.dram.data_in),
-            Select(two_cycle_nram_access, data_in_low, ndram_data_in_high)
+        # SDRAM command generation
+        cmd = SelectFirst(
+            do_precharge,           SdramCmds.precharge,
+            do_activate,            SdramCmds.activate,
+            do_write,               SdramCmds.write,
+            do_read | do_prefetch,  SdramCmds.read,
+            do_refresh,             SdramCmds.precharge_all,
+            do_refresh_cmd,         SdramCmds.refresh,
+            default_port = SdramCmds.nop
         )
-
-        resp_data = Wire()
-        resp_data <<= Reg(Select(
-            byte_en,
-            None, # Invalid
-            concat("8'b0", data_in_low), # 8-bit read from low-byte
-            concat("8'b0", data_in_high), # 8-bit read from high-byte
-            concat(data_in_high, data_in_low) # 16-bit read
-        ))
-
-        self.mem_response.valid <<= Reg(Reg(read_active & (arb_port_select == Ports.mem_port)))
-        self.fetch_response.valid <<= Reg(Reg(read_active & (arb_port_select == Ports.fetch_port)))
-        self.dma_response.valid <<= (state == BusIfStates.dma_wait) & ~waiting
-        self.mem_response.data <<= resp_data
-        self.fetch_response.data <<= resp_data
-
-def sim():
-    inst_stream = []
-
-
-    class DRAM_sim(Module):
-        addr_bus_len = 12
-        addr_bus_mask = (1 << addr_bus_len) - 1
-
-        bus_if = Input(ExternalBusIf)
-
-        def simulate(self, simulator) -> TSimEvent:
-            full_addr = 0
-            self.bus_if.data_in <<= None
-            self.bus_if.n_wait <<= 1
-            while True:
-                yield (self.bus_if.n_ras_a, self.bus_if.n_nren, self.bus_if.n_cas_0, self.bus_if.n_cas_1)
-                data_assigned = False
-                for (byte, cas) in (("low", self.bus_if.n_cas_0), ("high", self.bus_if.n_cas_1)):
-                    if (self.bus_if.n_ras_a.get_sim_edge() == EdgeType.Negative) or (self.bus_if.n_nren.get_sim_edge() == EdgeType.Negative):
-                        #assert self.dram_n_cas_0.get_sim_edge() == EdgeType.NoEdge
-                        #assert self.dram_n_cas_1.get_sim_edge() == EdgeType.NoEdge
-                        #assert self.dram_n_cas_0 == 1
-                        #assert self.dram_n_cas_1 == 1
-                        # Falling edge or nRAS: capture row address
-                        if full_addr is None:
-                            full_addr = 0
-                        full_addr = full_addr & self.addr_bus_mask | (self.bus_if.addr << self.addr_bus_len)
-                        simulator.log("Capturing raw address {self.bus_if.addr:03x} into full address {full_addr:08x}")
-                    else:
-                        if cas.get_sim_edge() == EdgeType.Negative:
-                            #assert self.DRAM_nRAS.get_sim_edge() == EdgeType.NoEdge
-                            #assert self.DRAM_nRAS == 0
-                            # Falling edge of nCAS
-                            full_addr = full_addr & (self.addr_bus_mask << self.addr_bus_len) | self.bus_if.addr
-                            if self.bus_if.n_we == 0:
-                                # Write to the address
-                                data = f"{self.bus_if.data_out:04x}"
-                                simulator.log(f"Writing byte {byte} to address {full_addr:08x} {data}")
-                            else:
-                                shift = 8 if byte == "high" else 0
-                                data = (full_addr >> shift) & 0xff
-                                if data_assigned:
-                                    simulator.log(f"Driving both bytes at the same time")
-                                simulator.log(f"Reading byte {byte} from address {full_addr:08x} {data:04x}")
-                                self.bus_if.data_in <<= data
-                                data_assigned = True
-                if not data_assigned:
-                    self.bus_if.data_in <<= None
-
-    class CsrDriver(Module):
+        cmd_bank = SelectFirst(
+            do_precharge,           row_bank,
+            do_activate,            activate_bank,
+            do_prefetch,            prefetch_tag[19],
+            default_port = cas_bank
+        )
+        cmd_addr = SelectFirst(
+            do_activate,            activate_row,
+            do_prefetch,            prefetch_tag[7:0],
+            do_read | do_write,     cas_col[8:1],
+            do_refresh,             0b1_00000_00000, # A10 set: precharge all banks
+            default_port = 0 # A10 cleared: single-bank precharge and no auto-precharge for reads and writes
+        )
+        byte_idx = concat(cas_col[0], cas_lane)
+        write_dqm = Select(byte_idx, 0b1110, 0b1101, 0b1011, 0b0111)
+
+        self.sdram.clk         <<= self.clk
+        self.sdram.cke         <<= 1
+        self.sdram.n_cs        <<= Reg(cmd == SdramCmds.nop, reset_value_port=1)
+        self.sdram.n_ras       <<= Reg((cmd != SdramCmds.activate) & (cmd != SdramCmds.precharge) & (cmd != SdramCmds.precharge_all) & (cmd != SdramCmds.refresh), reset_value_port=1)
+        self.sdram.n_cas       <<= Reg((cmd != SdramCmds.read) & (cmd != SdramCmds.write) & (cmd != SdramCmds.refresh), reset_value_port=1)
+        self.sdram.n_we        <<= Reg((cmd != SdramCmds.write) & (cmd != SdramCmds.precharge) & (cmd != SdramCmds.precharge_all), reset_value_port=1)
+        self.sdram.ba          <<= Reg(concat("1'b0", cmd_bank))
+        self.sdram.addr        <<= Reg(cmd_addr)
+        self.sdram.dqm         <<= Reg(Select(cmd == SdramCmds.write, 0, write_dqm))
+        self.sdram.data_out    <<= Reg(concat(cas_data, cas_data, cas_data, cas_data))
+        self.sdram.data_out_en <<= Reg(cmd == SdramCmds.write)
+
+        # Emulated read data: byte-lane selected by the active CAS line
+        low_byte = Select(cas_col[0], cur_data[7:0], cur_data[23:16])
+        high_byte = Select(cas_col[0], cur_data[15:8], cur_data[31:24])
+        self.dram.data_in <<= Select(self.dram.n_cas_0, low_byte, high_byte)
+        # DRAM cycles can't be stretched
+        self.dram.n_wait <<= 1
+
+
+def sim(rng_seed: int = 0, cycles: int = 12000) -> int:
+    """
+    DramEmu test-bench. A bus driver generates emulated RAS/CAS cycles (clocked from the emulator
+    clock, but much slower), an SDRAM model checks the command stream and timing of the emulator.
+
+    The following is checked:
+    - read data (including data written earlier through the emulator)
+    - open-row hits: RAS cycles to the open row don't re-activate it
+    - prefetch: the next word is read while the bus is idle, and a hit on it only triggers the next pre-fetch
+    - refresh: the average refresh rate is kept and RAS-only refresh cycles of the processor are ignored
+    """
+    seed(rng_seed)
+
+    cas_latency = 2
+    t_rcd = 2
+    t_rp = 2
+    t_rfc = 7
+    refresh_interval = 400
+    refresh_debt_limit = 4
+
+    # Emulated bus timing (in emulator clock cycles)
+    ras_to_cas = 8
+    cas_low = 32      # Long enough for a row change behind a refresh
+    cas_low_fast = 8  # Only enough for accesses that are served from the read buffers
+    cas_high = 4
+    ras_high = 12
+
+    def init_word(bank, row, sdram_col):
+        return ((bank << 31) ^ (row * 0x9e3779b1) ^ (sdram_col * 0x85ebca6b)) & 0xffffffff
+
+    # Expected content, indexed by (bank, row, col, lane)
+    expected = {}
+    def get_expected(bank, row, col, lane):
+        key = (bank, row, col, lane)
+        if key not in expected:
+            byte_idx = (col & 1) * 2 + lane
+            expected[key] = (init_word(bank, row, col >> 1) >> (8*byte_idx)) & 0xff
+        return expected[key]
+
+    class SdramModel(Module):
         clk = ClkPort()
-        rst = RstPort()
-
-        reg_if = Output(CsrIf)
-
-        def construct(self):
-            self.reg_if.paddr.set_net_type(Unsigned(1))
-
-        def simulate(self, simulator: Simulator):
-            def wait_clk():
-                yield (self.clk, )
-                while self.clk.get_sim_edge() != EdgeType.Positive:
-                    yield (self.clk, )
-
-            def wait_rst():
-                yield from wait_clk()
-                while self.rst == 1:
-                    yield from wait_clk()
 
-            def write_reg(addr, value):
-                self.reg_if.psel <<= 1
-                self.reg_if.penable <<= 0
-                self.reg_if.pwrite <<= 1
-                self.reg_if.paddr <<= addr
-                self.reg_if.pwdata <<= value
-                yield from wait_clk()
-                self.reg_if.penable <<= 1
-                yield from wait_clk()
-                while not self.reg_if.pready:
-                    yield from wait_clk()
-                simulator.log(f"REG {addr:02x} written with value {value:08x}")
-                self.reg_if.psel <<= 0
-                self.reg_if.penable <<= None
-                self.reg_if.pwrite <<= None
-                self.reg_if.paddr <<= None
-                self.reg_if.pwdata <<= None
-
-            def read_reg(addr):
-                self.reg_if.psel <<= 1
-                self.reg_if.penable <<= 0
-                self.reg_if.pwrite <<= 0
-                self.reg_if.paddr <<= addr
-                self.reg_if.pwdata <<= None
-                yield from wait_clk()
-                self.reg_if.penable <<= 1
-                yield from wait_clk()
-                while not self.reg_if.pready:
-                    yield from wait_clk()
-                ret_val = copy(self.reg_if.prdata)
-                simulator.log(f"REG {addr:02x} read returned value {ret_val:08x}")
-                self.reg_if.psel <<= 0
-                self.reg_if.penable <<= None
-                self.reg_if.pwrite <<= None
-                self.reg_if.paddr <<= None
-                self.reg_if.pwdata <<= None
-                return ret_val
-
-            self.reg_if.psel <<= 0
-            yield from wait_rst()
-            for _ in range(3):
-                yield from wait_clk()
-            yield from write_reg(0, (1 << 8) | (10))
+        sdram = Input(SDRamIf)
 
+        def simulate(self, simulator: Simulator) -> TSimEvent:
+            self.activates = 0
+            self.reads = 0
+            self.writes = 0
+            self.refreshes = 0
+            self.cycle = 0
 
-    # These two queues will contain the expected read-back values
-    read_data_l = []
-    read_data_h = []
-    class Generator(GenericModule):
-        clk = ClkPort()
-        rst = RstPort()
-
-        request_port = Output(BusIfRequestIf)
-
-        def construct(self, nram_base: int = 0) -> None:
-            self.mode = None
-            self.nram_base = nram_base
-            self.dram_base = 2 if nram_base == 0 else 0
-
-        def set_mode(self, mode):
-            self.mode = mode
-
-        #read_not_write  = logic
-        #byte_en         = Unsigned(2)
-        #addr            = BrewBusAddr
-        #data            = BrewBusData
-        #last            = logic
-
-        def simulate(self) -> TSimEvent:
-            self.burst_cnt = None
-            self.burst_addr = None
-            self.is_dram = None
-
-            def reset():
-                self.request_port.valid <<= 0
-                self.request_port.read_not_write <<= None
-                self.request_port.byte_en <<= None
-                self.request_port.addr <<= None
-                self.request_port.data <<= None
-
-            def read_or_write(addr, is_dram, burst_len, byte_en, data, wait_states, do_write):
-                if burst_len is not None:
-                    assert addr is not None
-                    assert is_dram is not None
-                    self.burst_cnt = burst_len
-                    self.burst_addr = addr
-                    self.is_dram = is_dram
-                    self.wait_states = wait_states
-                else:
-                    assert addr is None
-                    assert is_dram is None
-                    self.burst_addr += 1
-                    self.burst_cnt -= 1
-                assert self.burst_cnt >= 0
-
-                self.request_port.valid <<= 1
-                self.request_port.read_not_write <<= not do_write
-                self.request_port.byte_en <<= byte_en
-                self.request_port.addr <<= self.burst_addr | ((self.dram_base if self.is_dram else self.nram_base) << (29-4)) | ((self.wait_states + 1) << (29))
-                self.request_port.data <<= data
-
-            def start_read(addr, is_dram, burst_len, byte_en, wait_states):
-                if burst_len > 0:
-                    byte_en = 3
-                read_or_write(addr, is_dram, burst_len, byte_en, None, wait_states, do_write=False)
-
-            def cont_read():
-                read_or_write(None, None, None, 3, None, None, False)
-
-            def start_write(addr, is_dram, burst_len, byte_en, data, wait_states):
-                if burst_len > 0:
-                    byte_en = 3
-                read_or_write(addr, is_dram, burst_len, byte_en, data, wait_states, do_write=True)
-
-            def cont_write(data):
-                read_or_write(None, None, None, 3, data, None, False)
+            mem = {}
+            open_rows = [None, None]
+            activate_cycle = [None, None]
+            precharge_cycle = [-100, -100]
+            refresh_cycle = -100
+            read_queue = [] # (cycle to drive, cycle to clear, data)
 
             def wait_clk():
                 yield (self.clk, )
                 while self.clk.get_sim_edge() != EdgeType.Positive:
                     yield (self.clk, )
 
-            def wait_for_advance():
-                yield from wait_clk()
-                while not (self.request_port.ready & self.request_port.valid):
-                    yield from wait_clk()
-
-            def write(addr, is_dram, burst_len, byte_en, data, wait_states=0):
-                idx = 0
-                start_write(addr, is_dram, burst_len, byte_en, data[idx], wait_states)
-                yield from wait_for_advance()
-                while idx < burst_len:
-                    idx += 1
-                    cont_write(data[idx])
-                    yield from wait_for_advance()
-                reset()
-
-            def read(addr, is_dram, burst_len, byte_en, wait_states=0):
-                idx = 0
-                start_read(addr, is_dram, burst_len, byte_en, wait_states)
-                yield from wait_for_advance()
-                while idx < burst_len:
-                    idx += 1
-                    cont_read()
-                    yield from wait_for_advance()
-                reset()
-                yield from wait_clk()
-
-            reset()
-            if self.mode == "fetch":
-                yield from wait_clk()
-                while self.rst == 1:
-                    yield from wait_clk()
-                yield from read(0x1234,True,0,3)
-                yield from read(0x12,True,1,3)
-                yield from read(0x24,True,3,3)
-                yield from read(0x3,False,0,1)
-                yield from read(0x4,False,0,2, wait_states=5)
-                yield from wait_clk()
-                yield from wait_clk()
-                yield from wait_clk()
-                yield from wait_clk()
-                yield from read(0x34,True,0,2)
-                yield from read(0x4,False,0,3)
-            elif self.mode == "mem":
+            self.sdram.data_in <<= None
+            while True:
                 yield from wait_clk()
-                while self.rst == 1:
-                    yield from wait_clk()
-                yield from read(0x5678,False,0,3, wait_states=2)
+                self.cycle += 1
+
+                for entry in read_queue:
+                    if entry[0] == self.cycle:
+                        self.sdram.data_in <<= entry[2]
+                    if entry[1] == self.cycle:
+                        self.sdram.data_in <<= None
+                read_queue = list(entry for entry in read_queue if entry[1] > self.cycle)
+
+                if self.sdram.n_cs != 0:
+                    continue
+                cmd = (int(self.sdram.n_ras), int(self.sdram.n_cas), int(self.sdram.n_we))
+                if cmd == (1, 1, 1):
+                    continue
+                simulator.sim_assert(self.cycle - refresh_cycle >= t_rfc, "SDRAM command issued during refresh")
+                bank = int(self.sdram.ba)
+                addr = int(self.sdram.addr)
+                simulator.sim_assert(bank < 2, f"Access to unused SDRAM bank {bank}")
+                if cmd == (0, 1, 1): # activate
+                    simulator.sim_assert(open_rows[bank] is None, f"Activate on open SDRAM bank {bank}")
+                    simulator.sim_assert(self.cycle - precharge_cycle[bank] >= t_rp, f"tRP violation on SDRAM bank {bank}")
+                    open_rows[bank] = addr
+                    activate_cycle[bank] = self.cycle
+                    self.activates += 1
+                elif cmd == (1, 0, 1) or cmd == (1, 0, 0): # read or write
+                    simulator.sim_assert(open_rows[bank] is not None, f"Access to closed SDRAM bank {bank}")
+                    simulator.sim_assert(self.cycle - activate_cycle[bank] >= t_rcd, f"tRCD violation on SDRAM bank {bank}")
+                    simulator.sim_assert(addr & (1 << 10) == 0, "Unexpected auto-precharge")
+                    key = (bank, open_rows[bank], addr & 0xff)
+                    word = mem.get(key, init_word(*key))
+                    if cmd == (1, 0, 1):
+                        # Data is driven for the edge 'cas_latency' cycles after the command and held for an extra cycle
+                        read_queue.append((self.cycle + cas_latency - 1, self.cycle + cas_latency + 1, word))
+                        self.reads += 1
+                    else:
+                        dqm = int(self.sdram.dqm)
+                        data = int(self.sdram.data_out)
+                        for byte_idx in range(4):
+                            if (dqm >> byte_idx) & 1 == 0:
+                                mask = 0xff << (8*byte_idx)
+                                word = (word & ~mask) | (data & mask)
+                        mem[key] = word
+                        self.writes += 1
+                elif cmd == (0, 1, 0): # precharge
+                    banks = (0, 1) if addr & (1 << 10) else (bank, )
+                    for bank in banks:
+                        if open_rows[bank] is not None:
+                            precharge_cycle[bank] = self.cycle
+                        open_rows[bank] = None
+                elif cmd == (0, 0, 1): # refresh
+                    simulator.sim_assert(open_rows == [None, None], "Refresh with open SDRAM rows")
+                    simulator.sim_assert(self.cycle - max(precharge_cycle) >= t_rp, "tRP violation before refresh")
+                    refresh_cycle = self.cycle
+                    self.refreshes += 1
+                else:
+                    simulator.sim_assert(False, f"Unexpected SDRAM command {cmd}")
 
-    class DmaGenerator(GenericModule):
+    class BusDriver(Module):
         clk = ClkPort()
         rst = RstPort()
 
-        request_port = Output(BusIfDmaRequestIf)
+        dram = Output(ExternalBusIf)
 
-        def construct(self, nram_base: int = 0) -> None:
-            self.mode = None
-            self.nram_base = nram_base
-            self.dram_base = 2 if nram_base == 0 else 0
-
-        def body(self):
-            self.request_port.one_hot_channel.set_net_type(Unsigned(4))
-
-        def set_mode(self, mode):
-            self.mode = mode
-
-        #read_not_write  = logic
-        #byte_en         = Unsigned(2)
-        #addr            = BrewBusAddr
-        #data            = BrewBusData
-        #last            = logic
-
-        def simulate(self) -> TSimEvent:
-            def reset():
-                self.request_port.valid <<= 0
-                self.request_port.read_not_write <<= None
-                self.request_port.byte_en <<= None
-                self.request_port.addr <<= None
-                self.request_port.one_hot_channel <<= None
-                self.request_port.terminal_count <<= None
-
-            def read_or_write(addr, is_dram, byte_en, channel, terminal_count, wait_states, do_write, is_master):
-                assert addr is not None or is_master
-                assert is_dram is not None or is_master
-
-                self.request_port.valid <<= 1
-                self.request_port.read_not_write <<= not do_write
-                self.request_port.byte_en <<= byte_en
-                self.request_port.addr <<= None if is_master else addr | ((self.dram_base if is_dram else self.nram_base) << (29-4)) | ((wait_states + 1) << (29))
-                self.request_port.one_hot_channel <<= 1 << channel
-                self.request_port.terminal_count <<= terminal_count
-                self.request_port.is_master <<= is_master
-
-            def start_read(addr, is_dram, byte_en, channel, terminal_count, wait_states):
-                read_or_write(addr, is_dram, byte_en, channel, terminal_count, wait_states, do_write=False, is_master=False)
-
-            def start_write(addr, is_dram, byte_en, channel, terminal_count, wait_states):
-                read_or_write(addr, is_dram, byte_en, channel, terminal_count, wait_states, do_write=True, is_master=False)
-
-            def start_master(channel):
-                read_or_write(None, None, None, channel, None, None, do_write=None, is_master=True)
+        def simulate(self, simulator: Simulator) -> TSimEvent:
+            self.done = False
+            sdram = top_inst.sdram_model
 
-            def wait_clk():
-                yield (self.clk, )
-                while self.clk.get_sim_edge() != EdgeType.Positive:
+            def wait_clk(cnt = 1):
+                for _ in range(cnt):
                     yield (self.clk, )
+                    while self.clk.get_sim_edge() != EdgeType.Positive:
+                        yield (self.clk, )
 
-            def wait_for_advance():
+            def wait_rst():
                 yield from wait_clk()
-                while not (self.request_port.ready & self.request_port.valid):
+                while self.rst == 1:
                     yield from wait_clk()
 
-            def write(addr, is_dram, byte_en, channel, terminal_count, wait_states=0):
-                start_write(addr, is_dram, byte_en, channel, terminal_count, wait_states)
-                yield from wait_for_advance()
-                reset()
-                yield from wait_clk()
-
-            def read(addr, is_dram, byte_en, channel, terminal_count, wait_states=0):
-                start_read(addr, is_dram, byte_en, channel, terminal_count, wait_states)
-                yield from wait_for_advance()
-                reset()
-                yield from wait_clk()
-
-            reset()
-            #if self.mode == "fetch":
-            yield from wait_clk()
-            while self.rst == 1:
+            def idle_bus():
+                self.dram.n_ras_a <<= 1
+                self.dram.n_ras_b <<= 1
+                self.dram.n_cas_0 <<= 1
+                self.dram.n_cas_1 <<= 1
+                self.dram.n_we <<= 1
+                self.dram.addr <<= None
+                self.dram.data_out <<= None
+                self.dram.data_out_en <<= 0
+                self.dram.n_nren <<= 1
+                self.dram.n_dack <<= 0xf
+                self.dram.tc <<= 0
+                self.dram.bus_en <<= 1
+
+            def ras_cycle(bank, row, accesses, low_time = cas_low, idle_time = 0):
+                """
+                accesses is a list of (col, lane, data) tuples; reads have data set to None.
+                idle_time is the number of cycles spent between CAS cycles (with RAS still asserted)
+                """
+                n_ras = self.dram.n_ras_b if bank else self.dram.n_ras_a
+                self.dram.addr <<= row
                 yield from wait_clk()
-            yield from read(0x1000e,True,1,0,0)
-            yield from write(0x10010,True,2,0,0)
-            for _ in range(20):
-                yield from wait_clk()
-            start_master(1)
-            yield from wait_for_advance()
-            for _ in range(40):
-                yield from wait_clk()
-            reset()
-            yield from wait_clk()
-
-            #    yield from read(0x12,True,1,3)
-            #    yield from read(0x24,True,3,3)
-            #    yield from read(0x3,False,0,1)
-            #    yield from read(0x4,False,0,2)
-            #    yield from wait_clk()
-            #    yield from wait_clk()
-            #    yield from wait_clk()
-            #    yield from wait_clk()
-            #    yield from read(0x34,True,0,2)
-            #    yield from read(0x4,False,0,3)
-            #elif self.mode == "mem":
-            #    yield from wait_clk()
-            #    while self.rst == 1:
-            #        yield from wait_clk()
-            #    yield from read(0x100e,False,0,3)
-
-    '''
-    class Checker(RvSimSink):
-        def construct(self, max_wait_state: int = 0):
-            super().construct(None, max_wait_state)
-            self.cnt = 0
-        def checker(self, value):
-            def get_next_inst():
-                inst = inst_stream.pop(0)
-                print(f"  --- inst:", end="")
-                for i in inst:
-                    print(f" {i:04x}", end="")
-                print("")
-                has_prefix = inst[0] & 0x0ff0 == 0x0ff0
-                if has_prefix:
-                    prefix = inst[0]
-                    inst = inst[1:]
-                else:
-                    prefix = None
-                inst_len = len(inst)-1
-                inst_code = 0
-                for idx, word in enumerate(inst):
-                    inst_code |= word << (16*idx)
-                return prefix, has_prefix, inst_code, inst_len
-
-            expected_prefix, expected_has_prefix, expected_inst_code, expected_inst_len = get_next_inst()
-            print(f"Received: ", end="")
-            if value.inst_bottom.has_prefix:
-                print(f" [{value.inst_bottom.prefix:04x}]", end="")
-            for i in range(value.inst_bottom.inst_len+1):
-                print(f" {(value.inst_bottom.inst >> (16*i)) & 0xffff:04x}", end="")
-            if value.has_top:
-                print(f" top: {value.inst_top:04x}", end="")
-            print("")
-
-            assert expected_has_prefix == value.inst_bottom.has_prefix
-            assert not expected_has_prefix or expected_prefix == value.inst_bottom.prefix
-            assert expected_inst_len == value.inst_bottom.inst_len
-            inst_mask = (1 << (16*(expected_inst_len+1))) - 1
-            assert (expected_inst_code & inst_mask) == (value.inst_bottom.inst & inst_mask)
-            if value.has_top == 1:
-                expected_prefix, expected_has_prefix, expected_inst_code, expected_inst_len = get_next_inst()
-                assert not expected_has_prefix
-                assert expected_inst_len == 0
-                assert expected_inst_code == value.inst_top
-    '''
+                n_ras <<= 0
+                yield from wait_clk(ras_to_cas)
+                for col, lane, data in accesses:
+                    n_cas = self.dram.n_cas_1 if lane else self.dram.n_cas_0
+                    self.dram.addr <<= col
+                    self.dram.n_we <<= 0 if data is not None else 1
+                    self.dram.data_out <<= data
+                    self.dram.data_out_en <<= 1 if data is not None else 0
+                    yield from wait_clk()
+                    n_cas <<= 0
+                    yield from wait_clk(low_time)
+                    if data is None:
+                        actual = self.dram.data_in
+                        expected_data = get_expected(bank, row, col, lane)
+                        simulator.sim_assert(actual == expected_data, f"Read mismatch at bank {bank} row {row:03x} col {col:03x} lane {lane}: {actual}, expected {expected_data:02x}")
+                    else:
+                        expected[(bank, row, col, lane)] = data
+                    n_cas <<= 1
+                    self.dram.n_we <<= 1
+                    self.dram.data_out <<= None
+                    self.dram.data_out_en <<= 0
+                    yield from wait_clk(cas_high + idle_time)
+                n_ras <<= 1
+                self.dram.addr <<= None
+                yield from wait_clk(ras_high)
+
+            def refresh_cycle():
+                self.dram.n_ras_a <<= 0
+                self.dram.n_ras_b <<= 0
+                yield from wait_clk(ras_to_cas + cas_low)
+                self.dram.n_ras_a <<= 1
+                self.dram.n_ras_b <<= 1
+                yield from wait_clk(ras_high)
+
+            idle_bus()
+            yield from wait_rst()
+            yield from wait_clk(5)
+
+            # Write and read back a few bytes in both banks
+            writes = tuple((bank, row, randint(0, 511), randint(0, 1), randint(0, 255)) for bank, row in ((0, 5), (0, 5), (1, 9), (1, 9), (0, 6)))
+            for bank, row, col, lane, data in writes:
+                yield from ras_cycle(bank, row, ((col, lane, data), ))
+            for bank, row, col, lane, data in writes:
+                yield from ras_cycle(bank, row, ((col, lane, None), ))
+
+            # Open-row hits: a cycle to the same row doesn't re-activate it, unless a refresh closed it in the meantime
+            hits = 0
+            for i in range(4):
+                yield from ras_cycle(0, 0x123, ((0, 0, None), ))
+                activates = sdram.activates
+                refreshes = sdram.refreshes
+                yield from ras_cycle(0, 0x123, ((randint(0, 511), randint(0, 1), None), ))
+                # A new row in the other bank leaves this one open
+                yield from ras_cycle(1, 0x130 + i, ((0, 0, None), ))
+                yield from ras_cycle(0, 0x123, ((1, 1, None), ))
+                if sdram.refreshes == refreshes:
+                    simulator.sim_assert(sdram.activates == activates + 1, f"Open row got re-activated ({sdram.activates - activates} activates instead of 1)")
+                    hits += 1
+                # ... but a different row in the same bank needs an activation
+                activates = sdram.activates
+                yield from ras_cycle(0, 0x125, ((0, 0, None), ))
+                simulator.sim_assert(sdram.activates == activates + 1, "Row change didn't activate the new row")
+            simulator.sim_assert(hits > 0, "All open-row hit checks got interrupted by refresh")
+
+            # RAS-only refresh cycles are ignored
+            activates = sdram.activates
+            yield from refresh_cycle()
+            simulator.sim_assert(sdram.activates == activates, "RAS-only refresh cycle activated a row")
+
+            # Pre-fetch: while the bus is idle, the next word gets read; a hit on it only pre-fetches the one after
+            reads = sdram.reads
+            yield from ras_cycle(1, 0x33, (
+                (0x40, 0, None), # demand read of word 0x20, pre-fetch of 0x21
+                (0x41, 1, None), # hit on word 0x20: nothing to do
+                (0x42, 0, None), # hit on pre-fetched word 0x21: pre-fetch of 0x22
+                (0x43, 1, None),
+            ), idle_time = 20)
+            simulator.sim_assert(sdram.reads == reads + 3, f"Pre-fetch issued {sdram.reads - reads} SDRAM reads instead of 3")
+            # Sequential page-mode bursts are fast enough to only work from the buffers
+            yield from ras_cycle(1, 0x33, ((0x44, 0, None), ), idle_time = 20)
+            yield from ras_cycle(1, 0x33, tuple((col, lane, None) for col in range(0x45, 0x60) for lane in (0, 1)), low_time = cas_low_fast)
+
+            # Random traffic
+            for _ in range(30):
+                bank = randint(0, 1)
+                row = randint(0x40, 0x42)
+                col = randint(0, 511 - 4)
+                accesses = tuple((col + i, randint(0, 1), randint(0, 255) if randint(0, 3) == 0 else None) for i in range(randint(1, 4)))
+                yield from ras_cycle(bank, row, accesses)
+                if randint(0, 7) == 0:
+                    yield from refresh_cycle()
+                yield from wait_clk(randint(0, 20))
+
+            # Refresh rate: pulled-in refreshes are not allowed, postponed ones are limited (with one interval and
+            # one refresh worth of slack for the timer phase and a refresh in progress)
+            expected_refreshes = sdram.cycle // refresh_interval
+            simulator.sim_assert(sdram.refreshes <= expected_refreshes + 1, f"Too many refreshes ({sdram.refreshes} in {sdram.cycle} cycles)")
+            simulator.sim_assert(sdram.refreshes >= expected_refreshes - refresh_debt_limit - 1, f"Too few refreshes ({sdram.refreshes} in {sdram.cycle} cycles)")
+            simulator.log(f"SDRAM: {sdram.activates} activates, {sdram.reads} reads, {sdram.writes} writes, {sdram.refreshes} refreshes in {sdram.cycle} cycles")
+            self.done = True
 
     class top(Module):
         clk = ClkPort()
         rst = RstPort()
 
         def body(self):
-            seed(0)
-            fetch_req = Wire(BusIfRequestIf)
-            fetch_rsp = Wire(BusIfResponseIf)
-            fetch_generator = Generator()
-            fetch_generator.set_mode("fetch")
-            fetch_req <<= fetch_generator.request_port
-
-            mem_req = Wire(BusIfRequestIf)
-            mem_rsp = Wire(BusIfResponseIf)
-            mem_generator = Generator()
-            mem_generator.set_mode("mem")
-            mem_req <<= mem_generator.request_port
-
-            dma_req = Wire(BusIfDmaRequestIf)
-            dma_generator = DmaGenerator()
-            dma_req <<= dma_generator.request_port
-
-            csr_driver = CsrDriver()
-
-            dram_if = Wire(ExternalBusIf)
-            dram_sim = DRAM_sim()
-
-            dut = BusIf()
-
-            dut.fetch_request <<= fetch_req
-            fetch_rsp <<= dut.fetch_response
-            dut.mem_request <<= mem_req
-            dut.dma_request <<= dma_req
-            mem_rsp <<= dut.mem_response
-            dram_if <<= dut.dram
-            dram_sim.bus_if <<= dram_if
-            dut.reg_if <<= csr_driver.reg_if
+            self.dut = DramEmu(
+                cas_latency=cas_latency, t_rcd=t_rcd, t_rp=t_rp, t_rfc=t_rfc,
+                refresh_interval=refresh_interval, refresh_debt_limit=refresh_debt_limit
+            )
+            self.bus_driver = BusDriver()
+            self.sdram_model = SdramModel()
 
+            self.dut.dram <<= self.bus_driver.dram
+            self.sdram_model.sdram <<= self.dut.sdram
 
-        def simulate(self) -> TSimEvent:
+        def simulate(self, simulator: Simulator) -> TSimEvent:
             def clk() -> int:
                 yield 10
                 self.clk <<= ~self.clk & self.clk
@@ -961,7 +600,7 @@ def sim():
                 self.clk <<= ~self.clk
                 yield 0
 
-            print("Simulation started")
+            simulator.log("Simulation started")
 
             self.rst <<= 1
             self.clk <<= 1
@@ -970,21 +609,27 @@ def sim():
                 yield from clk()
             self.rst <<= 0
 
-            for i in range(150):
+            for i in range(cycles):
                 yield from clk()
+                if self.bus_driver.done:
+                    break
+            simulator.sim_assert(self.bus_driver.done, "Test didn't finish in time")
             now = yield 10
-            print(f"Done at {now}")
+            simulator.log(f"Done at {now}")
 
-    Build.simulation(top, "bus_if.vcd", add_unnamed_scopes=True)
+    with Netlist().elaborate() as netlist:
+        top_inst = top()
+    netlist.simulate("dram_emu.vcd", add_unnamed_scopes=True)
+    return cycles
 
 
 def gen():
     def top():
-        return ScanWrapper(BusIf, {"clk", "rst"})
+        return ScanWrapper(DramEmu, {"clk", "rst"})
 
-    netlist = Build.generate_rtl(top, "bus_if.sv")
+    netlist = Build.generate_rtl(top, "dram_emu.sv")
     top_level_name = netlist.get_module_class_name(netlist.top_level)
-    flow = QuartusFlow(target_dir="q_bus_if", top_level=top_level_name, source_files=("bus_if.sv",), clocks=(("clk", 10), ("top_clk", 100)), project_name="bus_if")
+    flow = QuartusFlow(target_dir="q_dram_emu", top_level=top_level_name, source_files=("dram_emu.sv",), clocks=(("clk", 10), ("top_clk", 100)), project_name="dram_emu")
     flow.generate()
     flow.run()
 
@@ -244,6 +244,8 @@ class BranchUnitInputIf(Interface):
     f_overflow      = logic
     is_branch_insn  = logic
     woi             = logic
+    pred_taken      = logic # Fetch predicted this instruction to be taken (a return or a loop branch) and continued from pred_target
+    pred_target     = BrewInstAddr
 
 class BranchUnitOutputIf(Interface):
     spc                       = BrewInstAddr
@@ -350,7 +352,16 @@ class BranchUnit(Module):
         )
         self.output_port.task_mode  <<= self.input_port.task_mode ^ self.output_port.task_mode_changed
 
-        self.output_port.do_branch  <<= in_mode_branch | self.output_port.task_mode_changed
+        # If fetch already continued from the right address, there's no need to re-direct it. Predictions are only
+        # made for '$pc <- $rD' (returns) and conditional branches (loops), so the target is the same in both modes.
+        pred_correct = \
+            self.input_port.pred_taken & ~is_exception & in_mode_branch & \
+            (spc_branch_target == self.input_port.pred_target)
+        # If a predicted branch is not taken, fetch needs to be re-directed to the following instruction.
+        # xPC already points there: it was advanced when the branch entered stage 1.
+        pred_missed = self.input_port.pred_taken & ~in_mode_branch
+
+        self.output_port.do_branch  <<= (in_mode_branch & ~pred_correct) | pred_missed | self.output_port.task_mode_changed
 
         swi_exception = self.input_port.is_branch_insn & (self.input_port.opcode == branch_ops.swi)
         unknown_inst_exception <<= self.input_port.is_branch_insn & (self.input_port.opcode == branch_ops.unknown)
@@ -454,9 +465,11 @@ class ExecuteStage(GenericModule):
 
     complete = Output(logic) # goes high for 1 cycle when an instruction completes. Used for verification
 
-    def construct(self, has_multiply: bool = True, has_shift: bool = True):
+    def construct(self, has_multiply: bool = True, has_shift: bool = True, store_buffer_depth: int = 0, nram_base: int = 0):
         self.has_multiply = has_multiply
         self.has_shift = has_shift
+        self.store_buffer_depth = store_buffer_depth
+        self.nram_base = nram_base
 
     def body(self):
         # We have two stages in one, really here
@@ -474,16 +487,22 @@ class ExecuteStage(GenericModule):
 
         multi_cycle_exec_lockout = Reg(self.input_port.ready & self.input_port.valid & (self.input_port.exec_unit == op_class.mult) & ~self.input_port.fetch_av)
 
+        # A predicted-taken branch doesn't assert do_branch if the prediction was correct. Since xPC is
+        # only updated when the branch leaves stage 1, we can't let the next instruction in until then:
+        # it would pick up (and advance from) the address following the branch instead of the branch target.
+        s1_pred_taken = Wire(logic)
+        pred_lockout = stage_1_valid & s1_pred_taken
+
         stage_1_fsm = ForwardBufLogic()
         stage_1_fsm.clear <<= self.do_branch
-        stage_1_fsm.input_valid <<= ~multi_cycle_exec_lockout & ~s1_was_branch & ~self.do_branch & self.input_port.valid
+        stage_1_fsm.input_valid <<= ~multi_cycle_exec_lockout & ~pred_lockout & ~s1_was_branch & ~self.do_branch & self.input_port.valid
         # we 'bite out' a cycle for two-cycle units, such as multiply
-        self.input_port.ready <<= ~multi_cycle_exec_lockout & ~s1_was_branch  & stage_1_fsm.input_ready
+        self.input_port.ready <<= ~multi_cycle_exec_lockout & ~pred_lockout & ~s1_was_branch  & stage_1_fsm.input_ready
         stage_1_valid <<= stage_1_fsm.output_valid
         stage_1_fsm.output_ready <<= stage_2_ready
 
         stage_1_reg_en = Wire(logic)
-        stage_1_reg_en <<= ~multi_cycle_exec_lockout & ~s1_was_branch  & stage_1_fsm.out_reg_en
+        stage_1_reg_en <<= ~multi_cycle_exec_lockout & ~pred_lockout & ~s1_was_branch  & stage_1_fsm.out_reg_en
 
         # ALU
         alu_output = Wire(AluOutputIf)
@@ -559,6 +578,8 @@ class ExecuteStage(GenericModule):
         s1_result_reg_addr = Reg(self.input_port.result_reg_addr, clock_en = stage_1_reg_en)
         s1_result_reg_addr_valid = Reg(self.input_port.result_reg_addr_valid, clock_en = stage_1_reg_en)
         s1_fetch_av = Reg(self.input_port.fetch_av, clock_en = stage_1_reg_en)
+        s1_pred_taken <<= Reg(self.input_port.pred_taken, clock_en = stage_1_reg_en)
+        s1_pred_target = Reg(self.input_port.pred_target, clock_en = stage_1_reg_en)
         s1_tpc = Reg(self.tpc_in, clock_en = stage_1_reg_en)
         s1_spc = Reg(self.spc_in, clock_en = stage_1_reg_en)
         s1_task_mode = Reg(self.task_mode_in, clock_en = stage_1_reg_en)
@@ -637,6 +658,8 @@ class ExecuteStage(GenericModule):
         branch_input.f_overflow      <<= s1_alu_output.f_overflow
         branch_input.is_branch_insn  <<= (s1_exec_unit == op_class.branch) | (s1_exec_unit == op_class.branch_ind)
         branch_input.woi             <<= s1_woi
+        branch_input.pred_taken      <<= s1_pred_taken
+        branch_input.pred_target     <<= s1_pred_target
 
         branch_unit.input_port <<= branch_input
         branch_output <<= branch_unit.output_port
@@ -650,7 +673,7 @@ class ExecuteStage(GenericModule):
         #do_branch
 
         # Memory unit
-        memory_unit = MemoryStage()
+        memory_unit = MemoryStage(store_buffer_depth=self.store_buffer_depth, nram_base=self.nram_base)
 
 
         mem_input.read_not_write <<= s1_is_ld_st & ((s1_ldst_op == ldst_ops.load) | (s1_ldst_op == ldst_ops.csr_load))
@@ -762,7 +785,46 @@ class ExecuteStage(GenericModule):
 
 
 
-def sim():
+def golden_results(op_a, op_b) -> Dict[Any, 'np.ndarray']:
+    """
+    Vectorised golden model of the execute stage.
+
+    Computes the expected ALU, shifter, multiplier and compare-branch results for
+    whole arrays of operands at once. Returns a dict, keyed by the operation
+    (an alu_ops, shifter_ops or branch_ops member or op_class.mult). Values are
+    uint32 arrays for results and bool arrays for branch decisions.
+    """
+    import numpy as np
+
+    a = np.asarray(op_a, dtype=np.uint32)
+    b = np.asarray(op_b, dtype=np.uint32)
+    signed_a = a.view(np.int32)
+    signed_b = b.view(np.int32)
+    shift_amount = b & 31
+
+    # NOTE: uint32 arithmetic wraps around, just like the HW does
+    return {
+        alu_ops.a_plus_b:  a + b,
+        alu_ops.a_minus_b: a - b,
+        alu_ops.a_and_b:   a & b,
+        alu_ops.a_or_b:    a | b,
+        alu_ops.a_xor_b:   a ^ b,
+
+        shifter_ops.shll:  a << shift_amount,
+        shifter_ops.shlr:  a >> shift_amount,
+        shifter_ops.shar:  (signed_a >> shift_amount.astype(np.int32)).view(np.uint32),
+
+        op_class.mult:     a * b,
+
+        branch_ops.cb_eq:  a == b,
+        branch_ops.cb_ne:  a != b,
+        branch_ops.cb_lts: signed_a < signed_b,
+        branch_ops.cb_ges: signed_a >= signed_b,
+        branch_ops.cb_lt:  a < b,
+        branch_ops.cb_ge:  a >= b,
+    }
+
+def sim(rng_seed: int = 0, random_vector_cnt: int = 100) -> int:
 
     def test(name, ref, act, fmt = None):
         if ref is not None and ref != act:
@@ -870,11 +932,13 @@ def sim():
         last_jump_type_input = Input(EnumNet(JumpType))
         this_jump_type_input = Input(EnumNet(JumpType))
 
-        def construct(self, result_queue, pc_result_queue, sideband_state, bus_req_queue):
+        def construct(self, result_queue, pc_result_queue, sideband_state, bus_req_queue, random_vectors):
             self.result_queue = result_queue
             self.pc_result_queue = pc_result_queue
             self.sideband_state = sideband_state
             self.bus_req_queue = bus_req_queue
+            self.random_vectors = random_vectors
+            self.done = False
 
         def simulate(self, simulator) -> TSimEvent:
             self.last_jump_type = DecodeEmulator.JumpType.Straight
@@ -909,6 +973,8 @@ def sim():
                     self.this_jump_type = DecodeEmulator.JumpType.Straight
                 self.this_jump_type_wire <<= self.this_jump_type
                 print(f"{simulator.now:4d} input transfer started")
+                self.output_port.pred_taken <<= 0
+                self.output_port.pred_target <<= None
                 self.output_port.valid <<= 1
                 yield from wait_clk()
                 assert self.output_port.ready.sim_value is not None
@@ -945,7 +1011,7 @@ def sim():
                     return f"{what:{fmt}}"
 
 
-            def send_rr_op(unit: op_class, op: alu_ops, op_a: int, op_b: int, op_c: int = None, *, result_reg = 0, result_reg_valid = True, fetch_av = False, inst_len = inst_len_16):
+            def send_rr_op(unit: op_class, op: alu_ops, op_a: int, op_b: int, op_c: int = None, *, result_reg = 0, result_reg_valid = True, fetch_av = False, inst_len = inst_len_16, expected: int = None):
                 self.output_port.exec_unit <<= unit
                 self.output_port.alu_op <<= op if unit == op_class.alu else None
                 self.output_port.shifter_op <<= op if unit == op_class.shift else None
@@ -965,7 +1031,10 @@ def sim():
                 self.output_port.fetch_av <<= 1 if fetch_av else 0
 
                 mask = 0xffffffff
-                if unit == op_class.alu:
+                if expected is not None:
+                    # Result is pre-computed by the golden model
+                    result = expected
+                elif unit == op_class.alu:
                     if op == alu_ops.a_plus_b:
                         result = (op_a + op_b) & mask
                     elif op == alu_ops.a_minus_b:
@@ -1040,12 +1109,12 @@ def sim():
                     self.pc_result_queue.append(PCResult())
                 yield from wait_for_transfer()
 
-            def send_alu_op(op: alu_ops, op_a: int, op_b: int, op_c: int = None, *, result_reg = 0, result_reg_valid = True, fetch_av = False, inst_len = inst_len_16):
-                yield from send_rr_op(op_class.alu, op, op_a, op_b, op_c, result_reg=result_reg, result_reg_valid=result_reg_valid, fetch_av=fetch_av, inst_len=inst_len)
-            def send_shifter_op(op: shifter_ops, op_a: int, op_b: int, op_c: int = None, *, result_reg = 0, result_reg_valid = True, fetch_av = False, inst_len = inst_len_16):
-                yield from send_rr_op(op_class.shift, op, op_a, op_b, op_c, result_reg=result_reg, result_reg_valid=result_reg_valid, fetch_av=fetch_av, inst_len=inst_len)
-            def send_mult_op(op_a: int, op_b: int, op_c: int = None, *, result_reg = 0, result_reg_valid = True, fetch_av = False, inst_len = inst_len_16):
-                yield from send_rr_op(op_class.mult, None, op_a, op_b, op_c, result_reg=result_reg, result_reg_valid=result_reg_valid, fetch_av=fetch_av, inst_len=inst_len)
+            def send_alu_op(op: alu_ops, op_a: int, op_b: int, op_c: int = None, *, result_reg = 0, result_reg_valid = True, fetch_av = False, inst_len = inst_len_16, expected: int = None):
+                yield from send_rr_op(op_class.alu, op, op_a, op_b, op_c, result_reg=result_reg, result_reg_valid=result_reg_valid, fetch_av=fetch_av, inst_len=inst_len, expected=expected)
+            def send_shifter_op(op: shifter_ops, op_a: int, op_b: int, op_c: int = None, *, result_reg = 0, result_reg_valid = True, fetch_av = False, inst_len = inst_len_16, expected: int = None):
+                yield from send_rr_op(op_class.shift, op, op_a, op_b, op_c, result_reg=result_reg, result_reg_valid=result_reg_valid, fetch_av=fetch_av, inst_len=inst_len, expected=expected)
+            def send_mult_op(op_a: int, op_b: int, op_c: int = None, *, result_reg = 0, result_reg_valid = True, fetch_av = False, inst_len = inst_len_16, expected: int = None):
+                yield from send_rr_op(op_class.mult, None, op_a, op_b, op_c, result_reg=result_reg, result_reg_valid=result_reg_valid, fetch_av=fetch_av, inst_len=inst_len, expected=expected)
             def send_bubble():
                 self.output_port.exec_unit <<= None
                 self.output_port.alu_op <<= None
@@ -1067,7 +1136,7 @@ def sim():
                 self.output_port.valid <<= 0
                 yield from wait_clk()
 
-            def send_cbranch_op(op: branch_ops, op_a: int, op_b: int, op_c: int = None, *, fetch_av = False, inst_len = inst_len_16):
+            def send_cbranch_op(op: branch_ops, op_a: int, op_b: int, op_c: int = None, *, fetch_av = False, inst_len = inst_len_16, expected: bool = None):
                 self.output_port.exec_unit <<= op_class.branch
                 self.output_port.alu_op <<= alu_ops.a_minus_b
                 self.output_port.shifter_op <<= None
@@ -1170,6 +1239,9 @@ def sim():
                     else:
                         branch = False
 
+                if expected is not None:
+                    # Branch decision is pre-computed by the golden model
+                    branch = expected
                 next_pc = pc + inst_len + 1 if not branch else branch_target
                 if not is_exception:
                     next_spc = self.sideband_state.spc if     self.sideband_state.task_mode else next_pc
@@ -1403,14 +1475,17 @@ def sim():
             ### random ALU tests
             for i in range(5):
                 yield from send_bubble()
-            for i in range(100):
-                op_a = randint(0, 0xffffffff)
-                op_b = randint(0, 0xffffffff)
-                yield from send_alu_op(alu_ops.a_plus_b,    op_a, op_b)
-                yield from send_alu_op(alu_ops.a_minus_b,   op_a, op_b)
-                yield from send_alu_op(alu_ops.a_and_b,     op_a, op_b)
-                yield from send_alu_op(alu_ops.a_or_b,      op_a, op_b)
-                yield from send_alu_op(alu_ops.a_xor_b,     op_a, op_b)
+            # Stimuli and expected results are all pre-computed by the golden model; we only stream them here
+            op_a_vec, op_b_vec, expected_vec = self.random_vectors
+            for op_a, op_b, idx in zip(op_a_vec, op_b_vec, range(len(op_a_vec))):
+                for op in (alu_ops.a_plus_b, alu_ops.a_minus_b, alu_ops.a_and_b, alu_ops.a_or_b, alu_ops.a_xor_b):
+                    yield from send_alu_op(op, op_a, op_b, expected=expected_vec[op][idx])
+                for op in (shifter_ops.shll, shifter_ops.shlr, shifter_ops.shar):
+                    yield from send_shifter_op(op, op_a, op_b, expected=expected_vec[op][idx])
+                yield from send_mult_op(op_a, op_b, expected=expected_vec[op_class.mult][idx])
+                for op in (branch_ops.cb_eq, branch_ops.cb_ne, branch_ops.cb_lts, branch_ops.cb_ges, branch_ops.cb_lt, branch_ops.cb_ge):
+                    yield from send_cbranch_op(op, op_a, op_b, 0x1000, expected=expected_vec[op][idx])
+            self.done = True
 
     class PCChecker(GenericModule):
         clk = ClkPort()
@@ -1698,18 +1773,31 @@ def sim():
         rst = RstPort()
 
         def body(self):
-            seed(0)
+            import numpy as np
+
+            seed(rng_seed)
             bus_queue = BusIfQueue(3)
             bus_req_queue = []
             csr_queue = []
             result_queue = []
             pc_result_queue = []
+            self.bus_req_queue = bus_req_queue
+            self.result_queue = result_queue
+            self.pc_result_queue = pc_result_queue
 
+            # Generate random stimuli and the expected results for all of them in one go
+            rng = np.random.default_rng(rng_seed)
+            op_a_vec = rng.integers(0, 0xffffffff, size=random_vector_cnt, dtype=np.uint32, endpoint=True)
+            # Make sure the compare branches get a fair share of equal operands
+            op_b_vec = np.where(rng.random(random_vector_cnt) < 0.25, op_a_vec, rng.integers(0, 0xffffffff, size=random_vector_cnt, dtype=np.uint32, endpoint=True))
+            expected_vec = {op: result.tolist() for op, result in golden_results(op_a_vec, op_b_vec).items()}
+            random_vectors = (op_a_vec.tolist(), op_b_vec.tolist(), expected_vec)
 
             class SidebandState(object): pass
             sideband_state = SidebandState()
 
-            decode_emulator = DecodeEmulator(result_queue, pc_result_queue, sideband_state, bus_req_queue)
+            decode_emulator = DecodeEmulator(result_queue, pc_result_queue, sideband_state, bus_req_queue, random_vectors)
+            self.decode_emulator = decode_emulator
 
 
             last_jump_type_wire = decode_emulator.last_jump_type_wire
@@ -1770,12 +1858,29 @@ def sim():
                 yield from clk()
             self.rst <<= 0
 
-            for i in range(1000):
+            nonlocal cycles
+            cycles = 0
+            while not self.decode_emulator.done:
+                assert cycles < max_cycles, f"Stimulus didn't complete in {max_cycles} cycles"
+                yield from clk()
+                cycles += 1
+            # Let the last instructions drain through the pipeline
+            for i in range(drain_cycles):
                 yield from clk()
+                cycles += 1
+            assert len(self.result_queue) == 0, f"{len(self.result_queue)} expected results never showed up"
+            assert len(self.pc_result_queue) == 0, f"{len(self.pc_result_queue)} expected PC updates never showed up"
+            assert len(self.bus_req_queue) == 0, f"{len(self.bus_req_queue)} expected bus requests never showed up"
             now = yield 10
             print(f"Done at {now}")
 
+    # Directed tests take about 1000 cycles, each random vector is 15 instructions, some of them taking two cycles.
+    # This is only a safety net: the simulation stops once all stimulus is sent and the pipeline drained.
+    max_cycles = 2 * (1000 + random_vector_cnt * 15 * 2)
+    drain_cycles = 50
+    cycles = None
     Build.simulation(top, "execute.vcd", add_unnamed_scopes=True)
+    return cycles
 
 
 def gen():
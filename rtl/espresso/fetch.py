@@ -26,7 +26,9 @@ In V1, fetch works from a 16-bit read port: it gets (up to) 16-bits of data at a
 It constructs full instructions and supplies them to decode.
 
 We don't do any branch-prediction, or to be more precise, we're following
-straight-line execution, until told otherwise.
+straight-line execution, until told otherwise. The only exceptions are the
+(optional) return address stack, which predicts the target of returns and the
+(optional) loop buffer, which replays short loops to decode without re-fetching them.
 
 We don't support any prefix instructions or extension groups either.
 As such, the maximum instruction length is 48 bits and can always be decoded by looking
@@ -235,8 +237,14 @@ class InstBuffer(GenericModule):
 
         # We have to make sure that we only start a new burst if we know for sure the queue can take all the responses,
         # including all the outstanding ones.
+        # The AV state of the responses is captured at the beginning of the burst (see req_av below), so a burst with a
+        # different AV state (the first one over the limit) can't start until all responses of the previous one are in.
         # We need to delay out_of_page_branch to align with the request address, which is delayed
-        start_new_request = (self.queue_free_cnt > fetch_threshold + next_outstanding_request) | Reg(out_of_page_branch)
+        req_av = Wire(logic)
+        start_new_request = (
+            (self.queue_free_cnt > fetch_threshold + next_outstanding_request) &
+            ((fetch_av == req_av) | (next_outstanding_request == 0))
+        ) | Reg(out_of_page_branch)
 
         if self.use_break_burst:
             if self.break_on_branch_early:
@@ -277,7 +285,6 @@ class InstBuffer(GenericModule):
         )
         # We capture the AV state at the beginning of the burst. We will terminate the burst if the AV state changes.
         # This way, the AV state is the same within a burst.
-        req_av = Wire(logic)
         req_av <<= Reg(
             Select(
                 start_new_request,
@@ -487,7 +494,411 @@ class InstAssemble(Module):
         self.decode.inst_2 <<= inst_reg_2
         self.decode.inst_len <<= inst_len_reg
         self.decode.av <<= fetch_av
+        self.decode.pred_taken <<= 0
+        self.decode.pred_target <<= None
+
+
+
+# Multi-parcel variant of the queue and the assembler (selected by FetchStage's 'wide_fetch' generic)
+#
+# The queue is the same as InstQueue in that it is filled one 16-bit parcel at a time from the instruction buffer, but it
+# exposes a window of the first three parcels to the assembler. This is the idea of the (32-bit) FeDecode front-end,
+# adapted to the 16-bit fetch port of espresso: the assembler can consume a whole 32- or 48-bit instruction in a single
+# cycle, provided all parcels are already in the queue. This is the case whenever the pipeline is stalled while fetch
+# is running ahead, for instance during loads and stores.
+class FetchWindowIf(Interface):
+    data_0 = Unsigned(16)
+    data_1 = Unsigned(16)
+    data_2 = Unsigned(16)
+    av_0 = logic
+    av_1 = logic
+    av_2 = logic
+    count = Unsigned(2) # Number of valid parcels in the window (0...3)
+    pop = Reverse(Unsigned(2)) # Number of parcels consumed from the window (0...3)
+
+class InstWindowQueue(Module):
+    clk = ClkPort()
+    rst = RstPort()
+
+    # Interface towards instruction buffer
+    inst = Input(FetchQueueIf)
+    queue_free_cnt = Output(QueuePointerType)
+    # Interface towards fetch
+    assemble = Output(FetchWindowIf)
+
+    # Side-band interfaces
+    do_branch = Input(logic)
+
+    # Events
+    event_queue_flush = Output(QueuePointerType)
+
+    def body(self):
+        def wrap_ptr(ptr):
+            # fetch_queue_length is not a power of 2, so pointers need explicit wrapping
+            return truncate_queue_ptr(Select(ptr < fetch_queue_length, ptr - fetch_queue_length, ptr))
+
+        push = self.inst.valid & self.inst.ready
+        pop = self.assemble.pop
+
+        wr_ptr = Wire(QueuePointerType)
+        rd_ptr = Wire(QueuePointerType)
+        wr_ptr <<= Reg(Select(self.do_branch, wrap_ptr(wr_ptr + push), 0))
+        rd_ptr <<= Reg(Select(self.do_branch, wrap_ptr(rd_ptr + pop), 0))
+
+        data_regs = []
+        av_regs = []
+        for idx in range(fetch_queue_length):
+            write = push & (wr_ptr == idx)
+            data_regs.append(Reg(self.inst.data, clock_en=write))
+            av_regs.append(Reg(self.inst.av, clock_en=write))
+
+        empty_cnt = Wire(QueuePointerType)
+        empty_cnt <<= Reg(
+            Select(
+                self.do_branch,
+                truncate_queue_ptr(empty_cnt + pop - push),
+                fetch_queue_length
+            ),
+            reset_value_port = fetch_queue_length
+        )
+        used_cnt = QueuePointerType(fetch_queue_length - empty_cnt)
+        self.inst.ready <<= empty_cnt != 0
+        self.queue_free_cnt <<= empty_cnt
+
+        self.assemble.data_0 <<= Select(rd_ptr, *data_regs)
+        self.assemble.data_1 <<= Select(wrap_ptr(rd_ptr + 1), *data_regs)
+        self.assemble.data_2 <<= Select(wrap_ptr(rd_ptr + 2), *data_regs)
+        self.assemble.av_0 <<= Select(rd_ptr, *av_regs)
+        self.assemble.av_1 <<= Select(wrap_ptr(rd_ptr + 1), *av_regs)
+        self.assemble.av_2 <<= Select(wrap_ptr(rd_ptr + 2), *av_regs)
+        self.assemble.count <<= Select(used_cnt > 2, used_cnt[1:0], 3)
+
+        self.event_queue_flush <<= Select(self.do_branch, 0, used_cnt)
+
+class InstWindowAssemble(Module):
+    clk = ClkPort()
+    rst = RstPort()
+
+    inst_buf = Input(FetchWindowIf)
+    decode = Output(FetchDecodeIf)
+
+    do_branch = Input(logic)
+
+    # Events
+    event_words_dropped = Output(Unsigned(2))
+
+    def body(self):
+        @module(1)
+        def inst_len(inst_word):
+            """
+            Decodes and returns the instruction length:
+                0 -> 16 bits
+                1 -> 32 bits
+                2 -> 48 bits
+            """
+            multi_parcel_inst = \
+                (field_d(inst_word) == 0xf) | \
+                ((field_c(inst_word) == 0xf) & ((field_b(inst_word) != 0xf) | (field_a(inst_word) == 0xf))) | \
+                ((field_c(inst_word) == 0xe) & (field_a(inst_word) == 0xf)) | \
+                ((field_c(inst_word) < 0xc) & ((field_b(inst_word) == 0xf) | (field_a(inst_word) == 0xf)))
+
+            inst_32_bit = (field_d(inst_word) == 0xf) | (field_a(inst_word) != 0xf)
+
+            # 0 -> 16 bits, 1 -> 32 bits, 2 -> 48 bits
+            return concat(
+                multi_parcel_inst & ~inst_32_bit,
+                multi_parcel_inst &  inst_32_bit
+            )
+
+        head_len = inst_len(self.inst_buf.data_0)
+
+        # An instruction is complete if all its parcels are in the window. An AV on the first parcel
+        # terminates the instruction right away (decode will raise the exception), just as in InstAssemble.
+        complete = Select(
+            self.inst_buf.av_0,
+            self.inst_buf.count > head_len,
+            self.inst_buf.count != 0
+        )
+
+        out_valid = Wire(logic)
+        load = complete & (~out_valid | self.decode.ready) & ~self.do_branch
+        out_valid <<= Reg(Select(self.do_branch, Select(load, out_valid & ~self.decode.ready, 1), 0))
+
+        self.inst_buf.pop <<= Select(load, 0, Select(self.inst_buf.av_0, (head_len + 1)[1:0], 1))
+
+        inst_len_reg = Wire(Unsigned(2))
+        inst_len_reg <<= Reg(head_len, clock_en=load)
+        fetch_av = Reg(
+            self.inst_buf.av_0 |
+            (self.inst_buf.av_1 & (head_len != inst_len_16)) |
+            (self.inst_buf.av_2 & (head_len == inst_len_48)),
+            clock_en=load
+        )
+
+        self.event_words_dropped <<= Select(self.do_branch, 0, Select(out_valid, 0, Unsigned(2)(inst_len_reg + 1)))
+
+        # Filling the output data
+        self.decode.valid <<= out_valid & ~self.do_branch
+        self.decode.inst_0 <<= Reg(self.inst_buf.data_0, clock_en=load)
+        self.decode.inst_1 <<= Reg(self.inst_buf.data_1, clock_en=load)
+        self.decode.inst_2 <<= Reg(self.inst_buf.data_2, clock_en=load)
+        self.decode.inst_len <<= inst_len_reg
+        self.decode.av <<= fetch_av
+        self.decode.pred_taken <<= 0
+        self.decode.pred_target <<= None
+
+
+# Return address stack (selected by FetchStage's 'ras_depth' generic)
+#
+# The stack observes the instructions handed over to decode. It keeps track of the logical address of the next instruction
+# (re-loaded from $spc/$tpc on every do_branch) and pushes the link address for every call. For every '$pc <- $r14'
+# (the return idiom) it pops the top of the stack and, in the next cycle, redirects fetch to the predicted address, just as
+# if do_branch was asserted. The return itself is marked (pred_taken) and carries the predicted target (pred_target) towards
+# execute. If the prediction turns out to be correct, execute doesn't assert do_branch, otherwise the regular do_branch
+# path re-directs fetch to the right address.
+#
+# NOTE: The stack is updated speculatively: calls and returns that get cancelled in the shadow of a branch still modify it.
+#       The stack is not cleared on do_branch either. Both of these result in mispredictions only, which are recovered from.
+class ReturnStack(GenericModule):
+    clk = ClkPort()
+    rst = RstPort()
+
+    # Instructions handed over to decode
+    inst_valid = Input(logic)
+    inst_ready = Input(logic)
+    inst_0 = Input(Unsigned(16))
+    inst_len = Input(Unsigned(2))
+    inst_av = Input(logic)
+
+    # Prediction for the instruction currently handed over to decode
+    ras_hit = Output(logic)
+    ras_target = Output(BrewInstAddr)
+
+    # Fetch re-direction: active for one cycle, the cycle after a predicted return is handed over to decode
+    predict_branch = Output(logic)
+    predict_target = Output(BrewInstAddr)
+
+    # Side-band interfaces
+    spc  = Input(BrewInstAddr)
+    tpc  = Input(BrewInstAddr)
+    task_mode  = Input(logic)
+    do_branch = Input(logic)
+
+    def construct(self, depth: int = 4):
+        assert depth > 0
+        self.depth = depth
+
+    def body(self):
+        def truncate_addr(a):
+            return a[BrewInstAddr.get_length()-1:0]
+
+        PtrType = Unsigned(max((self.depth-1).bit_length(), 1))
+        CntType = Unsigned(self.depth.bit_length())
+
+        def wrap_ptr(ptr):
+            return PtrType(Select(ptr < self.depth, ptr - self.depth, ptr))
+
+        advance = self.inst_valid & self.inst_ready & ~self.do_branch
+
+        # 40ef: call VALUE; 40fe: call short VALUE; 4ee.: call MEM32[$rA]; 4fe.: call MEM32[$rA+FIELD_E]; 4fef: call MEM32[FIELD_E]
+        is_call = ~self.inst_av & (
+            (self.inst_0 == 0x40ef) |
+            (self.inst_0 == 0x40fe) |
+            (self.inst_0[15:4] == 0x4ee) |
+            (self.inst_0[15:4] == 0x4fe)
+        )
+        # e002: $pc <- $r14
+        is_return = ~self.inst_av & (self.inst_0 == 0xe002)
+
+        tos = Wire(PtrType)
+        cnt = Wire(CntType)
+        entries = []
+
+        # Logical address of the instruction handed over to decode
+        inst_pc = Wire(BrewInstAddr)
+        link_addr = truncate_addr(inst_pc + self.inst_len + 1)
+
+        hit = is_return & (cnt != 0)
+        push = advance & is_call
+        pop = advance & hit
+
+        push_ptr = wrap_ptr(tos + 1)
+        for idx in range(self.depth):
+            entries.append(Reg(link_addr, clock_en=push & (push_ptr == idx)))
+        top = Select(tos, *entries) if self.depth > 1 else entries[0]
+
+        tos <<= Reg(SelectOne(
+            push, push_ptr,
+            pop, wrap_ptr(tos + self.depth - 1),
+            default_port = tos
+        ))
+        # On overflow the oldest entry is overwritten, so the count saturates
+        cnt <<= Reg(SelectOne(
+            push, Select(cnt == self.depth, (cnt + 1)[CntType.get_length()-1:0], cnt),
+            pop, (cnt - 1)[CntType.get_length()-1:0],
+            default_port = cnt
+        ))
+
+        inst_pc <<= Reg(
+            Select(
+                self.do_branch,
+                Select(
+                    advance,
+                    inst_pc,
+                    Select(hit, link_addr, top)
+                ),
+                Select(self.task_mode, self.spc, self.tpc)
+            )
+        )
+
+        self.ras_hit <<= hit
+        self.ras_target <<= top
+
+        self.predict_branch <<= Reg(pop)
+        self.predict_target <<= Reg(top, clock_en=pop)
+
+
+# Loop buffer (selected by FetchStage's 'loop_buffer_depth' generic)
+#
+# The buffer records the instructions handed over to decode since the last re-direction of fetch. If a (32-bit) conditional
+# branch jumps back to the first recorded instruction, the recorded instructions form a short loop: the branch is handed over
+# as predicted-taken (pred_taken, pred_target) and from then on the loop body is replayed from the buffer. In the meantime the
+# assembler holds on to the instruction following the loop and fetch stops as soon as the queue fills up. If the prediction
+# is correct, execute doesn't assert do_branch, so the loop keeps going without a re-fetch. Anything that re-directs fetch -
+# the loop exiting, any other branch, an exception or an interrupt - ends the replay and starts a new recording.
+#
+# NOTE: The buffer sits in front of decode and not between decode and execute: the output of decode contains the register
+#       values (and decode makes the reservations for the results), none of which can be replayed from one iteration to the next.
+#       Decode doesn't change timing in a loop either way, what's saved is the fetch bandwidth and the re-fetch after every iteration.
+class LoopBuffer(GenericModule):
+    clk = ClkPort()
+    rst = RstPort()
+
+    # Instructions from the assembler
+    inst_valid = Input(logic)
+    inst_ready = Output(logic)
+    inst_0 = Input(Unsigned(16))
+    inst_1 = Input(Unsigned(16))
+    inst_2 = Input(Unsigned(16))
+    inst_len = Input(Unsigned(2))
+    inst_av = Input(logic)
+    inst_pred_taken = Input(logic)
+    inst_pred_target = Input(BrewInstAddr)
+
+    # Decode interface
+    decode = Output(FetchDecodeIf)
+
+    # Side-band interfaces
+    spc  = Input(BrewInstAddr)
+    tpc  = Input(BrewInstAddr)
+    task_mode  = Input(logic)
+    do_branch = Input(logic)
+
+    def construct(self, depth: int = 8):
+        assert depth > 0
+        self.depth = depth
+
+    def body(self):
+        def truncate_addr(a):
+            return a[BrewInstAddr.get_length()-1:0]
+
+        PtrType = Unsigned(max((self.depth-1).bit_length(), 1))
+        CntType = Unsigned(self.depth.bit_length())
+
+        replay = Wire(logic)
+        rec_valid = Wire(logic)
+        rec_cnt = Wire(CntType)
+        rec_start = Wire(BrewInstAddr)
+        loop_end = Wire(PtrType)
+        replay_ptr = Wire(PtrType)
+
+        self.inst_ready <<= self.decode.ready & ~replay
+        advance = self.inst_valid & self.inst_ready & ~self.do_branch
+        replay_advance = replay & self.decode.ready & ~self.do_branch
+
+        # Logical address of the instruction coming from the assembler
+        inst_pc = Wire(BrewInstAddr)
+        inst_pc <<= Reg(
+            Select(
+                self.do_branch,
+                Select(
+                    advance,
+                    inst_pc,
+                    truncate_addr(inst_pc + self.inst_len + 1)
+                ),
+                Select(self.task_mode, self.spc, self.tpc)
+            )
+        )
+
+        # f...: conditional branches (same as 'could_be_branch' in InstBuffer). The offset is in inst_1, with the sign in bit 0.
+        is_cbranch = ~self.inst_av & (self.inst_len == inst_len_32) & (self.inst_0[15:12] == 0xf) & (self.inst_0[11:8] != 0xf)
+        offset = concat(
+            self.inst_1[0], self.inst_1[0], self.inst_1[0], self.inst_1[0], self.inst_1[0], self.inst_1[0], self.inst_1[0], self.inst_1[0],
+            self.inst_1[0], self.inst_1[0], self.inst_1[0], self.inst_1[0], self.inst_1[0], self.inst_1[0], self.inst_1[0], self.inst_1[0],
+            self.inst_1[15:1]
+        )
+        branch_target = truncate_addr(inst_pc + offset)
+
+        rec_full = rec_cnt == self.depth
+        is_loop_branch = is_cbranch & rec_valid & ~rec_full & (branch_target == rec_start)
+        record = advance & rec_valid & ~rec_full
+        capture = advance & is_loop_branch
+
+        entries_0 = []
+        entries_1 = []
+        entries_2 = []
+        entries_len = []
+        for idx in range(self.depth):
+            rec_en = record & (rec_cnt == idx)
+            entries_0.append(Reg(self.inst_0, clock_en=rec_en))
+            entries_1.append(Reg(self.inst_1, clock_en=rec_en))
+            entries_2.append(Reg(self.inst_2, clock_en=rec_en))
+            entries_len.append(Reg(self.inst_len, clock_en=rec_en))
+
+        def replayed(entries):
+            return Select(replay_ptr, *entries) if self.depth > 1 else entries[0]
+
+        # Recording restarts on every re-direction. It's abandoned if the loop doesn't fit or contains a fetch exception.
+        rec_start <<= Reg(Select(self.task_mode, self.spc, self.tpc), clock_en=self.do_branch)
+        rec_cnt <<= Reg(
+            Select(
+                self.do_branch,
+                Select(record, rec_cnt, (rec_cnt + 1)[CntType.get_length()-1:0]),
+                0
+            )
+        )
+        rec_valid <<= Reg(
+            Select(
+                self.do_branch,
+                rec_valid & ~(advance & (self.inst_av | rec_full)),
+                1
+            )
+        )
+
+        replay <<= Reg(
+            Select(
+                self.do_branch,
+                replay | capture,
+                0
+            )
+        )
+        loop_end <<= Reg(rec_cnt[PtrType.get_length()-1:0], clock_en=capture)
+        replay_ptr <<= Reg(
+            Select(
+                self.do_branch | capture | (replay_advance & (replay_ptr == loop_end)),
+                Select(replay_advance, replay_ptr, (replay_ptr + 1)[PtrType.get_length()-1:0]),
+                0
+            )
+        )
 
+        self.decode.valid <<= Select(replay, self.inst_valid, ~self.do_branch)
+        self.decode.inst_0 <<= Select(replay, self.inst_0, replayed(entries_0))
+        self.decode.inst_1 <<= Select(replay, self.inst_1, replayed(entries_1))
+        self.decode.inst_2 <<= Select(replay, self.inst_2, replayed(entries_2))
+        self.decode.inst_len <<= Select(replay, self.inst_len, replayed(entries_len))
+        self.decode.av <<= Select(replay, self.inst_av, 0)
+        self.decode.pred_taken <<= Select(replay, self.inst_pred_taken | is_loop_branch, replay_ptr == loop_end)
+        self.decode.pred_target <<= Select(replay, Select(is_loop_branch, self.inst_pred_target, rec_start), rec_start)
 
 
 class FetchStage(GenericModule):
@@ -514,13 +925,20 @@ class FetchStage(GenericModule):
     event_fetch = Output(logic)
     event_dropped = Output()
 
-    def construct(self, page_bits: int):
+    def construct(self, page_bits: int, wide_fetch: bool = False, ras_depth: int = 0, loop_buffer_depth: int = 0):
         self.page_bits = page_bits
+        self.wide_fetch = wide_fetch
+        self.ras_depth = ras_depth
+        self.loop_buffer_depth = loop_buffer_depth
 
     def body(self):
         inst_buf = InstBuffer(page_bits=self.page_bits)
-        inst_queue = InstQueue()
-        inst_assemble = InstAssemble()
+        if self.wide_fetch:
+            inst_queue = InstWindowQueue()
+            inst_assemble = InstWindowAssemble()
+        else:
+            inst_queue = InstQueue()
+            inst_assemble = InstAssemble()
 
         self.bus_if_request <<= inst_buf.bus_if_request
         inst_buf.bus_if_response <<= self.bus_if_response
@@ -528,19 +946,79 @@ class FetchStage(GenericModule):
         inst_queue.inst <<= inst_buf.queue
         inst_buf.queue_free_cnt <<= inst_queue.queue_free_cnt
 
+        inst_assemble.inst_buf <<= inst_queue.assemble
+
+        # The instruction stream, as it leaves the assembler (and the return address stack)
+        inst_ready = Wire(logic)
+        inst_assemble.decode.ready <<= inst_ready
+
+        if self.ras_depth > 0:
+            ras = ReturnStack(depth=self.ras_depth)
+            ras.inst_valid <<= inst_assemble.decode.valid
+            ras.inst_ready <<= inst_ready
+            ras.inst_0 <<= inst_assemble.decode.inst_0
+            ras.inst_len <<= inst_assemble.decode.inst_len
+            ras.inst_av <<= inst_assemble.decode.av
+            ras.spc <<= self.spc
+            ras.tpc <<= self.tpc
+            ras.task_mode <<= self.task_mode
+            ras.do_branch <<= self.do_branch
+
+            pred_taken = ras.ras_hit
+            pred_target = ras.ras_target
+
+            # A predicted return re-directs fetch the same way do_branch would, except that task mode doesn't change.
+            # A real branch in the same cycle takes precedence.
+            predict_branch = ras.predict_branch & ~self.do_branch
+            fetch_branch = self.do_branch | predict_branch
+            branch_spc = Select(predict_branch, self.spc, ras.predict_target)
+            branch_tpc = Select(predict_branch, self.tpc, ras.predict_target)
+        else:
+            pred_taken = 0
+            pred_target = None
+
+            fetch_branch = self.do_branch
+            branch_spc = self.spc
+            branch_tpc = self.tpc
+
+        if self.loop_buffer_depth > 0:
+            loop_buf = LoopBuffer(depth=self.loop_buffer_depth)
+            loop_buf.inst_valid <<= inst_assemble.decode.valid
+            inst_ready <<= loop_buf.inst_ready
+            loop_buf.inst_0 <<= inst_assemble.decode.inst_0
+            loop_buf.inst_1 <<= inst_assemble.decode.inst_1
+            loop_buf.inst_2 <<= inst_assemble.decode.inst_2
+            loop_buf.inst_len <<= inst_assemble.decode.inst_len
+            loop_buf.inst_av <<= inst_assemble.decode.av
+            loop_buf.inst_pred_taken <<= pred_taken
+            loop_buf.inst_pred_target <<= pred_target
+            loop_buf.spc <<= branch_spc
+            loop_buf.tpc <<= branch_tpc
+            loop_buf.task_mode <<= self.task_mode
+            loop_buf.do_branch <<= fetch_branch
+
+            self.decode <<= loop_buf.decode
+        else:
+            self.decode.valid <<= inst_assemble.decode.valid
+            inst_ready <<= self.decode.ready
+            self.decode.inst_0 <<= inst_assemble.decode.inst_0
+            self.decode.inst_1 <<= inst_assemble.decode.inst_1
+            self.decode.inst_2 <<= inst_assemble.decode.inst_2
+            self.decode.inst_len <<= inst_assemble.decode.inst_len
+            self.decode.av <<= inst_assemble.decode.av
+            self.decode.pred_taken <<= pred_taken
+            self.decode.pred_target <<= pred_target
+
         inst_buf.mem_base <<= self.mem_base
         inst_buf.mem_limit <<= self.mem_limit
-        inst_buf.spc <<= self.spc
-        inst_buf.tpc <<= self.tpc
+        inst_buf.spc <<= branch_spc
+        inst_buf.tpc <<= branch_tpc
         inst_buf.task_mode <<= self.task_mode
-        inst_buf.do_branch <<= self.do_branch
+        inst_buf.do_branch <<= fetch_branch
         inst_buf.break_burst <<= self.break_burst
 
-        inst_queue.do_branch <<= self.do_branch
-
-        inst_assemble.inst_buf <<= inst_queue.assemble
-        self.decode <<= inst_assemble.decode
-        inst_assemble.do_branch <<= self.do_branch
+        inst_queue.do_branch <<= fetch_branch
+        inst_assemble.do_branch <<= fetch_branch
 
         self.event_fetch <<= inst_buf.event_fetch
         self.event_dropped <<= inst_buf.event_drop + inst_queue.event_queue_flush + inst_assemble.event_words_dropped
@@ -667,7 +1145,7 @@ def sim():
 """
 
 
-def sim():
+def sim(rng_seed: int = 0, cycles: int = 50) -> int:
 
     class BusEmulator(Module):
         clk = ClkPort()
@@ -798,7 +1276,7 @@ def sim():
         rst = RstPort()
 
         def body(self):
-            seed(0)
+            seed(rng_seed)
 
             # Side-band interfaces
             self.mem_base = Wire(BrewMemBase)
@@ -859,12 +1337,298 @@ def sim():
                 yield from clk()
             self.rst <<= 0
 
-            for i in range(50):
+            for i in range(cycles):
                 yield from clk()
             now = yield 10
             print(f"Done at {now}")
 
     Build.simulation(top, "fetch.vcd", add_unnamed_scopes=True)
+    return cycles
+
+
+def sim2(rng_seed: int = 0, cycles: int = 4000, wide_fetch: bool = True) -> int:
+    """
+    Checked fetch bench: every instruction handed over to decode is compared against the memory image.
+
+    The image contains a random mix of 16-, 32- and 48-bit instructions. Fetch runs in task mode with a
+    varying mem_limit, and at every limit boundary an instruction straddles the boundary, so that
+    access violations show up on parcel 1 and 2 of multi-parcel instructions. Branches are issued at
+    random intervals, catching the assembler with partial instructions in its window, while both the
+    bus and decode apply random back-pressure.
+    """
+
+    def inst_len_of(word):
+        field_a = (word >>  0) & 0xf
+        field_b = (word >>  4) & 0xf
+        field_c = (word >>  8) & 0xf
+        field_d = (word >> 12) & 0xf
+        multi_parcel_inst = \
+            (field_d == 0xf) or \
+            ((field_c == 0xf) and ((field_b != 0xf) or (field_a == 0xf))) or \
+            ((field_c == 0xe) and (field_a == 0xf)) or \
+            ((field_c < 0xc) and ((field_b == 0xf) or (field_a == 0xf)))
+        inst_32_bit = (field_d == 0xf) or (field_a != 0xf)
+        if not multi_parcel_inst:
+            return inst_len_16
+        return inst_len_32 if inst_32_bit else inst_len_48
+
+    def random_inst(inst_len):
+        head = randint(0, 0xffff)
+        while inst_len_of(head) != inst_len:
+            head = randint(0, 0xffff)
+        return [head] + [randint(0, 0xffff) for _ in range(inst_len)]
+
+    seed(rng_seed)
+
+    # The limit granularity is 1kByte, that is 512 words. At each boundary an instruction straddles the limit:
+    # the key is the first word above the limit, the value is the instruction length and the index of the first AV parcel.
+    limit_words = 512
+    image_size = 4 * limit_words
+    image_mask = image_size - 1
+    straddlers = {
+        1 * limit_words: (inst_len_32, 1),
+        2 * limit_words: (inst_len_48, 2),
+        3 * limit_words: (inst_len_48, 1),
+    }
+    image = []
+    inst_starts = []
+    for boundary, (boundary_inst_len, av_parcel) in straddlers.items():
+        straddler_start = boundary - av_parcel
+        while len(image) < straddler_start:
+            inst_len = randint(inst_len_16, min(inst_len_48, straddler_start - len(image) - 1))
+            inst_starts.append(len(image))
+            image += random_inst(inst_len)
+        inst_starts.append(len(image))
+        image += random_inst(boundary_inst_len)
+    while len(image) < image_size:
+        inst_len = randint(inst_len_16, min(inst_len_48, image_size - len(image) - 1))
+        inst_starts.append(len(image))
+        image += random_inst(inst_len)
+    assert len(image) == image_size
+
+    def inst_start_before(boundary, inst_cnt):
+        return inst_starts[max(0, inst_starts.index(boundary - straddlers[boundary][1]) - inst_cnt)]
+
+    stats = {
+        "insts": 0,
+        "av_hits": set(),
+    }
+
+    class BusEmulator(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        bus_if_request = Input(BusIfRequestIf)
+        bus_if_response = Output(BusIfResponseIf)
+
+        def simulate(self, simulator: 'Simulator') -> TSimEvent:
+            delay_queue = [None, None, None]
+
+            def wait_clk():
+                yield (self.clk, )
+                while self.clk.get_sim_edge() != EdgeType.Positive:
+                    yield (self.clk, )
+
+            self.bus_if_request.ready <<= 0
+            self.bus_if_response.valid <<= 0
+            self.bus_if_response.data <<= None
+
+            while True:
+                yield from wait_clk()
+
+                if self.rst == 1:
+                    self.bus_if_request.ready <<= 0
+                    self.bus_if_response.valid <<= 0
+                    self.bus_if_response.data <<= None
+                    delay_queue = [None, None, None]
+                else:
+                    if self.bus_if_request.valid == 1 and self.bus_if_request.ready == 1:
+                        simulator.sim_assert(self.bus_if_request.read_not_write == 1, "Fetch should only read")
+                        simulator.sim_assert(self.bus_if_request.byte_en == 3, "Fetch should only do 16-bit reads")
+                        delay_queue[-1] = image[self.bus_if_request.addr.sim_value.value & image_mask]
+                    if delay_queue[0] is not None:
+                        self.bus_if_response.data <<= delay_queue[0]
+                        self.bus_if_response.valid <<= 1
+                    else:
+                        self.bus_if_response.data <<= None
+                        self.bus_if_response.valid <<= 0
+                    delay_queue = delay_queue[1:] + [None, ]
+                    self.bus_if_request.ready <<= randint(0, 3) != 0
+
+    class DecodeChecker(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        from_fetch = Input(FetchDecodeIf)
+        tpc = Input(BrewInstAddr)
+        mem_limit = Input(BrewMemBase)
+        do_branch = Input(logic)
+
+        def simulate(self, simulator: 'Simulator') -> TSimEvent:
+            def wait_clk():
+                yield (self.clk, )
+                while self.clk.get_sim_edge() != EdgeType.Positive:
+                    yield (self.clk, )
+
+            # Address of the next expected instruction; None until the first branch and after an AV
+            pc = None
+            av_start = None
+
+            self.from_fetch.ready <<= 0
+            while True:
+                yield from wait_clk()
+
+                if self.rst == 1:
+                    self.from_fetch.ready <<= 0
+                    continue
+                if self.do_branch == 1:
+                    pc = self.tpc.sim_value.value
+                    av_start = (self.mem_limit.sim_value.value + 1) * limit_words
+                elif self.from_fetch.valid == 1 and self.from_fetch.ready == 1 and pc is not None:
+                    words = tuple(image[(pc + idx) & image_mask] for idx in range(3))
+                    actual = (self.from_fetch.inst_0.sim_value.value, self.from_fetch.inst_1.sim_value.value, self.from_fetch.inst_2.sim_value.value)
+                    inst_len = inst_len_of(words[0])
+                    av_parcels = tuple(idx for idx in range(inst_len + 1) if pc + idx >= av_start)
+                    stats["insts"] += 1
+                    if len(av_parcels) == 0:
+                        simulator.sim_assert(self.from_fetch.av == 0, f"Unexpected AV at {pc:x}")
+                        simulator.sim_assert(self.from_fetch.inst_len == inst_len, f"Instruction length mismatch at {pc:x}")
+                        for idx in range(inst_len + 1):
+                            simulator.sim_assert(actual[idx] == words[idx], f"Instruction parcel {idx} mismatch at {pc:x}: {actual[idx]:04x} instead of {words[idx]:04x}")
+                        pc += inst_len + 1
+                    else:
+                        # Parcels after the first AV are don't care and so is the rest of the stream: decode raises an exception
+                        # and execute will branch away
+                        av_parcel = av_parcels[0]
+                        simulator.sim_assert(self.from_fetch.av == 1, f"Missing AV at {pc:x} (parcel {av_parcel})")
+                        if av_parcel > 0:
+                            simulator.sim_assert(self.from_fetch.inst_len == inst_len, f"Instruction length mismatch at {pc:x}")
+                            for idx in range(av_parcel):
+                                simulator.sim_assert(actual[idx] == words[idx], f"Instruction parcel {idx} mismatch at {pc:x}: {actual[idx]:04x} instead of {words[idx]:04x}")
+                        stats["av_hits"].add((inst_len, av_parcel))
+                        pc = None
+                self.from_fetch.ready <<= randint(0, 3) != 0
+
+    class BranchGenerator(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        mem_base = Output(BrewMemBase)
+        mem_limit = Output(BrewMemBase)
+        spc  = Output(BrewInstAddr)
+        tpc  = Output(BrewInstAddr)
+        task_mode  = Output(logic)
+        do_branch = Output(logic)
+
+        def simulate(self, simulator: 'Simulator') -> TSimEvent:
+            self.done = False
+
+            def wait_clk(cnt = 1):
+                for _ in range(cnt):
+                    yield (self.clk, )
+                    while self.clk.get_sim_edge() != EdgeType.Positive:
+                        yield (self.clk, )
+
+            def branch(target, limit):
+                self.tpc <<= target
+                self.mem_limit <<= limit
+                self.do_branch <<= 1
+                yield from wait_clk()
+                self.do_branch <<= 0
+
+            self.mem_base <<= 0
+            self.mem_limit <<= 0x3ffff
+            self.spc <<= 0
+            self.tpc <<= 0
+            self.task_mode <<= 1
+            self.do_branch <<= 0
+
+            yield from wait_clk()
+            while self.rst == 1:
+                yield from wait_clk()
+
+            # Run into each of the straddling instructions
+            for boundary in straddlers.keys():
+                yield from branch(inst_start_before(boundary, randint(4, 12)), boundary // limit_words - 1)
+                yield from wait_clk(150)
+
+            # Random branches, a lot of them in the middle of multi-parcel instructions
+            for _ in range(cycles // 25):
+                if randint(0, 1) == 0:
+                    boundary = choice(tuple(straddlers.keys()))
+                    yield from branch(inst_start_before(boundary, randint(0, 6)), boundary // limit_words - 1)
+                else:
+                    yield from branch(choice(inst_starts), randint(0, 3))
+                yield from wait_clk(randint(0, 40))
+
+            self.done = True
+
+    class top(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        def body(self):
+            seed(rng_seed)
+
+            self.dut = FetchStage(page_bits=7, wide_fetch=wide_fetch)
+            self.checker = DecodeChecker()
+            self.bus_emulator = BusEmulator()
+            self.branch_generator = BranchGenerator()
+
+            self.bus_emulator.bus_if_request <<= self.dut.bus_if_request
+            self.dut.bus_if_response <<= self.bus_emulator.bus_if_response
+            self.checker.from_fetch <<= self.dut.decode
+
+            self.dut.mem_base <<= self.branch_generator.mem_base
+            self.dut.mem_limit <<= self.branch_generator.mem_limit
+            self.dut.spc <<= self.branch_generator.spc
+            self.dut.tpc <<= self.branch_generator.tpc
+            self.dut.task_mode <<= self.branch_generator.task_mode
+            self.dut.do_branch <<= self.branch_generator.do_branch
+            self.dut.break_burst <<= 0
+
+            self.checker.tpc <<= self.branch_generator.tpc
+            self.checker.mem_limit <<= self.branch_generator.mem_limit
+            self.checker.do_branch <<= self.branch_generator.do_branch
+
+        def simulate(self, simulator: 'Simulator') -> TSimEvent:
+            def clk() -> int:
+                yield 10
+                self.clk <<= ~self.clk & self.clk
+                yield 10
+                self.clk <<= ~self.clk
+                yield 0
+
+            print("Simulation started")
+
+            self.rst <<= 1
+            self.clk <<= 1
+            yield 10
+            for i in range(5):
+                yield from clk()
+            self.rst <<= 0
+
+            for i in range(cycles * 4):
+                if getattr(self.branch_generator, "done", False):
+                    break
+                yield from clk()
+            simulator.sim_assert(getattr(self.branch_generator, "done", False), "Branch generator didn't finish")
+            for i in range(50):
+                yield from clk()
+            now = yield 10
+            simulator.sim_assert(stats["insts"] > 0, "No instructions were checked")
+            for inst_len, av_parcel in straddlers.values():
+                simulator.sim_assert((inst_len, av_parcel) in stats["av_hits"], f"AV on parcel {av_parcel} of a {16*(inst_len+1)}-bit instruction was never seen")
+            print(f"Done at {now}, {stats['insts']} instructions checked")
+
+    Build.simulation(top, "fetch_wide.vcd" if wide_fetch else "fetch_narrow.vcd", add_unnamed_scopes=True)
+    return cycles
+
+def sim3(rng_seed: int = 0, cycles: int = 4000) -> int:
+    """
+    Same as sim2(), but with the single-parcel queue and assembler
+    """
+    return sim2(rng_seed, cycles, wide_fetch=False)
 
 
 def gen():
@@ -26,6 +26,7 @@ except ImportError:
 
 from silicon import *
 from math import log2
+from random import *
 
 
 class Dram(GenericModule):
@@ -146,7 +147,22 @@ class Gpio(Module):
         self.data_out <<= Reg(Reg(self.input_pins))
 
 
-class ApbBridge(Module):
+class ApbBridgeWriteIf(ReadyValid):
+    addr = Unsigned(16)
+    data = BrewByte
+
+class ApbBridge(GenericModule):
+    """
+    Bridge between the external bus and the I/O APB bus.
+
+    Writes are posted into a write buffer: n_wait is released as soon as the write is accepted
+    into the buffer, so the CPU doesn't have to wait for the APB transfer to complete. Reads
+    wait until all posted writes have drained to the APB bus, so a read always observes the
+    effect of all the writes that preceded it.
+
+    If the buffer is full, writes wait for a free entry. With a 'write_buffer_depth' of 0, writes
+    are not posted: they hold n_wait low until the APB transfer completes, same as reads.
+    """
     clk = ClkPort()
     rst = RstPort()
 
@@ -160,29 +176,133 @@ class ApbBridge(Module):
     data_in = Input(BrewByte)
     data_out = Output(BrewByte)
 
+    def construct(self, write_buffer_depth: int = 4):
+        self.write_buffer_depth = write_buffer_depth
+
     def body(self):
-        self.apb_out.paddr <<= Reg(self.addr, clock_en=~self.n_ce)
-        self.apb_out.pwdata <<= Reg(self.data_in, clock_en=~self.n_ce)
-        self.apb_out.pwrite <<= Reg(~self.n_we, clock_en=~self.n_ce)
         apb_done = (self.apb_out.penable & self.apb_out.pready)
+        apb_idle = ~self.apb_out.psel
         served = Wire(logic)
+        access = ~self.n_ce & ~served
+
+        if self.write_buffer_depth > 0:
+            write_in = Wire(ApbBridgeWriteIf)
+            write_in.valid <<= access & ~self.n_we
+            write_in.addr <<= self.addr
+            write_in.data <<= self.data_in
+            write_out = Wire(ApbBridgeWriteIf)
+            write_out <<= Fifo(depth=self.write_buffer_depth)(write_in)
+            posted = write_in.valid & write_in.ready
+
+            # Posted writes have priority: reads only start once the buffer is empty
+            start_write = apb_idle & write_out.valid
+            start_read = apb_idle & ~write_out.valid & access & self.n_we
+            start = start_write | start_read
+            write_out.ready <<= apb_done & self.apb_out.pwrite
+
+            self.apb_out.paddr <<= Reg(Select(start_write, self.addr, write_out.addr), clock_en=start)
+            self.apb_out.pwdata <<= Reg(write_out.data, clock_en=start_write)
+            self.apb_out.pwrite <<= Reg(start_write, clock_en=start)
+            ack = posted | (apb_done & ~self.apb_out.pwrite)
+        else:
+            start = apb_idle & access
+            self.apb_out.paddr <<= Reg(self.addr, clock_en=start)
+            self.apb_out.pwdata <<= Reg(self.data_in, clock_en=start)
+            self.apb_out.pwrite <<= Reg(~self.n_we, clock_en=start)
+            ack = apb_done
+
         served <<= Reg(Select(
             self.n_ce,
-            apb_done | served,
+            ack | served,
             0
         ))
         self.apb_out.psel <<= Reg(Select(
             self.apb_out.psel,
-            ~self.n_ce & ~served,
+            start,
             ~apb_done
         ))
         self.apb_out.penable <<= Reg(Select(
             self.apb_out.penable,
-            self.apb_out.psel & ~served,
+            self.apb_out.psel,
             ~apb_done
         ))
         self.data_out <<= Select(apb_done, Reg(self.apb_out.prdata, clock_en=apb_done), self.apb_out.prdata)
-        self.n_wait <<= apb_done | self.n_ce | served
+        self.n_wait <<= ack | self.n_ce | served
+
+class ApbDmaBridge(GenericModule):
+    """
+    Turns DMA cycles for an APB peripheral into accesses to its data register.
+
+    APB peripherals can't take part in fly-by DMA cycles directly. Instead:
+    - on 'rx_channel' (I/O to memory), the data register is read as soon as nDACK is asserted. n_wait is
+      held low - combinationally from nDACK - until the read completes, after which the read data is
+      driven towards the DRAM for the rest of the cycle.
+    - on 'tx_channel' (memory to I/O), the DRAM data is captured while n_cas is asserted and written to
+      the data register after nDACK is de-asserted.
+
+    The bridge sits between the CPU-side APB master (apb_in) and the APB bus (apb_out). DMA accesses
+    only start while apb_in is idle. CPU accesses that start during a DMA access are held off (through
+    pready) until it completes and then get a fresh setup phase on apb_out.
+    """
+    clk = ClkPort()
+    rst = RstPort()
+
+    apb_in = Input(Apb8If)
+    apb_out = Output(Apb8If)
+
+    n_dack = Input()
+    n_cas = Input(logic)
+    n_wait = Output(logic)
+
+    data_in = Input(BrewByte)
+    data_out = Output(BrewByte)
+    rx_active = Output(logic)
+
+    def construct(self, rx_channel: int, tx_channel: int, data_addr: int):
+        self.rx_channel = rx_channel
+        self.tx_channel = tx_channel
+        self.data_addr = data_addr
+
+    def body(self):
+        rx_dack = ~self.n_dack[self.rx_channel]
+        tx_dack = ~self.n_dack[self.tx_channel]
+        prev_rx_dack = Reg(rx_dack)
+        prev_tx_dack = Reg(tx_dack)
+
+        dma_psel = Wire(logic)
+        dma_penable = Wire(logic)
+        dma_pwrite = Wire(logic)
+        dma_done = dma_psel & dma_penable & self.apb_out.pready
+        rx_done = dma_done & ~dma_pwrite
+        tx_done = dma_done & dma_pwrite
+
+        rx_pending = Wire(logic)
+        tx_pending = Wire(logic)
+        rx_data_valid = Wire(logic)
+        rx_pending <<= Reg((rx_pending & ~rx_done) | (rx_dack & ~prev_rx_dack))
+        tx_pending <<= Reg((tx_pending & ~tx_done) | (~tx_dack & prev_tx_dack))
+        rx_data_valid <<= Reg((rx_data_valid | rx_done) & rx_dack)
+
+        # RX has priority: the CPU is stalled until its read completes
+        start = ~dma_psel & (rx_pending | tx_pending) & ~self.apb_in.psel
+        dma_psel <<= Reg((dma_psel & ~dma_done) | start)
+        dma_penable <<= Reg(dma_psel & ~dma_done)
+        dma_pwrite <<= Reg(~rx_pending, clock_en=start)
+
+        tx_data = Reg(self.data_in, clock_en=tx_dack & ~self.n_cas)
+        self.data_out <<= Reg(self.apb_out.prdata, clock_en=rx_done)
+        self.rx_active <<= rx_dack
+        self.n_wait <<= ~rx_dack | rx_data_valid
+
+        # Give CPU accesses that got held off a setup phase before their enable phase
+        cpu_held = Reg(dma_psel)
+        self.apb_out.psel    <<= dma_psel | self.apb_in.psel
+        self.apb_out.penable <<= Select(dma_psel, self.apb_in.penable & ~cpu_held, dma_penable)
+        self.apb_out.pwrite  <<= Select(dma_psel, self.apb_in.pwrite, dma_pwrite)
+        self.apb_out.paddr   <<= Select(dma_psel, self.apb_in.paddr, self.data_addr)
+        self.apb_out.pwdata  <<= Select(dma_psel, self.apb_in.pwdata, tx_data)
+        self.apb_in.prdata   <<= self.apb_out.prdata
+        self.apb_in.pready   <<= self.apb_out.pready & ~dma_psel & ~cpu_held
 
 
 class Rom(GenericModule):
@@ -290,7 +410,13 @@ class FpgaSystem(GenericModule):
     gpio_size =     4096
     dram_base =     0x8000_0000
 
-    def construct(self, rom_content: str, *, dram_size: int = 128*1024, rom_size: int = 8*1024, dram0_content: str = None, dram1_content: str = None):
+    # If 'uart_dma_addr' is set, DMA cycles on these channels are turned into accesses to that
+    # address on the I/O APB bus (the data register of the UART) by an ApbDmaBridge
+    uart_rx_dma_channel = 0
+    uart_tx_dma_channel = 1
+
+    def construct(self, rom_content: str, *, dram_size: int = 128*1024, rom_size: int = 8*1024, dram0_content: str = None, dram1_content: str = None, uart_dma_addr: Optional[int] = None):
+        self.uart_dma_addr = uart_dma_addr
         self.rom_content = rom_content
         self.dram0_content = dram0_content
         self.dram1_content = dram1_content
@@ -335,11 +461,14 @@ class FpgaSystem(GenericModule):
             )
         )
 
-        self.brew_if.data_in <<= SelectOne(
+        bus_data_in = Wire(BrewByte)
+        bus_data_in <<= SelectOne(
             ~ext_if_n_ras_a & ~ext_if_n_cas_0, dram0.data_out,
             ~ext_if_n_ras_a & ~ext_if_n_cas_1, dram1.data_out,
             default_port = decode_input.data_in
         )
+        self.brew_if.data_in <<= bus_data_in
+        dram_data_in = Wire(BrewByte)
 
         # TODO: This should have blown up as both decode and the select above drives brew_if.data_in...
         #decode.brew_if <<= self.brew_if
@@ -356,22 +485,20 @@ class FpgaSystem(GenericModule):
         decode_input.tc            <<= ext_if_tc
         decode_input.bus_en        <<= ext_if_bus_en
 
-        self.brew_if.n_wait        <<= decode_input.n_wait
-
         decode.clk <<= self.clk2
         decode.brew_if <<= decode_input
 
         # We support 128kByte of DRAM.
         dram0.clk     <<= ~self.clk2
         dram0.addr    <<= self.brew_if.addr[dram_addr_width-1:0]
-        dram0.data_in <<= self.brew_if.data_out
+        dram0.data_in <<= dram_data_in
         dram0.n_ras   <<= self.brew_if.n_ras_a
         dram0.n_cas   <<= self.brew_if.n_cas_0
         dram0.n_we    <<= self.brew_if.n_we
 
         dram1.clk     <<= ~self.clk2
         dram1.addr    <<= self.brew_if.addr[dram_addr_width-1:0]
-        dram1.data_in <<= self.brew_if.data_out
+        dram1.data_in <<= dram_data_in
         dram1.n_ras   <<= self.brew_if.n_ras_a
         dram1.n_cas   <<= self.brew_if.n_cas_1
         dram1.n_we    <<= self.brew_if.n_we
@@ -418,7 +545,20 @@ class FpgaSystem(GenericModule):
         apb_bridge.data_in <<= ext_if_data_out_0
         decode.io_apb_data_in <<= apb_bridge.data_out
 
-        self.io_apb_if <<= apb_bridge.apb_out
+        if self.uart_dma_addr is not None:
+            uart_dma = ApbDmaBridge(rx_channel=self.uart_rx_dma_channel, tx_channel=self.uart_tx_dma_channel, data_addr=self.uart_dma_addr)
+            uart_dma.clk <<= self.clk2
+            uart_dma.apb_in <<= apb_bridge.apb_out
+            uart_dma.n_dack <<= self.brew_if.n_dack
+            uart_dma.n_cas <<= ext_if_n_cas_0 & ext_if_n_cas_1
+            uart_dma.data_in <<= bus_data_in
+            self.io_apb_if <<= uart_dma.apb_out
+            dram_data_in <<= Select(uart_dma.rx_active, self.brew_if.data_out, uart_dma.data_out)
+            self.brew_if.n_wait <<= Select(uart_dma.rx_active, decode_input.n_wait, uart_dma.n_wait)
+        else:
+            self.io_apb_if <<= apb_bridge.apb_out
+            dram_data_in <<= self.brew_if.data_out
+            self.brew_if.n_wait <<= decode_input.n_wait
 
 def sim():
 
@@ -744,6 +884,499 @@ def sim():
         top_inst = top_class()
     netlist.simulate(vcd_filename, add_unnamed_scopes=False)
 
+def sim2(rng_seed: int = 0, cycles: int = 2000, write_buffer_depth: int = 4) -> int:
+    """
+    Bench for ApbBridge: back-to-back writes followed by reads, then random traffic against an APB
+    register model with random wait states. It checks that
+
+    - transfers appear on APB in program order, with the right address and data;
+    - reads return the last value written, so they don't overtake posted writes;
+    - posted writes complete without wait states while the buffer has room, and the buffer never overfills;
+    - reads (and writes without a buffer) only complete together with their APB transfer.
+    """
+    expected_transfers = []
+    apb_regs = {}
+
+    def reset_value(addr):
+        return (addr ^ (addr >> 8)) & 0xff
+
+    class ApbSlave(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        apb_if = Input(Apb8If)
+
+        def simulate(self, simulator: Simulator) -> TSimEvent:
+            def wait_clk():
+                yield (self.clk, )
+                while self.clk.get_sim_edge() != EdgeType.Positive:
+                    yield (self.clk, )
+
+            self.apb_if.pready <<= 0
+            self.apb_if.prdata <<= None
+            while True:
+                yield from wait_clk()
+                if (self.apb_if.psel & self.apb_if.penable & self.apb_if.pready) == 1:
+                    simulator.sim_assert(len(expected_transfers) > 0, "Unexpected APB transfer")
+                    pwrite, paddr, pwdata = expected_transfers.pop(0)
+                    simulator.sim_assert(self.apb_if.pwrite == pwrite, f"APB transfer to {paddr:04x} has the wrong direction")
+                    simulator.sim_assert(self.apb_if.paddr == paddr, f"APB transfer to {self.apb_if.paddr:04x}, expected {paddr:04x}")
+                    if pwrite:
+                        simulator.sim_assert(self.apb_if.pwdata == pwdata, f"APB write to {paddr:04x} with {self.apb_if.pwdata:02x}, expected {pwdata:02x}")
+                        apb_regs[paddr] = pwdata
+                if self.apb_if.psel == 1:
+                    addr = int(self.apb_if.paddr)
+                    self.apb_if.prdata <<= apb_regs.get(addr, reset_value(addr))
+                else:
+                    self.apb_if.prdata <<= None
+                self.apb_if.pready <<= randint(0, 2) == 0
+
+    class Driver(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        n_ce = Output(logic)
+        n_we = Output(logic)
+        n_wait = Input(logic)
+        addr = Output(Unsigned(16))
+        data_out = Output(BrewByte)
+        data_in = Input(BrewByte)
+
+        # Observed APB completions
+        apb_done = Input(logic)
+        apb_pwrite = Input(logic)
+
+        def construct(self):
+            self.done = False
+            self.full_stalls = 0
+
+        def simulate(self, simulator: Simulator) -> TSimEvent:
+            regs = {}
+            writes_posted = 0
+            apb_writes_done = 0
+
+            def wait_clk():
+                nonlocal apb_writes_done
+                yield (self.clk, )
+                while self.clk.get_sim_edge() != EdgeType.Positive:
+                    yield (self.clk, )
+                if (self.apb_done & self.apb_pwrite) == 1:
+                    apb_writes_done += 1
+                if write_buffer_depth > 0:
+                    simulator.sim_assert(writes_posted - apb_writes_done <= write_buffer_depth, "Write buffer overfilled")
+
+            def wait_rst():
+                yield from wait_clk()
+                while self.rst == 1:
+                    yield from wait_clk()
+
+            def access(addr, value = None):
+                nonlocal writes_posted
+                is_write = value is not None
+                expected_transfers.append((is_write, addr, value))
+                buffer_has_room = writes_posted - apb_writes_done < write_buffer_depth
+                self.n_ce <<= 0
+                self.n_we <<= 0 if is_write else 1
+                self.addr <<= addr
+                self.data_out <<= value
+                wait_states = 0
+                yield from wait_clk()
+                while self.n_wait != 1:
+                    wait_states += 1
+                    yield from wait_clk()
+                if is_write and write_buffer_depth > 0:
+                    writes_posted += 1
+                    if buffer_has_room:
+                        simulator.sim_assert(wait_states == 0, f"Posted write to {addr:04x} took {wait_states} wait states")
+                    else:
+                        self.full_stalls += 1
+                else:
+                    simulator.sim_assert(self.apb_done == 1 and self.apb_pwrite == int(is_write), f"Access to {addr:04x} completed without its APB transfer")
+                if is_write:
+                    regs[addr] = value
+                else:
+                    expected = regs.get(addr, reset_value(addr))
+                    simulator.sim_assert(self.data_in == expected, f"Read from {addr:04x} returned {self.data_in}, expected {expected:02x}")
+                self.n_ce <<= 1
+                self.n_we <<= None
+                self.addr <<= None
+                self.data_out <<= None
+                yield from wait_clk()
+
+            self.n_ce <<= 1
+            yield from wait_rst()
+
+            # Back-to-back writes, enough to fill the buffer, then reads of the first and the last of them
+            addrs = list(range(0x10, 0x10 + write_buffer_depth + 2))
+            for addr in addrs:
+                yield from access(addr, randint(0, 0xff))
+            yield from access(addrs[0])
+            yield from access(addrs[-1])
+
+            # Random traffic on a few registers, so reads often follow writes of the same address
+            while not self.done:
+                addr = 0x20 + randint(0, 3)
+                if randint(0, 2) == 0:
+                    yield from access(addr)
+                else:
+                    yield from access(addr, randint(0, 0xff))
+                for _ in range(randint(0, 2)):
+                    yield from wait_clk()
+
+    class top(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        def body(self):
+            seed(rng_seed)
+
+            self.driver = Driver()
+            self.slave = ApbSlave()
+            dut = ApbBridge(write_buffer_depth=write_buffer_depth)
+
+            dut.n_ce <<= self.driver.n_ce
+            dut.n_we <<= self.driver.n_we
+            dut.addr <<= self.driver.addr
+            dut.data_in <<= self.driver.data_out
+            self.driver.n_wait <<= dut.n_wait
+            self.driver.data_in <<= dut.data_out
+            self.slave.apb_if <<= dut.apb_out
+            self.driver.apb_done <<= dut.apb_out.psel & dut.apb_out.penable & dut.apb_out.pready
+            self.driver.apb_pwrite <<= dut.apb_out.pwrite
+
+        def simulate(self, simulator: Simulator) -> TSimEvent:
+            def clk() -> int:
+                yield 10
+                self.clk <<= ~self.clk & self.clk
+                yield 10
+                self.clk <<= ~self.clk
+                yield 0
+
+            print("Simulation started")
+
+            self.rst <<= 1
+            self.clk <<= 1
+            yield 10
+            for i in range(5):
+                yield from clk()
+            self.rst <<= 0
+
+            for i in range(cycles):
+                yield from clk()
+            self.driver.done = True
+            for i in range(100):
+                yield from clk()
+            now = yield 10
+            print(f"Done at {now}")
+            assert len(expected_transfers) == 0, f"{len(expected_transfers)} APB transfers never happened"
+            if write_buffer_depth > 0:
+                assert self.driver.full_stalls > 0, "The write buffer never filled up"
+
+    Build.simulation(top, f"apb_bridge_{write_buffer_depth}.vcd", add_unnamed_scopes=True)
+    return cycles
+
+def sim3(rng_seed: int = 0, cycles: int = 2000) -> int:
+    return sim2(rng_seed, cycles, write_buffer_depth=0)
+
+def sim4(rng_seed: int = 0, cycles: int = 4000, char_cnt: int = 12) -> int:
+    """
+    Bench for the UART DMA path of FpgaSystem: BusIf and CpuDma drive the external bus of an FpgaSystem,
+    with an ApbUart - in loopback - on its I/O APB bus.
+
+    A TX DMA channel moves a buffer from DRAM into the UART, while an RX DMA channel moves the looped-back
+    characters into a second buffer. In the meantime the CPU side keeps reading and re-writing a UART
+    register through BusIf. It checks that
+
+    - the RX buffer ends up holding the TX buffer, so RX data is only driven towards the DRAM after its
+      APB read completed;
+    - the UART data register is written with the TX buffer and read once per character, nothing more;
+    - every APB transfer starts with a setup phase and its signals are stable until it completes, so DMA
+      and CPU-side transfers never get mixed up;
+    - CPU-side reads return the right value while DMA is running.
+    """
+    try:
+        from .bus_if import BusIf
+        from .cpu_dma import CpuDma
+        from .apb_uart import ApbUart, UartParityType, UartStopBits, UartWordSize
+    except ImportError:
+        from bus_if import BusIf
+        from cpu_dma import CpuDma
+        from apb_uart import ApbUart, UartParityType, UartStopBits, UartWordSize
+
+    seed(rng_seed)
+    tx_buf = 0x1000
+    rx_buf = 0x1100
+    tx_chars = tuple(randint(0, 0xff) for _ in range(char_cnt))
+    # The UART is the only device on the I/O APB bus; it decodes the bottom 4 address bits
+    uart_base = FpgaSystem.io_apb_base
+    uart_divider = 3
+    rx_ch = FpgaSystem.uart_rx_dma_channel
+    tx_ch = FpgaSystem.uart_tx_dma_channel
+    # Data register transfers on APB
+    data_reg_writes = []
+    data_reg_reads = []
+
+    class ApbMonitor(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        psel = Input(logic)
+        penable = Input(logic)
+        pwrite = Input(logic)
+        paddr = Input(Unsigned(4))
+        pwdata = Input(BrewByte)
+        prdata = Input(BrewByte)
+        pready = Input(logic)
+
+        def simulate(self, simulator: Simulator) -> TSimEvent:
+            def wait_clk():
+                yield (self.clk, )
+                while self.clk.get_sim_edge() != EdgeType.Positive:
+                    yield (self.clk, )
+
+            prev = None
+            while True:
+                yield from wait_clk()
+                if self.rst == 1:
+                    continue
+                if self.psel != 1:
+                    prev = None
+                    continue
+                transfer = (int(self.paddr), int(self.pwrite), int(self.pwdata) if self.pwrite == 1 else None)
+                if self.penable == 1:
+                    simulator.sim_assert(prev is not None, f"APB transfer to {transfer[0]:x} without a setup phase")
+                    simulator.sim_assert(prev == transfer, f"APB transfer changed from {prev} to {transfer} before completing")
+                    if self.pready == 1:
+                        if transfer[0] == ApbUart.data_buf_reg_ofs and transfer[1] == 1:
+                            data_reg_writes.append(transfer[2])
+                        elif transfer[0] == ApbUart.data_buf_reg_ofs:
+                            data_reg_reads.append(int(self.prdata))
+                        prev = None
+                        continue
+                else:
+                    simulator.sim_assert(prev is None, f"APB transfer {prev} lost its enable phase")
+                prev = transfer
+
+    class Driver(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        mem_request = Output(BusIfRequestIf)
+        mem_response = Input(BusIfResponseIf)
+        dma_reg_if = Output(CsrIf)
+        bus_if_reg_if = Output(CsrIf)
+
+        def construct(self):
+            self.dma_reg_if.paddr.set_net_type(Unsigned(5))
+            self.bus_if_reg_if.paddr.set_net_type(Unsigned(4))
+            self.done = False
+
+        def simulate(self, simulator: Simulator) -> TSimEvent:
+            def wait_clk():
+                yield (self.clk, )
+                while self.clk.get_sim_edge() != EdgeType.Positive:
+                    yield (self.clk, )
+
+            def wait_rst():
+                yield from wait_clk()
+                while self.rst == 1:
+                    yield from wait_clk()
+
+            def mem_access(addr, is_dram, value = None):
+                # Single byte access; 8-bit accesses to the high byte use the low byte of the data
+                self.mem_request.valid <<= 1
+                self.mem_request.read_not_write <<= value is None
+                self.mem_request.byte_en <<= 2 if addr & 1 else 1
+                self.mem_request.addr <<= (addr >> 1) | ((2 if is_dram else 0) << 25) | (1 << 27) # no wait-states
+                self.mem_request.data <<= value
+                yield from wait_clk()
+                while not (self.mem_request.ready & self.mem_request.valid):
+                    yield from wait_clk()
+                self.mem_request.valid <<= 0
+                self.mem_request.read_not_write <<= None
+                self.mem_request.byte_en <<= None
+                self.mem_request.addr <<= None
+                self.mem_request.data <<= None
+                if value is not None:
+                    return None
+                while self.mem_response.valid != 1:
+                    yield from wait_clk()
+                ret_val = int(self.mem_response.data) & 0xff
+                yield from wait_clk()
+                return ret_val
+
+            def write_uart(ofs, value):
+                yield from mem_access(uart_base + ofs, False, value)
+
+            def read_uart(ofs):
+                return (yield from mem_access(uart_base + ofs, False))
+
+            def write_dma_reg(addr, value):
+                self.dma_reg_if.psel <<= 1
+                self.dma_reg_if.penable <<= 0
+                self.dma_reg_if.pwrite <<= 1
+                self.dma_reg_if.paddr <<= addr
+                self.dma_reg_if.pwdata <<= value
+                yield from wait_clk()
+                self.dma_reg_if.penable <<= 1
+                yield from wait_clk()
+                while not self.dma_reg_if.pready:
+                    yield from wait_clk()
+                self.dma_reg_if.psel <<= 0
+                self.dma_reg_if.penable <<= None
+                self.dma_reg_if.pwrite <<= None
+                self.dma_reg_if.paddr <<= None
+                self.dma_reg_if.pwdata <<= None
+
+            def read_dma_reg(addr):
+                self.dma_reg_if.psel <<= 1
+                self.dma_reg_if.penable <<= 0
+                self.dma_reg_if.pwrite <<= 0
+                self.dma_reg_if.paddr <<= addr
+                self.dma_reg_if.pwdata <<= None
+                yield from wait_clk()
+                self.dma_reg_if.penable <<= 1
+                yield from wait_clk()
+                while not self.dma_reg_if.pready:
+                    yield from wait_clk()
+                ret_val = int(self.dma_reg_if.prdata)
+                self.dma_reg_if.psel <<= 0
+                self.dma_reg_if.penable <<= None
+                self.dma_reg_if.pwrite <<= None
+                self.dma_reg_if.paddr <<= None
+                return ret_val
+
+            def start_dma(ch, base, length, read_not_write):
+                # Burst mode, active-high request from the (synchronous) clk2 domain
+                config = (read_not_write << 1) | (1 << 5) | (1 << 6)
+                dma_addr = (1 << 28) | (2 << 26) # DRAM, no wait-states
+                yield from write_dma_reg(ch*4+2, config)
+                yield from write_dma_reg(ch*4+1, dma_addr | (base + length - 1))
+                yield from write_dma_reg(ch*4+0, dma_addr | base) # Writing the address activates the channel
+
+            self.mem_request.valid <<= 0
+            self.dma_reg_if.psel <<= 0
+            self.bus_if_reg_if.psel <<= 0
+            yield from wait_rst()
+
+            for idx, char in enumerate(tx_chars):
+                yield from mem_access(tx_buf + idx, True, char)
+            for idx in range(char_cnt):
+                yield from mem_access(rx_buf + idx, True, 0)
+
+            yield from write_uart(ApbUart.config1_reg_ofs, (UartParityType.none.value << 0) | (UartStopBits.one.value << 2) | (UartWordSize.bit8.value << 4))
+            yield from write_uart(ApbUart.config2_reg_ofs, (1 << 5) | (1 << 7)) # RX and TX enable
+            yield from write_uart(ApbUart.divider_reg_ofs, uart_divider)
+            yield from start_dma(rx_ch, rx_buf, char_cnt, False)
+            yield from start_dma(tx_ch, tx_buf, char_cnt, True)
+            yield from write_uart(ApbUart.fifo_ctrl_reg_ofs, (1 << 0) | (1 << 1)) # RX and TX DMA request enable
+
+            # CPU-side traffic to the UART while the DMA channels are active
+            while (yield from read_dma_reg(rx_ch*4+3)) & 1:
+                divider = yield from read_uart(ApbUart.divider_reg_ofs)
+                simulator.sim_assert(divider == uart_divider, f"UART divider read back as {divider}, expected {uart_divider}")
+                if randint(0, 1) == 0:
+                    yield from write_uart(ApbUart.divider_reg_ofs, uart_divider)
+                for _ in range(randint(0, 3)):
+                    yield from wait_clk()
+            simulator.sim_assert(((yield from read_dma_reg(tx_ch*4+3)) & 1) == 0, "TX DMA channel is still active")
+
+            for idx, char in enumerate(tx_chars):
+                rx_char = yield from mem_access(rx_buf + idx, True)
+                simulator.sim_assert(rx_char == char, f"RX buffer byte {idx} is {rx_char:02x}, expected {char:02x}")
+            simulator.sim_assert(data_reg_writes == list(tx_chars), f"UART data register writes {data_reg_writes} don't match the TX buffer")
+            simulator.sim_assert(data_reg_reads == list(tx_chars), f"UART data register reads {data_reg_reads} don't match the TX buffer")
+            self.done = True
+
+    class top(Module):
+        clk = ClkPort()
+        clk2 = ClkPort()
+        rst = RstPort()
+
+        def body(self):
+            self.driver = Driver()
+            bus_if = BusIf()
+            dma = CpuDma()
+            system = FpgaSystem(rom_content=None, uart_dma_addr=uart_base - FpgaSystem.io_apb_base + ApbUart.data_buf_reg_ofs)
+            uart = ApbUart()
+            monitor = ApbMonitor()
+
+            bus_if.fetch_request.valid <<= 0
+            bus_if.mem_request <<= self.driver.mem_request
+            self.driver.mem_response <<= bus_if.mem_response
+            bus_if.dma_request <<= dma.bus_req_if
+            dma.bus_rsp_if <<= bus_if.dma_response
+            bus_if.reg_if <<= self.driver.bus_if_reg_if
+            dma.reg_if <<= self.driver.dma_reg_if
+            dma.drq <<= concat("2'b0", uart.tx_drq, uart.rx_drq)
+
+            system.clk2 <<= self.clk2
+            system.brew_if <<= bus_if.dram
+            system.input_pins <<= 0
+            system.input_pins2 <<= 0
+            system.is_sim <<= 1
+
+            uart_bus = Wire(Apb8If)
+            uart_bus.paddr.set_net_type(Unsigned(4))
+            uart_bus.psel <<= system.io_apb_if.psel
+            uart_bus.penable <<= system.io_apb_if.penable
+            uart_bus.pwrite <<= system.io_apb_if.pwrite
+            uart_bus.paddr <<= system.io_apb_if.paddr[3:0]
+            uart_bus.pwdata <<= system.io_apb_if.pwdata
+            system.io_apb_if.prdata <<= uart_bus.prdata
+            system.io_apb_if.pready <<= uart_bus.pready
+            uart.clk <<= self.clk2
+            uart.bus_if <<= uart_bus
+            uart.rxd <<= uart.txd
+            uart.cts <<= 0
+
+            monitor.clk <<= self.clk2
+            monitor.psel <<= uart_bus.psel
+            monitor.penable <<= uart_bus.penable
+            monitor.pwrite <<= uart_bus.pwrite
+            monitor.paddr <<= uart_bus.paddr
+            monitor.pwdata <<= uart_bus.pwdata
+            monitor.prdata <<= uart_bus.prdata
+            monitor.pready <<= uart_bus.pready
+
+        def simulate(self, simulator: Simulator) -> TSimEvent:
+            clk_period = 100
+            clk_ratio = 5
+
+            clk_wait = clk_period // 2
+            clk2_wait = clk_wait // clk_ratio
+
+            def clk() -> int:
+                self.clk <<= 1
+                self.clk2 <<= 1
+                for _ in range(clk_ratio):
+                    yield clk2_wait
+                    self.clk2 <<= ~self.clk2
+                self.clk <<= ~self.clk
+                for _ in range(clk_ratio):
+                    yield clk2_wait
+                    self.clk2 <<= ~self.clk2
+
+            simulator.log("Simulation started")
+
+            self.rst <<= 1
+            self.clk <<= 1
+            yield 10
+            for i in range(5):
+                yield from clk()
+            self.rst <<= 0
+
+            for i in range(cycles):
+                yield from clk()
+                if self.driver.done:
+                    break
+            yield 10
+            simulator.sim_assert(self.driver.done, "Test didn't finish in time")
+            simulator.log("Done")
+
+    Build.simulation(top, "fpga_system_uart_dma.vcd", add_unnamed_scopes=True)
+    return cycles
+
 def gen():
     def top():
         return FpgaSystem
@@ -12,6 +12,7 @@ try:
     from .fpga_system import FpgaSystem
     from .brew_v1 import BrewV1Top
     from .assembler import *
+    from .semihost import Semihost
 except ImportError:
     from brew_types import *
     from scan import *
@@ -19,6 +20,7 @@ except ImportError:
     from fpga_system import FpgaSystem
     from brew_v1 import BrewV1Top
     from assembler import *
+    from semihost import Semihost
 
 from silicon import *
 
@@ -137,6 +139,9 @@ def sim(
     dram0_content: str = None,
     dram1_content: str = None
 ):
+    # The semihosting window overlaps GPIO2: the bus-cycles only change 'output_pins2', which is not used here
+    semihost_base = FpgaSystem.gpio2_base
+
     class top(Module):
         clk               = ClkPort()
         clk2              = ClkPort()
@@ -157,6 +162,11 @@ def sim(
             top.n_rst <<= self.n_rst
             top.input_pins <<= self.input_pins
             self.output_pins <<= top.output_pins
+            self.fpga_top = top
+
+            self.semihost = Semihost(base_addr=semihost_base)
+            self.semihost.clk <<= self.clk
+            self.semihost.rst <<= ~self.n_rst
 
         def simulate(self, simulator: Simulator) -> TSimEvent:
             clk_period = 100
@@ -176,6 +186,12 @@ def sim(
                     yield clk2_wait
                     self.clk2 <<= ~self.clk2
 
+            brew = first(self.fpga_top.get_inner_objects("brew"))
+            self.semihost.set_execute(first(first(brew.get_inner_objects("pipeline")).get_inner_objects("execute_stage")))
+            # The shadow memory of the semihosting device only knows about the generated program
+            if program_generator is not None:
+                self.semihost.program(get_all_segments())
+
             #self.program()
             simulator.log("Simulation started")
 
@@ -187,8 +203,11 @@ def sim(
             self.n_rst <<= 1
 
             for i in range(1000):
+                if self.semihost.terminated:
+                    break
                 yield from clk()
             yield 10
+            assert self.semihost.exit_code in (None, 0), f"Simulation terminated with exit code {self.semihost.exit_code}"
             simulator.log("Done")
 
     top_class = top
@@ -24,11 +24,149 @@ except ImportError:
 
 from silicon import *
 from os import makedirs
+from hashlib import sha256
+from time import perf_counter
+import ast
+import json
 
 target_dir="anacron_fpga"
 
 makedirs(target_dir, exist_ok=True)
 
+# Generation cache: for each output file we store a key (hash of all the inputs) and the hash of the generated file.
+# Every output has its own cache entry, so blocks can be generated in parallel.
+gen_cache_dir = Path(target_dir) / "gen_cache"
+
+def _file_hash(file_name: Union[str, Path]) -> str:
+    return sha256(Path(file_name).read_bytes()).hexdigest()
+
+def _local_sources(module_file: Union[str, Path]) -> Set[Path]:
+    """
+    Returns 'module_file' and all the modules from the same directory it (transitively) imports
+    """
+    module_file = Path(module_file).resolve()
+    base_dir = module_file.parent
+    sources = set()
+    to_scan = [module_file]
+    while len(to_scan) > 0:
+        source = to_scan.pop()
+        if source in sources:
+            continue
+        sources.add(source)
+        for node in ast.walk(ast.parse(source.read_text(), str(source))):
+            if isinstance(node, ast.ImportFrom):
+                names = (node.module, ) if node.module is not None else tuple(alias.name for alias in node.names)
+            elif isinstance(node, ast.Import):
+                names = tuple(alias.name for alias in node.names)
+            else:
+                continue
+            for name in names:
+                dep = base_dir / (name.replace(".", "/") + ".py")
+                if dep.exists():
+                    to_scan.append(dep.resolve())
+    return sources
+
+_silicon_version = None
+def silicon_version() -> str:
+    """
+    Returns the installed silicon version. For source checkouts, returns a hash of the sources instead.
+    """
+    global _silicon_version
+    if _silicon_version is None:
+        from importlib.metadata import version, PackageNotFoundError
+        try:
+            _silicon_version = version("silicon")
+        except PackageNotFoundError:
+            import silicon
+            hasher = sha256()
+            for source in sorted(Path(silicon.__file__).parent.rglob("*.py")):
+                hasher.update(source.read_bytes())
+            _silicon_version = hasher.hexdigest()
+    return _silicon_version
+
+def _load_gen_cache_entry(file_name: Union[str, Path]) -> Optional[Dict[str, str]]:
+    try:
+        with open(gen_cache_dir / f"{Path(file_name).name}.json", "rt") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def _save_gen_cache_entry(file_name: Union[str, Path], entry: Dict[str, str]):
+    makedirs(gen_cache_dir, exist_ok=True)
+    with open(gen_cache_dir / f"{Path(file_name).name}.json", "wt") as f:
+        json.dump(entry, f, indent=2, sort_keys=True)
+
+def _replace_if_changed(src: Path, dst: Path) -> bool:
+    """
+    Moves 'src' over 'dst' if their contents differ. Otherwise deletes 'src', leaving 'dst' (and its timestamp) alone.
+    """
+    if dst.exists() and _file_hash(src) == _file_hash(dst):
+        src.unlink()
+        return False
+    src.replace(dst)
+    return True
+
+def generate_incremental(
+    file_name: Union[str, Path],
+    top_class: type,
+    params: Dict[str, Any],
+    generator: Callable[[Path], str],
+    *,
+    data_files: Sequence[Union[str, Path]] = (),
+    force: bool = False
+) -> str:
+    """
+    Calls 'generator' to create 'file_name' in 'target_dir', unless none of its inputs changed since the last run.
+
+    The inputs are the Python source of 'top_class' (and all the local modules it depends on),
+    this file, the generic parameters in 'params', the content of 'data_files' and the silicon version.
+
+    If the output needs regenerating, but comes out identical to the old one, the old file is kept
+    with its timestamp, so downstream tools don't re-synthesize it.
+
+    Returns the top level module name, as returned by 'generator'.
+    """
+    out_file = Path(target_dir) / file_name
+    # Blocks, customized in this file are subclasses: find the module of the original class
+    this_file = Path(__file__).resolve()
+    sources = {this_file}
+    for cls in top_class.__mro__:
+        module_file = Path(sys.modules[cls.__module__].__file__).resolve()
+        if module_file != this_file:
+            sources |= _local_sources(module_file)
+            break
+    hasher = sha256()
+    for source in sorted(sources):
+        hasher.update(source.name.encode())
+        hasher.update(source.read_bytes())
+    hasher.update(repr(sorted(params.items())).encode())
+    for data_file in data_files:
+        hasher.update(Path(data_file).name.encode())
+        hasher.update(_file_hash(data_file).encode() if Path(data_file).exists() else b"missing")
+    hasher.update(silicon_version().encode())
+    key = hasher.hexdigest()
+
+    entry = _load_gen_cache_entry(file_name)
+    if not force and entry is not None and entry["key"] == key and out_file.exists() and _file_hash(out_file) == entry["output_hash"]:
+        print(f"{file_name} is up to date, skipping")
+        return entry["top_level_name"]
+
+    tmp_file = out_file.with_suffix(".tmp" + out_file.suffix)
+    start = perf_counter()
+    top_level_name = generator(tmp_file)
+    gen_time = perf_counter() - start
+    if _replace_if_changed(tmp_file, out_file):
+        print(f"{file_name} regenerated in {gen_time:.2f}s")
+    else:
+        print(f"{file_name} regenerated in {gen_time:.2f}s, but is unchanged")
+
+    _save_gen_cache_entry(file_name, {
+        "key": key,
+        "output_hash": _file_hash(out_file),
+        "top_level_name": top_level_name,
+    })
+    return top_level_name
+
 def create_back_end():
     back_end = SystemVerilog()
     back_end.support_unique_case = False
@@ -40,16 +178,19 @@ def generate_system(
     dram0_content: str = None,
     dram1_content: str = None,
     dram_size: int=128*1024,
-    rom_size: int=8*1024
+    rom_size: int=8*1024,
+    uart_dma_addr: Optional[int] = None
 ) :
     def copy_file(source: str) -> str:
         """
-        Copies the file 'source' to the destination folder (if exists) and returns it's name
+        Copies the file 'source' to the destination folder (if exists and changed) and returns it's name
         """
         from shutil import copyfile
-        dst_name = str(Path(target_dir) / Path(source).name)
+        from filecmp import cmp
+        dst_name = Path(target_dir) / Path(source).name
         try:
-            copyfile(source, dst_name)
+            if not dst_name.exists() or not cmp(source, dst_name, shallow=False):
+                copyfile(source, dst_name)
         except FileNotFoundError:
             pass
         return Path(source).name
@@ -64,54 +205,77 @@ def generate_system(
             dram0_content=dram0_content,
             dram1_content=dram1_content,
             dram_size=dram_size,
-            rom_size=rom_size
+            rom_size=rom_size,
+            uart_dma_addr=uart_dma_addr
         )
 
-    netlist = Build.generate_rtl(
-        top,
-        Path(target_dir) / file_name,
-        back_end=create_back_end(),
-        name_prefix = "fpga_system",
-        top_level_prefix = None
+    def generator(out_file: Path) -> str:
+        netlist = Build.generate_rtl(
+            top,
+            out_file,
+            back_end=create_back_end(),
+            name_prefix = "fpga_system",
+            top_level_prefix = None
+        )
+        return netlist.get_module_class_name(netlist.top_level)
+
+    return generate_incremental(
+        file_name,
+        FpgaSystem,
+        {
+            "rom_content": rom_content,
+            "dram0_content": dram0_content,
+            "dram1_content": dram1_content,
+            "dram_size": dram_size,
+            "rom_size": rom_size,
+            "uart_dma_addr": uart_dma_addr
+        },
+        generator,
+        data_files = tuple(Path(target_dir) / content for content in (rom_content, dram0_content, dram1_content) if content is not None)
     )
-    top_level_name = netlist.get_module_class_name(netlist.top_level)
-    return top_level_name
 
 def generate_brew(file_name: Union[str, Path]):
+    params = {
+        "nram_base":    0x0,
+        "has_multiply": True,
+        "has_shift":    True,
+        "page_bits":    7
+    }
+
     def top():
-        return BrewV1Top(
-            nram_base    = 0x0,
-            has_multiply = True,
-            has_shift    = True,
-            page_bits    = 7
+        return BrewV1Top(**params)
+
+    def generator(out_file: Path) -> str:
+        netlist = Build.generate_rtl(
+            top,
+            out_file,
+            back_end=create_back_end(),
+            name_prefix = "brew",
+            top_level_prefix = None
         )
+        return netlist.get_module_class_name(netlist.top_level)
 
-    netlist = Build.generate_rtl(
-        top,
-        Path(target_dir) / file_name,
-        back_end=create_back_end(),
-        name_prefix = "brew",
-        top_level_prefix = None
-    )
-    top_level_name = netlist.get_module_class_name(netlist.top_level)
-    return top_level_name
+    return generate_incremental(file_name, BrewV1Top, params, generator)
 
 def generate_uart(file_name: Union[str, Path]):
     class ApbUart(globals()["ApbUart"]):
-        def construct(self):
-            self.bus_if.paddr.set_net_type(Unsigned(3))
+        def construct(self, rx_fifo_depth: int = 16, tx_fifo_depth: int = 16):
+            super().construct(rx_fifo_depth, tx_fifo_depth)
+            self.bus_if.paddr.set_net_type(Unsigned(4))
 
     def top(): return ApbUart()
 
-    netlist = Build.generate_rtl(
-        top,
-        Path(target_dir) / file_name,
-        back_end=create_back_end(),
-        name_prefix = "apb_uart",
-        top_level_prefix = None
-    )
-    top_level_name = netlist.get_module_class_name(netlist.top_level)
-    return top_level_name
+    def generator(out_file: Path) -> str:
+        netlist = Build.generate_rtl(
+            top,
+            out_file,
+            back_end=create_back_end(),
+            name_prefix = "apb_uart",
+            top_level_prefix = None
+        )
+        return netlist.get_module_class_name(netlist.top_level)
+
+    return generate_incremental(file_name, ApbUart, {"paddr_bits": 4, "rx_fifo_depth": 16, "tx_fifo_depth": 16}, generator)
 
 def generate_gpio(file_name: Union[str, Path]):
     class ApbGpio(globals()["ApbGpio"]):
@@ -120,27 +284,87 @@ def generate_gpio(file_name: Union[str, Path]):
 
     def top(): return ApbGpio()
 
-    netlist = Build.generate_rtl(
-        top,
-        Path(target_dir) / file_name,
-        back_end=create_back_end(),
-        name_prefix = "apb_gpio",
-        top_level_prefix = None
-    )
-    top_level_name = netlist.get_module_class_name(netlist.top_level)
-    return top_level_name
-
+    def generator(out_file: Path) -> str:
+        netlist = Build.generate_rtl(
+            top,
+            out_file,
+            back_end=create_back_end(),
+            name_prefix = "apb_gpio",
+            top_level_prefix = None
+        )
+        return netlist.get_module_class_name(netlist.top_level)
+
+    return generate_incremental(file_name, ApbGpio, {"paddr_bits": 3}, generator)
+
+
+def _timed_call(func: Callable, args: Sequence, kwargs: Dict[str, Any]) -> Tuple[Any, float]:
+    start = perf_counter()
+    ret_val = func(*args, **kwargs)
+    return ret_val, perf_counter() - start
+
+def _unit_gen(module_name: str):
+    from importlib import import_module
+    return import_module(module_name).gen()
+
+def run_parallel(targets: Dict[str, Tuple[Callable, Sequence, Dict[str, Any]]], *, jobs: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Runs independent generation targets concurrently in a process pool.
+
+    'targets' maps a name to a (function, args, kwargs) tuple. Each target does its own,
+    full elaboration, so nothing is shared between them. Reports the time each target took
+    (elaboration and emit together, since that's what Build.generate_rtl does in a single call)
+    and returns the return values of all targets, by name.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    start = perf_counter()
+    results = {}
+    times = {}
+    failures = {}
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {name: pool.submit(_timed_call, func, args, kwargs) for name, (func, args, kwargs) in targets.items()}
+        for name, future in futures.items():
+            try:
+                results[name], times[name] = future.result()
+            except Exception as ex:
+                failures[name] = ex
+    total_time = perf_counter() - start
+
+    print("Generation times:")
+    for name in targets.keys():
+        if name in times:
+            print(f"    {name:<20} {times[name]:8.2f}s")
+        else:
+            print(f"    {name:<20}   FAILED: {failures[name]}")
+    print(f"    {'total (wall)':<20} {total_time:8.2f}s, sum of blocks: {sum(times.values()):.2f}s")
+    if len(failures) > 0:
+        raise next(iter(failures.values()))
+    return results
 
 def gen(
     *,
     rom_content: str,
     dram0_content: str = None,
-    dram1_content: str = None
+    dram1_content: str = None,
+    unit_targets: Sequence[str] = (),
+    jobs: Optional[int] = None
 ):
-    generate_brew("brew.sv")
-    generate_system("fpga_system.sv", rom_content=rom_content, dram0_content=dram0_content, dram1_content=dram1_content)
-    generate_uart("apb_uart.sv")
-    generate_gpio("apb_gpio.sv")
+    """
+    Generates all the blocks of the FPGA system in parallel.
+
+    Modules listed in 'unit_targets' (such as 'fetch' or 'decode') also get their own gen() called,
+    as part of the same parallel run.
+    """
+    # The UART sits on page 0 of the I/O APB bus in fpga_top.sv; its data register is serviced by DMA
+    targets = {
+        "brew.sv":        (generate_brew, ("brew.sv", ), {}),
+        "fpga_system.sv": (generate_system, ("fpga_system.sv", ), {"rom_content": rom_content, "dram0_content": dram0_content, "dram1_content": dram1_content, "uart_dma_addr": 0x0000}),
+        "apb_uart.sv":    (generate_uart, ("apb_uart.sv", ), {}),
+        "apb_gpio.sv":    (generate_gpio, ("apb_gpio.sv", ), {}),
+    }
+    for unit in unit_targets:
+        targets[f"{unit}.gen"] = (_unit_gen, (unit, ), {})
+    return run_parallel(targets, jobs=jobs)
 
 
 def gen_quartus_proj():
@@ -261,10 +485,13 @@ def gen_quartus_proj():
 
     flow.generate()
 
-gen(
-    rom_content="rom.mef",
-    dram0_content="dram.0.mef",
-    dram1_content="dram.1.mef"
-)
-#gen_quartus_proj()
+if __name__ == "__main__":
+    gen(
+        rom_content="rom.mef",
+        dram0_content="dram.0.mef",
+        dram1_content="dram.1.mef",
+        jobs=int(sys.argv[1]) if len(sys.argv) > 1 else None,
+        unit_targets=sys.argv[2:]
+    )
+    #gen_quartus_proj()
 
@@ -40,7 +40,7 @@ In other words, AV and unaligned exceptions are generated in a previous stage.
 
 """
 
-class MemoryStage(Module):
+class MemoryStage(GenericModule):
     clk = ClkPort()
     rst = RstPort()
 
@@ -57,6 +57,11 @@ class MemoryStage(Module):
     # Interface to the CSR registers
     csr_if = Output(CsrIf)
 
+    def construct(self, store_buffer_depth: int = 0, nram_base: int = 0):
+        assert store_buffer_depth == 0 or (store_buffer_depth >= 2 and (store_buffer_depth & (store_buffer_depth - 1)) == 0), "store buffer depth must be 0 or a power of 2"
+        self.store_buffer_depth = store_buffer_depth
+        self.nram_base = nram_base
+
     def body(self):
 
         '''
@@ -129,6 +134,14 @@ class MemoryStage(Module):
             OUT_data_h          ------------<=====>-------------------~---<=====>------
 
         '''
+        # With a store buffer, the logic below (the sequencer) is fed by the store buffer logic at the end
+        if self.store_buffer_depth == 0:
+            core_in = self.input_port
+            core_out = self.output_port
+        else:
+            core_in = Wire(MemInputIf)
+            core_out = Wire(MemOutputIf)
+
         def remember(interface, signal):
             return Select(interface.ready & interface.valid, Reg(signal, clock_en=interface.ready & interface.valid), signal)
 
@@ -136,21 +149,21 @@ class MemoryStage(Module):
 
         is_csr = Wire(logic)
 
-        input_advance = (self.input_port.ready & self.input_port.valid)
+        input_advance = (core_in.ready & core_in.valid)
         bus_request_advance = (self.bus_req_if.ready & self.bus_req_if.valid)
         bus_response_advance = self.bus_rsp_if.valid
-        output_advance = self.output_port.valid
+        output_advance = core_out.valid
 
         multi_cycle = Wire(logic)
-        multi_cycle <<= Reg((self.input_port.access_len == access_len_32) & ~is_csr, clock_en = input_advance)
+        multi_cycle <<= Reg((core_in.access_len == access_len_32) & ~is_csr, clock_en = input_advance)
         # Active is set for 32-bit transfers, until all requests are sent
         active = Wire(logic)
         next_active = Wire(logic)
-        next_active <<= Select((self.input_port.access_len == access_len_32) & ~is_csr & input_advance, Select(bus_request_advance, active, 0), 1)
+        next_active <<= Select((core_in.access_len == access_len_32) & ~is_csr & input_advance, Select(bus_request_advance, active, 0), 1)
         active <<= Reg(next_active)
         # Pending is set for 32-bit transfers, until the first response is back
         pending = Wire(logic)
-        pending <<= Reg(Select((self.input_port.access_len == access_len_32) & ~is_csr & input_advance & self.input_port.read_not_write, Select(bus_response_advance, pending, 0), 1))
+        pending <<= Reg(Select((core_in.access_len == access_len_32) & ~is_csr & input_advance & core_in.read_not_write, Select(bus_response_advance, pending, 0), 1))
         ##### # We need to delay pending by one cycle after the input is accepted due to the following reason:
         ##### # Response comes back a cycle *after* bus_if accepts the subsequent request. Because of that,
         ##### # if there are back-to-back reads, where the first is 8- or 16-bit long and the next one is 32-bit long,
@@ -168,12 +181,12 @@ class MemoryStage(Module):
         gap = Wire(logic)
         gap <<= Reg(
             Select(
-                ((self.input_port.access_len != access_len_32) & ~is_csr & input_advance) | (active & ~next_active),
+                ((core_in.access_len != access_len_32) & ~is_csr & input_advance) | (active & ~next_active),
                 0,
                 1
             )
         )
-        csr_select = self.input_port.is_csr
+        csr_select = core_in.is_csr
         is_csr <<= Select(
             input_advance,
             Reg(
@@ -187,17 +200,18 @@ class MemoryStage(Module):
         )
 
         csr_active = Wire()
-        self.input_port.ready <<= (self.bus_req_if.ready & ~active & ~gap) | (csr_select & self.input_port.valid & ~csr_active) # this is not ideal: we won't accept a CSR access if the bus is occupied. Yet, I don't think we should depend on is_dram here.
-        self.bus_req_if.valid <<= ((self.input_port.valid & ~csr_select) | active) & ~gap
-        self.output_port.valid <<= (self.bus_rsp_if.valid & ~pending) | (csr_pen & self.csr_if.pready & ~self.csr_if.pwrite)
+        # CSR accesses are only accepted once all beats of the previous bus request went out: accepting one changes the request registers
+        core_in.ready <<= (self.bus_req_if.ready & ~active & ~gap) | (csr_select & core_in.valid & ~csr_active & ~active & ~gap) # this is not ideal: we won't accept a CSR access if the bus is occupied. Yet, I don't think we should depend on is_dram here.
+        self.bus_req_if.valid <<= ((core_in.valid & ~csr_select) | active) & ~gap
+        core_out.valid <<= (self.bus_rsp_if.valid & ~pending) | (csr_pen & self.csr_if.pready & ~self.csr_if.pwrite)
 
-        first_addr = self.input_port.addr[BrewBusAddr.length:1]
+        first_addr = core_in.addr[BrewBusAddr.length:1]
         # We already have aligned addresses. As a result, LSB should be 0 for 32-bit accesses, so incrementing it is the same as setting LSB to 1.
         next_addr = Reg(first_addr | 1, clock_en=input_advance)
 
         byte_en = Wire(Unsigned(2))
-        byte_en[0] <<= (self.input_port.access_len != 0) | ~self.input_port.addr[0]
-        byte_en[1] <<= (self.input_port.access_len != 0) |  self.input_port.addr[0]
+        byte_en[0] <<= (core_in.access_len != 0) | ~core_in.addr[0]
+        byte_en[1] <<= (core_in.access_len != 0) |  core_in.addr[0]
 
         data_store = Wire(Unsigned(16)) # Stores high-word for writes, low-word reads
         data_store <<= Reg(
@@ -208,28 +222,151 @@ class MemoryStage(Module):
                     data_store,
                     self.bus_rsp_if.data
                 ),
-                self.input_port.data[31:16]
+                core_in.data[31:16]
             )
         )
 
-        self.bus_req_if.read_not_write  <<= remember(self.input_port, self.input_port.read_not_write)
-        self.bus_req_if.byte_en         <<= remember(self.input_port, byte_en)
+        self.bus_req_if.read_not_write  <<= remember(core_in, core_in.read_not_write)
+        self.bus_req_if.byte_en         <<= remember(core_in, byte_en)
         self.bus_req_if.addr            <<= Select(input_advance, next_addr, first_addr)
-        self.bus_req_if.data            <<= Select(input_advance, data_store, self.input_port.data[15:0])
+        self.bus_req_if.data            <<= Select(input_advance, data_store, core_in.data[15:0])
 
-        self.output_port.data_l <<= Select(csr_pen, Select(multi_cycle, self.bus_rsp_if.data, data_store), self.csr_if.prdata[15: 0])
-        self.output_port.data_h <<= Select(csr_pen, self.bus_rsp_if.data,                                  self.csr_if.prdata[31:16])
+        core_out.data_l <<= Select(csr_pen, Select(multi_cycle, self.bus_rsp_if.data, data_store), self.csr_if.prdata[15: 0])
+        core_out.data_h <<= Select(csr_pen, self.bus_rsp_if.data,                                  self.csr_if.prdata[31:16])
 
         csr_pen <<= Reg(Select(input_advance, Select(self.csr_if.pready & csr_pen, csr_pen, 0), is_csr))
         csr_active <<= Reg(self.csr_if.psel) # Active for an extra cycle, to allow the bus to return to idle
         self.csr_if.psel <<= input_advance & is_csr | csr_pen
         self.csr_if.penable <<= csr_pen
-        self.csr_if.pwrite <<= remember(self.input_port, ~self.input_port.read_not_write)
+        self.csr_if.pwrite <<= remember(core_in, ~core_in.read_not_write)
         # We maintain the LSB csr bit to retain the ability to define SCHEDULER-mode only CSRs
-        self.csr_if.paddr <<= remember(self.input_port, self.input_port.addr[BrewCsrAddrWidth+1:2])
-        self.csr_if.pwdata <<= remember(self.input_port, self.input_port.data)
+        self.csr_if.paddr <<= remember(core_in, core_in.addr[BrewCsrAddrWidth+1:2])
+        self.csr_if.pwdata <<= remember(core_in, core_in.data)
+
+        if self.store_buffer_depth == 0:
+            return
+
+        '''
+        Store buffer
 
-def sim():
+        Stores are accepted into the buffer right away (unless it's full), so execute doesn't have to wait for the
+        bus. The buffer is drained in order through the sequencer above, whenever it's not busy with a load.
+
+        Loads to DRAM with no address conflict go ahead of buffered stores. Loads that hit a single buffered
+        store that covers all of its bytes are served from the buffer. All other loads (including anything
+        outside DRAM space, which might be I/O) and all CSR accesses wait until the buffer is drained.
+
+        Forwarding only happens if there are no reads in flight, so responses are still returned in order.
+        '''
+        def any_of(signals):
+            result = signals[0]
+            for signal in signals[1:]:
+                result = result | signal
+            return result
+
+        def all_of(signals):
+            result = signals[0]
+            for signal in signals[1:]:
+                result = result & signal
+            return result
+
+        def lane_mask(addr, access_len):
+            return Select(
+                access_len,
+                Select(addr[1:0], 1, 2, 4, 8),
+                Select(addr[1], 3, 12),
+                15,
+                15
+            )
+
+        ptr_bits = (self.store_buffer_depth - 1).bit_length()
+        in_port = self.input_port
+        in_is_store = ~in_port.read_not_write & ~in_port.is_csr
+        in_is_load  =  in_port.read_not_write & ~in_port.is_csr
+        in_is_dram  = in_port.addr[27:26] != self.nram_base
+
+        sb_push = in_port.valid & in_port.ready & in_is_store
+        sb_pop = Wire(logic)
+        wr_ptr = Wire(Unsigned(ptr_bits))
+        rd_ptr = Wire(Unsigned(ptr_bits))
+        wr_ptr <<= Reg(Select(sb_push, wr_ptr, (wr_ptr + 1)[ptr_bits-1:0]))
+        rd_ptr <<= Reg(Select(sb_pop, rd_ptr, (rd_ptr + 1)[ptr_bits-1:0]))
+
+        sb_valid = []
+        sb_addr = []
+        sb_data = []
+        sb_len = []
+        for idx in range(self.store_buffer_depth):
+            write = sb_push & (wr_ptr == idx)
+            valid = Wire(logic)
+            valid <<= Reg(Select(write, valid & ~(sb_pop & (rd_ptr == idx)), 1))
+            sb_valid.append(valid)
+            sb_addr.append(Reg(in_port.addr, clock_en=write))
+            sb_data.append(Reg(in_port.data, clock_en=write))
+            sb_len.append(Reg(in_port.access_len, clock_en=write))
+        sb_empty = ~any_of(sb_valid)
+        sb_full = all_of(sb_valid)
+
+        # Forwarding: find the buffered stores to the same 32-bit word as the load
+        matches = tuple(valid & (addr[31:2] == in_port.addr[31:2]) for valid, addr in zip(sb_valid, sb_addr))
+        any_match = any_of(matches)
+        multi_match = any_of(tuple(matches[i] & matches[j] for i in range(len(matches)) for j in range(i+1, len(matches))))
+        fwd_mask = SelectOne(*(item for match, addr, access_len in zip(matches, sb_addr, sb_len) for item in (match, lane_mask(addr, access_len))))
+        fwd_lanes = SelectOne(*(item for match, addr, data in zip(matches, sb_addr, sb_data) for item in (match, Select(
+            addr[1:0],
+            data,
+            concat(data[23:0], "8'b0"),
+            concat(data[15:0], "16'b0"),
+            concat(data[7:0], "24'b0")
+        ))))
+        ld_mask = lane_mask(in_port.addr, in_port.access_len)
+
+        # Number of reads (bus or CSR) that are accepted by the sequencer, but didn't respond yet
+        outstanding = Wire(Unsigned(2))
+        core_read_accept = core_in.valid & core_in.ready & core_in.read_not_write
+        outstanding <<= Reg(SelectFirst(
+            core_read_accept & ~core_out.valid, (outstanding + 1)[1:0],
+            ~core_read_accept & core_out.valid, (outstanding - 1)[1:0],
+            default_port = outstanding
+        ))
+
+        fwd_hit = in_is_load & in_is_dram & any_match & ~multi_match & ((ld_mask & ~fwd_mask) == 0) & (outstanding == 0)
+        load_bypass = in_is_load & in_is_dram & ~any_match
+        # A CSR access right behind the last buffered store waits for the sequencer to finish with it
+        direct = in_port.valid & ~in_is_store & ~fwd_hit & (sb_empty | load_bypass) & (~in_port.is_csr | (~active & ~gap))
+
+        # Sequencer input: either the incoming request or the head of the store buffer
+        head_valid = Select(rd_ptr, *sb_valid)
+        core_in.valid          <<= Select(direct, head_valid, 1)
+        core_in.read_not_write <<= Select(direct, 0, in_port.read_not_write)
+        core_in.data           <<= Select(direct, Select(rd_ptr, *sb_data), in_port.data)
+        core_in.addr           <<= Select(direct, Select(rd_ptr, *sb_addr), in_port.addr)
+        core_in.is_csr         <<= Select(direct, 0, in_port.is_csr)
+        core_in.access_len     <<= Select(direct, Select(rd_ptr, *sb_len), in_port.access_len)
+        sb_pop <<= ~direct & head_valid & core_in.ready
+
+        in_port.ready <<= Select(
+            in_is_store,
+            fwd_hit | (direct & core_in.ready),
+            ~sb_full
+        )
+
+        fwd_advance = in_port.valid & fwd_hit
+        fwd_valid = Reg(fwd_advance)
+        fwd_data = Reg(Select(
+            in_port.addr[1:0],
+            fwd_lanes,
+            concat("8'b0", fwd_lanes[31:8]),
+            concat("16'b0", fwd_lanes[31:16]),
+            concat("24'b0", fwd_lanes[31:24])
+        ), clock_en=fwd_advance)
+
+        self.output_port.valid  <<= core_out.valid | fwd_valid
+        self.output_port.data_l <<= Select(fwd_valid, core_out.data_l, fwd_data[15:0])
+        self.output_port.data_h <<= Select(fwd_valid, core_out.data_h, fwd_data[31:16])
+
+
+def sim(rng_seed: int = 0, cycles: int = 100) -> int:
 
     class CsrQueueItem(object):
         def __init__(self, req: ApbBaseIf = None, *, pwrite = None, paddr = None, pwdata = None):
@@ -606,14 +743,14 @@ def sim():
             rsp_queue = []
             csr_queue = []
 
-            seed(0)
+            seed(rng_seed)
             stimulator = Stimulator(req_queue=req_queue, rsp_queue=rsp_queue, csr_queue=csr_queue)
             csr_emulator = CsrEmulator(csr_queue)
             bus_req_emulator = BusIfReqEmulator(bus_queue, expect_queue=req_queue)
             bus_rsp_emulator = BusIfRspEmulator(bus_queue)
             response_checker = ResponseChecker(queue=rsp_queue)
 
-            dut = MemoryStage()
+            dut = MemoryStage(store_buffer_depth=0)
 
             dut.input_port <<= stimulator.output_port
             response_checker.input_port <<= dut.output_port
@@ -639,12 +776,373 @@ def sim():
                 yield from clk()
             self.rst <<= 0
 
-            for i in range(100):
+            for i in range(cycles):
                 yield from clk()
             now = yield 10
             print(f"Done at {now}")
 
     Build.simulation(top, "memory.vcd", add_unnamed_scopes=True)
+    return cycles
+
+def sim2(rng_seed: int = 0, cycles: int = 3000, store_buffer_depth: int = 2) -> int:
+    """
+    Store buffer bench: random loads and stores, checked against a reference memory.
+
+    The stimulus is biased towards the cases the store buffer has to get right: loads that bypass
+    buffered stores, loads that are served from the buffer (including right behind an outstanding
+    read), loads that partially overlap buffered stores, and CSR or non-DRAM accesses, which have
+    to wait for the buffer to drain.
+    """
+
+    dram_base = 0x0800_0000
+    nram_base = 0x0000_0100
+
+    def initial_byte(addr):
+        return (addr * 37 + 11) & 0xff
+
+    def initial_csr(paddr):
+        return (0x5a000000 | (paddr * 0x010101)) & 0xffffffff
+
+    ref_mem = {} # Memory contents in program order
+    bus_mem = {} # Memory contents as written on the bus
+    ref_csrs = {}
+    bus_csrs = {}
+    stats = {
+        "store_beats_issued": 0,
+        "store_beats_written": 0,
+        "read_beats_issued": 0, # Bus reads the loads would need without a store buffer
+        "read_beats_seen": 0,
+        "loads_behind_stores": 0,
+        "done": False,
+    }
+    expected_writes = [] # (byte address, byte_en, data) of each store beat, in program order
+    expected_responses = [] # (data, mask) of each load, in program order
+    fences = [] # [store beats before the access, remaining beats] of each CSR and non-DRAM access, in program order
+
+    def is_dram(addr):
+        return ((addr >> 26) & 3) != 0
+
+    def check_fence(simulator, what):
+        simulator.sim_assert(len(fences) > 0, f"Unexpected {what}")
+        fence = fences[0]
+        simulator.sim_assert(stats["store_beats_written"] == fence[0], f"{what} before the store buffer drained ({stats['store_beats_written']} of {fence[0]} store beats written)")
+        fence[1] -= 1
+        if fence[1] == 0:
+            fences.pop(0)
+
+    class BusEmulator(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        request = Input(BusIfRequestIf)
+        response = Output(BusIfResponseIf)
+
+        def simulate(self, simulator: 'Simulator') -> TSimEvent:
+            def wait_clk():
+                yield (self.clk, )
+                while self.clk.get_sim_edge() != EdgeType.Positive:
+                    yield (self.clk, )
+
+            # Responses come back two cycles after the request is accepted
+            delay_queue = [None, None]
+
+            self.request.ready <<= 0
+            self.response.valid <<= 0
+            self.response.data <<= None
+            while True:
+                yield from wait_clk()
+
+                if self.rst == 1:
+                    self.request.ready <<= 0
+                    self.response.valid <<= 0
+                    self.response.data <<= None
+                    continue
+
+                if self.request.valid == 1 and self.request.ready == 1:
+                    addr = self.request.addr.sim_value.value << 1
+                    byte_en = self.request.byte_en.sim_value.value
+                    simulator.sim_assert(byte_en != 0, "Bus request without byte-enables")
+                    low = bus_mem.get(addr, initial_byte(addr))
+                    high = bus_mem.get(addr + 1, initial_byte(addr + 1))
+                    if self.request.read_not_write == 1:
+                        stats["read_beats_seen"] += 1
+                        if not is_dram(addr):
+                            check_fence(simulator, f"non-DRAM read from {addr:08x}")
+                        # 8-bit reads return the byte in the low byte
+                        delay_queue[-1] = (low, high, low | (high << 8))[byte_en - 1]
+                    else:
+                        data = self.request.data.sim_value.value
+                        simulator.sim_assert(len(expected_writes) > 0, f"Unexpected write to {addr:08x}")
+                        expected_addr, expected_byte_en, expected_data = expected_writes.pop(0)
+                        mask = 0xffff if byte_en == 3 else 0xff
+                        simulator.sim_assert(
+                            addr == expected_addr and byte_en == expected_byte_en and (data & mask) == expected_data,
+                            f"Write mismatch: {addr:08x} byte_en:{byte_en} data:{data:04x} (expected {expected_addr:08x} byte_en:{expected_byte_en} data:{expected_data:04x})"
+                        )
+                        # 8-bit writes to the high byte take their data from the low byte, just as in BusIf
+                        if byte_en & 1:
+                            bus_mem[addr] = data & 0xff
+                        if byte_en & 2:
+                            bus_mem[addr + 1] = (data >> 8) & 0xff if byte_en == 3 else data & 0xff
+                        stats["store_beats_written"] += 1
+
+                if delay_queue[0] is not None:
+                    self.response.valid <<= 1
+                    self.response.data <<= delay_queue[0]
+                else:
+                    self.response.valid <<= 0
+                    self.response.data <<= None
+                delay_queue = delay_queue[1:] + [None, ]
+                self.request.ready <<= randint(0, 3) != 0
+
+    class CsrEmulator(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        csr = Input(ApbIf)
+
+        def simulate(self, simulator: 'Simulator') -> TSimEvent:
+            def wait_clk():
+                yield (self.clk, )
+                while self.clk.get_sim_edge() != EdgeType.Positive:
+                    yield (self.clk, )
+
+            self.csr.pready <<= None
+            self.csr.prdata <<= None
+            while True:
+                yield from wait_clk()
+
+                if self.rst == 1 or self.csr.psel != 1:
+                    self.csr.pready <<= None
+                    self.csr.prdata <<= None
+                    continue
+                self.csr.pready <<= 1
+                if self.csr.penable == 0:
+                    paddr = self.csr.paddr.sim_value.value
+                    check_fence(simulator, f"CSR access to {paddr:03x}")
+                    if self.csr.pwrite == 1:
+                        bus_csrs[paddr] = self.csr.pwdata.sim_value.value
+                        self.csr.prdata <<= None
+                    else:
+                        self.csr.prdata <<= bus_csrs.get(paddr, initial_csr(paddr))
+
+    class ResponseChecker(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        input_port = Input(MemOutputIf)
+
+        def simulate(self, simulator: 'Simulator') -> TSimEvent:
+            def wait_clk():
+                yield (self.clk, )
+                while self.clk.get_sim_edge() != EdgeType.Positive:
+                    yield (self.clk, )
+
+            while True:
+                yield from wait_clk()
+                if self.rst == 0 and self.input_port.valid == 1:
+                    simulator.sim_assert(len(expected_responses) > 0, "Unexpected response")
+                    expected, mask = expected_responses.pop(0)
+                    data_l = self.input_port.data_l.sim_value
+                    data_h = self.input_port.data_h.sim_value
+                    actual = (data_l.value if data_l is not None else 0) | ((data_h.value if data_h is not None and mask > 0xffff else 0) << 16)
+                    simulator.sim_assert((actual & mask) == (expected & mask), f"Load data mismatch: {actual & mask:08x} instead of {expected & mask:08x}")
+
+    class Stimulator(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        output_port = Output(MemInputIf)
+
+        def simulate(self) -> TSimEvent:
+            self.cycle = 0
+
+            def wait_clk():
+                yield (self.clk, )
+                while self.clk.get_sim_edge() != EdgeType.Positive:
+                    yield (self.clk, )
+                self.cycle += 1
+
+            def present(read_not_write, addr, access_len, data=None, is_csr=False):
+                # All earlier accesses are accepted by now, so the reference model is up to date
+                size = 1 << access_len
+                beats = 2 if access_len == access_len_32 else 1
+                if is_csr:
+                    paddr = (addr >> 2) & 0xffff
+                    fences.append([stats["store_beats_issued"], 1])
+                    if read_not_write:
+                        expected_responses.append((ref_csrs.get(paddr, initial_csr(paddr)), 0xffffffff))
+                    else:
+                        ref_csrs[paddr] = data
+                elif read_not_write:
+                    if not is_dram(addr):
+                        fences.append([stats["store_beats_issued"], beats])
+                    if stats["store_beats_issued"] != stats["store_beats_written"]:
+                        stats["loads_behind_stores"] += 1
+                    stats["read_beats_issued"] += beats
+                    expected_responses.append((sum(ref_mem.get(addr + i, initial_byte(addr + i)) << (8*i) for i in range(size)), (1 << (8*size)) - 1))
+                else:
+                    for i in range(size):
+                        ref_mem[addr + i] = (data >> (8*i)) & 0xff
+                    if access_len == access_len_32:
+                        expected_writes.append((addr, 3, data & 0xffff))
+                        expected_writes.append((addr + 2, 3, (data >> 16) & 0xffff))
+                    elif access_len == access_len_16:
+                        expected_writes.append((addr, 3, data & 0xffff))
+                    else:
+                        expected_writes.append((addr & ~1, 1 << (addr & 1), data & 0xff))
+                    stats["store_beats_issued"] += beats
+
+                self.output_port.read_not_write <<= 1 if read_not_write else 0
+                self.output_port.data <<= data
+                self.output_port.addr <<= addr
+                self.output_port.is_csr <<= 1 if is_csr else 0
+                self.output_port.access_len <<= access_len
+                self.output_port.valid <<= 1
+                yield from wait_clk()
+                while (self.output_port.valid & self.output_port.ready) != 1:
+                    yield from wait_clk()
+                self.output_port.valid <<= 0
+                self.output_port.read_not_write <<= None
+                self.output_port.data <<= None
+                self.output_port.addr <<= None
+                self.output_port.is_csr <<= None
+                self.output_port.access_len <<= None
+
+            def random_addr(access_len, word=None, dram=True):
+                if word is None:
+                    word = randint(0, 7)
+                return (dram_base if dram else nram_base) + word * 4 + (randint(0, 3) & ~((1 << access_len) - 1))
+
+            def store(word=None, access_len=None, dram=True):
+                if access_len is None:
+                    access_len = randint(access_len_8, access_len_32)
+                yield from present(False, random_addr(access_len, word, dram), access_len, data=randint(0, 0xffffffff))
+
+            def load(word=None, access_len=None, dram=True):
+                if access_len is None:
+                    access_len = randint(access_len_8, access_len_32)
+                yield from present(True, random_addr(access_len, word, dram), access_len)
+
+            self.output_port.valid <<= 0
+            yield from wait_clk()
+            while self.rst == 1:
+                yield from wait_clk()
+
+            while self.cycle < cycles:
+                pattern = randint(0, 9)
+                word = randint(0, 7)
+                other_word = (word + randint(1, 7)) & 7
+                if pattern == 0:
+                    yield from store()
+                elif pattern == 1:
+                    yield from load()
+                elif pattern == 2:
+                    # Load bypassing buffered stores
+                    yield from store(word)
+                    yield from store(word)
+                    yield from load(other_word)
+                elif pattern == 3:
+                    # Load served from the buffer
+                    yield from store(word, access_len_32)
+                    yield from load(word)
+                elif pattern == 4:
+                    # Narrower store, followed by a load that might or might not be covered by it
+                    yield from store(word, randint(access_len_8, access_len_16))
+                    yield from load(word, randint(access_len_8, access_len_16))
+                elif pattern == 5:
+                    # Partial overlap and multiple matches: the load has to wait for the buffer to drain
+                    yield from store(word, access_len_8)
+                    if randint(0, 1) == 0:
+                        yield from store(word)
+                    yield from load(word, access_len_32)
+                elif pattern == 6:
+                    # Load hitting the buffer right behind a read that's still in flight
+                    yield from store(word, access_len_32)
+                    yield from load(other_word)
+                    yield from load(word)
+                elif pattern == 7:
+                    # CSR accesses behind buffered stores
+                    yield from store(word)
+                    csr_addr = randint(0, 3) * 4
+                    if randint(0, 1) == 0:
+                        yield from present(True, csr_addr, access_len_32, is_csr=True)
+                    else:
+                        yield from present(False, csr_addr, access_len_32, data=randint(0, 0xffffffff), is_csr=True)
+                elif pattern == 8:
+                    # Non-DRAM (potentially I/O) accesses behind buffered stores
+                    yield from store(word)
+                    if randint(0, 1) == 0:
+                        yield from load(randint(0, 3), dram=False)
+                    else:
+                        yield from store(randint(0, 3), dram=False)
+                        yield from load(randint(0, 3), dram=False)
+                else:
+                    for _ in range(randint(1, 4)):
+                        yield from wait_clk()
+            stats["done"] = True
+
+    class top(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        def body(self):
+            seed(rng_seed)
+
+            stimulator = Stimulator()
+            bus_emulator = BusEmulator()
+            csr_emulator = CsrEmulator()
+            response_checker = ResponseChecker()
+
+            dut = MemoryStage(store_buffer_depth=store_buffer_depth)
+
+            dut.input_port <<= stimulator.output_port
+            response_checker.input_port <<= dut.output_port
+            bus_emulator.request <<= dut.bus_req_if
+            dut.bus_rsp_if <<= bus_emulator.response
+            csr_emulator.csr <<= dut.csr_if
+
+        def simulate(self, simulator: 'Simulator') -> TSimEvent:
+            def clk() -> int:
+                yield 5
+                self.clk <<= ~self.clk & self.clk
+                yield 5
+                self.clk <<= ~self.clk
+                yield 0
+
+            print("Simulation started")
+
+            self.rst <<= 1
+            self.clk <<= 1
+            yield 10
+            for i in range(5):
+                yield from clk()
+            self.rst <<= 0
+
+            for i in range(cycles * 2):
+                if stats["done"]:
+                    break
+                yield from clk()
+            for i in range(20):
+                yield from clk()
+            now = yield 10
+            simulator.sim_assert(stats["done"], "Stimulus didn't finish")
+            simulator.sim_assert(len(expected_responses) == 0, f"{len(expected_responses)} load responses never arrived")
+            simulator.sim_assert(len(expected_writes) == 0, f"{len(expected_writes)} store beats never reached the bus")
+            simulator.sim_assert(len(fences) == 0, f"{len(fences)} CSR or non-DRAM accesses never happened")
+            if store_buffer_depth > 0:
+                simulator.sim_assert(stats["loads_behind_stores"] > 0, "No load was issued behind a buffered store")
+                simulator.sim_assert(stats["read_beats_seen"] < stats["read_beats_issued"], "No load was served from the store buffer")
+            print(f"Done at {now}, {stats['read_beats_issued'] - stats['read_beats_seen']} read beats served from the store buffer")
+
+    Build.simulation(top, f"memory_sb{store_buffer_depth}.vcd", add_unnamed_scopes=True)
+    return cycles
+
+def sim3(rng_seed: int = 0, cycles: int = 3000) -> int:
+    """
+    Same as sim2(), but without a store buffer
+    """
+    return sim2(rng_seed, cycles, store_buffer_depth=0)
 
 def gen():
     def top():
@@ -72,10 +72,19 @@ class Pipeline(GenericModule):
     event_fetch_drop        = Output()
     event_inst_word         = Output()
 
-    def construct(self, has_multiply: bool = True, has_shift: bool = True, page_bits: int = 7):
+    def construct(self, has_multiply: bool = True, has_shift: bool = True, page_bits: int = 7, wide_fetch: bool = False, ras_depth: int = 0, loop_buffer_depth: int = 0, store_buffer_depth: int = 0, nram_base: int = 0, shadow_bank: bool = False):
         self.has_multiply = has_multiply
         self.has_shift = has_shift
         self.page_bits = page_bits
+        self.wide_fetch = wide_fetch
+        self.ras_depth = ras_depth
+        self.loop_buffer_depth = loop_buffer_depth
+        self.store_buffer_depth = store_buffer_depth
+        self.nram_base = nram_base
+        self.shadow_bank = shadow_bank
+        if shadow_bank:
+            # CSR access to the TASK mode register bank
+            self.reg_bank_if = Input(CsrIf)
 
     def body(self):
         # Instruction pointers
@@ -93,11 +102,11 @@ class Pipeline(GenericModule):
         rf_write = Wire(RegFileWriteBackIf)
 
         # Stages
-        fetch_stage = FetchStage(page_bits=self.page_bits)
+        fetch_stage = FetchStage(page_bits=self.page_bits, wide_fetch=self.wide_fetch, ras_depth=self.ras_depth, loop_buffer_depth=self.loop_buffer_depth)
         decode_stage = DecodeStage(has_multiply=self.has_multiply, has_shift=self.has_multiply)
-        execute_stage = ExecuteStage(has_multiply=self.has_multiply, has_shift=self.has_multiply)
+        execute_stage = ExecuteStage(has_multiply=self.has_multiply, has_shift=self.has_multiply, store_buffer_depth=self.store_buffer_depth, nram_base=self.nram_base)
         result_extend_stage = ResultExtendStage()
-        reg_file = RegFile()
+        reg_file = RegFile(shadow_bank=self.shadow_bank)
 
         # FETCH STAGE
         ############################
@@ -183,6 +192,9 @@ class Pipeline(GenericModule):
         reg_file.write <<= rf_write
 
         reg_file.do_branch <<= do_branch
+        if self.shadow_bank:
+            reg_file.task_mode <<= task_mode
+            reg_file.bank_csr_if <<= self.reg_bank_if
 
 
 def gen():
@@ -32,9 +32,15 @@ The V1 version doesn't implement types, so only values are provided.
 For FPGAs, BRAMs can be used to implement the register file.
 
 The register file also implements the score-board for the rest of the pipeline to handle reservations
+
+Optionally (shadow_bank generic), a second bank of registers can be added. In that case TASK mode and SCHEDULER mode
+have their own set of registers: reads and writes from the pipeline go to the bank selected by task_mode. This works,
+because task_mode only changes with do_branch, at which point all in-flight instructions that would belong to the
+new mode are cancelled. The TASK mode bank is also accessible through 'bank_csr_if' (register N at offset N), so that
+SCHEDULER mode can inspect and modify the context of the task without it having to save and restore it.
 """
 
-class RegFile(Module):
+class RegFile(GenericModule):
     clk = ClkPort()
     rst = RstPort()
 
@@ -47,6 +53,12 @@ class RegFile(Module):
 
     do_branch = Input(logic)
 
+    def construct(self, shadow_bank: bool = False):
+        self.shadow_bank = shadow_bank
+        if shadow_bank:
+            self.task_mode = Input(logic)
+            self.bank_csr_if = Input(CsrIf)
+
     '''
     CLK                    /^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__/^^\__
     write.valid            ______/^^^^^\_______________________/^^^^^\_______________________________________________/^^^^^\___________
@@ -106,18 +118,56 @@ class RegFile(Module):
         # NOTE: disabling read-new-data behavior for Quartus-es sake.
         #mem1 = SimpleDualPortMemory(registered_input_a=False, registered_output_a=True, registered_input_b=True, registered_output_b=False, addr_type=BrewRegAddr, data_type=BrewData)
         #mem2 = SimpleDualPortMemory(registered_input_a=False, registered_output_a=True, registered_input_b=True, registered_output_b=False, addr_type=BrewRegAddr, data_type=BrewData)
-        mem1 = SimpleDualPortMemory(registered_input_a=False, registered_output_a=True, registered_input_b=False, registered_output_b=True, addr_type=BrewRegAddr, data_type=BrewData)
-        mem2 = SimpleDualPortMemory(registered_input_a=False, registered_output_a=True, registered_input_b=False, registered_output_b=True, addr_type=BrewRegAddr, data_type=BrewData)
+        if self.shadow_bank:
+            bank_size = 1 << (BrewRegCnt-1).bit_length()
+            mem_addr_type = Number(min_val=0, max_val=2*bank_size-1)
+            def bank_addr(task_bank, addr):
+                return mem_addr_type(addr + Select(task_bank, 0, bank_size))
+        else:
+            mem_addr_type = BrewRegAddr
+            def bank_addr(task_bank, addr):
+                return addr
+
+        mem1 = SimpleDualPortMemory(registered_input_a=False, registered_output_a=True, registered_input_b=False, registered_output_b=True, addr_type=mem_addr_type, data_type=BrewData)
+        mem2 = SimpleDualPortMemory(registered_input_a=False, registered_output_a=True, registered_input_b=False, registered_output_b=True, addr_type=mem_addr_type, data_type=BrewData)
 
         # We disable forwarding and writing to the RF if write.data_en is not asserted.
         # This allows for clearing a reservation without touching the data
         # during (branch/exception recovery).
-        mem1.port1_write_en <<= self.write.valid & self.write.data_en
-        mem1.port1_data_in <<= self.write.data
-        mem1.port1_addr <<= self.write.addr
-        mem2.port1_write_en <<= self.write.valid & self.write.data_en
-        mem2.port1_data_in <<= self.write.data
-        mem2.port1_addr <<= self.write.addr
+        pipeline_write_en = self.write.valid & self.write.data_en
+        if self.shadow_bank:
+            # CSR accesses always target the TASK mode bank. They are only possible from SCHEDULER mode (the CSR page is not
+            # visible from TASK mode), so they never alias with the pipeline reads, and we don't need to bypass them either.
+            # We have a third memory instance to serve CSR reads; writes wait for the write port to be free.
+            csr_addr = bank_addr(1, self.bank_csr_if.paddr[3:0])
+            csr_write_en = self.bank_csr_if.psel & self.bank_csr_if.penable & self.bank_csr_if.pwrite & ~pipeline_write_en
+            self.bank_csr_if.pready <<= ~self.bank_csr_if.pwrite | ~pipeline_write_en
+
+            mem_write_en = pipeline_write_en | csr_write_en
+            mem_write_data = Select(pipeline_write_en, self.bank_csr_if.pwdata, self.write.data)
+            mem_write_addr = Select(pipeline_write_en, csr_addr, bank_addr(self.task_mode, self.write.addr))
+
+            mem3 = SimpleDualPortMemory(registered_input_a=False, registered_output_a=True, registered_input_b=False, registered_output_b=True, addr_type=mem_addr_type, data_type=BrewData)
+            mem3.port1_write_en <<= mem_write_en
+            mem3.port1_data_in <<= mem_write_data
+            mem3.port1_addr <<= mem_write_addr
+            mem3.port2_addr <<= csr_addr
+            self.bank_csr_if.prdata <<= mem3.port2_data_out
+
+            read_bank = self.task_mode
+        else:
+            mem_write_en = pipeline_write_en
+            mem_write_data = self.write.data
+            mem_write_addr = self.write.addr
+
+            read_bank = 0
+
+        mem1.port1_write_en <<= mem_write_en
+        mem1.port1_data_in <<= mem_write_data
+        mem1.port1_addr <<= mem_write_addr
+        mem2.port1_write_en <<= mem_write_en
+        mem2.port1_data_in <<= mem_write_data
+        mem2.port1_addr <<= mem_write_addr
 
         write_data_d = Wire()
         write_data_d <<= Reg(self.write.data)
@@ -140,7 +190,7 @@ class RegFile(Module):
         #       read of the same address conflicts with the write, generating X-es. Not sure
         #       if this is a simulation issue or a true problem in the operation of the RAMs
         #       but since we have the bypass logic here anyway, let's not depend on the RAMS.
-        mem1.port2_addr <<= read1_addr
+        mem1.port2_addr <<= bank_addr(read_bank, read1_addr)
         #self.read_rsp.read1_data <<= mem1.port2_data_out
         self.read_rsp.read1_data <<= Select(
             Reg((self.write.addr == read1_addr) & self.write.valid & self.write.data_en),
@@ -148,7 +198,7 @@ class RegFile(Module):
             write_data_d
         )
 
-        mem2.port2_addr <<= read2_addr
+        mem2.port2_addr <<= bank_addr(read_bank, read2_addr)
         #self.read_rsp.read2_data <<= mem2.port2_data_out
         self.read_rsp.read2_data <<= Select(
             Reg((self.write.addr == read2_addr) & self.write.valid & self.write.data_en),
@@ -270,7 +320,7 @@ class RegFile(Module):
 
 from dataclasses import dataclass
 
-def sim2():
+def sim2(rng_seed: int = 0, cycles: int = 500) -> int:
     sim_regs = list(i << 16 for i in range(15))
 
     write_queue: List['WriteQueueItem'] = []
@@ -279,6 +329,7 @@ def sim2():
 
     done = False
     checker_idle = True
+    sim_cycles = 0
 
     def next_val(idx):
         return ((sim_regs[idx] & 0xffff) + 1) | (idx << 16)
@@ -457,7 +508,7 @@ def sim2():
         rst = RstPort()
 
         def body(self):
-            seed(0)
+            seed(rng_seed)
 
             self.requestor = Requestor()
             self.writer = Writer()
@@ -471,7 +522,7 @@ def sim2():
 
 
         def simulate(self) -> TSimEvent:
-            nonlocal done
+            nonlocal done, sim_cycles
 
             def clk() -> int:
                 yield 10
@@ -489,16 +540,18 @@ def sim2():
                 yield from clk()
             self.rst <<= 0
 
-            for i in range(500):
+            for i in range(cycles):
                 yield from clk()
+                sim_cycles += 1
                 if done: break
             now = yield 10
             print(f"Done at {now}")
             assert done
 
     Build.simulation(top, "reg_file2.vcd", add_unnamed_scopes=False)
+    return sim_cycles
 
-def sim():
+def sim(rng_seed: int = 0, cycles: int = 50) -> int:
 
     class Excerciser(Module):
         clk = ClkPort()
@@ -654,7 +707,7 @@ def sim():
         rst = RstPort()
 
         def body(self):
-            seed(0)
+            seed(rng_seed)
 
             self.excericeser = Excerciser()
             self.dut = RegFile()
@@ -683,12 +736,226 @@ def sim():
                 yield from clk()
             self.rst <<= 0
 
-            for i in range(50):
+            for i in range(cycles):
                 yield from clk()
             now = yield 10
             print(f"Done at {now}")
 
     Build.simulation(top, "reg_file.vcd", add_unnamed_scopes=True)
+    return cycles
+
+def sim3(rng_seed: int = 0, cycles: int = 4000) -> int:
+    """
+    Bench for the shadow register bank. A reference model of both banks is checked against:
+
+    - pipeline reads and writes in both modes;
+    - CSR reads and writes of the TASK mode bank, including CSR writes colliding with pipeline write-backs;
+    - write-backs in the last cycle before task_mode flips, which have to land in the old bank.
+    """
+    # banks[0] is the SCHEDULER mode bank, banks[1] is the TASK mode bank
+    banks = [[None] * BrewRegCnt, [None] * BrewRegCnt]
+
+    class Driver(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        read_req = Output(RegFileReadRequestIf)
+        read_rsp = Input(RegFileReadResponseIf)
+        write = Output(RegFileWriteBackIf)
+        do_branch = Output(logic)
+        task_mode = Output(logic)
+        reg_if = Output(CsrIf)
+
+        def construct(self):
+            self.reg_if.paddr.set_net_type(Unsigned(4))
+            self.done = False
+            self.mode_flips = 0
+            self.late_write_backs = 0
+            self.csr_collisions = 0
+
+        def simulate(self, simulator: Simulator):
+            def wait_clk():
+                yield (self.clk, )
+                while self.clk.get_sim_edge() != EdgeType.Positive:
+                    yield (self.clk, )
+
+            def wait_rst():
+                yield from wait_clk()
+                while self.rst == 1:
+                    yield from wait_clk()
+
+            mode = 0
+
+            def drive_write(addr, value):
+                # Pipeline write-back, landing on the next clock edge in the bank of the current mode
+                self.write.valid <<= 1
+                self.write.data_en <<= 1
+                self.write.addr <<= addr
+                self.write.data <<= value
+                banks[mode][addr] = value
+
+            def write(addr, value):
+                drive_write(addr, value)
+                yield from wait_clk()
+                self.write.valid <<= 0
+
+            def read(addr1, addr2):
+                self.read_req.read1_addr <<= addr1
+                self.read_req.read1_valid <<= 1
+                self.read_req.read2_addr <<= addr2
+                self.read_req.read2_valid <<= 1
+                self.read_req.rsv_addr <<= None
+                self.read_req.rsv_valid <<= 0
+                self.read_req.valid <<= 1
+                yield from wait_clk()
+                while self.read_req.ready != 1:
+                    yield from wait_clk()
+                self.read_req.valid <<= 0
+                yield from wait_clk()
+                while self.read_rsp.valid != 1:
+                    yield from wait_clk()
+                for addr, data in ((addr1, self.read_rsp.read1_data), (addr2, self.read_rsp.read2_data)):
+                    expected = banks[mode][addr]
+                    simulator.sim_assert(data == expected, f"mode {mode} $r{addr} read {data}, expected {expected:08x}")
+
+            def flip_mode(late_write: bool):
+                # task_mode changes with do_branch. A write-back in the same cycle belongs to an older instruction.
+                nonlocal mode
+                self.do_branch <<= 1
+                if late_write:
+                    drive_write(randint(0, BrewRegCnt-1), randint(0, 0xffffffff))
+                    self.late_write_backs += 1
+                yield from wait_clk()
+                self.do_branch <<= 0
+                self.write.valid <<= 0
+                mode = 1 - mode
+                self.task_mode <<= mode
+                self.mode_flips += 1
+                yield from wait_clk()
+
+            def csr_access(addr, value = None, collisions = 0):
+                # A pipeline write-back is driven in each of the first 'collisions' cycles of the access phase
+                is_write = value is not None
+                self.reg_if.psel <<= 1
+                self.reg_if.penable <<= 0
+                self.reg_if.pwrite <<= is_write
+                self.reg_if.paddr <<= addr
+                self.reg_if.pwdata <<= value
+                yield from wait_clk()
+                self.reg_if.penable <<= 1
+                while True:
+                    if collisions > 0:
+                        drive_write(randint(0, BrewRegCnt-1), randint(0, 0xffffffff))
+                    else:
+                        self.write.valid <<= 0
+                    yield from wait_clk()
+                    if collisions > 0:
+                        if is_write:
+                            simulator.sim_assert(self.reg_if.pready == 0, "CSR write should wait while a write-back is in progress")
+                            self.csr_collisions += 1
+                        collisions -= 1
+                    if self.reg_if.pready == 1:
+                        break
+                self.write.valid <<= 0
+                if is_write:
+                    banks[1][addr] = value
+                else:
+                    expected = banks[1][addr]
+                    data = self.reg_if.prdata
+                    simulator.sim_assert(data == expected, f"CSR read of task $r{addr} returned {data}, expected {expected:08x}")
+                self.reg_if.psel <<= 0
+                self.reg_if.penable <<= None
+                self.reg_if.pwrite <<= None
+                self.reg_if.paddr <<= None
+                self.reg_if.pwdata <<= None
+
+            self.read_req.valid <<= 0
+            self.read_rsp.ready <<= 1
+            self.write.valid <<= 0
+            self.do_branch <<= 0
+            self.task_mode <<= mode
+            self.reg_if.psel <<= 0
+            yield from wait_rst()
+
+            # Fill both banks through the pipeline, then check that they are separate
+            for _ in range(2):
+                for addr in range(BrewRegCnt):
+                    yield from write(addr, (mode << 31) | (addr << 16) | randint(0, 0xffff))
+                yield from flip_mode(late_write=False)
+            for addr in range(BrewRegCnt):
+                yield from read(addr, BrewRegCnt-1-addr)
+                yield from csr_access(addr)
+
+            # CSR writes show up in the TASK mode bank only
+            for addr in range(BrewRegCnt):
+                yield from csr_access(addr, randint(0, 0xffffffff))
+                yield from read(addr, addr)
+            yield from flip_mode(late_write=False)
+            for addr in range(BrewRegCnt):
+                yield from read(addr, addr)
+
+            # Random mix of everything, with CSR accesses from SCHEDULER mode only
+            while not self.done:
+                op = randint(0, 5)
+                if op == 0:
+                    yield from flip_mode(late_write=randint(0, 1) == 1)
+                elif op == 1:
+                    yield from write(randint(0, BrewRegCnt-1), randint(0, 0xffffffff))
+                elif op == 2:
+                    yield from read(randint(0, BrewRegCnt-1), randint(0, BrewRegCnt-1))
+                elif mode == 0:
+                    is_write = op == 3
+                    yield from csr_access(randint(0, BrewRegCnt-1), randint(0, 0xffffffff) if is_write else None, collisions=randint(0, 2))
+                for _ in range(randint(0, 2)):
+                    yield from wait_clk()
+
+    class top(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        def body(self):
+            seed(rng_seed)
+
+            self.driver = Driver()
+            self.dut = RegFile(shadow_bank=True)
+
+            self.dut.do_branch <<= self.driver.do_branch
+            self.dut.task_mode <<= self.driver.task_mode
+            self.dut.read_req <<= self.driver.read_req
+            self.driver.read_rsp <<= self.dut.read_rsp
+            self.dut.write <<= self.driver.write
+            self.dut.bank_csr_if <<= self.driver.reg_if
+
+        def simulate(self, simulator: Simulator) -> TSimEvent:
+            def clk() -> int:
+                yield 10
+                self.clk <<= ~self.clk & self.clk
+                yield 10
+                self.clk <<= ~self.clk
+                yield 0
+
+            print("Simulation started")
+
+            self.rst <<= 1
+            self.clk <<= 1
+            yield 10
+            for i in range(5):
+                yield from clk()
+            self.rst <<= 0
+
+            for i in range(cycles):
+                yield from clk()
+            self.driver.done = True
+            for i in range(20):
+                yield from clk()
+            now = yield 10
+            print(f"Done at {now}")
+            assert self.driver.mode_flips > 0, "No mode changes happened"
+            assert self.driver.late_write_backs > 0, "No write-backs happened right before a mode change"
+            assert self.driver.csr_collisions > 0, "No CSR writes collided with write-backs"
+
+    Build.simulation(top, "reg_file3.vcd", add_unnamed_scopes=False)
+    return cycles
 
 def gen():
     def top():
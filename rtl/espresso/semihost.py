@@ -0,0 +1,171 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent / ".." / ".." / ".." / "silicon"))
+sys.path.append(str(Path(__file__).parent / ".." / ".." / ".." / "silicon" / "unit_tests"))
+
+try:
+    from .brew_types import *
+except ImportError:
+    from brew_types import *
+
+from silicon import *
+
+# Semihosting device for the simulation rigs (test/rig.py:top and fpga_top.sim)
+#
+# This is a simulation-only model. It doesn't sit on the external bus, instead it observes
+# the memory requests of the execute stage (the same way the leeches in test/rig.py do).
+# Stores into its window are interpreted as register writes; everything else is ignored.
+# Since it can't look into the simulated memories, it keeps a shadow copy of them: it's
+# loaded from the program segments and kept up-to-date by observing all CPU stores.
+# Consequently DMA writes are not visible to the device.
+#
+# The device is write-only, which means that the real bus-cycle to the window still happens
+# and must be harmless in the rig.
+#
+# Register map (byte offsets within the window, all registers are 32 bits wide):
+#     0x00: command. Any store to the low byte executes the command
+#     0x04: argument 0
+#     0x08: argument 1
+#     0x0c: argument 2
+#
+# Commands:
+#     1 - WRITE:  print 'arg1' bytes, starting at address 'arg0'
+#     2 - EXIT:   terminate the simulation with exit code 'arg0' (0 means success)
+#     3 - CYCLES: log the number of clock cycles since reset and since the previous CYCLES command.
+#                 If 'arg0' is not 0, it points to a NUL-terminated label for the log entry
+#     4 - DUMP:   write 'arg1' bytes, starting at address 'arg0' into a file. 'arg2' points
+#                 to the NUL-terminated file name
+#
+# All pointers are physical addresses: in task mode the caller needs to add the base.
+#
+# With this a whole buffer can be printed by the cost of a handful of stores, instead of a
+# bus transaction (or more) per character.
+
+class SemihostCommands(object):
+    write = 1
+    exit = 2
+    cycles = 3
+    dump = 4
+
+class Semihost(GenericModule):
+    clk = ClkPort()
+    rst = RstPort()
+
+    cmd_reg_ofs = 0x00
+    arg0_reg_ofs = 0x04
+    arg1_reg_ofs = 0x08
+    arg2_reg_ofs = 0x0c
+
+    window_size = 0x10
+
+    def construct(self, base_addr: int, dump_dir: str = "."):
+        self.base_addr = base_addr
+        self.dump_dir = Path(dump_dir)
+        self.memory = {}
+        self.output = ""
+        self.line_buf = ""
+        self.exit_code = None
+        self.cycles = 0
+        self.last_cycles = 0
+        self.regs = bytearray(self.window_size)
+
+    def set_execute(self, execute: 'ExecuteStage'):
+        self.bus_req_if = execute.bus_req_if
+
+    def clear(self):
+        self.memory = {}
+        self.output = ""
+        self.line_buf = ""
+        self.exit_code = None
+        self.cycles = 0
+        self.last_cycles = 0
+        self.regs = bytearray(self.window_size)
+
+    def set_mem(self, addr: int, data: ByteString):
+        for ofs, byte in enumerate(data):
+            if byte is not None:
+                self.memory[addr + ofs] = byte
+
+    def program(self, segments):
+        for segment in segments:
+            self.set_mem(segment.base_addr, segment.content)
+
+    @property
+    def terminated(self) -> bool:
+        return self.exit_code is not None
+
+    def get_mem(self, addr: int, size: int) -> bytes:
+        # Uninitialized memory reads back as 0
+        return bytes(self.memory.get(addr + ofs, 0) for ofs in range(size))
+
+    def get_str(self, addr: int, max_len: int = 1024) -> str:
+        chars = []
+        for ofs in range(max_len):
+            byte = self.memory.get(addr + ofs, 0)
+            if byte == 0:
+                break
+            chars.append(chr(byte))
+        return "".join(chars)
+
+    def get_reg(self, ofs: int) -> int:
+        return int.from_bytes(self.regs[ofs:ofs+4], "little")
+
+    def execute_cmd(self, simulator: Simulator, cmd: int):
+        arg0 = self.get_reg(Semihost.arg0_reg_ofs)
+        arg1 = self.get_reg(Semihost.arg1_reg_ofs)
+        arg2 = self.get_reg(Semihost.arg2_reg_ofs)
+        if cmd == SemihostCommands.write:
+            text = self.get_mem(arg0, arg1).decode("latin-1")
+            self.output += text
+            # Log complete lines only, keep the rest in the buffer until the next write
+            *lines, self.line_buf = (self.line_buf + text).split("\n")
+            for line in lines:
+                simulator.log(f"SEMIHOST: {line}")
+        elif cmd == SemihostCommands.exit:
+            self.exit_code = arg0
+            simulator.log(f"SEMIHOST: exit with code {arg0} after {self.cycles} cycles")
+        elif cmd == SemihostCommands.cycles:
+            label = "" if arg0 == 0 else f" {self.get_str(arg0)}"
+            simulator.log(f"SEMIHOST: CYCLES{label}: {self.cycles} (+{self.cycles - self.last_cycles})")
+            self.last_cycles = self.cycles
+        elif cmd == SemihostCommands.dump:
+            file_name = self.dump_dir / self.get_str(arg2)
+            with open(file_name, "wb") as dump_file:
+                dump_file.write(self.get_mem(arg0, arg1))
+            simulator.log(f"SEMIHOST: dumped {arg1} bytes from address {arg0:08x} into {file_name}")
+        else:
+            simulator.sim_assert(False, f"SEMIHOST: unknown command {cmd}")
+
+    def simulate(self, simulator: Simulator) -> TSimEvent:
+        def wait_clk():
+            yield self.clk
+            while self.clk.get_sim_edge() != EdgeType.Positive:
+                yield self.clk
+
+        while True:
+            yield from wait_clk()
+            if self.rst == 1:
+                continue
+            self.cycles += 1
+            if (self.bus_req_if.valid & self.bus_req_if.ready) != 1 or self.bus_req_if.read_not_write != 0:
+                continue
+            if self.bus_req_if.data.sim_value is None or self.bus_req_if.byte_en.sim_value is None:
+                continue
+            addr = int(self.bus_req_if.addr) << 1
+            data = int(self.bus_req_if.data)
+            byte_en = int(self.bus_req_if.byte_en)
+            do_cmd = False
+            for lane in range(2):
+                if (byte_en >> lane) & 1 == 0:
+                    continue
+                byte_addr = addr + lane
+                byte = (data >> (8*lane)) & 0xff
+                ofs = byte_addr - self.base_addr
+                if 0 <= ofs < self.window_size:
+                    self.regs[ofs] = byte
+                    do_cmd |= ofs == Semihost.cmd_reg_ofs
+                else:
+                    self.memory[byte_addr] = byte
+            if do_cmd:
+                self.execute_cmd(simulator, self.regs[Semihost.cmd_reg_ofs])
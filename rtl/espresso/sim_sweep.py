@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+# Multi-seed regression sweep of the per-module sim() test-benches
+#
+# Benches are discovered by scanning the modules in this directory for top-level
+# 'sim' or 'simN' functions that take an 'rng_seed' and/or a 'cycles' argument.
+# Seeded benches are run over all requested seeds, unseeded ones only once.
+# Every run happens in a separate process and in a separate directory (so VCD files
+# don't collide). For each run the seed, the number of simulated cycles, the wall
+# time and the failure (if any) is recorded.
+#
+# Usage:
+#     sim_sweep.py [--seeds N] [--base-seed S] [--jobs J] [--bench fetch.sim ...]
+#     sim_sweep.py --replay decode.sim:1234
+#
+# A replay runs the bench in the foreground, in the current directory with the given seed,
+# reproducing the failing run exactly.
+
+import sys
+import os
+import ast
+import json
+import shutil
+import traceback
+import importlib
+from pathlib import Path
+from time import perf_counter
+from dataclasses import dataclass, asdict
+from contextlib import redirect_stdout, redirect_stderr
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import *
+
+bench_dir = Path(__file__).resolve().parent
+if str(bench_dir) not in sys.path:
+    sys.path.insert(0, str(bench_dir))
+
+@dataclass
+class Bench(object):
+    module_name: str
+    func_name: str
+    seeded: bool
+    has_cycles: bool
+
+    @property
+    def name(self) -> str:
+        return f"{self.module_name}.{self.func_name}"
+
+@dataclass
+class SweepResult(object):
+    bench: str
+    seed: Optional[int]
+    cycles: Optional[int]
+    wall_time: float
+    failure: Optional[str] = None
+
+    @property
+    def passed(self) -> bool:
+        return self.failure is None
+
+def discover_benches(directory: Path = bench_dir) -> List[Bench]:
+    """
+    Finds all sim() entry points that support sweeping.
+
+    The source is parsed, not imported, so discovery is cheap and doesn't elaborate anything.
+    """
+    benches = []
+    for file_name in sorted(directory.glob("*.py")):
+        if file_name.name == Path(__file__).name:
+            continue
+        try:
+            tree = ast.parse(file_name.read_text(), str(file_name))
+        except SyntaxError:
+            continue
+        for node in tree.body:
+            if not isinstance(node, ast.FunctionDef):
+                continue
+            if node.name != "sim" and not (node.name.startswith("sim") and node.name[3:].isdigit()):
+                continue
+            arg_names = set(arg.arg for arg in node.args.args + node.args.kwonlyargs)
+            if "rng_seed" not in arg_names and "cycles" not in arg_names:
+                continue
+            benches.append(Bench(file_name.stem, node.name, "rng_seed" in arg_names, "cycles" in arg_names))
+    return benches
+
+def run_bench(bench: Bench, seed: Optional[int], *, cycles: Optional[int] = None) -> Optional[int]:
+    """
+    Runs a single bench in the current process and directory. Returns the number of simulated cycles.
+    """
+    module = importlib.import_module(bench.module_name)
+    kwargs = {}
+    if bench.seeded:
+        kwargs["rng_seed"] = seed
+    if cycles is not None and bench.has_cycles:
+        kwargs["cycles"] = cycles
+    return getattr(module, bench.func_name)(**kwargs)
+
+def _sweep_job(bench: Bench, seed: Optional[int], out_dir: str, cycles: Optional[int], keep: bool) -> SweepResult:
+    job_dir = Path(out_dir) / (bench.name if seed is None else f"{bench.name}.{seed}")
+    job_dir.mkdir(parents=True, exist_ok=True)
+    old_cwd = os.getcwd()
+    os.chdir(job_dir)
+    failure = None
+    sim_cycles = None
+    start = perf_counter()
+    try:
+        with open("sim.log", "wt") as log, redirect_stdout(log), redirect_stderr(log):
+            try:
+                sim_cycles = run_bench(bench, seed, cycles=cycles)
+            except BaseException as ex:
+                failure = "".join(traceback.format_exception(type(ex), ex, ex.__traceback__))
+                print(failure)
+    finally:
+        os.chdir(old_cwd)
+    wall_time = perf_counter() - start
+    if failure is None and not keep:
+        shutil.rmtree(job_dir, ignore_errors=True)
+    return SweepResult(bench.name, seed, sim_cycles, wall_time, failure)
+
+def sweep(
+    benches: Sequence[Bench],
+    seeds: Sequence[int],
+    *,
+    out_dir: Union[str, Path] = "sweep",
+    jobs: Optional[int] = None,
+    cycles: Optional[int] = None,
+    keep: bool = False
+) -> List[SweepResult]:
+    """
+    Runs every bench over every seed (unseeded benches once) in a process pool.
+
+    Directories of passing runs are removed, unless 'keep' is set. Failing runs leave their
+    VCD and sim.log behind in '<out_dir>/<bench>.<seed>'.
+    """
+    out_dir = Path(out_dir).resolve()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = []
+        for bench in benches:
+            for seed in (seeds if bench.seeded else (None,)):
+                futures.append(pool.submit(_sweep_job, bench, seed, str(out_dir), cycles, keep))
+        for future in as_completed(futures):
+            result = future.result()
+            status = "PASS" if result.passed else "FAIL"
+            seed_str = "-" if result.seed is None else str(result.seed)
+            print(f"{status} {result.bench:<20} seed {seed_str:>8} cycles {result.cycles} in {result.wall_time:.2f}s")
+            results.append(result)
+    results.sort(key=lambda result: (result.bench, -1 if result.seed is None else result.seed))
+    with open(out_dir / "sweep_results.json", "wt") as json_file:
+        json.dump(list(asdict(result) for result in results), json_file, indent=2)
+    return results
+
+def _find_bench(name: str) -> Bench:
+    for bench in discover_benches():
+        if bench.name == name or (bench.module_name == name and bench.func_name == "sim"):
+            return bench
+    raise ValueError(f"Unknown bench '{name}'")
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Multi-seed regression sweep of the per-module sim() test-benches")
+    parser.add_argument("--seeds", type=int, default=8, help="number of seeds to run each seeded bench with")
+    parser.add_argument("--base-seed", type=int, default=0, help="first seed of the sweep")
+    parser.add_argument("--jobs", type=int, default=None, help="number of parallel processes (defaults to CPU count)")
+    parser.add_argument("--cycles", type=int, default=None, help="override the number of simulated cycles of each bench")
+    parser.add_argument("--bench", action="append", default=None, help="run only the named bench (e.g. 'reg_file.sim2'); can be repeated")
+    parser.add_argument("--out-dir", default="sweep", help="directory for the results and the artifacts of failing runs")
+    parser.add_argument("--keep", action="store_true", help="keep the artifacts of passing runs as well")
+    parser.add_argument("--replay", metavar="BENCH:SEED", default=None, help="re-run a single bench with the given seed in the foreground")
+    parser.add_argument("--list", action="store_true", help="list the discovered benches and exit")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for bench in discover_benches():
+            print(f"{bench.name}{'' if bench.seeded else ' (unseeded)'}")
+        return 0
+
+    if args.replay is not None:
+        name, _, seed = args.replay.partition(":")
+        bench = _find_bench(name)
+        seed = int(seed) if seed != "" else args.base_seed
+        cycles = run_bench(bench, seed, cycles=args.cycles)
+        print(f"{bench.name} seed {seed}: SUCCESS in {cycles} cycles")
+        return 0
+
+    benches = discover_benches() if args.bench is None else list(_find_bench(name) for name in args.bench)
+    seeds = range(args.base_seed, args.base_seed + args.seeds)
+    results = sweep(benches, seeds, out_dir=args.out_dir, jobs=args.jobs, cycles=args.cycles, keep=args.keep)
+
+    failures = list(result for result in results if not result.passed)
+    total_time = sum(result.wall_time for result in results)
+    print(f"{len(results)} runs, {len(failures)} failures, {total_time:.2f}s total simulation time")
+    for result in failures:
+        replay = result.bench if result.seed is None else f"{result.bench}:{result.seed}"
+        print(f"    FAILED: {replay} (replay with: {Path(__file__).name} --replay {replay})")
+    return 1 if len(failures) > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,8 +2,14 @@ from brew_v1 import BrewV1Top
 from brew_types import *
 from assembler import *
 from silicon import *
+from semihost import Semihost
+from time import perf_counter
+from dataclasses import dataclass
 
 con_base = 0x0001_0000
+semihost_base = con_base + 0x100
+# Writing a byte here requests an external interrupt that many cycles later; writing 0 withdraws it (see IntGen)
+int_gen_base = con_base + 0xc
 
 class RegFileLeech(Module):
     clk = ClkPort()
@@ -12,6 +18,8 @@ class RegFileLeech(Module):
     def set_reg_file(self, reg_file: 'RegFile'):
         self.reg_file = reg_file
         self.wb_if = reg_file.write
+        # Architectural view of the register file (None for registers that were never written)
+        self.regs = [None] * 15
     def simulate(self, simulator: Simulator):
         def wait_clk():
             yield self.clk
@@ -24,6 +32,7 @@ class RegFileLeech(Module):
                 reg_name = f"$r{self.wb_if.addr}"
                 reg_value = f"{self.wb_if.data:08x} ({self.wb_if.data})"
                 simulator.log(f"                          <<<<<<<<<< {reg_name} <= {reg_value}")
+                self.regs[int(self.wb_if.addr)] = int(self.wb_if.data)
 
 class ExecLeech(Module):
     clk = ClkPort()
@@ -36,6 +45,14 @@ class ExecLeech(Module):
         self.spc = execute.spc_in
         self.task_mode = execute.task_mode_in
         self.exec_input = execute.input_port
+        # Retirement tracking for the watchdog in 'top'
+        self.retire_cnt = 0
+        self.last_pc = None
+        self.same_pc_cnt = 0
+        # Program counters and mode of the last retired instruction (byte addresses)
+        self.last_spc = None
+        self.last_tpc = None
+        self.last_task_mode = None
     def simulate(self, simulator: Simulator):
         def wait_clk():
             yield self.clk
@@ -54,6 +71,17 @@ class ExecLeech(Module):
                     pc = self.tpc
                 if self.do_branch == 0:
                     simulator.log(f"{b}: {prefix}{(pc << 1):08x}")
+                    self.retire_cnt += 1
+                    # A self-loop (such as '$pc <- $pc') keeps retiring the same instruction over and over again
+                    pc_val = int(pc)
+                    if pc_val == self.last_pc:
+                        self.same_pc_cnt += 1
+                    else:
+                        self.same_pc_cnt = 0
+                    self.last_pc = pc_val
+                    self.last_spc = int(self.spc) << 1
+                    self.last_tpc = int(self.tpc) << 1
+                    self.last_task_mode = self.task_mode == 1
 
 class LdStLeech(Module):
     clk = ClkPort()
@@ -92,6 +120,25 @@ class LdStLeech(Module):
                     mode = "NONE"
                 simulator.log(f"                          ---------- {mode} {access_size}-bit memory addr {addr:08x}{value}")
 
+class CsrLeech(Module):
+    clk = ClkPort()
+    rst = RstPort()
+
+    def set_execute(self, execute: 'ExecuteStage'):
+        self.csr_if = execute.csr_if
+        # Last value written into each CSR
+        self.csrs = {}
+    def simulate(self, simulator: Simulator):
+        def wait_clk():
+            yield self.clk
+            while self.clk.get_sim_edge() != EdgeType.Positive:
+                yield self.clk
+
+        while True:
+            yield from wait_clk()
+            if (self.csr_if.psel & self.csr_if.penable & self.csr_if.pwrite & self.csr_if.pready) == 1:
+                self.csrs[int(self.csr_if.paddr)] = int(self.csr_if.pwdata)
+
 from copy import copy
 class Dram(GenericModule):
     n_ras         = Input(logic)
@@ -107,10 +154,12 @@ class Dram(GenericModule):
         self.latency = latency
         self.hold_time = hold_time
         self.content = {}
+        self.written = set()
         self.name = name
 
     def clear(self):
         self.content = {}
+        self.written = set()
 
     def set_mem(self, addr: int, data: ByteString):
         for ofs, byte in enumerate(data):
@@ -156,6 +205,7 @@ class Dram(GenericModule):
                         elif self.n_we == 0:
                             value = None if self.data_in_en != 1 else self.data_in
                             self.content[addr] = int(value)
+                            self.written.add(addr)
                             val_str = "--" if value is None else f"{value:02x}"
                             #simulator.log(f"                                              DRAM {self.name} Writing address {addr:08x} with value {val_str}")
                             self.data_out <<= None
@@ -293,7 +343,7 @@ class Console(Module):
                 if self.n_we == 0:
                     value = None if self.data_in_en != 1 else self.data_in
                     val_str = "--" if value is None else f"{value:02x}"
-                    addr = self.addr & 0xff
+                    addr = self.addr & 0xffff
                     if addr == 0:
                         simulator.log(f"CONSOLE got value {val_str}")
                     if addr == 4:
@@ -308,30 +358,102 @@ class Console(Module):
             else:
                 simulator.sim_assert(f"Unexpected CONSOLE enable edge: {self.enable.get_sim_edge()}")
 
+class IntGen(Module):
+    """
+    Drives the (level-sensitive, active low) external interrupt input of the CPU.
+
+    A non-zero byte written to 'int_gen_base' asserts n_int that many clock cycles later. The interrupt stays
+    asserted until 0 is written to the same address, the way a real interrupt source needs to be cleared.
+    """
+    clk           = ClkPort()
+    enable        = Input(logic)
+    addr          = Input(Unsigned(23))
+    n_we          = Input(logic)
+    data_in       = Input(BrewByte)
+    data_in_en    = Input(logic)
+    n_int         = Output(logic)
 
-class top(Module):
+    def simulate(self, simulator: Simulator) -> TSimEvent:
+        self.n_int <<= 1
+        delay = None
+        while True:
+            yield self.clk, self.enable
+            if self.enable.get_sim_edge() == EdgeType.Positive and self.n_we == 0 and (self.addr & 0xffff) == (int_gen_base & 0xffff):
+                simulator.sim_assert(self.data_in_en == 1, "Interrupt generator written with invalid data")
+                value = int(self.data_in)
+                if value == 0:
+                    simulator.log("INTERRUPT withdrawn")
+                    delay = None
+                    self.n_int <<= 1
+                else:
+                    delay = value
+            if self.clk.get_sim_edge() == EdgeType.Positive and delay is not None:
+                delay -= 1
+                if delay == 0:
+                    simulator.log("INTERRUPT asserted")
+                    delay = None
+                    self.n_int <<= 0
+
+
+@dataclass
+class Checkpoint(object):
+    """
+    Architectural state of the system, captured by 'top' at a checkpoint_here() marker
+    """
+    cycle: int                  # Number of cycles it took to reach the checkpoint
+    resume_addr: int            # Address of the first instruction after the marker
+    regs: List[Optional[int]]   # Register file content; None for registers that were never written
+    spc: int                    # Scheduler mode PC (byte address); don't care if task_mode is False
+    tpc: Optional[int]          # Task mode PC (byte address); don't care if task_mode is True
+    task_mode: bool
+    csrs: Dict[int, int]        # Last value written into each CSR
+    memory: Dict[int, int]      # All bytes of DRAM written before the checkpoint, by physical address
+
+class top(GenericModule):
     clk               = ClkPort()
     rst               = RstPort()
 
     nram_base = 0x000_0000
     dram_base = 0x800_0000
 
-    def construct(self):
+    def construct(self, ras_depth: int = 0, loop_buffer_depth: int = 0, shadow_bank: bool = False):
+        # CPU options, beyond the defaults of the rig
+        self.ras_depth = ras_depth
+        self.loop_buffer_depth = loop_buffer_depth
+        self.shadow_bank = shadow_bank
         self.pc = 0
         self.asm = BrewAssembler()
         self.default_timeout = 1500
         self.timeout = self.default_timeout
+        # Watchdog: terminate the simulation if no instruction retires for this many cycles...
+        self.retire_limit = None
+        # ... or if the same instruction retires this many times in a row (self-loop). Both are off
+        # by default; tests enable them through set_watchdog (or the run_test arguments).
+        self.self_loop_limit = None
+        # Print simulation speed every this many cycles (None to disable)
+        self.heartbeat_interval = 1000
+        # Number of clock cycles it took to reach SUCCESS in the last simulation (None if didn't)
+        self.cycles = None
+        # If set, the simulation stops at the checkpoint marker (the self-loop at this address) and captures the state...
+        self.checkpoint_addr = None
+        # ... once the marker retired this many times, by which point all prior instructions completed
+        self.checkpoint_drain = 4
+        # The state captured in the last simulation
+        self.checkpoint = None
 
     def body(self):
-        self.cpu = BrewV1Top(nram_base=self.nram_base >> 26, has_multiply=True, has_shift=True, page_bits=7)
+        self.cpu = BrewV1Top(nram_base=self.nram_base >> 26, has_multiply=True, has_shift=True, page_bits=7, ras_depth=self.ras_depth, loop_buffer_depth=self.loop_buffer_depth, shadow_bank=self.shadow_bank)
         self.dram_l = Dram(name="l")
         self.dram_h = Dram(name="h")
         self.addr_decode = AddressDecode()
         self.rom = Rom()
         self.con = Console()
+        self.int_gen = IntGen()
+        self.semihost = Semihost(base_addr=semihost_base)
         self.rf_leech = RegFileLeech()
         self.exec_leech = ExecLeech()
         self.ldst_leech = LdStLeech()
+        self.csr_leech = CsrLeech()
 
         self.dram_l.n_ras         <<= self.cpu.dram.n_ras_a
         self.dram_l.n_cas         <<= self.cpu.dram.n_cas_0
@@ -363,14 +485,29 @@ class top(Module):
         self.con.enable           <<= self.addr_decode.con_en
         self.con.addr             <<= self.addr_decode.full_addr
         self.con.n_we             <<= self.cpu.dram.n_we
+        self.int_gen.enable       <<= self.addr_decode.con_en
+        self.int_gen.addr         <<= self.addr_decode.full_addr
+        self.int_gen.n_we         <<= self.cpu.dram.n_we
+        self.int_gen.data_in      <<= self.cpu.dram.data_out
+        self.int_gen.data_in_en   <<= self.cpu.dram.data_out_en
 
         self.cpu.dram.n_wait      <<= 1
         self.cpu.drq              <<= 0
-        self.cpu.n_int            <<= 1
+        self.cpu.n_int            <<= self.int_gen.n_int
 
     def set_timeout(self, timeout):
         self.timeout = timeout
 
+    def set_watchdog(self, retire_limit: Optional[int] = None, self_loop_limit: Optional[int] = None):
+        """
+        Set watchdog limits. Setting either to None disables that check.
+        """
+        self.retire_limit = retire_limit
+        self.self_loop_limit = self_loop_limit
+
+    def set_heartbeat(self, interval: Optional[int]):
+        self.heartbeat_interval = interval
+
     def simulate(self, simulator: Simulator) -> TSimEvent:
         def get_reg_file():
             reg_file = first(first(self.cpu.get_inner_objects("pipeline")).get_inner_objects("reg_file"))
@@ -383,6 +520,8 @@ class top(Module):
         self.rf_leech.set_reg_file(get_reg_file())
         self.exec_leech.set_execute(get_exec())
         self.ldst_leech.set_execute(get_exec())
+        self.semihost.set_execute(get_exec())
+        self.csr_leech.set_execute(get_exec())
 
         def clk() -> int:
             yield 50
@@ -401,15 +540,107 @@ class top(Module):
             yield from clk()
         self.rst <<= 0
 
+        self.cycles = None
+        start_time = perf_counter()
+        heartbeat_time = start_time
+        last_retire_cnt = self.exec_leech.retire_cnt
+        last_retire_cycle = 0
+        watchdog_reason = None
         for i in range(self.timeout):
-            if self.con.terminate == 1:
+            if self.con.terminate == 1 or self.semihost.terminated:
+                self.cycles = i
+                break
+            if self.checkpoint_addr is not None and self.exec_leech.same_pc_cnt >= self.checkpoint_drain and self.exec_leech.last_pc << 1 == self.checkpoint_addr:
+                self.cycles = i
+                self.checkpoint = self.capture_checkpoint(i)
+                simulator.log(f"CHECKPOINT captured at cycle {i}")
+                break
+            if self.exec_leech.retire_cnt != last_retire_cnt:
+                last_retire_cnt = self.exec_leech.retire_cnt
+                last_retire_cycle = i
+            if self.retire_limit is not None and i - last_retire_cycle >= self.retire_limit:
+                watchdog_reason = f"no instruction retired for {self.retire_limit} cycles"
+                break
+            if self.self_loop_limit is not None and self.exec_leech.same_pc_cnt >= self.self_loop_limit:
+                watchdog_reason = f"self-loop detected at {self.exec_leech.last_pc << 1:08x}"
                 break
+            if self.heartbeat_interval is not None and i != 0 and i % self.heartbeat_interval == 0:
+                now = perf_counter()
+                simulator.log(f"HEARTBEAT cycle {i}: {self.heartbeat_interval / (now - heartbeat_time):.1f} cycles/s")
+                heartbeat_time = now
             yield from clk()
         yield 10
-        assert(self.con.terminate == 1)
-        simulator.log("Done")
+        elapsed = perf_counter() - start_time
+        if watchdog_reason is not None:
+            simulator.log(f"WATCHDOG at cycle {i}: {watchdog_reason}")
+        assert self.con.terminate == 1 or self.semihost.terminated or self.checkpoint is not None, f"Simulation didn't terminate: {watchdog_reason or 'timeout'}"
+        assert self.semihost.exit_code in (None, 0), f"Simulation terminated with exit code {self.semihost.exit_code}"
+        simulator.log(f"Done in {self.cycles} cycles ({self.cycles / elapsed:.1f} cycles/s)")
+
+    def capture_checkpoint(self, cycle: int) -> Checkpoint:
+        # The marker is a 'pc <- <self>' instruction, which is 6 bytes long
+        resume_addr = self.checkpoint_addr + 6
+        task_mode = self.exec_leech.last_task_mode
+        memory = {}
+        for lane, dram in enumerate((self.dram_l, self.dram_h)):
+            for dram_addr in dram.written:
+                memory[self.dram_base + (dram_addr << 1 | lane)] = dram.content[dram_addr]
+        return Checkpoint(
+            cycle=cycle,
+            resume_addr=resume_addr,
+            regs=copy(self.rf_leech.regs),
+            spc=self.exec_leech.last_spc if task_mode else resume_addr,
+            tpc=resume_addr if task_mode else self.exec_leech.last_tpc,
+            task_mode=task_mode,
+            csrs=copy(self.csr_leech.csrs),
+            memory=memory
+        )
+
+    def restore(self, checkpoint: Checkpoint):
+        """
+        Injects 'checkpoint' into the system after reset. Must be called after 'program'.
+
+        Memory is patched directly. The CPU state is loaded by a stub, appended to ROM and
+        pointed to by the reset vector (overwriting the first 6 bytes of ROM).
+        """
+        for addr, byte in checkpoint.memory.items():
+            self.set_mem(addr, bytes((byte,)))
+
+        # CSRs are loaded through a register that is restored afterwards, so its value doesn't get clobbered
+        stub = []
+        scratch = next((idx for idx, value in enumerate(checkpoint.regs) if value is not None), None)
+        if len(checkpoint.csrs) > 0 and scratch is None:
+            raise SimulationException("Can't restore CSRs from a checkpoint that doesn't contain any registers")
+        for csr, value in checkpoint.csrs.items():
+            stub += self.asm.r_eq_I(scratch, value)
+            stub += self.asm.csr_eq_r(csr, scratch)
+        for idx, value in enumerate(checkpoint.regs):
+            if value is not None:
+                stub += self.asm.r_eq_I(idx, value)
+        if checkpoint.task_mode:
+            # Enter task mode; when the task returns to the scheduler, continue where the scheduler was
+            stub += self.asm.tpc_eq_I(checkpoint.tpc)
+            stub += self.asm.stm()
+            stub += self.asm.pc_eq_I(checkpoint.spc)
+        else:
+            if checkpoint.tpc is not None:
+                stub += self.asm.tpc_eq_I(checkpoint.tpc)
+            stub += self.asm.pc_eq_I(checkpoint.spc)
+
+        def to_bytes(words):
+            return bytes(b for word in words for b in (word & 0xff, word >> 8))
+
+        stub_addr = (self.rom.get_size() + 0xff) & ~0xff
+        self.rom.set_mem(stub_addr, to_bytes(stub))
+        reset_vector = to_bytes(self.asm.pc_eq_I(self.nram_base + stub_addr))
+        for ofs, byte in enumerate(reset_vector):
+            if ofs < self.rom.get_size():
+                self.rom.content[ofs] = byte
+            else:
+                self.rom.content.append(byte)
 
     def set_mem(self, addr: int, data: ByteString):
+        self.semihost.set_mem(addr, data)
         section = addr & 0xc00_0000
         if section == self.nram_base:
             self.rom.set_mem(addr & 0x03ff_ffff, data)
@@ -427,7 +658,12 @@ class top(Module):
         self.dram_h.clear()
         self.dram_l.clear()
         self.rom.clear()
+        self.semihost.clear()
         self.timeout = self.default_timeout
+        self.retire_limit = None
+        self.self_loop_limit = None
+        self.checkpoint_addr = None
+        self.checkpoint = None
 
     def program(self, segments):
         for segment in segments:
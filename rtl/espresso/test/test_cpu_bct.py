@@ -959,6 +959,322 @@ def test_ldst(top):
     terminate()
 
 
+def checkpoint_prog(top):
+    """
+    Program for test_checkpoint: sets up some registers, a CSR and memory before the checkpoint marker and checks them after it.
+
+    $r0 is never written, so it's not part of the checkpoint and can't be used by the restore stub.
+    """
+
+    create_segment("code", 0)
+    create_segment("code_dram", 0x0800_0000)
+    set_active_segment("code_dram")
+    place_symbol("_start")
+    set_active_segment("code")
+
+    pc_eq_I("_start")
+
+    set_active_segment("code_dram")
+    r_eq_I("$r1", 0x0012_3400)
+    csr_eq_r(top.cpu.csr_dmem_limit_reg, "$r1")
+    # Not all bits of the CSR are implemented: remember what it reads back as
+    r_eq_csr("$r6", top.cpu.csr_dmem_limit_reg)
+    r_eq_I("$r2", 0x0800_2000)
+    r_eq_I("$r3", 0xdeadbeef)
+    mem32_r_plus_t_eq_r("$r2", 0, "$r3")
+    r_eq_I("$r1", 0x1111_1111)
+    checkpoint_here()
+
+    check_reg("$r1", 0x1111_1111)
+    check_reg("$r2", 0x0800_2000)
+    check_reg("$r3", 0xdeadbeef)
+    r_eq_csr("$r4", top.cpu.csr_dmem_limit_reg)
+    r_eq_r_xor_r("$r4", "$r4", "$r6")
+    check_reg("$r4", 0)
+    r_eq_mem32_r_plus_t("$r5", "$r2", 0)
+    check_reg("$r5", 0xdeadbeef)
+    terminate()
+
+def test_checkpoint():
+    """
+    Test checkpoint capture and restore: the program runs to its checkpoint marker, then again from the captured state
+    """
+    checkpoint = capture_checkpoint(None, checkpoint_prog)
+    assert checkpoint.regs[0] is None
+    run_test(None, checkpoint_prog, checkpoint=checkpoint)
+
+
+def ras_prog(top):
+    """
+    Program for test_ras: nested calls, a recursion deeper than the return address stack and a return through a modified $r14.
+
+    Every return has to land where the architecture says it should, whether or not the return stack predicted it.
+    """
+    def push(reg):
+        r_eq_r_plus_t("$r13", "$r13", -4)
+        mem32_r_plus_t_eq_r("$r13", 0, reg)
+    def pop(reg):
+        r_eq_mem32_r_plus_t(reg, "$r13", 0)
+        r_eq_r_plus_t("$r13", "$r13", 4)
+
+    top.set_timeout(6000)
+    startup(call_init_regs=False)
+    r_eq_I("$r13", 0x0800_4000) # Stack pointer
+
+    # Nested calls, within the depth of the return stack
+    r_eq_t("$r1", 0)
+    call_I("nested_1")
+    check_reg("$r1", 7)
+
+    # Recursion, deeper than the return stack: the outer returns find their entries overwritten
+    r_eq_t("$r1", 0)
+    r_eq_t("$r2", 7)
+    call_I("recurse")
+    check_reg("$r1", 7)
+    check_reg("$r2", 0)
+
+    # Return through a modified $r14: the return stack predicts the instruction after the call
+    r_eq_t("$r3", 0)
+    call_I("detour")
+    r_eq_t("$r3", 2)
+    fail()
+    place_symbol("detour_return")
+    check_reg("$r3", 1)
+
+    # Predictions still work after all that
+    r_eq_t("$r1", 0)
+    call_I("nested_1")
+    check_reg("$r1", 7)
+    terminate()
+
+    place_symbol("nested_1")
+    push("$r14")
+    call_I("nested_2")
+    pop("$r14")
+    r_eq_r_plus_t("$r1", "$r1", 4)
+    pc_eq_r("$r14")
+
+    place_symbol("nested_2")
+    push("$r14")
+    call_I("nested_3")
+    pop("$r14")
+    r_eq_r_plus_t("$r1", "$r1", 2)
+    pc_eq_r("$r14")
+
+    place_symbol("nested_3")
+    r_eq_r_plus_t("$r1", "$r1", 1)
+    pc_eq_r("$r14")
+
+    place_symbol("recurse")
+    if_r_eq_z("$r2", "recurse_bottom")
+    push("$r14")
+    r_eq_r_plus_t("$r2", "$r2", -1)
+    call_I("recurse")
+    pop("$r14")
+    r_eq_r_plus_t("$r1", "$r1", 1)
+    place_symbol("recurse_bottom")
+    pc_eq_r("$r14")
+
+    place_symbol("detour")
+    r_eq_t("$r3", 1)
+    r_eq_I("$r14", "detour_return")
+    pc_eq_r("$r14")
+
+def test_ras():
+    """
+    Calls and returns on a CPU with a 4-entry return address stack
+    """
+    run_test(prep_variant(top, ras_depth=4), ras_prog)
+
+
+def shadow_int_prog(top):
+    """
+    Program for test_shadow_bank_int: a TASK mode loop gets interrupted and SCHEDULER mode inspects and modifies the
+    registers of the task through the CSRs of the shadow bank, before letting the task finish with an SWI.
+
+    Both modes use $r1...$r3, so the scheduler can check that the task never touched its registers.
+    """
+    task_reg_csr = 0x0500 # TASK mode $r0 in the shadow register bank
+
+    top.set_timeout(4000)
+
+    create_segment("code", 0)
+    create_segment("code_dram", 0x800_0000)
+    create_segment("code_task", 0x800_1000)
+    set_active_segment("code_dram")
+    place_symbol("_start")
+    set_active_segment("code_task")
+    place_symbol("_task_start")
+    set_active_segment("code")
+
+    pc_eq_I("_start")
+
+    set_active_segment("code_dram")
+    r_eq_I("$r0",0xffffffff)
+    csr_eq_r(top.cpu.csr_pmem_limit_reg,"$r0")
+    csr_eq_r(top.cpu.csr_dmem_limit_reg,"$r0")
+    r_eq_t("$r0",0)
+    csr_eq_r(top.cpu.csr_pmem_base_reg,"$r0")
+    csr_eq_r(top.cpu.csr_dmem_base_reg,"$r0")
+
+    r_eq_I("$r1", 0x1111_1111)
+    r_eq_I("$r2", 0x2222_2222)
+    r_eq_I("$r3", 0x3333_3333)
+    # Task context: $r1 counts loop iterations, a non-zero $r2 ends the loop
+    csr_eq_r(task_reg_csr+1, "$r0")
+    csr_eq_r(task_reg_csr+2, "$r0")
+    tpc_eq_I("_task_start")
+    request_int(100, "$r4")
+    stm()
+
+    # Interrupted: clear the interrupt at the source, then the exc_hwi it left behind in ecause
+    r_eq_csr("$r4", top.cpu.csr_ecause_reg)
+    check_reg("$r4", brew_exceptions.exc_hwi.value)
+    request_int(0, "$r4")
+    fence()
+    r_eq_csr("$r4", top.cpu.csr_ecause_reg)
+    check_reg("$r1", 0x1111_1111)
+    check_reg("$r2", 0x2222_2222)
+    check_reg("$r3", 0x3333_3333)
+    # The task got somewhere before the interrupt
+    r_eq_csr("$r5", task_reg_csr+1)
+    if_r_ne_z("$r5", "task_progressed")
+    fail()
+    place_symbol("task_progressed")
+
+    # Return to the task, with its loop ending
+    r_eq_t("$r5", 1)
+    csr_eq_r(task_reg_csr+2, "$r5")
+    stm()
+    r_eq_csr("$r4", top.cpu.csr_ecause_reg)
+    check_reg("$r4", brew_exceptions.exc_swi_3.value)
+    # The task left its counter + 1 in its $r3
+    r_eq_csr("$r5", task_reg_csr+1)
+    r_eq_csr("$r6", task_reg_csr+3)
+    r_eq_r_plus_t("$r5", "$r5", 1)
+    r_eq_r_xor_r("$r6", "$r6", "$r5")
+    check_reg("$r6", 0)
+    check_reg("$r1", 0x1111_1111)
+    check_reg("$r2", 0x2222_2222)
+    check_reg("$r3", 0x3333_3333)
+    terminate()
+
+    set_active_segment("code_task")
+    r_eq_r_plus_t("$r1", "$r1", 1)
+    if_r_eq_z("$r2", "_task_start")
+    r_eq_r_plus_t("$r3", "$r1", 1)
+    swi(3)
+
+def test_shadow_bank_int():
+    """
+    Interrupt entry and return on a CPU with a shadow register bank
+    """
+    run_test(prep_variant(top, shadow_bank=True), shadow_int_prog)
+
+
+def loop_buffer_prog(top):
+    """
+    Program for test_loop_buffer: a loop that fits in the loop buffer, one that doesn't and a TASK mode loop
+    that gets interrupted while it's replayed.
+
+    The instructions right after the loops check that each loop exited exactly once, at the right point.
+    """
+    top.set_timeout(5000)
+
+    create_segment("code", 0)
+    create_segment("code_dram", 0x800_0000)
+    create_segment("code_task", 0x800_1000)
+    set_active_segment("code_dram")
+    place_symbol("_start")
+    set_active_segment("code_task")
+    place_symbol("_task_start")
+    set_active_segment("code")
+
+    pc_eq_I("_start")
+
+    set_active_segment("code_dram")
+    r_eq_I("$r0",0xffffffff)
+    csr_eq_r(top.cpu.csr_pmem_limit_reg,"$r0")
+    csr_eq_r(top.cpu.csr_dmem_limit_reg,"$r0")
+    r_eq_t("$r0",0)
+    csr_eq_r(top.cpu.csr_pmem_base_reg,"$r0")
+    csr_eq_r(top.cpu.csr_dmem_base_reg,"$r0")
+
+    # Three instructions: fits in the loop buffer and gets replayed from the second iteration on
+    r_eq_t("$r1", 0)
+    r_eq_i("$r2", 20)
+    r_eq_t("$r3", 0)
+    place_symbol("fit_loop")
+    r_eq_r_plus_t("$r1", "$r1", 1)
+    r_eq_r_plus_t("$r2", "$r2", -1)
+    if_r_ne_z("$r2", "fit_loop")
+    r_eq_r_plus_t("$r3", "$r3", 1)
+    check_reg("$r1", 20)
+    check_reg("$r2", 0)
+    check_reg("$r3", 1)
+
+    # Seven instructions: recording is abandoned every iteration
+    r_eq_t("$r1", 0)
+    r_eq_i("$r2", 10)
+    r_eq_t("$r3", 0)
+    r_eq_t("$r4", 0)
+    r_eq_t("$r5", 0)
+    r_eq_t("$r6", 0)
+    place_symbol("big_loop")
+    r_eq_r_plus_t("$r1", "$r1", 1)
+    r_eq_r_plus_t("$r4", "$r4", 2)
+    r_eq_r_plus_t("$r5", "$r5", 3)
+    r_eq_r_plus_t("$r6", "$r6", 4)
+    r_eq_r_plus_t("$r2", "$r2", -1)
+    r_eq_r_plus_t("$r1", "$r1", 1)
+    if_r_ne_z("$r2", "big_loop")
+    r_eq_r_plus_t("$r3", "$r3", 1)
+    check_reg("$r1", 20)
+    check_reg("$r2", 0)
+    check_reg("$r3", 1)
+    check_reg("$r4", 20)
+    check_reg("$r5", 30)
+    check_reg("$r6", 40)
+
+    # TASK mode loop, spinning until $r2 becomes non-zero. The interrupt hits it long after replay started.
+    r_eq_t("$r1", 0)
+    r_eq_t("$r2", 0)
+    r_eq_t("$r3", 0)
+    tpc_eq_I("_task_start")
+    request_int(150, "$r4")
+    stm()
+    r_eq_csr("$r4", top.cpu.csr_ecause_reg)
+    check_reg("$r4", brew_exceptions.exc_hwi.value)
+    request_int(0, "$r4")
+    fence()
+    r_eq_csr("$r4", top.cpu.csr_ecause_reg)
+    if_r_ne_z("$r1", "task_progressed")
+    fail()
+    place_symbol("task_progressed")
+    check_reg("$r3", 0)
+    # Resume the task where it was interrupted and let it leave the loop
+    r_eq_t("$r2", 1)
+    stm()
+    r_eq_csr("$r4", top.cpu.csr_ecause_reg)
+    check_reg("$r4", brew_exceptions.exc_swi_3.value)
+    r_eq_r_plus_t("$r5", "$r1", 1)
+    r_eq_r_xor_r("$r5", "$r5", "$r3")
+    check_reg("$r5", 0)
+    terminate()
+
+    set_active_segment("code_task")
+    r_eq_r_plus_t("$r1", "$r1", 1)
+    if_r_eq_z("$r2", "_task_start")
+    r_eq_r_plus_t("$r3", "$r1", 1)
+    swi(3)
+
+def test_loop_buffer():
+    """
+    Loops on a CPU with a 4-entry loop buffer
+    """
+    run_test(prep_variant(top, loop_buffer_depth=4), loop_buffer_prog)
+
+
 # TODO: zero-compare branches; compare branches; bit-test branches
 #       stack operations
 #       load-stores
@@ -979,6 +1295,10 @@ if __name__ == "__main__":
     #test_branch_rc()
     #test_branch_bit()
     #test_ldst()
+    #test_checkpoint()
+    #test_ras()
+    #test_shadow_bank_int()
+    #test_loop_buffer()
 
 if "pytest" in sys.modules:
     prep_test(top)
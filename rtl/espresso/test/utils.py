@@ -1,10 +1,11 @@
 from silicon import *
 
 from assembler import *
+from semihost import Semihost, SemihostCommands
 try:
-    from .rig import con_base
+    from .rig import con_base, semihost_base, int_gen_base, Checkpoint
 except ImportError:
-    from rig import con_base
+    from rig import con_base, semihost_base, int_gen_base, Checkpoint
 
 def fail():
     mem32_I_eq_r(con_base+8, "$r0")
@@ -18,6 +19,47 @@ def check_reg(reg, value):
 def terminate():
     mem32_I_eq_r(con_base+4, "$r0")
 
+# Set while a program is generated for capturing or restoring a checkpoint
+checkpoint_layout = False
+
+def checkpoint_here():
+    """
+    Marks the point where a checkpoint is captured (see capture_checkpoint).
+
+    The marker is a self-loop, which the rig recognizes. It is only emitted when the program is generated
+    for capturing or restoring a checkpoint, so the same programmer runs normally from reset as well.
+    """
+    if not checkpoint_layout:
+        return
+    place_symbol("checkpoint")
+    pc_eq_I("checkpoint")
+    place_symbol("checkpoint_resume")
+
+def semihost_cmd(cmd, tmp_reg="$r14"):
+    r_eq_i(tmp_reg, cmd)
+    mem8_I_eq_r(semihost_base+Semihost.cmd_reg_ofs, tmp_reg)
+
+def semihost_write(buf_reg, len_reg, tmp_reg="$r14"):
+    mem32_I_eq_r(semihost_base+Semihost.arg0_reg_ofs, buf_reg)
+    mem32_I_eq_r(semihost_base+Semihost.arg1_reg_ofs, len_reg)
+    semihost_cmd(SemihostCommands.write, tmp_reg)
+
+def semihost_exit(code_reg, tmp_reg="$r14"):
+    mem32_I_eq_r(semihost_base+Semihost.arg0_reg_ofs, code_reg)
+    semihost_cmd(SemihostCommands.exit, tmp_reg)
+
+def semihost_cycles(tmp_reg="$r14"):
+    r_eq_i(tmp_reg, 0)
+    mem32_I_eq_r(semihost_base+Semihost.arg0_reg_ofs, tmp_reg)
+    semihost_cmd(SemihostCommands.cycles, tmp_reg)
+
+def request_int(delay, tmp_reg="$r14"):
+    """
+    Asserts the external interrupt 'delay' cycles after the write reaches the rig. A 'delay' of 0 withdraws it.
+    """
+    r_eq_i(tmp_reg, delay)
+    mem8_I_eq_r(int_gen_base, tmp_reg)
+
 #def con_wr(reg, tmp_reg=14):
 #    prog(a.r_eq_r_or_r(tmp_reg, reg, reg))
 #    prog(a.r_eq_r_shl_i(tmp_reg, tmp_reg, 28))
@@ -28,6 +70,9 @@ def terminate():
 
 test_netlist = None
 
+# Number of clock cycles each test took to reach SUCCESS
+test_cycles = {}
+
 def prep_test(top) -> Netlist:
     with Netlist().elaborate() as netlist:
         top()
@@ -35,8 +80,34 @@ def prep_test(top) -> Netlist:
     test_netlist = netlist
     return netlist
 
-def run_test(netlist: Netlist, programmer: callable, test_name: str = None):
-    global test_netlist
+# Netlists of 'top' variants, by their generics
+variant_netlists = {}
+
+def prep_variant(top, **generics) -> Netlist:
+    """
+    Elaborates 'top' with the given generics for tests that need a non-default CPU configuration.
+
+    The netlist used by default (see prep_test) is left alone. Variants are only elaborated once.
+    """
+    key = tuple(sorted(generics.items()))
+    if key not in variant_netlists:
+        with Netlist().elaborate() as netlist:
+            top(**generics)
+        variant_netlists[key] = netlist
+    return variant_netlists[key]
+
+def run_test(netlist: Netlist, programmer: callable, test_name: str = None, checkpoint: Optional[Checkpoint] = None, *, retire_limit: Optional[int] = None, self_loop_limit: Optional[int] = None):
+    """
+    Runs the program, generated by 'programmer'.
+
+    If 'checkpoint' is given, the simulation starts from it, instead of from reset: everything
+    before the checkpoint_here() marker in the program is skipped. The program needs to be
+    identical to the one the checkpoint was captured with up to the marker.
+
+    'retire_limit' and 'self_loop_limit' enable the watchdog of the rig for this test only
+    (see top.set_watchdog). By default, the watchdog is off and only the timeout applies.
+    """
+    global test_netlist, checkpoint_layout
     clear_asm()
     if netlist is None:
         netlist = test_netlist
@@ -48,10 +119,55 @@ def run_test(netlist: Netlist, programmer: callable, test_name: str = None):
     vcd_filename = f"brew_v1_{test_name}.vcd"
 
     top_inst.clear()
-    programmer(top_inst)
+    top_inst.set_watchdog(retire_limit, self_loop_limit)
+    checkpoint_layout = checkpoint is not None
+    try:
+        programmer(top_inst)
+    finally:
+        checkpoint_layout = False
+    reloc()
+    top_inst.program(get_all_segments())
+    if checkpoint is not None:
+        assert get_symbol_addr("checkpoint_resume") == checkpoint.resume_addr, "Program layout doesn't match the checkpoint"
+        top_inst.restore(checkpoint)
+    netlist.simulate(vcd_filename, add_unnamed_scopes=False)
+    test_cycles[test_name] = top_inst.cycles
+    skipped = "" if checkpoint is None else f" (skipped {checkpoint.cycle} cycles using a checkpoint)"
+    print(f"{test_name}: SUCCESS in {top_inst.cycles} cycles{skipped}")
+
+def capture_checkpoint(netlist: Netlist, programmer: callable, test_name: str = None, *, retire_limit: Optional[int] = None) -> Checkpoint:
+    """
+    Runs the program, generated by 'programmer' up to its checkpoint_here() marker and returns the captured state.
+
+    The checkpoint can be used for any number of run_test calls, as long as their programs match up to the marker.
+    'retire_limit' enables the retirement watchdog, same as for run_test. The self-loop check is not available
+    here, as the marker itself is a self-loop.
+    """
+    global test_netlist, checkpoint_layout
+    clear_asm()
+    if netlist is None:
+        netlist = test_netlist
+    top_inst = netlist.top_level
+
+    if test_name is None:
+        test_name = programmer.__name__
+
+    vcd_filename = f"brew_v1_{test_name}_checkpoint.vcd"
+
+    top_inst.clear()
+    top_inst.set_watchdog(retire_limit)
+    checkpoint_layout = True
+    try:
+        programmer(top_inst)
+    finally:
+        checkpoint_layout = False
     reloc()
     top_inst.program(get_all_segments())
+    top_inst.checkpoint_addr = get_symbol_addr("checkpoint")
     netlist.simulate(vcd_filename, add_unnamed_scopes=False)
+    assert top_inst.checkpoint is not None, "Checkpoint marker not reached"
+    print(f"{test_name}: checkpoint captured in {top_inst.checkpoint.cycle} cycles")
+    return top_inst.checkpoint
 
 def prog_wrapper(func):
     def wrapper():
@@ -85,6 +201,8 @@ def init_regs():
 def startup(call_init_regs = True):
     """
     Setting up initial segments, jump to DRAM and load all registers
+
+    Ends with a checkpoint marker, so tests can skip all this by starting from a checkpoint
     """
     global r
 
@@ -98,6 +216,7 @@ def startup(call_init_regs = True):
 
     set_active_segment("code_dram")
     if call_init_regs: init_regs()
+    checkpoint_here()
 
 def check(start=0, stop=14):
     """
@@ -2,10 +2,8 @@
 import time
 
 import numpy as np
-import pyaudio
 from math import *
-from typing import Sequence
-import matplotlib.pyplot as plt
+from typing import Sequence, Optional
 from enum import Enum
 
 """
@@ -182,6 +180,7 @@ class Param(object):
     def __init__(self, value = None):
         global params
         self._value = value
+        self.block = None
         params.append(self)
 
     def update(self,value):
@@ -194,6 +193,27 @@ class Param(object):
     def value(self):
         return self._value
 
+    # Block-processing interface: same as above, but for a whole block of samples at once
+    def update_block(self, values):
+        self.block += values
+
+    def reset_block(self, block_size: int):
+        if self.block is None or len(self.block) != block_size:
+            self.block = np.zeros(block_size, dtype=np.float64)
+        else:
+            self.block.fill(0)
+
+def input_block(input, block_size: int) -> np.ndarray:
+    """
+    Returns the values of a control input for a whole block.
+
+    Inputs are normally Params, but anything with a 'value' (such as a Const) works as well.
+    """
+    block = getattr(input, "block", None)
+    if block is not None:
+        return block
+    return np.full(block_size, input.value, dtype=np.float64)
+
 procedures = []
 
 class Const(object):
@@ -207,6 +227,9 @@ class Const(object):
     def next(self):
         self.out.update(self.value)
 
+    def next_block(self, block_size: int):
+        self.out.update_block(self.value)
+
 class Ramp(object):
     def __init__(self, value, slope):
         global procedures
@@ -220,6 +243,10 @@ class Ramp(object):
         self.out.update(self.value)
         self.value += self.slope/fs
 
+    def next_block(self, block_size: int):
+        self.out.update_block(self.value + self.slope/fs * np.arange(block_size))
+        self.value += self.slope/fs * block_size
+
 class WaveForms(Enum):
     sine = 0
     triangle = 1
@@ -264,64 +291,153 @@ class Oscillator(object):
         self._phase += phase_increment
         while self._phase > 2*pi: self._phase -= 2*pi
 
+    def next_block(self, block_size: int):
+        freq_in_hz = f0 * 2.0**(input_block(self.in_freq, block_size)/120)
+        if self.in_fmod is not None:
+            freq_in_hz = freq_in_hz * (1+np.trunc(input_block(self.in_fmod, block_size))/100)
+        lin_ampl = 10.0**(input_block(self.in_ampl, block_size)/100)
+        phase_increment = 2*pi*freq_in_hz/fs
+        # Phase of each sample is the starting phase plus the increments of all previous samples in the block.
+        # NOTE: we wrap into [0, 2*pi), while next() never wraps negative phases. This only makes a difference
+        #       for non-sine waveforms, when the frequency is modulated below 0.
+        phase_acc = np.cumsum(phase_increment)
+        phase = np.mod(self._phase + phase_acc - phase_increment, 2*pi)
+        if self.waveform == WaveForms.sine:
+            a = np.sin(phase)
+        elif self.waveform == WaveForms.sawtooth:
+            a = phase/pi - 1
+        elif self.waveform == WaveForms.triangle:
+            a = np.abs(phase/pi*2 - 2) - 1
+        elif self.waveform == WaveForms.square:
+            a = np.where(phase > pi, 1.0, -1.0)
+        self.out.update_block(lin_ampl * a)
+        self._phase = float(np.mod(self._phase + phase_acc[-1], 2*pi))
+
+def render_reference(output: Param, sample_cnt: int) -> np.ndarray:
+    """
+    Renders 'sample_cnt' samples of 'output', one sample at a time
+    """
+    samples = []
+    for i in range(sample_cnt):
+        for p in params:
+            p.reset()
+        for procedure in procedures:
+            procedure.next()
+        samples.append(output.value)
+    return np.array(samples, dtype=np.float32)
+
+def render(output: Param, sample_cnt: int, block_size: int = 1024, buffer: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Renders 'sample_cnt' samples of 'output', evaluating the procedure graph over blocks of 'block_size' samples.
+
+    Procedures are evaluated in creation order (which needs to be a valid topological order of the graph).
+    The result is stored in 'buffer', if provided, otherwise into a newly allocated float32 array.
+    """
+    if buffer is None:
+        buffer = np.empty(sample_cnt, dtype=np.float32)
+    assert len(buffer) >= sample_cnt
+    for start in range(0, sample_cnt, block_size):
+        size = min(block_size, sample_cnt - start)
+        for p in params:
+            p.reset_block(size)
+        for procedure in procedures:
+            procedure.next_block(size)
+        buffer[start:start+size] = output.block
+    return buffer
+
+def write_wav(file_name: str, samples: np.ndarray, sample_rate: int = None):
+    """
+    Writes 'samples' (floats in the range of [-1.0, 1.0]) into a 16-bit mono WAV file
+    """
+    import wave
+
+    if sample_rate is None:
+        sample_rate = fs
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype("<i2")
+    with wave.open(file_name, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm.tobytes())
+
 # generate samples, note conversion to float32 array
 #samples = (np.sin(2 * np.pi * np.arange(fs * duration) * f / fs)).astype(np.float32)
 
-note_freq = -240
-note = Const(note_freq)
-#note2 = Ramp(0,60)
-ampl = Const(-100)
-
-modulator_freq = Const(note_freq)
-modulator_ampl = Const(200)
-
-modulator = Oscillator(WaveForms.sine, initial_phase=pi)
-osc = Oscillator(WaveForms.sine)
-
-modulator.in_ampl = modulator_ampl
-modulator.in_freq = modulator_freq
-
-osc.in_ampl = ampl.out
-osc.in_freq = note.out
-#note2.out = osc.in_freq
-#modulator.out = osc.in_freq
-osc.in_fmod = modulator.out
-
-output = osc.out
-samples = []
-for i in range(fs*duration):
-    for p in params:
-        p.reset()
-    note.next()
-    #note2.next()
-    ampl.next()
-    modulator.next()
-    osc.next()
-    samples.append(output.value)
-
-# per @yahweh comment explicitly convert to bytes sequence
-output_bytes = np.array(samples, dtype="float32").tobytes()
-
-# for paFloat32 sample values must be in range [-1.0, 1.0]
-p = pyaudio.PyAudio()
-
-stream = p.open(
-    format=pyaudio.paFloat32,
-    channels=1,
-    rate=fs,
-    output=True
-)
-
-# play. May repeat with different volume values (if done interactively)
-start_time = time.time()
-stream.write(output_bytes)
-print("Played sound for {:.2f} seconds".format(time.time() - start_time))
-
-stream.stop_stream()
-stream.close()
-
-p.terminate()
-
-section = samples[0:1500]
-plt.plot(np.arange(0, len(section)/fs, 1/fs), section)
-plt.show(block=True)
\ No newline at end of file
+def default_patch() -> Param:
+    """
+    Builds the default patch (an FM-modulated sine) and returns its output.
+
+    Procedures and parameters register themselves in the global lists when created, so any
+    previously built patch is dropped first.
+    """
+    procedures.clear()
+    params.clear()
+
+    note_freq = -240
+    note = Const(note_freq)
+    #note2 = Ramp(0,60)
+    ampl = Const(-100)
+
+    modulator_freq = Const(note_freq)
+    modulator_ampl = Const(200)
+
+    modulator = Oscillator(WaveForms.sine, initial_phase=pi)
+    osc = Oscillator(WaveForms.sine)
+
+    modulator.in_ampl = modulator_ampl
+    modulator.in_freq = modulator_freq
+
+    osc.in_ampl = ampl.out
+    osc.in_freq = note.out
+    #note2.out = osc.in_freq
+    #modulator.out = osc.in_freq
+    osc.in_fmod = modulator.out
+
+    return osc.out
+
+def play(samples: np.ndarray):
+    import pyaudio
+
+    # per @yahweh comment explicitly convert to bytes sequence
+    output_bytes = samples.astype(np.float32).tobytes()
+
+    # for paFloat32 sample values must be in range [-1.0, 1.0]
+    p = pyaudio.PyAudio()
+
+    stream = p.open(
+        format=pyaudio.paFloat32,
+        channels=1,
+        rate=fs,
+        output=True
+    )
+
+    # play. May repeat with different volume values (if done interactively)
+    start_time = time.time()
+    stream.write(output_bytes)
+    print("Played sound for {:.2f} seconds".format(time.time() - start_time))
+
+    stream.stop_stream()
+    stream.close()
+
+    p.terminate()
+
+if __name__ == "__main__":
+    import sys
+
+    output = default_patch()
+    start_time = time.perf_counter()
+    samples = render(output, fs*duration)
+    render_time = time.perf_counter() - start_time
+    print(f"Rendered {duration} seconds of audio with {len(procedures)} procedures in {render_time:.3f} seconds ({duration/render_time:.1f}x real-time)")
+
+    if len(sys.argv) > 1:
+        # Offline mode: write the result into a WAV file instead of playing it
+        write_wav(sys.argv[1], samples)
+    else:
+        import matplotlib.pyplot as plt
+
+        play(samples)
+
+        section = samples[0:1500]
+        plt.plot(np.arange(0, len(section)/fs, 1/fs), section)
+        plt.show(block=True)
@@ -0,0 +1,522 @@
+#!/bin/python
+"""
+Bit-exact fixed-point model of the procedure engine, outlined in the notes of sine1.py
+
+The goal of this model is to settle the sizing questions before any RTL gets written:
+- How wide the lookup tables need to be
+- How many bits of phase accumulator we need
+- How many procedures we can run per sample at a given engine clock rate
+
+Everything here is integer arithmetic on numpy int64 arrays; the model is evaluated over whole
+blocks of samples at once (one procedure at a time, in graph order), same as sine1.render().
+
+Number formats
+--------------
+
+Values in the connectivity array are signed 'sample_bits'-bit integers. Procedures ADD their
+outputs into the array, the sums are saturated when read back.
+
+Frequency controls are 10-bit logarithmic values in 1/10th of a semitone steps, 0 corresponding to
+'freq_base'. Conversion to a phase increment follows the notes:
+1. E = I[9:7], M = I[6:0] + 8*E (the 'correction factor': 128 vs. 120 steps per octave)
+2. If M >= 120: E += 1, M -= 120
+3. Two lookups: one on M[2:0], one on M[6:3]. Their product is the linear mantissa, which is
+   then shifted up by E.
+The constant scaling (freq_base/sample_rate*2^phase_bits) is folded into the M[6:3] table.
+
+Amplitude controls are 10-bit logarithmic attenuation values in 1/64th of 6.02dB steps
+(~0.094dB, 96dB range). E = A[9:6], M = A[5:0], no correction is needed. Two 3-bit lookups
+on M[2:0] and M[5:3] give the linear mantissa, which is then shifted down by E.
+
+Frequency modulation inputs are linear: the phase increment is scaled by (1+fmod/2^fmod_frac_bits).
+NOTE: the notes call for 1% steps; we use a power-of-two step (1/128 by default) instead, to avoid
+      a divide. The float reference uses 1% steps, so that shows up in the error figures.
+
+Phase accumulators
+------------------
+
+Two versions are modelled:
+
+'multiply': the two lookups are multiplied together, and the result is the phase increment.
+    The phase accumulator simply adds the increment every sample.
+'bresenham': the M[2:0] lookup stores reciprocals and is used as the denominator, the (shifted)
+    M[6:3] lookup is the numerator. The integer part of the quotient (computed when the control
+    changes) is added to the phase every sample, the remainder goes to an error accumulator,
+    which carries into the phase whenever it overflows the denominator. This is multiply-free,
+    except for frequency modulation, which is applied to the integer increment.
+    The error accumulator is cleared whenever the frequency control changes.
+
+Usage: synth_fixed.py [--phase-mode multiply|bresenham]
+"""
+
+import time
+from math import *
+from enum import Enum
+from dataclasses import dataclass
+from typing import Optional, Dict, List, Tuple
+
+import numpy as np
+
+import sine1
+from sine1 import WaveForms
+
+class PhaseMode(Enum):
+    multiply = 0
+    bresenham = 1
+
+@dataclass(frozen=True)
+class EngineConfig(object):
+    sample_rate: int = 15000
+    clock_rate: int = 10_000_000 # engine clock rate; used for throughput estimates only
+    control_bits: int = 10
+    sample_bits: int = 12
+    freq_base: float = 16.0
+    freq_lut_bits: int = 12
+    ampl_lut_bits: int = 12
+    phase_bits: int = 24
+    wave_bits: int = 8
+    fmod_frac_bits: int = 7
+    phase_mode: PhaseMode = PhaseMode.multiply
+
+    @property
+    def sample_max(self) -> int:
+        return (1 << (self.sample_bits-1)) - 1
+
+    @property
+    def sample_min(self) -> int:
+        return -(1 << (self.sample_bits-1))
+
+class LookupTables(object):
+    """
+    All the ROMs the engine needs for a given configuration
+    """
+    def __init__(self, config: EngineConfig):
+        self.config = config
+        F = config.freq_lut_bits
+        G = config.ampl_lut_bits
+        # Scaling of the frequency mantissa (1.0...2.0) to phase accumulator units per sample
+        phase_scale = config.freq_base / config.sample_rate * (1 << config.phase_bits)
+
+        self.freq_lo = np.array(list(round(2.0**(j/120) * (1 << F)) for j in range(8)), dtype=np.int64)
+        self.freq_hi = np.array(list(round(2.0**(8*k/120) * phase_scale) for k in range(15)), dtype=np.int64)
+        # Reciprocals for the Bresenham denominator
+        self.freq_den = np.array(list(round(2.0**(-j/120) * (1 << F)) for j in range(8)), dtype=np.int64)
+
+        self.ampl_lo = np.array(list(round(2.0**(-j/64) * (1 << G)) for j in range(8)), dtype=np.int64)
+        self.ampl_hi = np.array(list(round(2.0**(-8*k/64) * (1 << G)) for k in range(8)), dtype=np.int64)
+
+        wave_size = 1 << config.wave_bits
+        self.sine = np.array(list(round(sin(2*pi*i/wave_size) * config.sample_max) for i in range(wave_size)), dtype=np.int64)
+
+    def sizes(self) -> Dict[str, Tuple[int, int]]:
+        """
+        Returns the (entries, width in bits) of each table
+        """
+        def size(table: np.ndarray, signed: bool = False) -> Tuple[int, int]:
+            width = int(np.max(np.abs(table))).bit_length() + (1 if signed else 0)
+            return (len(table), width)
+        ret_val = {
+            "freq M[2:0]": size(self.freq_lo if self.config.phase_mode == PhaseMode.multiply else self.freq_den),
+            "freq M[6:3]": size(self.freq_hi),
+            "ampl M[2:0]": size(self.ampl_lo),
+            "ampl M[5:3]": size(self.ampl_hi),
+            "sine": size(self.sine, signed=True),
+        }
+        return ret_val
+
+    def total_bits(self) -> int:
+        return sum(entries * width for entries, width in self.sizes().values())
+
+    def freq_fields(self, freq: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Splits a frequency control into (E, M[2:0], M[6:3])
+        """
+        exp = freq >> 7
+        mant = (freq & 127) + 8*exp
+        wrap = mant >= 120
+        exp = exp + wrap
+        mant = mant - 120*wrap
+        return exp, mant & 7, mant >> 3
+
+    def phase_increment(self, freq: np.ndarray) -> np.ndarray:
+        """
+        Log-to-linear conversion of frequency controls to phase increments (multiply version)
+        """
+        exp, lo, hi = self.freq_fields(freq)
+        return ((self.freq_lo[lo] * self.freq_hi[hi]) >> self.config.freq_lut_bits) << exp
+
+    def bresenham_fraction(self, freq: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Log-to-linear conversion of frequency controls to a (numerator, denominator) pair
+        """
+        exp, lo, hi = self.freq_fields(freq)
+        return (self.freq_hi[hi] << exp) << self.config.freq_lut_bits, self.freq_den[lo]
+
+    def amplitude(self, ampl: np.ndarray) -> np.ndarray:
+        """
+        Log-to-linear conversion of attenuation controls. Result is in 2^-ampl_lut_bits units
+        """
+        exp = ampl >> 6
+        lo = ampl & 7
+        hi = (ampl >> 3) & 7
+        return ((self.ampl_lo[lo] * self.ampl_hi[hi]) >> self.config.ampl_lut_bits) >> exp
+
+
+class FixedProcedure(object):
+    # Estimated memory accesses per evaluation; the engine is assumed to do one access per clock cycle
+    state_reads = 0
+    state_writes = 0
+    array_reads = 0
+    array_writes = 0
+
+    @classmethod
+    def cycles(cls) -> int:
+        return cls.state_reads + cls.state_writes + cls.array_reads + cls.array_writes
+
+class FixedConst(FixedProcedure):
+    state_reads = 1
+    array_writes = 1
+
+    def __init__(self, engine: 'FixedEngine', value: int):
+        self.value = value
+        self.out = engine.add_procedure(self)
+
+    def next_block(self, engine: 'FixedEngine', block_size: int):
+        engine.update(self.out, np.full(block_size, self.value, dtype=np.int64))
+
+class FixedOscillator(FixedProcedure):
+    # phase, error accumulator, waveform/output pointer, input pointers
+    state_reads = 4
+    state_writes = 2
+    array_reads = 3
+    array_writes = 1
+
+    def __init__(self, engine: 'FixedEngine', waveform: WaveForms, initial_phase: int = 0):
+        self.waveform = waveform
+        self.in_freq: Optional[int] = None
+        self.in_ampl: Optional[int] = None
+        self.in_fmod: Optional[int] = None
+        self.phase = initial_phase
+        self.error = 0
+        self.last_freq = None
+        self.out = engine.add_procedure(self)
+
+    def _phases(self, engine: 'FixedEngine', freq: np.ndarray, fmod: Optional[np.ndarray]) -> np.ndarray:
+        """
+        Returns the phase for each sample in the block, and updates the phase accumulator state
+        """
+        config = engine.config
+        luts = engine.luts
+        phase_mask = (1 << config.phase_bits) - 1
+        block_size = len(freq)
+
+        if config.phase_mode == PhaseMode.multiply:
+            increment = luts.phase_increment(freq)
+            if fmod is not None:
+                increment = increment + ((increment * fmod) >> config.fmod_frac_bits)
+            # Phase of each sample is the starting phase plus the increments of all previous samples
+            acc = self.phase + np.cumsum(increment)
+            phases = np.empty(block_size, dtype=np.int64)
+            phases[0] = self.phase
+            phases[1:] = acc[:-1]
+            self.phase = int(acc[-1]) & phase_mask
+            return phases & phase_mask
+
+        # Bresenham: process runs of samples with a constant frequency control in closed form
+        phases = np.empty(block_size, dtype=np.int64)
+        change_points = np.flatnonzero(np.diff(freq)) + 1
+        starts = np.concatenate(([0], change_points))
+        ends = np.concatenate((change_points, [block_size]))
+        for start, end in zip(starts, ends):
+            control = int(freq[start])
+            if control != self.last_freq:
+                self.error = 0
+                self.last_freq = control
+            num, den = luts.bresenham_fraction(np.array([control]))
+            num = int(num[0])
+            den = int(den[0])
+            quotient, remainder = divmod(num, den)
+            run = end - start
+            increment = np.full(run, quotient, dtype=np.int64)
+            if fmod is not None:
+                increment = increment + ((increment * fmod[start:end]) >> config.fmod_frac_bits)
+            # Carries from the error accumulator: after n samples it holds error + n*remainder
+            errors = self.error + remainder * np.arange(1, run+1, dtype=np.int64)
+            acc = self.phase + np.cumsum(increment) + errors // den
+            phases[start] = self.phase
+            phases[start+1:end] = acc[:-1]
+            self.phase = int(acc[-1]) & phase_mask
+            self.error = int(errors[-1] % den)
+        return phases & phase_mask
+
+    def next_block(self, engine: 'FixedEngine', block_size: int):
+        config = engine.config
+        control_max = (1 << config.control_bits) - 1
+        freq = np.clip(engine.read(self.in_freq), 0, control_max)
+        ampl = np.clip(engine.read(self.in_ampl), 0, control_max)
+        fmod = engine.read(self.in_fmod) if self.in_fmod is not None else None
+
+        phases = self._phases(engine, freq, fmod)
+        wave_idx = phases >> (config.phase_bits - config.wave_bits)
+        if self.waveform == WaveForms.sine:
+            wave = engine.luts.sine[wave_idx]
+        elif self.waveform == WaveForms.sawtooth:
+            wave = (phases >> (config.phase_bits - config.sample_bits)) + config.sample_min
+        elif self.waveform == WaveForms.triangle:
+            # Triangle is a folded sawtooth, with twice the slope
+            saw = (phases >> (config.phase_bits - config.sample_bits - 1)) - (1 << config.sample_bits)
+            wave = np.minimum(np.abs(saw), (1 << config.sample_bits) - 1) - config.sample_max
+        elif self.waveform == WaveForms.square:
+            wave = np.where(phases >> (config.phase_bits - 1), config.sample_max, -config.sample_max)
+        engine.update(self.out, (wave * engine.luts.amplitude(ampl)) >> config.ampl_lut_bits)
+
+class FixedEngine(object):
+    """
+    The procedure engine: a list of procedures (in evaluation order) and a connectivity array
+    """
+    def __init__(self, config: EngineConfig = EngineConfig()):
+        self.config = config
+        self.luts = LookupTables(config)
+        self.procedures: List[FixedProcedure] = []
+        self.array = None
+
+    def add_procedure(self, procedure: FixedProcedure) -> int:
+        """
+        Registers a procedure and returns the index of its (single) output in the connectivity array
+        """
+        self.procedures.append(procedure)
+        return len(self.procedures) - 1
+
+    def read(self, slot: int) -> np.ndarray:
+        return np.clip(self.array[slot], self.config.sample_min, self.config.sample_max)
+
+    def update(self, slot: int, values: np.ndarray):
+        self.array[slot] += values
+
+    def render(self, output: int, sample_cnt: int, block_size: int = 1024) -> np.ndarray:
+        buffer = np.empty(sample_cnt, dtype=np.int64)
+        for start in range(0, sample_cnt, block_size):
+            size = min(block_size, sample_cnt - start)
+            self.array = np.zeros((len(self.procedures), size), dtype=np.int64)
+            for procedure in self.procedures:
+                procedure.next_block(self, size)
+            buffer[start:start+size] = self.read(output)
+        return buffer
+
+    def cycles_per_sample(self) -> int:
+        return sum(procedure.cycles() for procedure in self.procedures)
+
+    def max_procedures_per_sample(self, procedure_type: type = FixedOscillator) -> int:
+        return self.config.clock_rate // self.config.sample_rate // procedure_type.cycles()
+
+def sequential_oscillator(luts: LookupTables, freq: int, ampl: int, sample_cnt: int, initial_phase: int = 0) -> np.ndarray:
+    """
+    Sample-by-sample version of FixedOscillator (sine, no modulation), the way HW would compute it.
+    Used to check that the vectorised model is indeed bit-exact.
+    """
+    config = luts.config
+    phase_mask = (1 << config.phase_bits) - 1
+    phase = initial_phase
+    error = 0
+    lin_ampl = int(luts.amplitude(np.array([ampl]))[0])
+    if config.phase_mode == PhaseMode.multiply:
+        increment = int(luts.phase_increment(np.array([freq]))[0])
+    else:
+        num, den = luts.bresenham_fraction(np.array([freq]))
+        quotient, remainder = divmod(int(num[0]), int(den[0]))
+    samples = []
+    for _ in range(sample_cnt):
+        wave = int(luts.sine[phase >> (config.phase_bits - config.wave_bits)])
+        samples.append((wave * lin_ampl) >> config.ampl_lut_bits)
+        if config.phase_mode == PhaseMode.multiply:
+            phase = (phase + increment) & phase_mask
+        else:
+            phase += quotient
+            error += remainder
+            if error >= int(den[0]):
+                error -= int(den[0])
+                phase += 1
+            phase &= phase_mask
+    return np.array(samples, dtype=np.int64)
+
+def reference_freq(config: EngineConfig, freq: int) -> float:
+    """
+    Converts a fixed frequency control into the units of sine1.Oscillator.in_freq
+    """
+    return freq + 120*log2(config.freq_base/sine1.f0)
+
+def reference_ampl(config: EngineConfig, ampl: int, scale: float = 1.0) -> float:
+    """
+    Converts a fixed attenuation control into the units of sine1.Oscillator.in_ampl
+    """
+    return 100*log10(2.0**(-ampl/64) * scale)
+
+def reference_patch(config: EngineConfig, freq: int, ampl: int, fm: Optional[Tuple[int, int]] = None) -> sine1.Param:
+    """
+    Creates a (float) sine1 patch: an oscillator, optionally frequency-modulated by another one.
+    Returns the output of the patch.
+    """
+    sine1.fs = config.sample_rate
+    sine1.params.clear()
+    sine1.procedures.clear()
+    if fm is not None:
+        fm_freq, fm_ampl = fm
+        # The modulator output is in 1% units in the reference, 1/2^fmod_frac_bits units in the fixed model
+        fm_scale = config.sample_max * 100 / (1 << config.fmod_frac_bits)
+        # Procedures are evaluated in creation order, so inputs need to be created first
+        modulator_freq = sine1.Const(reference_freq(config, fm_freq))
+        modulator_ampl = sine1.Const(reference_ampl(config, fm_ampl, fm_scale))
+        modulator = sine1.Oscillator(WaveForms.sine)
+        modulator.in_freq = modulator_freq.out
+        modulator.in_ampl = modulator_ampl.out
+    carrier_freq = sine1.Const(reference_freq(config, freq))
+    carrier_ampl = sine1.Const(reference_ampl(config, ampl))
+    osc = sine1.Oscillator(WaveForms.sine)
+    osc.in_freq = carrier_freq.out
+    osc.in_ampl = carrier_ampl.out
+    if fm is not None:
+        osc.in_fmod = modulator.out
+    return osc.out
+
+def fixed_patch(config: EngineConfig, freq: int, ampl: int, fm: Optional[Tuple[int, int]] = None) -> Tuple[FixedEngine, int]:
+    engine = FixedEngine(config)
+    if fm is not None:
+        fm_freq, fm_ampl = fm
+        modulator_freq = FixedConst(engine, fm_freq)
+        modulator_ampl = FixedConst(engine, fm_ampl)
+        modulator = FixedOscillator(engine, WaveForms.sine)
+        modulator.in_freq = modulator_freq.out
+        modulator.in_ampl = modulator_ampl.out
+    carrier_freq = FixedConst(engine, freq)
+    carrier_ampl = FixedConst(engine, ampl)
+    osc = FixedOscillator(engine, WaveForms.sine)
+    osc.in_freq = carrier_freq.out
+    osc.in_ampl = carrier_ampl.out
+    if fm is not None:
+        osc.in_fmod = modulator.out
+    return engine, osc.out
+
+def tuning_error(luts: LookupTables) -> np.ndarray:
+    """
+    Returns the frequency error (in cents) of the log-to-linear conversion for every frequency control value
+    """
+    config = luts.config
+    controls = np.arange(1 << config.control_bits, dtype=np.int64)
+    if config.phase_mode == PhaseMode.multiply:
+        increment = luts.phase_increment(controls).astype(np.float64)
+    else:
+        num, den = luts.bresenham_fraction(controls)
+        increment = num / den
+    exact = config.freq_base * 2.0**(controls/120) / config.sample_rate * (1 << config.phase_bits)
+    return 1200*np.log2(increment/exact)
+
+def amplitude_error(luts: LookupTables) -> np.ndarray:
+    """
+    Returns the error (in dB) of the log-to-linear conversion for every attenuation control value
+    """
+    config = luts.config
+    controls = np.arange(1 << config.control_bits, dtype=np.int64)
+    linear = luts.amplitude(controls) / (1 << config.ampl_lut_bits)
+    exact = 2.0**(-controls/64)
+    with np.errstate(divide="ignore"):
+        return 20*np.log10(linear/exact)
+
+def compare(config: EngineConfig, freq: int, ampl: int, fm: Optional[Tuple[int, int]] = None, sample_cnt: int = 256) -> Dict[str, float]:
+    """
+    Renders the same patch with the fixed model and the float reference (sine1.Oscillator.next()).
+    Returns error figures in LSBs of the output and the SNR in dB.
+
+    NOTE: tuning errors accumulate into phase errors over time, which eventually dominate any
+          sample-by-sample comparison. That's why the default window is short; tuning accuracy
+          is reported separately by tuning_error().
+    """
+    engine, output = fixed_patch(config, freq, ampl, fm)
+    fixed = engine.render(output, sample_cnt).astype(np.float64)
+    reference = sine1.render_reference(reference_patch(config, freq, ampl, fm), sample_cnt).astype(np.float64) * config.sample_max
+    error = fixed - reference
+    rms_error = sqrt(np.mean(error**2))
+    rms_signal = sqrt(np.mean(reference**2))
+    return {
+        "max_error": float(np.max(np.abs(error))),
+        "rms_error": rms_error,
+        "snr_db": 20*log10(rms_signal/rms_error) if rms_error > 0 else inf,
+    }
+
+def report(config: EngineConfig = EngineConfig()):
+    print(f"Configuration: {config}")
+
+    luts = LookupTables(config)
+    print("Lookup tables:")
+    for name, (entries, width) in luts.sizes().items():
+        print(f"    {name:<12} {entries:4} x {width:2} bits")
+    print(f"    total: {luts.total_bits()} bits")
+
+    engine = FixedEngine(config)
+    print("Throughput:")
+    for procedure_type in (FixedConst, FixedOscillator):
+        print(f"    {procedure_type.__name__:<16} {procedure_type.cycles()} cycles")
+    max_procs = engine.max_procedures_per_sample(FixedOscillator)
+    print(f"    {config.clock_rate/1e6:.1f}MHz clock at {config.sample_rate}Hz sample rate: {max_procs} oscillators per sample ({'meets' if max_procs >= 50 else 'MISSES'} the 50 procedure budget)")
+
+    # Self-check: vectorised model vs. sample-by-sample evaluation
+    for freq in (0, 517, 1023):
+        engine, output = fixed_patch(config, freq, 0)
+        vectorised = engine.render(output, 2000, block_size=333)
+        sequential = sequential_oscillator(luts, freq, 0, 2000)
+        assert np.array_equal(vectorised, sequential), f"Vectorised and sequential models differ for frequency control {freq}"
+    print("Vectorised model matches sample-by-sample evaluation")
+
+    cents = tuning_error(luts)
+    print(f"Tuning error: max {np.max(np.abs(cents)):.3f} cents, rms {sqrt(np.mean(cents**2)):.3f} cents")
+    db = amplitude_error(luts)
+    # Only consider controls where the output is still above 1 LSB
+    audible = np.arange(len(db)) < 64 * (config.sample_bits - 1)
+    finite = audible & np.isfinite(db)
+    print(f"Amplitude error: max {np.max(np.abs(db[finite])):.3f}dB above 1 LSB output, {np.count_nonzero(~np.isfinite(db))} controls mute")
+
+    print("Error against float reference:")
+    cases = (
+        ("low tone",        (120, 0, None)),
+        ("mid tone",        (600, 0, None)),
+        ("high tone",       (1000, 0, None)),
+        ("-30dB",           (600, 320, None)),
+        ("-60dB",           (600, 640, None)),
+        ("FM (sine1 patch)", (600, 0, (600, 256))),
+    )
+    for name, (freq, ampl, fm) in cases:
+        result = compare(config, freq, ampl, fm)
+        print(f"    {name:<18} max {result['max_error']:8.2f} LSB  rms {result['rms_error']:8.3f} LSB  SNR {result['snr_db']:6.1f}dB")
+
+    print("Sine table size vs. error (mid tone):")
+    for wave_bits in range(6, 13):
+        sized_config = EngineConfig(**{**config.__dict__, "wave_bits": wave_bits})
+        result = compare(sized_config, 600, 0)
+        print(f"    {1 << wave_bits:5} entries: max {result['max_error']:8.2f} LSB  SNR {result['snr_db']:6.1f}dB")
+
+    sample_cnt = config.sample_rate
+    engine = FixedEngine(config)
+    carrier = None
+    for _ in range(24):
+        modulator_freq = FixedConst(engine, 500)
+        modulator_ampl = FixedConst(engine, 256)
+        modulator = FixedOscillator(engine, WaveForms.sine)
+        modulator.in_freq = modulator_freq.out
+        modulator.in_ampl = modulator_ampl.out
+        carrier_freq = FixedConst(engine, 600)
+        carrier_ampl = FixedConst(engine, 300)
+        carrier = FixedOscillator(engine, WaveForms.sine)
+        carrier.in_freq = carrier_freq.out
+        carrier.in_ampl = carrier_ampl.out
+        carrier.in_fmod = modulator.out
+    start_time = time.perf_counter()
+    engine.render(carrier.out, sample_cnt)
+    render_time = time.perf_counter() - start_time
+    print(f"Model speed: {len(engine.procedures)} procedures, 1s of audio in {render_time:.3f}s ({len(engine.procedures)*sample_cnt/render_time/1e6:.1f}M procedures/s)")
+
+if __name__ == "__main__":
+    import sys
+
+    phase_mode = PhaseMode.multiply
+    if "--phase-mode" in sys.argv:
+        phase_mode = PhaseMode[sys.argv[sys.argv.index("--phase-mode")+1]]
+    report(EngineConfig(phase_mode=phase_mode))
@@ -0,0 +1,579 @@
+#!/usr/bin/python3
+"""
+Hardware implementation of the procedure-list synthesizer, explored in experiments/sine1.py
+
+The fixed-point details (table sizes, control formats and rounding) follow experiments/synth_fixed.py,
+so that model can be used as the golden reference for this block.
+
+The engine processes a list of procedures, once every sample period. Each procedure is described
+by an 8-byte record in the state RAM:
+
+    byte 0:    [1:0] opcode (0: nop, 1: constant, 2: oscillator)
+               [3:2] waveform (sine, triangle, sawtooth, square; same encoding as sine1.WaveForms)
+               [4]   oscillator is frequency-modulated
+    byte 1:    output slot in the connectivity array
+    byte 2..3: constant: 16-bit value (little endian)
+               oscillator: frequency slot (byte 2) and attenuation slot (byte 3)
+    byte 4:    oscillator: frequency modulation slot
+    byte 5..7: oscillator: 24-bit phase accumulator (maintained by the engine)
+
+Procedures add their output to their output slot in the connectivity array. The array is cleared at the
+beginning of every sample: each entry carries a generation tag and an entry is read as 0 unless its
+tag matches that of the current sample. Advancing the generation clears the whole array in zero cycles.
+The tag is wider than the array index and, after every sample, one entry (in a round-robin fashion) is
+cleared explicitly. This way an entry is zeroed long before the generation counter wraps around, so an
+entry that is not written any more (after a patch change for instance) never becomes valid again.
+
+Once all procedures are processed, the contents of 'out_slot' are saturated and presented on 'sample'.
+If the next sample period starts before the engine is done, the 'underrun' bit is set in the status register.
+
+The state RAM can be written through the register interface (a pointer and a data register), or
+by a (fly-by) DMA channel of CpuDma: when 'dma_en' is set in the control register, 'drq' is asserted
+and every DMA cycle stores a byte at the pointer, until the DMA controller signals terminal count.
+The DMA channel should be set up in 'read' mode (memory to I/O) and as a master.
+
+Register map:
+    0: control:         [0] enable [1] dma_en [2] underrun interrupt enable [3] sample interrupt enable
+    1: status:          [0] busy [1] underrun [2] sample ready [3] dma_en
+                        underrun and sample ready are cleared by writing 1 to them
+    2: pointer low:     state RAM byte address, bits 7...0
+    3: pointer high:    state RAM byte address, bits 9...8
+    4: data:            write-only; writes to the state RAM at pointer, then increments pointer
+    5: procedure count: number of procedures to process every sample
+    6: divider low:     sample period in clock cycles - 1, bits 7...0
+    7: divider high:    sample period in clock cycles - 1, bits 15...8
+    8: output slot:     connectivity array entry presented on 'sample'
+    9: sample low:      last sample, bits 7...0
+   10: sample high:     last sample, bits 15...8
+"""
+import sys
+from pathlib import Path
+from math import sin, pi
+
+sys.path.append(str(Path(__file__).parent / ".." / ".." / ".." / "silicon"))
+sys.path.append(str(Path(__file__).parent / ".." / "espresso"))
+
+from brew_types import *
+from silicon import *
+
+proc_addr_bits = 7 # up to 128 procedures
+slot_bits = 6 # 64 entries in the connectivity array
+array_bits = 16
+control_bits = 10
+sample_bits = 12
+freq_lut_bits = 12
+ampl_lut_bits = 12
+phase_bits = 24
+wave_bits = 8
+fmod_frac_bits = 7
+
+sample_max = (1 << (sample_bits-1)) - 1
+sample_min = -(1 << (sample_bits-1))
+
+class FmSynthOps(Enum):
+    nop = 0
+    const = 1
+    osc = 2
+
+class FmSynthWaveForms(Enum):
+    sine = 0
+    triangle = 1
+    sawtooth = 2
+    square = 3
+
+def freq_lo_table():
+    return list(round(2.0**(j/120) * (1 << freq_lut_bits)) for j in range(8))
+
+def freq_hi_table(sample_rate: int, freq_base: float):
+    phase_scale = freq_base / sample_rate * (1 << phase_bits)
+    # Only 15 entries are used, the last one is there to make the table a power of 2
+    table = list(round(2.0**(8*k/120) * phase_scale) for k in range(15))
+    return table + [table[-1]]
+
+def ampl_lo_table():
+    return list(round(2.0**(-j/64) * (1 << ampl_lut_bits)) for j in range(8))
+
+def ampl_hi_table():
+    return list(round(2.0**(-8*k/64) * (1 << ampl_lut_bits)) for k in range(8))
+
+def sine_table():
+    # Two's complement encoded sample_bits wide values
+    wave_size = 1 << wave_bits
+    sample_mask = (1 << sample_bits) - 1
+    return list(round(sin(2*pi*i/wave_size) * sample_max) & sample_mask for i in range(wave_size))
+
+def lookup(idx: Junction, table: Sequence[int], width: int) -> Junction:
+    return Select(idx, *(Unsigned(width)(value) for value in table))
+
+def saturate(value: Junction) -> Junction:
+    """
+    Clips a (two's complement) connectivity array entry to sample_bits
+    """
+    top = value[array_bits-1:sample_bits-1]
+    all_ones = (1 << (array_bits-sample_bits+1)) - 1
+    pos_overflow = ~value[array_bits-1] & (top != 0)
+    neg_overflow =  value[array_bits-1] & (top != all_ones)
+    return SelectFirst(
+        pos_overflow, sample_max,
+        neg_overflow, sample_min & ((1 << sample_bits) - 1),
+        default_port = value[sample_bits-1:0]
+    )
+
+def control(value: Junction) -> Junction:
+    """
+    Clips a saturated array entry to the (unsigned) control_bits wide range
+    """
+    return Select(value[sample_bits-1],
+        Select(value[sample_bits-2:control_bits] != 0, value[control_bits-1:0], (1 << control_bits) - 1),
+        0
+    )
+
+class FmSynth(GenericModule):
+    clk = ClkPort()
+    rst = RstPort()
+
+    bus_if = Input(Apb8If)
+    interrupt = Output(logic)
+
+    # Fly-by DMA interface towards CpuDma
+    drq = Output(logic)
+    n_dack = Input(logic)
+    tc = Input(logic)
+    dma_data = Input(BrewByte)
+
+    sample = Output(Unsigned(16)) # two's complement
+    sample_valid = Output(logic)
+
+    ctrl_reg_ofs = 0
+    status_reg_ofs = 1
+    ptr_lo_reg_ofs = 2
+    ptr_hi_reg_ofs = 3
+    data_reg_ofs = 4
+    proc_cnt_reg_ofs = 5
+    divider_lo_reg_ofs = 6
+    divider_hi_reg_ofs = 7
+    out_slot_reg_ofs = 8
+    sample_lo_reg_ofs = 9
+    sample_hi_reg_ofs = 10
+
+    def construct(self, sample_rate: int = 15000, freq_base: float = 16.0):
+        # The frequency tables are computed for a nominal sample rate. Other rates (set by the divider register)
+        # shift all frequencies by the same ratio.
+        self.sample_rate = sample_rate
+        self.freq_base = freq_base
+
+    def body(self):
+        class FmSynthStates(Enum):
+            idle = 0
+            fetch = 1
+            decode = 2
+            read_freq = 3
+            read_ampl = 4
+            read_fmod = 5
+            read_out = 6
+            write = 7
+            output_fetch = 8
+            output = 9
+            scrub = 10
+
+        ptr_bits = proc_addr_bits + 3
+
+        # Register interface
+        ####################
+        def reg_wr(ofs):
+            return self.bus_if.psel & self.bus_if.penable & self.bus_if.pwrite & (self.bus_if.paddr == ofs)
+
+        ctrl_reg_wr = reg_wr(FmSynth.ctrl_reg_ofs)
+        status_reg_wr = reg_wr(FmSynth.status_reg_ofs)
+        data_reg_wr = reg_wr(FmSynth.data_reg_ofs)
+
+        enable = Reg(self.bus_if.pwdata[0], clock_en=ctrl_reg_wr)
+        underrun_int_en = Reg(self.bus_if.pwdata[2], clock_en=ctrl_reg_wr)
+        sample_int_en = Reg(self.bus_if.pwdata[3], clock_en=ctrl_reg_wr)
+        proc_cnt = Reg(self.bus_if.pwdata, clock_en=reg_wr(FmSynth.proc_cnt_reg_ofs))
+        divider_lo = Reg(self.bus_if.pwdata, clock_en=reg_wr(FmSynth.divider_lo_reg_ofs))
+        divider_hi = Reg(self.bus_if.pwdata, clock_en=reg_wr(FmSynth.divider_hi_reg_ofs))
+        divider = concat(divider_hi, divider_lo)
+        out_slot = Reg(self.bus_if.pwdata[slot_bits-1:0], clock_en=reg_wr(FmSynth.out_slot_reg_ofs))
+
+        # DMA interface: the byte is captured while n_dack is low and written to the state RAM once the cycle ends
+        dma_en = Wire(logic)
+        prev_n_dack = Reg(self.n_dack, reset_value_port=1)
+        dma_byte = Reg(self.dma_data, clock_en=~self.n_dack)
+        dma_tc = Reg(self.tc, clock_en=~self.n_dack)
+        dma_write = ~prev_n_dack & self.n_dack
+        dma_en <<= Reg(Select(ctrl_reg_wr, Select(dma_write & dma_tc, dma_en, 0), self.bus_if.pwdata[1]))
+        self.drq <<= dma_en
+
+        host_write = data_reg_wr | dma_write
+        host_data = Select(dma_write, self.bus_if.pwdata, dma_byte)
+
+        ptr = Wire(Unsigned(ptr_bits))
+        ptr <<= Reg(SelectFirst(
+            reg_wr(FmSynth.ptr_lo_reg_ofs), concat(ptr[ptr_bits-1:8], self.bus_if.pwdata),
+            reg_wr(FmSynth.ptr_hi_reg_ofs), concat(self.bus_if.pwdata[ptr_bits-9:0], ptr[7:0]),
+            host_write, (ptr + 1)[ptr_bits-1:0],
+            default_port = ptr
+        ))
+
+        # Sample clock
+        ##############
+        divider_cnt = Wire(Unsigned(16))
+        sample_tick = enable & (divider_cnt == divider)
+        divider_cnt <<= Reg(Select(sample_tick | ~enable, (divider_cnt + 1)[15:0], 0))
+
+        # Engine state machine
+        ######################
+        self.fsm = FSM()
+
+        self.fsm.reset_value   <<= FmSynthStates.idle
+        self.fsm.default_state <<= FmSynthStates.idle
+
+        state = self.fsm.state
+
+        proc_idx = Wire(Unsigned(8))
+        last_proc = proc_idx == proc_cnt
+        # Host (and DMA) writes take priority over the engine on the state RAM port
+        stall = host_write
+
+        self.fsm.add_transition(FmSynthStates.idle,         sample_tick,          FmSynthStates.fetch)
+        self.fsm.add_transition(FmSynthStates.fetch,        stall,                FmSynthStates.fetch)
+        self.fsm.add_transition(FmSynthStates.fetch,        ~stall &  last_proc,  FmSynthStates.output_fetch)
+        self.fsm.add_transition(FmSynthStates.fetch,        ~stall & ~last_proc,  FmSynthStates.decode)
+        self.fsm.add_transition(FmSynthStates.decode,       1,                    FmSynthStates.read_freq)
+        self.fsm.add_transition(FmSynthStates.read_freq,    1,                    FmSynthStates.read_ampl)
+        self.fsm.add_transition(FmSynthStates.read_ampl,    1,                    FmSynthStates.read_fmod)
+        self.fsm.add_transition(FmSynthStates.read_fmod,    1,                    FmSynthStates.read_out)
+        self.fsm.add_transition(FmSynthStates.read_out,     1,                    FmSynthStates.write)
+        self.fsm.add_transition(FmSynthStates.write,        stall,                FmSynthStates.write)
+        self.fsm.add_transition(FmSynthStates.write,        ~stall,               FmSynthStates.fetch)
+        self.fsm.add_transition(FmSynthStates.output_fetch, 1,                    FmSynthStates.output)
+        self.fsm.add_transition(FmSynthStates.output,       1,                    FmSynthStates.scrub)
+        self.fsm.add_transition(FmSynthStates.scrub,        1,                    FmSynthStates.idle)
+
+        busy = state != FmSynthStates.idle
+        proc_write = (state == FmSynthStates.write) & ~stall
+        proc_idx <<= Reg(SelectFirst(
+            state == FmSynthStates.idle, 0,
+            proc_write, (proc_idx + 1)[7:0],
+            default_port = proc_idx
+        ))
+
+        # Generation tag of the connectivity array entries: one more bit than the array index,
+        # so scrubbing (one entry per sample) always gets around before the generation wraps.
+        gen_bits = slot_bits + 1
+        epoch = Wire(Unsigned(gen_bits))
+        epoch <<= Reg(Select(sample_tick & ~busy, epoch, (epoch + 1)[gen_bits-1:0]))
+        scrub = state == FmSynthStates.scrub
+        scrub_ptr = Wire(Unsigned(slot_bits))
+        scrub_ptr <<= Reg(Select(scrub, scrub_ptr, (scrub_ptr + 1)[slot_bits-1:0]))
+
+        # State RAM: 8 byte-lanes, one for each byte of a procedure record
+        ##################################################################
+        state_addr = Select(host_write, proc_idx[proc_addr_bits-1:0], ptr[ptr_bits-1:3])
+        new_phase = Wire(Unsigned(phase_bits))
+        rec_opcode = Wire(Unsigned(2))
+        lanes = []
+        for lane_idx in range(8):
+            lane = Memory(MemoryConfig(
+                (
+                    MemoryPortConfig(addr_type=Unsigned(proc_addr_bits), data_type=BrewByte, registered_input=False, registered_output=True),
+                ),
+                None
+            ))
+            lane.addr <<= state_addr
+            host_lane_write = host_write & (ptr[2:0] == lane_idx)
+            if lane_idx >= 5:
+                phase_byte = new_phase[(lane_idx-5)*8+7:(lane_idx-5)*8]
+                lane.data_in <<= Select(host_write, phase_byte, host_data)
+                lane.write_en <<= host_lane_write | (proc_write & (rec_opcode == FmSynthOps.osc.value))
+            else:
+                lane.data_in <<= host_data
+                lane.write_en <<= host_lane_write
+            setattr(self, f"state_lane_{lane_idx}", lane)
+            lanes.append(lane.data_out)
+
+        decode = state == FmSynthStates.decode
+        rec_opcode <<= Reg(lanes[0][1:0], clock_en=decode)
+        rec_waveform = Reg(lanes[0][3:2], clock_en=decode)
+        rec_has_fmod = Reg(lanes[0][4], clock_en=decode)
+        rec_out_slot = Reg(lanes[1][slot_bits-1:0], clock_en=decode)
+        rec_ampl_slot = Reg(lanes[3][slot_bits-1:0], clock_en=decode)
+        rec_fmod_slot = Reg(lanes[4][slot_bits-1:0], clock_en=decode)
+        rec_value = Reg(concat(lanes[3], lanes[2]), clock_en=decode)
+        rec_phase = Reg(concat(lanes[7], lanes[6], lanes[5]), clock_en=decode)
+
+        # Connectivity array
+        ####################
+        array = Memory(MemoryConfig(
+            (
+                MemoryPortConfig(addr_type=Unsigned(slot_bits), data_type=Unsigned(array_bits+gen_bits), registered_input=False, registered_output=True),
+            ),
+            None
+        ))
+        array.addr <<= SelectOne(
+            decode,                               lanes[2][slot_bits-1:0],
+            state == FmSynthStates.read_freq,     rec_ampl_slot,
+            state == FmSynthStates.read_ampl,     rec_fmod_slot,
+            state == FmSynthStates.read_fmod,     rec_out_slot,
+            state == FmSynthStates.read_out,      rec_out_slot,
+            state == FmSynthStates.write,         rec_out_slot,
+            scrub,                                scrub_ptr,
+            default_port = out_slot
+        )
+        # Entries written in a previous sample read as 0
+        array_value = Select(array.data_out[array_bits+gen_bits-1:array_bits] == epoch, 0, array.data_out[array_bits-1:0])
+        array_sat = saturate(array_value)
+
+        freq_ctrl = Reg(control(array_sat), clock_en=state == FmSynthStates.read_freq)
+        ampl_ctrl = Reg(control(array_sat), clock_en=state == FmSynthStates.read_ampl)
+        fmod = Reg(Select(rec_has_fmod, 0, array_sat), clock_en=state == FmSynthStates.read_fmod)
+        acc_value = Reg(array_value, clock_en=state == FmSynthStates.read_out)
+
+        # Oscillator datapath
+        #####################
+        # Log-to-linear frequency conversion: 120 steps per octave. See LookupTables.freq_fields
+        freq_exp = freq_ctrl[control_bits-1:7]
+        freq_mant = freq_ctrl[6:0] + concat(freq_exp, "3'b0")
+        freq_wrap = freq_mant >= 120
+        freq_exp = (freq_exp + freq_wrap)[3:0]
+        freq_mant = Select(freq_wrap, freq_mant, freq_mant - 120)[6:0]
+        freq_lo = lookup(freq_mant[2:0], freq_lo_table(), freq_lut_bits+1)
+        freq_hi = lookup(freq_mant[6:3], freq_hi_table(self.sample_rate, self.freq_base), phase_bits)
+        increment = ((freq_lo * freq_hi) >> freq_lut_bits) << freq_exp
+
+        # Frequency modulation: increment * (1 + fmod/2^fmod_frac_bits), rounded towards negative infinity
+        signed_increment = Signed(phase_bits+4)(increment[phase_bits+2:0])
+        fm_term = (signed_increment * Signed(sample_bits)(fmod)) >> fmod_frac_bits
+        new_phase <<= (rec_phase + signed_increment + fm_term)[phase_bits-1:0]
+
+        # Waveform generation
+        wave_idx = rec_phase[phase_bits-1:phase_bits-wave_bits]
+        sine_wave = Signed(sample_bits)(lookup(wave_idx, sine_table(), sample_bits))
+        # Sawtooth: (phase >> (phase_bits - sample_bits)) + sample_min; the addition simply inverts the MSB
+        saw_wave = Signed(sample_bits)(concat(~rec_phase[phase_bits-1], rec_phase[phase_bits-2:phase_bits-sample_bits]))
+        # Triangle: folded sawtooth with twice the slope
+        tri_saw = Signed(sample_bits+1)(concat(~rec_phase[phase_bits-1], rec_phase[phase_bits-2:phase_bits-sample_bits-1]))
+        tri_abs = Select(tri_saw < 0, tri_saw, -tri_saw)
+        tri_wave = Select(tri_abs > (1 << sample_bits) - 1, tri_abs, (1 << sample_bits) - 1) - sample_max
+        square_wave = Select(rec_phase[phase_bits-1], -sample_max, sample_max)
+        wave = Signed(sample_bits+1)(Select(rec_waveform, sine_wave, tri_wave, saw_wave, square_wave))
+
+        # Log-to-linear attenuation: 64 steps per 6dB. See LookupTables.amplitude
+        ampl_lo = lookup(ampl_ctrl[2:0], ampl_lo_table(), ampl_lut_bits+1)
+        ampl_hi = lookup(ampl_ctrl[5:3], ampl_hi_table(), ampl_lut_bits+1)
+        ampl_lin = ((ampl_lo * ampl_hi) >> ampl_lut_bits) >> ampl_ctrl[control_bits-1:6]
+        osc_value = (wave * Signed(ampl_lut_bits+2)(ampl_lin)) >> ampl_lut_bits
+
+        result = Reg(SelectOne(
+            rec_opcode == FmSynthOps.const.value, rec_value,
+            rec_opcode == FmSynthOps.osc.value,   osc_value[array_bits-1:0],
+            default_port = 0
+        ), clock_en=state == FmSynthStates.read_out)
+
+        array.data_in <<= Select(scrub, concat(epoch, (acc_value + result)[array_bits-1:0]), 0)
+        array.write_en <<= (proc_write & (rec_opcode != FmSynthOps.nop.value)) | scrub
+
+        # Output
+        ########
+        output_valid = state == FmSynthStates.output
+        sample = Reg(Signed(16)(Signed(sample_bits)(array_sat)), clock_en=output_valid)
+        self.sample <<= sample
+        self.sample_valid <<= Reg(output_valid)
+
+        # Status and interrupts
+        #######################
+        underrun = Wire(logic)
+        underrun <<= Reg(SelectFirst(
+            sample_tick & busy, 1,
+            status_reg_wr & self.bus_if.pwdata[1], 0,
+            default_port = underrun
+        ))
+        sample_ready = Wire(logic)
+        sample_ready <<= Reg(SelectFirst(
+            output_valid, 1,
+            status_reg_wr & self.bus_if.pwdata[2], 0,
+            default_port = sample_ready
+        ))
+        self.interrupt <<= (underrun & underrun_int_en) | (sample_ready & sample_int_en)
+
+        self.bus_if.pready <<= 1
+        self.bus_if.prdata <<= Reg(Select(self.bus_if.paddr,
+            concat(sample_int_en, underrun_int_en, dma_en, enable),     # ctrl_reg_ofs
+            concat(dma_en, sample_ready, underrun, busy),               # status_reg_ofs
+            ptr[7:0],                                                   # ptr_lo_reg_ofs
+            ptr[ptr_bits-1:8],                                          # ptr_hi_reg_ofs
+            0,                                                          # data_reg_ofs
+            proc_cnt,                                                   # proc_cnt_reg_ofs
+            divider_lo,                                                 # divider_lo_reg_ofs
+            divider_hi,                                                 # divider_hi_reg_ofs
+            out_slot,                                                   # out_slot_reg_ofs
+            sample[7:0],                                                # sample_lo_reg_ofs
+            sample[15:8],                                               # sample_hi_reg_ofs
+            default_port = 0
+        ))
+
+
+def const_record(out_slot: int, value: int) -> bytes:
+    """
+    Creates a state RAM record for a constant procedure
+    """
+    value &= 0xffff
+    return bytes((FmSynthOps.const.value, out_slot, value & 0xff, value >> 8, 0, 0, 0, 0))
+
+def osc_record(out_slot: int, waveform: FmSynthWaveForms, freq_slot: int, ampl_slot: int, fmod_slot: Optional[int] = None, phase: int = 0) -> bytes:
+    """
+    Creates a state RAM record for an oscillator procedure
+    """
+    has_fmod = fmod_slot is not None
+    op = FmSynthOps.osc.value | (waveform.value << 2) | (int(has_fmod) << 4)
+    return bytes((op, out_slot, freq_slot, ampl_slot, fmod_slot if has_fmod else 0, phase & 0xff, (phase >> 8) & 0xff, (phase >> 16) & 0xff))
+
+def sim(cycles: int = 10000) -> int:
+    # A frequency modulated sine, the same patch as synth_fixed.fixed_patch()
+    program = (
+        const_record(0, 600),
+        const_record(1, 256),
+        osc_record(2, FmSynthWaveForms.sine, 0, 1),
+        const_record(3, 600),
+        const_record(4, 0),
+        osc_record(5, FmSynthWaveForms.sine, 3, 4, fmod_slot=2),
+    )
+    divider = 199
+
+    class top(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        interrupt = Output(logic)
+
+        def body(self):
+            self.synth = FmSynth()
+            self.reg_if = Wire(Apb8If)
+            self.reg_if.paddr.set_net_type(Unsigned(4))
+            self.synth.bus_if <<= self.reg_if
+            self.synth.n_dack <<= 1
+            self.synth.tc <<= 0
+            self.synth.dma_data <<= 0
+            self.interrupt <<= self.synth.interrupt
+
+        def simulate(self, simulator: Simulator) -> TSimEvent:
+            def clk() -> int:
+                yield 50
+                self.clk <<= ~self.clk & self.clk
+                yield 50
+                self.clk <<= ~self.clk
+                yield 0
+
+            def write_reg(addr, value):
+                self.reg_if.psel <<= 1
+                self.reg_if.penable <<= 0
+                self.reg_if.pwrite <<= 1
+                self.reg_if.paddr <<= addr
+                self.reg_if.pwdata <<= value
+                yield from clk()
+                self.reg_if.penable <<= 1
+                yield from clk()
+                self.reg_if.psel <<= 0
+                self.reg_if.penable <<= None
+                self.reg_if.pwrite <<= None
+                self.reg_if.paddr <<= None
+                self.reg_if.pwdata <<= None
+
+            simulator.log("Simulation started")
+
+            self.rst <<= 1
+            self.clk <<= 1
+            self.reg_if.psel <<= 0
+            yield 10
+            for i in range(5):
+                yield from clk()
+            self.rst <<= 0
+
+            yield from write_reg(FmSynth.ptr_lo_reg_ofs, 0)
+            yield from write_reg(FmSynth.ptr_hi_reg_ofs, 0)
+            for record in program:
+                for byte in record:
+                    yield from write_reg(FmSynth.data_reg_ofs, byte)
+            yield from write_reg(FmSynth.proc_cnt_reg_ofs, len(program))
+            yield from write_reg(FmSynth.divider_lo_reg_ofs, divider & 0xff)
+            yield from write_reg(FmSynth.divider_hi_reg_ofs, divider >> 8)
+            yield from write_reg(FmSynth.out_slot_reg_ofs, 5)
+            yield from write_reg(FmSynth.ctrl_reg_ofs, 1 | (1 << 2))
+
+            def collect_samples(cycle_cnt):
+                samples = []
+                for i in range(cycle_cnt):
+                    yield from clk()
+                    if self.synth.sample_valid == 1:
+                        sample = int(self.synth.sample)
+                        samples.append(sample - 0x10000 if sample & 0x8000 else sample)
+                    assert self.interrupt != 1, "Sample underrun"
+                return samples
+
+            samples = yield from collect_samples(cycles)
+
+            # Compare against the fixed-point model
+            sys.path.append(str(Path(__file__).parent / "experiments"))
+            import synth_fixed
+            engine, output = synth_fixed.fixed_patch(synth_fixed.EngineConfig(), 600, 0, (600, 256))
+            expected = engine.render(output, len(samples))
+            for idx, (actual, golden) in enumerate(zip(samples, expected)):
+                assert actual == golden, f"Sample {idx} mismatch: {actual} vs. expected {golden}"
+            simulator.log(f"Done: {len(samples)} samples matched")
+
+            # Patch change: drop the last procedure, so the output slot is not written any more. The slot must read as 0
+            # from then on, even after the generation counter wraps around. The first couple of samples might still be
+            # in progress while the change happens, so they are not checked.
+            sample_cycles = divider + 1
+            gen_cnt = 1 << (slot_bits + 1)
+            yield from write_reg(FmSynth.proc_cnt_reg_ofs, len(program) - 1)
+            samples = yield from collect_samples((gen_cnt + 16) * sample_cycles)
+            for idx, actual in enumerate(samples[2:]):
+                assert actual == 0, f"Sample {idx} after patch change is not 0: {actual}"
+            simulator.log(f"Done: {len(samples)} samples after patch change")
+
+            # Replace the dropped procedure with a constant and enable it again
+            yield from write_reg(FmSynth.ptr_lo_reg_ofs, (len(program) - 1) * 8)
+            yield from write_reg(FmSynth.ptr_hi_reg_ofs, 0)
+            for byte in const_record(5, 100):
+                yield from write_reg(FmSynth.data_reg_ofs, byte)
+            yield from write_reg(FmSynth.proc_cnt_reg_ofs, len(program))
+            samples = yield from collect_samples(16 * sample_cycles)
+            for idx, actual in enumerate(samples[2:]):
+                assert actual == 100, f"Sample {idx} after second patch change is not 100: {actual}"
+            simulator.log(f"Done: {len(samples)} samples after second patch change")
+
+    vcd_filename = "fm_synth.vcd"
+    with Netlist().elaborate() as netlist:
+        top_inst = top()
+    netlist.simulate(vcd_filename, add_unnamed_scopes=False)
+    return cycles + ((1 << (slot_bits + 1)) + 32) * (divider + 1)
+
+def gen():
+    class FmSynth(globals()["FmSynth"]):
+        def construct(self, sample_rate: int = 15000, freq_base: float = 16.0):
+            super().construct(sample_rate, freq_base)
+            self.bus_if.paddr.set_net_type(Unsigned(4))
+
+    def top():
+        return FmSynth()
+
+    back_end = SystemVerilog()
+    back_end.support_unique_case = False
+    netlist = Build.generate_rtl(top, "fm_synth.sv", back_end=back_end)
+    top_level_name = netlist.get_module_class_name(netlist.top_level)
+    flow = QuartusFlow(
+        target_dir="q_fm_synth",
+        top_level=top_level_name,
+        source_files=("fm_synth.sv",),
+        clocks=(("clk", 10),),
+        project_name="fm_synth",
+        device="10M50DAF484C6G" # Device on the DECA board
+    )
+    flow.generate()
+    flow.run()
+
+
+if __name__ == "__main__":
+    gen()
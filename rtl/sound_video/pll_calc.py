@@ -6,6 +6,26 @@
 # There are a set of standard timings as well: https://glenwing.github.io/docs/VESA-DMT-1.13.pdf
 # For DMT, the tolerance appears to be +/-0.5%
 
+#
+# The solver prunes the search space analytically: the input divider is limited by the CLKIN
+# (phase comparator) range, the feedback divider by the VCO range and the output divider is
+# determined (up to rounding) by the ratio of the PLL and the target frequency. The remaining
+# candidates are evaluated with numpy.
+#
+# Usage:
+#     pll_calc.py                 prints the (cached) mode table
+#     pll_calc.py --force         re-computes the mode table
+#     pll_calc.py 74.25 108       prints the best solutions for arbitrary pixel clocks (in MHz)
+
+import sys
+import json
+import hashlib
+from pathlib import Path
+from dataclasses import dataclass, asdict
+from typing import *
+
+import numpy as np
+
 f_in = 8
 modes = (
     ("320x200@60 CVT",   5.000, 0.5, "MHz"),
@@ -31,41 +51,130 @@ sdiv_values = range(1,128) # NOTE: if sdiv is 1, that means we're using CLKOUT,
 
 dvi_out = True
 
-for v_info, f_out, accuracy, accuracy_type in modes:
-    if dvi_out:
-        f_out *= 5 # For the serializer, we actually need to generate 5x the pixel clock
-
-    best_idiv = None
-    best_fbdiv = None
-    best_vcodiv = None
-    best_sdiv = None
-    best_freq = None
-    best_error = None
-
-    for sdiv in sdiv_values:
-        for idiv in idiv_values:
-            for fbdiv in fbdiv_values:
-                for vcodiv in vcodiv_values:
-                    f_cmp = f_in / idiv
-                    if f_cmp < clkin_min: continue
-                    if f_cmp > clkin_max: continue
-                    f_vco = f_cmp * vcodiv * fbdiv
-                    if f_vco < vco_min: continue
-                    if f_vco > vco_max: continue
-                    f_actual = f_vco / vcodiv / sdiv
-                    error = abs(f_out - f_actual)
-                    if best_error is None or best_error > error:
-                        best_error = error
-                        best_freq = f_actual
-                        best_idiv = idiv
-                        best_fbdiv = fbdiv
-                        best_vcodiv = vcodiv
-                        best_sdiv = sdiv
+mode_table_file = Path(__file__).parent / "pll_modes.json"
+
+@dataclass
+class PllSolution(object):
+    idiv: int
+    fbdiv: int
+    vcodiv: int
+    sdiv: int
+    f_vco: float
+    f_actual: float
+    error_ppm: float
+
+def solve(f_out: float, *, f_in: float = f_in, max_solutions: Optional[int] = 10) -> List[PllSolution]:
+    """
+    Returns PLL settings for the output frequency 'f_out', best first.
+
+    Solutions are ranked by the absolute error, then by the smallest input divider (higher
+    comparator frequency), then by the smallest output divider.
+    """
+    idiv = np.array(idiv_values, dtype=np.int64)
+    f_cmp = f_in / idiv
+    idiv = idiv[(f_cmp >= clkin_min) & (f_cmp <= clkin_max)]
+    fbdiv = np.array(fbdiv_values, dtype=np.int64)
+    vcodiv = np.array(vcodiv_values, dtype=np.int64)
+
+    # Grid of all (idiv, fbdiv, vcodiv) triplets with the VCO in range
+    idiv, fbdiv, vcodiv = (axis.ravel() for axis in np.meshgrid(idiv, fbdiv, vcodiv, indexing="ij"))
+    f_vco = f_in / idiv * fbdiv * vcodiv
+    in_range = (f_vco >= vco_min) & (f_vco <= vco_max)
+    idiv, fbdiv, vcodiv, f_vco = idiv[in_range], fbdiv[in_range], vcodiv[in_range], f_vco[in_range]
+
+    # The best output dividers are the two integers around the ideal (real) divider
+    f_pll = f_vco / vcodiv
+    sdiv_ideal = f_pll / f_out
+    sdiv_min, sdiv_max = min(sdiv_values), max(sdiv_values)
+    sdiv = np.concatenate((np.floor(sdiv_ideal), np.ceil(sdiv_ideal))).astype(np.int64)
+    sdiv = np.clip(sdiv, sdiv_min, sdiv_max)
+    idiv, fbdiv, vcodiv, f_vco, f_pll = (np.tile(axis, 2) for axis in (idiv, fbdiv, vcodiv, f_vco, f_pll))
+    f_actual = f_pll / sdiv
+    error_ppm = (f_actual / f_out - 1) * 1e6
+
+    order = np.lexsort((sdiv, idiv, np.abs(error_ppm)))
+    solutions = []
+    seen = set()
+    for idx in order:
+        key = (int(idiv[idx]), int(fbdiv[idx]), int(vcodiv[idx]), int(sdiv[idx]))
+        if key in seen:
+            continue
+        seen.add(key)
+        solutions.append(PllSolution(*key, float(f_vco[idx]), float(f_actual[idx]), float(error_ppm[idx])))
+        if max_solutions is not None and len(solutions) >= max_solutions:
+            break
+    return solutions
+
+def is_good_enough(solution: PllSolution, f_out: float, accuracy: float, accuracy_type: str) -> bool:
     if accuracy_type == "%":
-        good_enough = abs(best_freq / f_out - 1) < (accuracy / 100)
-    elif accuracy_type == "MHz":
-        good_enough = best_error < accuracy
-    else:
-        good_enough = True
-    print(f"For video mode {v_info}, output freq {f_out}: we get actual {best_freq} with idiv={best_idiv}, fbdiv={best_fbdiv}, vcodiv={best_vcodiv}, sdiv={best_sdiv}; is it good? {good_enough}")
+        return abs(solution.error_ppm) < accuracy * 1e4
+    if accuracy_type == "MHz":
+        return abs(solution.f_actual - f_out) < accuracy
+    return True
+
+def _config_hash(modes: Sequence[Tuple[str, float, float, str]], f_in: float, dvi_out: bool) -> str:
+    config = (
+        modes, f_in, dvi_out,
+        vco_min, vco_max, clkin_min, clkin_max,
+        tuple(idiv_values), tuple(fbdiv_values), tuple(vcodiv_values), tuple(sdiv_values)
+    )
+    return hashlib.sha256(repr(config).encode()).hexdigest()
+
+def mode_table(
+    modes: Sequence[Tuple[str, float, float, str]] = modes,
+    *,
+    f_in: float = f_in,
+    dvi_out: bool = dvi_out,
+    cache_file: Optional[Path] = mode_table_file,
+    force: bool = False
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Returns the best PLL settings for each video mode, keyed by the mode name.
+
+    The table is cached in 'cache_file' (JSON) and is only re-computed if the modes, the input
+    clock or the PLL limits change.
+    """
+    config_hash = _config_hash(modes, f_in, dvi_out)
+    if cache_file is not None and not force and cache_file.exists():
+        try:
+            with open(cache_file, "rt") as cache:
+                cached = json.load(cache)
+            if cached.get("config_hash") == config_hash:
+                return cached["modes"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    table = {}
+    for v_info, pixel_clock, accuracy, accuracy_type in modes:
+        # For the serializer, we actually need to generate 5x the pixel clock
+        f_out = pixel_clock * 5 if dvi_out else pixel_clock
+        best = solve(f_out, f_in=f_in, max_solutions=1)[0]
+        table[v_info] = dict(
+            pixel_clock=pixel_clock,
+            f_out=f_out,
+            good_enough=is_good_enough(best, f_out, accuracy, accuracy_type),
+            **asdict(best)
+        )
+
+    if cache_file is not None:
+        with open(cache_file, "wt") as cache:
+            json.dump(dict(config_hash=config_hash, f_in=f_in, dvi_out=dvi_out, modes=table), cache, indent=2)
+    return table
+
+def main(argv: Sequence[str]) -> int:
+    force = "--force" in argv
+    freqs = list(float(arg) for arg in argv if arg != "--force")
+    if len(freqs) > 0:
+        for pixel_clock in freqs:
+            f_out = pixel_clock * 5 if dvi_out else pixel_clock
+            print(f"Output freq {f_out}:")
+            for solution in solve(f_out):
+                print(f"    actual {solution.f_actual:.6f} ({solution.error_ppm:+.1f}ppm) with idiv={solution.idiv}, fbdiv={solution.fbdiv}, vcodiv={solution.vcodiv}, sdiv={solution.sdiv}; VCO at {solution.f_vco:.3f}")
+        return 0
+
+    for v_info, mode in mode_table(force=force).items():
+        print(f"For video mode {v_info}, output freq {mode['f_out']}: we get actual {mode['f_actual']} ({mode['error_ppm']:+.1f}ppm) with idiv={mode['idiv']}, fbdiv={mode['fbdiv']}, vcodiv={mode['vcodiv']}, sdiv={mode['sdiv']}; is it good? {mode['good_enough']}")
+    return 0
 
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
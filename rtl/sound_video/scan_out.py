@@ -0,0 +1,451 @@
+#!/usr/bin/python3
+"""
+Frame-buffer scan-out engine
+
+The engine fetches scan lines from memory into a double-buffered line RAM, from where the pixel
+generator reads them. While one half of the line RAM is being displayed, the next line is fetched
+into the other half.
+
+Lines are fetched using DRAM bursts as long as possible: a burst is only broken at DRAM page
+boundaries (as required by the BusIf contract) and at the end of the line. The bus master interface
+is the same as that of the fetch unit (BusIfRequestIf/BusIfResponseIf). The DMA port of BusIf only
+supports single, fly-by transfers, so it can't be used for line fetches.
+
+Line timing is provided by the video timing generator:
+- frame_start: pulsed once per frame, before the first visible line. It resets the line pointer to the
+  frame base address and starts fetching the first line.
+- line_start: pulsed before every visible line (ideally at the beginning of the preceding horizontal
+  blanking period). It flips the line RAM halves and starts fetching the next line.
+
+If a line fetch is not complete by the time its line_start arrives, the line is counted as an underrun.
+The fetch is not aborted: the rest of the line lands in the half being displayed and the fetch of the
+next line starts once it's done.
+
+The pixel generator reads the displayed line through pixel_addr (word address within the line); data
+is returned on pixel_data in the next cycle.
+
+Register map:
+    0:     control:          [0] enable [1] underrun interrupt enable
+    1:     status:           [0] fetch active [1] underrun (cleared by writing 1 to it)
+    2..5:  frame base:       byte address of the first line, bits 7...0 to 31...24
+    6..7:  line stride:      distance between lines in bytes
+    8..9:  line length:      number of 16-bit words to fetch for each line
+    10..11:line count:       number of lines to fetch in each frame
+    12..13:line underruns:   number of lines that were not fetched in time; any write clears it
+    14..15:frame underruns:  number of frames with at least one underrun; any write clears it
+"""
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent / ".." / ".." / ".." / "silicon"))
+sys.path.append(str(Path(__file__).parent / ".." / "espresso"))
+
+from brew_types import *
+from silicon import *
+
+def saturating_inc(counter: Junction, inc: Junction) -> Junction:
+    all_ones = (1 << counter.get_num_bits()) - 1
+    return Select(inc & (counter != all_ones), counter, (counter + 1)[counter.get_num_bits()-1:0])
+
+class ScanOut(GenericModule):
+    clk = ClkPort()
+    rst = RstPort()
+
+    bus_if = Input(Apb8If)
+    interrupt = Output(logic)
+
+    bus_if_request = Output(BusIfRequestIf)
+    bus_if_response = Input(BusIfResponseIf)
+
+    frame_start = Input(logic)
+    line_start = Input(logic)
+
+    pixel_addr = Input()
+    pixel_data = Output(BrewBusData)
+
+    ctrl_reg_ofs = 0
+    status_reg_ofs = 1
+    base_reg_ofs = 2
+    stride_reg_ofs = 6
+    line_len_reg_ofs = 8
+    line_cnt_reg_ofs = 10
+    line_underrun_reg_ofs = 12
+    frame_underrun_reg_ofs = 14
+
+    def construct(self, line_addr_bits: int = 9, page_bits: int = 8):
+        """
+        line_addr_bits: size of each half of the line RAM (in 16-bit words)
+        page_bits:      number of word-address bits that can change within a DRAM burst
+        """
+        self.line_addr_bits = line_addr_bits
+        self.page_bits = page_bits
+        self.pixel_addr.set_net_type(Unsigned(line_addr_bits))
+
+    def body(self):
+        class ScanOutStates(Enum):
+            idle = 0
+            request = 1
+
+        line_len_bits = self.line_addr_bits + 1
+
+        # Register interface
+        ####################
+        def reg_wr(ofs):
+            return self.bus_if.psel & self.bus_if.penable & self.bus_if.pwrite & (self.bus_if.paddr == ofs)
+
+        def reg16(ofs):
+            return concat(
+                Reg(self.bus_if.pwdata, clock_en=reg_wr(ofs+1)),
+                Reg(self.bus_if.pwdata, clock_en=reg_wr(ofs))
+            )
+
+        ctrl_reg_wr = reg_wr(ScanOut.ctrl_reg_ofs)
+        enable = Reg(self.bus_if.pwdata[0], clock_en=ctrl_reg_wr)
+        underrun_int_en = Reg(self.bus_if.pwdata[1], clock_en=ctrl_reg_wr)
+        frame_base = concat(*reversed(list(Reg(self.bus_if.pwdata, clock_en=reg_wr(ScanOut.base_reg_ofs+i)) for i in range(4))))
+        stride = reg16(ScanOut.stride_reg_ofs)
+        line_len = reg16(ScanOut.line_len_reg_ofs)[line_len_bits-1:0]
+        line_cnt = reg16(ScanOut.line_cnt_reg_ofs)
+
+        # Line sequencing
+        #################
+        fetch_active = Wire(logic)
+        line_pending = Wire(logic)
+        lines_left = Wire(Unsigned(16))
+        line_addr = Wire(BrewBusAddr)
+        display_buf = Wire(logic)
+        fetch_buf = Wire(logic)
+
+        frame_start = self.frame_start & enable
+        line_start = self.line_start & enable
+        fetch_start = line_pending & ~fetch_active & (lines_left != 0)
+        # If the previous line didn't even start fetching by the time the next line_start arrives, we skip it
+        # to keep the lines on the screen in their right place
+        skip_line = line_start & line_pending & ~fetch_start & (lines_left != 0)
+        next_line = fetch_start | skip_line
+
+        display_buf <<= Reg(Select(line_start, display_buf, ~display_buf))
+        # If a (late) fetch starts in the same cycle as line_start, display_buf flips in that same cycle,
+        # so the fetch needs to go into the half that is displayed until now.
+        fetch_buf <<= Reg(Select(fetch_start, fetch_buf, Select(line_start, ~display_buf, display_buf)))
+        line_pending <<= Reg(SelectFirst(
+            frame_start | line_start, 1,
+            fetch_start | (lines_left == 0), 0,
+            default_port = line_pending
+        ))
+        lines_left <<= Reg(SelectFirst(
+            frame_start, line_cnt,
+            next_line, (lines_left - 1)[15:0],
+            default_port = lines_left
+        ))
+        line_addr <<= Reg(SelectFirst(
+            frame_start, frame_base[31:1],
+            next_line, (line_addr + stride[15:1])[BrewBusAddr.length-1:0],
+            default_port = line_addr
+        ))
+
+        # Line fetch
+        ############
+        advance_request = self.bus_if_request.valid & self.bus_if_request.ready
+        advance_response = self.bus_if_response.valid
+
+        fetch_addr = Wire(BrewBusAddr)
+        fetch_addr <<= Reg(Select(
+            fetch_start,
+            (fetch_addr + advance_request)[BrewBusAddr.length-1:0],
+            line_addr
+        ))
+        req_left = Wire(Unsigned(line_len_bits))
+        req_left <<= Reg(Select(
+            fetch_start,
+            (req_left - advance_request)[line_len_bits-1:0],
+            line_len
+        ))
+        rsp_left = Wire(Unsigned(line_len_bits))
+        rsp_left <<= Reg(Select(
+            fetch_start,
+            (rsp_left - advance_response)[line_len_bits-1:0],
+            line_len
+        ))
+        rsp_ptr = Wire(Unsigned(self.line_addr_bits))
+        rsp_ptr <<= Reg(Select(
+            fetch_start,
+            (rsp_ptr + advance_response)[self.line_addr_bits-1:0],
+            0
+        ))
+        fetch_active <<= rsp_left != 0
+
+        self.fsm = FSM()
+
+        self.fsm.reset_value   <<= ScanOutStates.idle
+        self.fsm.default_state <<= ScanOutStates.idle
+
+        state = self.fsm.state
+
+        # Bursts end at the end of the line or at a page boundary. Going back to idle de-asserts
+        # valid for (at least) a cycle, which tells BusIf to close the burst.
+        last_in_page = (~fetch_addr[self.page_bits-1:0]) == 0
+        last_request = advance_request & (last_in_page | (req_left == 1))
+        more_requests = Select(fetch_start, req_left != 0, line_len != 0)
+
+        self.fsm.add_transition(ScanOutStates.idle,    more_requests,  ScanOutStates.request)
+        self.fsm.add_transition(ScanOutStates.request, ~last_request,  ScanOutStates.request)
+
+        self.bus_if_request.valid           <<= state == ScanOutStates.request
+        self.bus_if_request.read_not_write  <<= 1
+        self.bus_if_request.byte_en         <<= 3
+        self.bus_if_request.addr            <<= fetch_addr
+        self.bus_if_request.data            <<= None
+
+        # Line RAM
+        ##########
+        line_ram = SimpleDualPortMemory(
+            registered_input_a=False, registered_output_a=True, registered_input_b=False, registered_output_b=True,
+            addr_type=Unsigned(self.line_addr_bits+1), data_type=BrewBusData
+        )
+        line_ram.port1_write_en <<= advance_response & fetch_active
+        line_ram.port1_data_in <<= self.bus_if_response.data
+        line_ram.port1_addr <<= concat(fetch_buf, rsp_ptr)
+        line_ram.port2_addr <<= concat(display_buf, self.pixel_addr)
+        self.pixel_data <<= line_ram.port2_data_out
+
+        # Underrun tracking
+        ###################
+        # A line is late if it's still being fetched, or if its fetch hasn't even started yet
+        line_underrun = line_start & (fetch_active | (line_pending & (lines_left != 0)))
+        frame_underrun = Wire(logic)
+        frame_underrun <<= Reg(SelectFirst(
+            line_underrun, 1,
+            frame_start, 0,
+            default_port = frame_underrun
+        ))
+
+        line_underrun_cnt_wr = reg_wr(ScanOut.line_underrun_reg_ofs) | reg_wr(ScanOut.line_underrun_reg_ofs+1)
+        frame_underrun_cnt_wr = reg_wr(ScanOut.frame_underrun_reg_ofs) | reg_wr(ScanOut.frame_underrun_reg_ofs+1)
+        line_underrun_cnt = Wire(Unsigned(16))
+        line_underrun_cnt <<= Reg(Select(line_underrun_cnt_wr, saturating_inc(line_underrun_cnt, line_underrun), 0))
+        frame_underrun_cnt = Wire(Unsigned(16))
+        frame_underrun_cnt <<= Reg(Select(frame_underrun_cnt_wr, saturating_inc(frame_underrun_cnt, frame_start & frame_underrun), 0))
+
+        underrun = Wire(logic)
+        underrun <<= Reg(SelectFirst(
+            line_underrun, 1,
+            reg_wr(ScanOut.status_reg_ofs) & self.bus_if.pwdata[1], 0,
+            default_port = underrun
+        ))
+        self.interrupt <<= underrun & underrun_int_en
+
+        self.bus_if.pready <<= 1
+        self.bus_if.prdata <<= Reg(Select(self.bus_if.paddr,
+            concat(underrun_int_en, enable),                # ctrl_reg_ofs
+            concat(underrun, fetch_active),                 # status_reg_ofs
+            frame_base[7:0],                                # base_reg_ofs
+            frame_base[15:8],
+            frame_base[23:16],
+            frame_base[31:24],
+            stride[7:0],                                    # stride_reg_ofs
+            stride[15:8],
+            line_len[7:0],                                  # line_len_reg_ofs
+            line_len[line_len_bits-1:8],
+            line_cnt[7:0],                                  # line_cnt_reg_ofs
+            line_cnt[15:8],
+            line_underrun_cnt[7:0],                         # line_underrun_reg_ofs
+            line_underrun_cnt[15:8],
+            frame_underrun_cnt[7:0],                        # frame_underrun_reg_ofs
+            frame_underrun_cnt[15:8],
+        ))
+
+
+def sim(rng_seed: int = 0, cycles: int = 20000) -> int:
+    from random import seed, randint
+
+    line_addr_bits = 5
+    page_bits = 4
+    frame_base = 0x1000
+    stride = 40 # in bytes
+    line_len = 18 # in words, crosses page boundaries
+    line_cnt = 6
+    line_period = 60 # cycles between line_start pulses
+
+    def mem_content(word_addr: int) -> int:
+        return (word_addr * 0x9e37) & 0xffff
+
+    class BusEmulator(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        bus_if_request = Input(BusIfRequestIf)
+        bus_if_response = Output(BusIfResponseIf)
+
+        def simulate(self, simulator: 'Simulator') -> TSimEvent:
+            delay_queue = [None, None]
+            burst_page = None
+
+            def wait_clk():
+                now = yield (self.clk, )
+                while self.clk.get_sim_edge() != EdgeType.Positive:
+                    now = yield (self.clk, )
+                return now
+
+            self.bus_if_request.ready <<= 0
+            self.bus_if_response.valid <<= 0
+            self.bus_if_response.data <<= None
+
+            while True:
+                now = yield from wait_clk()
+
+                if self.rst == 1:
+                    self.bus_if_request.ready <<= 0
+                    self.bus_if_response.valid <<= 0
+                    self.bus_if_response.data <<= None
+                    continue
+
+                if self.bus_if_request.valid == 1 and self.bus_if_request.ready == 1:
+                    assert self.bus_if_request.read_not_write == 1
+                    addr = int(self.bus_if_request.addr)
+                    page = addr >> page_bits
+                    assert burst_page is None or burst_page == page, f"Burst crossed page boundary at address {addr:x}"
+                    burst_page = page
+                    delay_queue[-1] = mem_content(addr)
+                elif self.bus_if_request.valid != 1:
+                    burst_page = None
+                if burst_page is None:
+                    # Emulate arbitration: other masters take the bus from time to time
+                    self.bus_if_request.ready <<= randint(0, 3) != 0
+                if delay_queue[0] is not None:
+                    self.bus_if_response.data <<= delay_queue[0]
+                    self.bus_if_response.valid <<= 1
+                else:
+                    self.bus_if_response.data <<= None
+                    self.bus_if_response.valid <<= 0
+                delay_queue = delay_queue[1:] + [None, ]
+
+    class top(Module):
+        clk = ClkPort()
+        rst = RstPort()
+
+        def body(self):
+            self.scan_out = ScanOut(line_addr_bits=line_addr_bits, page_bits=page_bits)
+            self.bus = BusEmulator()
+            self.reg_if = Wire(Apb8If)
+            self.reg_if.paddr.set_net_type(Unsigned(4))
+            self.scan_out.bus_if <<= self.reg_if
+            self.bus.bus_if_request <<= self.scan_out.bus_if_request
+            self.scan_out.bus_if_response <<= self.bus.bus_if_response
+            self.frame_start = Wire(logic)
+            self.line_start = Wire(logic)
+            self.pixel_addr = Wire(Unsigned(line_addr_bits))
+            self.scan_out.frame_start <<= self.frame_start
+            self.scan_out.line_start <<= self.line_start
+            self.scan_out.pixel_addr <<= self.pixel_addr
+
+        def simulate(self, simulator: Simulator) -> TSimEvent:
+            sim_cycles = 0
+
+            def clk() -> int:
+                nonlocal sim_cycles
+                yield 50
+                self.clk <<= ~self.clk & self.clk
+                yield 50
+                self.clk <<= ~self.clk
+                yield 0
+                sim_cycles += 1
+
+            def write_reg(addr, value):
+                self.reg_if.psel <<= 1
+                self.reg_if.penable <<= 0
+                self.reg_if.pwrite <<= 1
+                self.reg_if.paddr <<= addr
+                self.reg_if.pwdata <<= value
+                yield from clk()
+                self.reg_if.penable <<= 1
+                yield from clk()
+                self.reg_if.psel <<= 0
+                self.reg_if.penable <<= None
+                self.reg_if.pwrite <<= None
+                self.reg_if.paddr <<= None
+                self.reg_if.pwdata <<= None
+
+            def write_reg16(addr, value):
+                yield from write_reg(addr, value & 0xff)
+                yield from write_reg(addr+1, value >> 8)
+
+            simulator.log("Simulation started")
+
+            self.rst <<= 1
+            self.clk <<= 1
+            self.reg_if.psel <<= 0
+            self.frame_start <<= 0
+            self.line_start <<= 0
+            self.pixel_addr <<= 0
+            yield 10
+            for i in range(5):
+                yield from clk()
+            self.rst <<= 0
+
+            for i in range(4):
+                yield from write_reg(ScanOut.base_reg_ofs+i, (frame_base >> (i*8)) & 0xff)
+            yield from write_reg16(ScanOut.stride_reg_ofs, stride)
+            yield from write_reg16(ScanOut.line_len_reg_ofs, line_len)
+            yield from write_reg16(ScanOut.line_cnt_reg_ofs, line_cnt)
+            yield from write_reg(ScanOut.ctrl_reg_ofs, 1)
+
+            frame_cnt = 0
+            while sim_cycles < cycles:
+                self.frame_start <<= 1
+                yield from clk()
+                self.frame_start <<= 0
+                for line in range(line_cnt):
+                    for i in range(line_period):
+                        yield from clk()
+                    self.line_start <<= 1
+                    yield from clk()
+                    self.line_start <<= 0
+                    # Read back the line that just got flipped in for display
+                    line_base = (frame_base >> 1) + line * (stride >> 1)
+                    for word in range(line_len):
+                        self.pixel_addr <<= word
+                        yield from clk()
+                        yield 1
+                        actual = int(self.scan_out.pixel_data)
+                        expected = mem_content(line_base + word)
+                        assert actual == expected, f"Frame {frame_cnt} line {line} word {word}: read {actual:04x}, expected {expected:04x}"
+                frame_cnt += 1
+                for i in range(line_period):
+                    yield from clk()
+            simulator.log(f"Done: {frame_cnt} frames checked")
+
+    seed(rng_seed)
+    vcd_filename = "scan_out.vcd"
+    with Netlist().elaborate() as netlist:
+        top_inst = top()
+    netlist.simulate(vcd_filename, add_unnamed_scopes=False)
+    return cycles
+
+def gen():
+    class ScanOut(globals()["ScanOut"]):
+        def construct(self, line_addr_bits: int = 9, page_bits: int = 8):
+            super().construct(line_addr_bits, page_bits)
+            self.bus_if.paddr.set_net_type(Unsigned(4))
+
+    def top():
+        return ScanOut()
+
+    back_end = SystemVerilog()
+    back_end.support_unique_case = False
+    netlist = Build.generate_rtl(top, "scan_out.sv", back_end=back_end)
+    top_level_name = netlist.get_module_class_name(netlist.top_level)
+    flow = QuartusFlow(
+        target_dir="q_scan_out",
+        top_level=top_level_name,
+        source_files=("scan_out.sv",),
+        clocks=(("clk", 10),),
+        project_name="scan_out",
+        device="10M50DAF484C6G" # Device on the DECA board
+    )
+    flow.generate()
+    flow.run()
+
+
+if __name__ == "__main__":
+    gen()
@@ -58,6 +58,11 @@ const uint32_t uart_status_reg_ofs                  = 1;
 const uint32_t uart_config1_reg_ofs                 = 2;
 const uint32_t uart_config2_reg_ofs                 = 3;
 const uint32_t uart_divider_reg_ofs                 = 4;
+const uint32_t uart_rx_threshold_reg_ofs            = 5;
+const uint32_t uart_tx_threshold_reg_ofs            = 6;
+const uint32_t uart_fifo_ctrl_reg_ofs               = 7;
+const uint32_t uart_rx_cnt_reg_ofs                  = 8;
+const uint32_t uart_tx_cnt_reg_ofs                  = 9;
 
 // Status register
 const uint8_t uart_status_rx_full_bit               = 0;
@@ -113,6 +118,13 @@ const uint8_t uart_config2_rx_enable                = 1 * (1 << uart_config2_rx_
 const uint8_t uart_config2_use_hw_tx_en             = 1 * (1 << uart_config2_use_hw_tx_en_bit);
 const uint8_t uart_config2_tx_en                    = 1 * (1 << uart_config2_tx_en_bit);
 
+// FIFO control register
+const uint8_t uart_fifo_ctrl_rx_dma_en_bit          = 0;
+const uint8_t uart_fifo_ctrl_tx_dma_en_bit          = 1;
+const uint8_t uart_fifo_ctrl_threshold_int_bit      = 2;
+const uint8_t uart_fifo_ctrl_rx_flush_bit           = 3;
+const uint8_t uart_fifo_ctrl_tx_flush_bit           = 4;
+
 /*
 inline uint32_t next_power_of_2(uint32_t v) {
     v--;
@@ -171,6 +183,16 @@ CREATE_CSR(csr_dmem_limit, 0x0083)
 CREATE_CSR(csr_ecause,     0x0000)
 CREATE_CSR(csr_eaddr,      0x0001)
 
+CREATE_CSR(csr_timer_cycle_low,  csr_timer_base + 3)
+CREATE_CSR(csr_timer_cycle_high, csr_timer_base + 4)
+
+// Reading the low word latches the high word, so the two reads return a consistent 64-bit value
+inline uint64_t csr_timer_cycles() {
+    uint32_t low = csr_timer_cycle_low();
+    uint32_t high = csr_timer_cycle_high();
+    return (uint64_t(high) << 32) | low;
+}
+
 // THIS IS DIFFICULT IN THIS CONCEPT TO CREATE A VARIABLE NUMBER OF EVENT COUNTERS.
 // SO THIS HAS TO MATCH THE NUMBER OF COUNTERS DEFINED IN brew_v1.py:225 (event_counter_cnt variable)
 #define EVENT_SEL_REG(idx) (csr_event_base + (idx)*2 + 2)